@@ -0,0 +1,58 @@
+"""Benchmarks runnable without hardware, from the repository root with the
+package installed (``pip install -e .``): ``python -m benchmarks.<name>``.
+"""
+
+import json
+import math
+from pathlib import Path
+from typing import Optional
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    """Nearest-rank percentile of ``samples`` (0 for an empty list)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def latency_summary(samples: list[float]) -> dict[str, float]:
+    """p50/p90/p99/max of latencies given in seconds, reported in ms."""
+    return {
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p90_ms": percentile(samples, 90) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": max(samples, default=0.0) * 1000,
+    }
+
+
+def write_report(report: dict, path: Optional[Path]) -> None:
+    """Print a report and optionally save it as JSON."""
+    print(json.dumps(report, indent=2, default=str))
+    if path:
+        path.write_text(json.dumps(report, indent=2, default=str))
+
+
+def compare_reports(
+    current: dict,
+    baseline_path: Path,
+    keys: list[tuple[str, ...]],
+    tolerance: float,
+) -> list[str]:
+    """List metrics in ``keys`` that regressed by more than ``tolerance``.
+
+    Keys are paths into the nested report; larger values are worse.
+    """
+    baseline = json.loads(baseline_path.read_text())
+    regressions = []
+    for key in keys:
+        old, new = baseline, current
+        for part in key:
+            old = old.get(part, {}) if isinstance(old, dict) else {}
+            new = new.get(part, {}) if isinstance(new, dict) else {}
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+            continue
+        if old > 0 and new > old * (1 + tolerance):
+            regressions.append(f"{' / '.join(key)}: {old:.2f} -> {new:.2f}")
+    return regressions
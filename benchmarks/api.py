@@ -0,0 +1,188 @@
+"""Load test the API and monitor loop against a simulated modem farm.
+
+    python -m benchmarks.api --modems 16 --concurrency 32 --requests 400
+
+Endpoints are given as ``"METHOD /path"``; ``{modem}`` in the path cycles
+through the simulated modem IDs. Use ``--json`` to save a report and
+``--compare`` to fail when latency regressed against a saved baseline.
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+import httpx
+
+from benchmarks import compare_reports, latency_summary, write_report
+from proxyfarm.config import get_config
+from proxyfarm.core import modem as modem_module
+from proxyfarm.core import sim
+from proxyfarm.main import create_app
+from proxyfarm.services.monitor import monitor_service
+
+DEFAULT_ENDPOINTS = [
+    "GET /api/v1/modems",
+    "GET /api/v1/modems/{modem}",
+    "GET /api/v1/system/status",
+    "GET /api/v1/proxy/status",
+    "POST /api/v1/modems/{modem}/ussd",
+]
+
+
+def _commands_since(before: Counter) -> Counter:
+    return modem_module.command_counts - before
+
+
+async def bench_endpoint(
+    client: httpx.AsyncClient,
+    spec: str,
+    total: int,
+    concurrency: int,
+    modem_ids: list[int],
+) -> dict:
+    """Fire ``total`` requests at one endpoint with ``concurrency`` workers."""
+    method, path = spec.split(" ", 1)
+    modems = itertools.cycle(modem_ids)
+    body = {"command": "*100#"} if path.endswith("/ussd") else None
+    latencies: list[float] = []
+    statuses: Counter = Counter()
+    remaining = iter(range(total))
+
+    async def worker() -> None:
+        for _ in remaining:
+            url = path.format(modem=next(modems))
+            started = time.perf_counter()
+            response = await client.request(method, url, json=body)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] += 1
+
+    before = Counter(modem_module.command_counts)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    commands = _commands_since(before)
+
+    return {
+        "requests": total,
+        "elapsed_s": elapsed,
+        "throughput_rps": total / elapsed if elapsed else 0.0,
+        **latency_summary(latencies),
+        "status": dict(statuses),
+        "subprocesses": sum(commands.values()),
+        "subprocesses_per_request": sum(commands.values()) / total if total else 0.0,
+        "commands": dict(commands),
+    }
+
+
+async def bench_monitor(cycles: int) -> dict:
+    """Time full monitor health-check cycles."""
+    durations = []
+    before = Counter(modem_module.command_counts)
+    for _ in range(cycles):
+        started = time.perf_counter()
+        await monitor_service._check_modems()
+        durations.append(time.perf_counter() - started)
+    commands = _commands_since(before)
+    return {
+        "cycles": cycles,
+        **latency_summary(durations),
+        "subprocesses_per_cycle": sum(commands.values()) / cycles if cycles else 0.0,
+        "commands": dict(commands),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    app = create_app()
+    config = get_config()
+    config.api.api_key = "bench"
+    config.admission.enabled = not args.no_admission
+    config.simulation.modems = args.modems
+    config.simulation.seed = args.seed
+    config.simulation.latency = {
+        kind: value * args.latency_scale
+        for kind, value in config.simulation.latency.items()
+    }
+    if args.failure_rate:
+        config.simulation.failure_rates = {"default": args.failure_rate}
+    backend = sim.install(config.simulation)
+    modem_ids = sorted(backend.modems)
+
+    report: dict = {
+        "modems": args.modems,
+        "concurrency": args.concurrency,
+        "latency_scale": args.latency_scale,
+        "endpoints": {},
+    }
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport,
+        base_url="http://bench",
+        headers={"X-API-Key": "bench"},
+        timeout=None,
+    ) as client:
+        for spec in args.endpoint or DEFAULT_ENDPOINTS:
+            report["endpoints"][spec] = await bench_endpoint(
+                client, spec, args.requests, args.concurrency, modem_ids
+            )
+        if args.rotations:
+            spec = "POST /api/v1/modems/{modem}/rotate"
+            report["endpoints"][spec] = await bench_endpoint(
+                client, spec, args.rotations, args.concurrency, modem_ids
+            )
+
+    if args.monitor_cycles:
+        report["monitor"] = await bench_monitor(args.monitor_cycles)
+
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modems", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--rotations", type=int, default=0,
+                        help="Number of rotate requests to add (slow)")
+    parser.add_argument("--monitor-cycles", type=int, default=3)
+    parser.add_argument("--endpoint", action="append",
+                        help='e.g. "GET /api/v1/modems"; repeatable')
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="Multiplier for simulated command latencies")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-admission", action="store_true")
+    parser.add_argument("--json", type=Path, help="Save report to this file")
+    parser.add_argument("--compare", type=Path, help="Baseline report to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    report = asyncio.run(run(args))
+    write_report(report, args.json)
+
+    if args.compare:
+        keys = [
+            ("endpoints", spec, metric)
+            for spec in report["endpoints"]
+            for metric in ("p99_ms", "subprocesses_per_request")
+        ]
+        if "monitor" in report:
+            keys += [("monitor", "p99_ms"), ("monitor", "subprocesses_per_cycle")]
+        regressions = compare_reports(report, args.compare, keys, args.tolerance)
+        if regressions:
+            print("Regressions against baseline:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
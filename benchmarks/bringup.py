@@ -0,0 +1,83 @@
+"""Measure cold-boot time to full farm capacity on a simulated farm.
+
+    python -m benchmarks.bringup --modems 16 --concurrency 1 8
+
+Every modem starts disabled with no NetworkManager connection. Each
+``--concurrency`` value runs one bring-up job from that state; a second job
+on the finished farm measures the idempotent (nothing to do) path.
+"""
+
+import argparse
+import asyncio
+import logging
+from collections import Counter
+from pathlib import Path
+
+from benchmarks import write_report
+from proxyfarm.config import get_config
+from proxyfarm.core import modem as modem_module
+from proxyfarm.core import sim
+from proxyfarm.core.bringup import ModemBringup
+
+
+def _cold_boot(backend: sim.SimulatedBackend) -> None:
+    backend.connections.clear()
+    for modem in backend.modems.values():
+        modem.enabled = False
+        modem.connected = False
+
+
+async def _job(bringup: ModemBringup) -> dict:
+    before = Counter(modem_module.command_counts)
+    job, _ = bringup.start()
+    job = await bringup.wait(job.id)
+    return {
+        "status": job.status,
+        "modems_ready": job.modems_ready,
+        "elapsed_s": (job.finished_at - job.started_at).total_seconds(),
+        "time_to_first_ready_s": job.time_to_first_ready,
+        "time_to_capacity_s": job.time_to_capacity,
+        "commands": sum((modem_module.command_counts - before).values()),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    config = get_config()
+    config.simulation.modems = args.modems
+    config.simulation.seed = args.seed
+    config.simulation.latency = {
+        kind: value * args.latency_scale for kind, value in config.simulation.latency.items()
+    }
+    config.store.enabled = False
+    config.squid.conf_path = "/nonexistent/squid.conf"
+
+    report = {"modems": args.modems, "runs": {}}
+    for concurrency in args.concurrency:
+        config.bringup.concurrency = concurrency
+        backend = sim.install(config.simulation)
+        _cold_boot(backend)
+        bringup = ModemBringup()
+        report["runs"][str(concurrency)] = {
+            "cold": await _job(bringup),
+            "warm": await _job(bringup),
+        }
+    sim.uninstall()
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modems", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="Multiplier for simulated command latencies")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", type=Path, help="Save report to this file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    write_report(asyncio.run(run(args)), args.json)
+
+
+if __name__ == "__main__":
+    main()
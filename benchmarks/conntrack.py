@@ -0,0 +1,244 @@
+"""Track conntrack flows injected in a private network namespace.
+
+    sudo python -m benchmarks.conntrack --flows 50000 --modems 8
+
+Needs root. Moves the process into a new network namespace (its own empty
+conntrack table, so the host is untouched), creates ``--existing`` flows,
+starts the tracker (which reads them with its initial dump), then creates
+``--flows`` more on the modems' addresses plus ``--other-flows`` on
+unrelated ones and deletes half of everything. The kernel reports no end
+for flows created before the tracker subscribed, so deleting those is only
+seen on the next re-read (every ``--stale-resync`` seconds). After each phase the
+tracker's per-modem counts are checked against what was injected, and the
+time until they matched is reported. A last phase gives a tracker a tiny
+socket buffer so events get lost, and checks that it recovers.
+"""
+
+import argparse
+import asyncio
+import ctypes
+import logging
+import os
+import socket
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+from benchmarks import compare_reports, write_report
+from proxyfarm.config import get_config
+from proxyfarm.core.conntrack import (
+    IPCTNL_MSG_CT_DELETE,
+    IPCTNL_MSG_CT_NEW,
+    ConntrackTracker,
+    flow_message,
+    open_socket,
+)
+from proxyfarm.core.state import ModemRecord
+
+_CLONE_NEWNET = 0x40000000
+_BATCH = 256
+
+
+def _enter_namespace() -> None:
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.unshare(_CLONE_NEWNET) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, f"unshare(CLONE_NEWNET): {os.strerror(error)}")
+
+
+def _modem_ip(modem_id: int) -> str:
+    return f"10.77.{modem_id // 250}.{modem_id % 250 + 1}"
+
+
+def _flow(index: int, modems: int, other: bool) -> tuple[str, int, str, int]:
+    """(source, source port, destination, destination port) of flow ``index``."""
+    source = f"10.99.0.{index % 250 + 1}" if other else _modem_ip(index % modems)
+    destination = f"198.18.{index // 60000 % 256}.{index // 240 % 250 + 1}"
+    return source, 1024 + index % 60000, destination, 443 + index % 240
+
+
+async def _send(sock: socket.socket, messages: list[bytes]) -> None:
+    """Send requests in batches, draining error replies as they come."""
+    loop = asyncio.get_running_loop()
+    for start in range(0, len(messages), _BATCH):
+        await loop.sock_sendall(sock, b"".join(messages[start:start + _BATCH]))
+        while True:
+            try:
+                sock.recv(65536)
+            except BlockingIOError:
+                break
+        # Let the tracker read its events
+        await asyncio.sleep(0)
+
+
+def _requests(msg_type: int, flows: list[tuple[int, bool]], modems: int) -> list[bytes]:
+    return [
+        flow_message(
+            msg_type, index, source, destination, sport, dport, timeout=600, ack=False,
+        )
+        for index, other in flows
+        for source, sport, destination, dport in [_flow(index, modems, other)]
+    ]
+
+
+def _expected(flows: set[tuple[int, bool]], modems: int) -> Counter:
+    return Counter(f"bench{index % modems}" for index, other in flows if not other)
+
+
+def _counts(tracker: ConntrackTracker) -> Counter:
+    return Counter({
+        egress.interface: egress.active_flows
+        for egress in tracker.stats().egress if egress.active_flows
+    })
+
+
+async def _settle(tracker: ConntrackTracker, expected: Counter, timeout: float) -> float:
+    """Seconds until the tracker's counts match ``expected`` (or the timeout)."""
+    started = time.perf_counter()
+    while _counts(tracker) != expected and time.perf_counter() - started < timeout:
+        await asyncio.sleep(0.01)
+    return time.perf_counter() - started
+
+
+async def _phase(
+    tracker: ConntrackTracker, sock: socket.socket, msg_type: int,
+    flows: list[tuple[int, bool]], live: set[tuple[int, bool]], args: argparse.Namespace,
+) -> dict:
+    messages = _requests(msg_type, flows, args.modems)
+    events = tracker.stats().events
+    started = time.perf_counter()
+    await _send(sock, messages)
+    sent = time.perf_counter() - started
+    expected = _expected(live, args.modems)
+    waited = await _settle(tracker, expected, args.timeout)
+    elapsed = sent + waited
+    stats = tracker.stats()
+    return {
+        "requests": len(messages),
+        "matched": _counts(tracker) == expected,
+        "tracked_flows": stats.tracked_flows,
+        "expected_flows": sum(expected.values()),
+        "elapsed_s": elapsed,
+        "events": stats.events - events,
+        "events_per_second": (stats.events - events) / elapsed if elapsed else 0.0,
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    config = get_config().conntrack
+    config.enabled = True
+    config.resync_interval = 0
+    config.stale_resync_interval = args.stale_resync
+    config.rate_interval = 3600
+    modems = [
+        ModemRecord(id=m, interface=f"bench{m}", ip_address=_modem_ip(m))
+        for m in range(args.modems)
+    ]
+    sock = open_socket()
+    report: dict = {"modems": args.modems, "phases": {}}
+
+    existing = [(i, False) for i in range(args.existing)]
+    live = set(existing)
+    await _send(sock, _requests(IPCTNL_MSG_CT_NEW, existing, args.modems))
+
+    tracker = ConntrackTracker()
+    tracker.update_modems(modems)
+    started = time.perf_counter()
+    await tracker.start()
+    if not tracker.running:
+        raise RuntimeError("Conntrack tracker did not start (is nf_conntrack loaded?)")
+    expected = _expected(live, args.modems)
+    await _settle(tracker, expected, args.timeout)
+    report["phases"]["dump"] = {
+        "matched": _counts(tracker) == expected,
+        "tracked_flows": tracker.stats().tracked_flows,
+        "expected_flows": sum(expected.values()),
+        "elapsed_s": time.perf_counter() - started,
+    }
+
+    try:
+        base = args.existing
+        added = [(base + i, False) for i in range(args.flows)]
+        added += [(base + args.flows + i, True) for i in range(args.other_flows)]
+        live |= set(added)
+        report["phases"]["create"] = await _phase(
+            tracker, sock, IPCTNL_MSG_CT_NEW, added, live, args
+        )
+
+        removed = sorted(live)[::2]
+        live -= set(removed)
+        report["phases"]["delete"] = await _phase(
+            tracker, sock, IPCTNL_MSG_CT_DELETE, removed, live, args
+        )
+    finally:
+        await tracker.stop()
+
+    # A buffer too small for a burst: events are lost and the table re-read
+    config.receive_buffer = 4096
+    lossy = ConntrackTracker()
+    lossy.update_modems(modems)
+    await lossy.start()
+    try:
+        burst = [(10_000_000 + i, False) for i in range(args.burst)]
+        live |= set(burst)
+        for start in range(0, len(burst), _BATCH):
+            # No yielding in between, so the tracker falls behind
+            batch = burst[start:start + _BATCH]
+            sock.sendall(b"".join(_requests(IPCTNL_MSG_CT_NEW, batch, args.modems)))
+        expected = _expected(live, args.modems)
+        waited = await _settle(lossy, expected, args.timeout)
+        stats = lossy.stats()
+        report["phases"]["overrun"] = {
+            "requests": len(burst),
+            "matched": _counts(lossy) == expected,
+            "overruns": stats.overruns,
+            "dumps": stats.dumps,
+            "elapsed_s": waited,
+        }
+    finally:
+        await lossy.stop()
+        sock.close()
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modems", type=int, default=8)
+    parser.add_argument("--existing", type=int, default=10000, help="Flows before the start")
+    parser.add_argument("--flows", type=int, default=50000)
+    parser.add_argument("--other-flows", type=int, default=10000)
+    parser.add_argument("--burst", type=int, default=20000)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument(
+        "--stale-resync", type=float, default=1.0,
+        help="Re-read interval while flows from before the start remain",
+    )
+    parser.add_argument(
+        "--no-netns", action="store_true", help="Use the current namespace's table"
+    )
+    parser.add_argument("--json", type=Path, help="Save report to this file")
+    parser.add_argument("--compare", type=Path, help="Baseline report to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if not args.no_netns:
+        _enter_namespace()
+    report = asyncio.run(run(args))
+    write_report(report, args.json)
+
+    if not all(phase["matched"] for phase in report["phases"].values()):
+        print("Flow counts did not match", file=sys.stderr)
+        sys.exit(1)
+    if args.compare:
+        regressions = compare_reports(
+            report, args.compare, [("phases", "create", "elapsed_s")], args.tolerance
+        )
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""Cost of the always-on loop monitor, and whether stalls and hot code are found.
+
+    python -m benchmarks.diagnostics --seconds 3 --rounds 5
+
+Runs a loopback echo workload (``--clients`` connections ping-ponging
+small messages) with the loop monitor off and on, and reports round trips
+per second and CPU time per round trip for both (median of ``--rounds``
+alternating runs, so warm-up doesn't favour either). Then blocks the loop
+in a known function for ``--stall-ms`` and checks the monitor recorded a
+stall with that function on its stack and a duration within the
+documented margin (no less than the block, no more than one lag interval
+over), and profiles a task burning CPU in a known function to check it
+dominates the samples.
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from benchmarks import compare_reports, write_report
+from proxyfarm.config import get_config
+from proxyfarm.diagnostics import loop_monitor, sampling_profiler
+
+_MESSAGE = b"x" * 64
+
+
+async def _echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        while data := await reader.read(4096):
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def _client(port: int, deadline: float) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    trips = 0
+    try:
+        while time.monotonic() < deadline:
+            writer.write(_MESSAGE)
+            await reader.readexactly(len(_MESSAGE))
+            trips += 1
+    finally:
+        writer.close()
+    return trips
+
+
+async def _run_mode(args: argparse.Namespace, port: int, monitor: bool) -> dict:
+    if monitor:
+        loop_monitor.start()
+    try:
+        cpu = time.process_time()
+        started = time.monotonic()
+        counts = await asyncio.gather(
+            *(_client(port, started + args.seconds) for _ in range(args.clients))
+        )
+        elapsed = time.monotonic() - started
+        cpu = time.process_time() - cpu
+    finally:
+        if monitor:
+            loop_monitor.stop()
+    trips = sum(counts)
+    return {
+        "round_trips_per_s": trips / elapsed,
+        "cpu_us_per_trip": cpu / trips * 1e6 if trips else 0.0,
+    }
+
+
+def _blocking_parse(seconds: float) -> None:
+    # Stands in for synchronous work done on the loop by mistake
+    time.sleep(seconds)
+
+
+async def _check_stall(args: argparse.Namespace) -> dict:
+    loop_monitor.start()
+    try:
+        await asyncio.sleep(0.2)
+        seen = loop_monitor.stall_count
+        asyncio.get_running_loop().call_soon(_blocking_parse, args.stall_ms / 1000)
+        await asyncio.sleep(0.2)
+        stall = loop_monitor.stalls[-1] if loop_monitor.stall_count > seen else None
+    finally:
+        loop_monitor.stop()
+    reported = stall.duration_ms if stall else None
+    return {
+        "stall_ms": args.stall_ms,
+        "detected": stall is not None,
+        "reported_ms": reported,
+        "within_margin": reported is not None
+        and args.stall_ms <= reported <= args.stall_ms + args.lag_interval * 1000,
+        "function_on_stack": bool(stall) and any("_blocking_parse" in f for f in stall.stack),
+    }
+
+
+def _hot_function(n: int) -> int:
+    return sum(i * i for i in range(n))
+
+
+async def _burn(deadline: float) -> None:
+    while time.monotonic() < deadline:
+        _hot_function(20000)
+        await asyncio.sleep(0)
+
+
+async def _check_profile(args: argparse.Namespace) -> dict:
+    burner = asyncio.create_task(_burn(time.monotonic() + args.profile_seconds + 0.5))
+    try:
+        report = await sampling_profiler.profile(args.profile_seconds, 0.005)
+    finally:
+        await burner
+    total = sum(report.stacks.values())
+    hot = sum(count for stack, count in report.stacks.items() if "_hot_function" in stack)
+    return {
+        "samples": report.samples,
+        "distinct_stacks": len(report.stacks),
+        "hot_function_share": hot / total if total else 0.0,
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    config = get_config().diagnostics
+    config.enabled = True
+    config.lag_interval = args.lag_interval
+    config.slow_callback = args.slow_callback
+
+    server = await asyncio.start_server(_echo, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    runs: dict[bool, list[dict]] = {False: [], True: []}
+    try:
+        for _ in range(args.rounds):
+            for monitor in (False, True):
+                runs[monitor].append(await _run_mode(args, port, monitor))
+    finally:
+        server.close()
+        await server.wait_closed()
+    off, on = (
+        {key: statistics.median(run[key] for run in runs[monitor]) for key in runs[monitor][0]}
+        for monitor in (False, True)
+    )
+
+    return {
+        "clients": args.clients,
+        "seconds": args.seconds,
+        "rounds": args.rounds,
+        "lag_interval": args.lag_interval,
+        "off": off,
+        "on": on,
+        "throughput_cost": 1 - on["round_trips_per_s"] / off["round_trips_per_s"],
+        "stall": await _check_stall(args),
+        "profile": await _check_profile(args),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=3.0, help="Per run")
+    parser.add_argument("--rounds", type=int, default=3, help="Runs per mode")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--lag-interval", type=float, default=0.05)
+    parser.add_argument("--slow-callback", type=float, default=0.1)
+    parser.add_argument("--stall-ms", type=float, default=300.0)
+    parser.add_argument("--profile-seconds", type=float, default=1.0)
+    parser.add_argument("--json", type=Path, help="Save report to this file")
+    parser.add_argument("--compare", type=Path, help="Baseline report to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    report = asyncio.run(run(args))
+    write_report(report, args.json)
+
+    if not report["stall"]["function_on_stack"]:
+        print("The injected stall was not caught with its stack", file=sys.stderr)
+        sys.exit(1)
+    if not report["stall"]["within_margin"]:
+        print("The stall duration is off by more than one lag interval", file=sys.stderr)
+        sys.exit(1)
+    if report["profile"]["hot_function_share"] < 0.5:
+        print("The profiler missed the function burning CPU", file=sys.stderr)
+        sys.exit(1)
+    if args.compare:
+        regressions = compare_reports(
+            report, args.compare, [("on", "cpu_us_per_trip")], args.tolerance
+        )
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Compare connect tail latency with and without hedging.
+
+    python -m benchmarks.hedge --modems 4 --connects 500
+
+A local TLS server stands in for upstream hosts. Each simulated modem gets
+its own loopback source address, and the server delays the TLS handshake
+per source: a lognormal base latency plus occasional multi-second spikes,
+more frequent on the first (bad) modem. Needs the ``openssl`` binary to
+create a throwaway certificate.
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks import compare_reports, latency_summary, write_report
+from proxyfarm.config import get_config
+from proxyfarm.core.connector import ConnectError, HedgedConnector
+
+_SOURCE_BASE = 10
+
+
+def _source_ip(modem_id: int) -> str:
+    return f"127.0.0.{_SOURCE_BASE + modem_id}"
+
+
+def _make_certificate(directory: Path) -> tuple[Path, Path]:
+    cert, key = directory / "cert.pem", directory / "key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-keyout", str(key), "-out", str(cert)],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+class StandInServer:
+    """TLS server with per-source injected handshake delay."""
+
+    def __init__(self, args: argparse.Namespace, context: ssl.SSLContext):
+        self.args = args
+        self.context = context
+        self.rng = random.Random(args.seed)
+
+    def delay(self, modem_id: int) -> float:
+        args = self.args
+        delay = self.rng.lognormvariate(math.log(args.base_ms / 1000), 0.3)
+        spike_rate = args.bad_spike_rate if modem_id == 0 else args.spike_rate
+        if self.rng.random() < spike_rate:
+            delay += self.rng.uniform(args.spike_ms / 2000, args.spike_ms / 1000)
+        return delay
+
+    async def serve(self, listener: socket.socket) -> None:
+        loop = asyncio.get_running_loop()
+        tasks = set()
+        while True:
+            conn, (source, _) = await loop.sock_accept(listener)
+            task = asyncio.create_task(self.handle(conn, source))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def handle(self, conn: socket.socket, source: str) -> None:
+        # The ClientHello waits in the kernel buffer until the delay is over
+        loop = asyncio.get_running_loop()
+        modem_id = int(source.rsplit(".", 1)[1]) - _SOURCE_BASE
+        await asyncio.sleep(self.delay(modem_id))
+        reader = asyncio.StreamReader()
+        try:
+            transport, _ = await loop.connect_accepted_socket(
+                lambda: asyncio.StreamReaderProtocol(reader), conn, ssl=self.context
+            )
+        except (ConnectionError, ssl.SSLError):
+            conn.close()
+            return
+        try:
+            await reader.read()
+        except (ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            transport.close()
+
+
+async def _run_mode(
+    args: argparse.Namespace, port: int, client_context: ssl.SSLContext, hedging: bool
+) -> dict:
+    get_config().connector.hedging = hedging
+    connector = HedgedConnector()
+    for modem_id in range(args.modems):
+        connector.set_target(modem_id, None, _source_ip(modem_id))
+
+    latencies: list[float] = []
+    failures = 0
+    remaining = iter(range(args.connects))
+
+    async def worker() -> None:
+        nonlocal failures
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                connection = await connector.connect("127.0.0.1", port, ssl_context=client_context)
+            except ConnectError:
+                failures += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            connection.writer.close()
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    stats = connector.stats()
+    attempts = stats.connects + stats.hedges + stats.retries
+    return {
+        "latency": latency_summary(latencies),
+        "failures": failures,
+        "hedges": stats.hedges,
+        "hedge_wins": stats.hedge_wins,
+        "retries": stats.retries,
+        "budget_exhausted": stats.budget_exhausted,
+        "attempts_per_connect": attempts / stats.connects if stats.connects else 0.0,
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    config = get_config().connector
+    config.min_samples = args.min_samples
+    config.budget_ratio = args.budget_ratio
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = _make_certificate(Path(tmp))
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(cert, key)
+        client_context = ssl.create_default_context(cafile=str(cert))
+        client_context.check_hostname = False
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1024)
+        listener.setblocking(False)
+        port = listener.getsockname()[1]
+        server = asyncio.create_task(StandInServer(args, server_context).serve(listener))
+        try:
+            single = await _run_mode(args, port, client_context, hedging=False)
+            hedged = await _run_mode(args, port, client_context, hedging=True)
+        finally:
+            server.cancel()
+            listener.close()
+
+    return {
+        "modems": args.modems,
+        "connects": args.connects,
+        "concurrency": args.concurrency,
+        "single": single,
+        "hedged": hedged,
+        "p99_improvement": (
+            single["latency"]["p99_ms"] / hedged["latency"]["p99_ms"]
+            if hedged["latency"]["p99_ms"] else None
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modems", type=int, default=4)
+    parser.add_argument("--connects", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--base-ms", type=float, default=60.0)
+    parser.add_argument("--spike-ms", type=float, default=1500.0)
+    parser.add_argument("--spike-rate", type=float, default=0.03)
+    parser.add_argument("--bad-spike-rate", type=float, default=0.25)
+    parser.add_argument("--min-samples", type=int, default=20)
+    parser.add_argument("--budget-ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", type=Path, help="Save report to this file")
+    parser.add_argument("--compare", type=Path, help="Baseline report to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    write_report(report, args.json)
+
+    if args.compare:
+        regressions = compare_reports(
+            report, args.compare,
+            [("hedged", "latency", "p99_ms"), ("hedged", "attempts_per_connect")],
+            args.tolerance,
+        )
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
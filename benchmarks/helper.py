@@ -0,0 +1,135 @@
+"""Measure Squid auth helper lookup throughput.
+
+    python -m benchmarks.helper --users 100 --lookups 20000 --window 1 64
+
+Runs ``python -m proxyfarm.helper`` as Squid would, with a state file of
+synthetic users and modems, and drives it over stdin/stdout with up to
+``--window`` lookups in flight (1 is what a helper without the concurrent
+protocol allows). The cold phase is every user's first login (PBKDF2);
+the warm phase is repeated logins served from the credential cache.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks import latency_summary, write_report
+from proxyfarm.helper import hash_password
+
+
+def _state(args: argparse.Namespace) -> tuple[dict, dict[str, str]]:
+    passwords = {f"user{i}": f"secret{i}" for i in range(args.users)}
+    groups = [f"group{g}" for g in range(args.groups)]
+    users = {
+        name: {
+            "password": hash_password(password, args.iterations),
+            "groups": [groups[i % len(groups)]],
+            "enabled": True,
+        }
+        for i, (name, password) in enumerate(passwords.items())
+    }
+    modems = [
+        {"id": m, "interface": f"wwan{m}", "usable": True, "tags": [groups[m % len(groups)]]}
+        for m in range(args.modems)
+    ]
+    return {"users": users, "modems": modems}, passwords
+
+
+async def _drive(
+    process: asyncio.subprocess.Process, requests: list[str], window: int
+) -> tuple[float, list[float], int]:
+    """Send ``requests`` with at most ``window`` in flight."""
+    sent: dict[str, float] = {}
+    latencies: list[float] = []
+    failures = 0
+    free = asyncio.Semaphore(window)
+
+    async def reader() -> None:
+        nonlocal failures
+        for _ in requests:
+            line = (await process.stdout.readline()).decode()
+            channel, result = line.split(" ", 2)[:2]
+            latencies.append(time.perf_counter() - sent.pop(channel))
+            if result != "OK":
+                failures += 1
+            free.release()
+
+    started = time.perf_counter()
+    read = asyncio.create_task(reader())
+    for channel, request in enumerate(requests):
+        await free.acquire()
+        sent[str(channel)] = time.perf_counter()
+        process.stdin.write(f"{channel} {request}\n".encode())
+        await process.stdin.drain()
+    await read
+    return time.perf_counter() - started, latencies, failures
+
+
+def _summary(elapsed: float, latencies: list[float], failures: int) -> dict:
+    return {
+        "lookups": len(latencies),
+        "failures": failures,
+        "elapsed_s": elapsed,
+        "lookups_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "latency": latency_summary(latencies),
+    }
+
+
+async def _helper_run(state_path: Path, cold: list[str], warm: list[str], window: int) -> dict:
+    """Cold then warm logins against one fresh helper process."""
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "proxyfarm.helper",
+        "--state", str(state_path), "--socket", str(state_path.with_suffix(".sock")),
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+    )
+    try:
+        return {
+            "cold": _summary(*await _drive(process, cold, window)),
+            "warm": _summary(*await _drive(process, warm, window)),
+        }
+    finally:
+        process.stdin.close()
+        await process.wait()
+
+
+async def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    state, passwords = _state(args)
+    names = list(passwords)
+    cold = [f"{name} {passwords[name]}" for name in names]
+    warm = [
+        f"{name} {passwords[name]}"
+        for name in (rng.choice(names) for _ in range(args.lookups))
+    ]
+
+    report = {"users": args.users, "iterations": args.iterations, "windows": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        state_path = Path(tmp) / "helper-state.json"
+        state_path.write_text(json.dumps(state))
+        for window in args.window:
+            report["windows"][str(window)] = await _helper_run(state_path, cold, warm, window)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--groups", type=int, default=4)
+    parser.add_argument("--modems", type=int, default=8)
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--window", type=int, nargs="+", default=[1, 64])
+    parser.add_argument("--iterations", type=int, default=100_000,
+                        help="PBKDF2 iterations of the synthetic password hashes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", type=Path, help="Save report to this file")
+    args = parser.parse_args()
+    write_report(asyncio.run(run(args)), args.json)
+
+
+if __name__ == "__main__":
+    main()
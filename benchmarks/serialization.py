@@ -0,0 +1,171 @@
+"""Compare pydantic schemas and internal records for modem state.
+
+    python -m benchmarks.serialization --modems 64
+
+Two parts:
+
+- monitor cycle: ``modem_manager.get_modems`` against a zero-latency
+  simulated farm followed by ``MonitorService._update_inventory``, the way
+  the monitor runs it, versus the same poll building pydantic
+  ``Modem``/``Bearer`` models that replace the inventory wholesale (the code
+  before ``ModemRecord``). Both sides parse the same mmcli output and keep
+  the inventory alive between cycles; reported in time and in peak memory
+  allocated per cycle (tracemalloc);
+- response: serializing ``GET /modems`` the way FastAPI does for a
+  ``response_model`` (validate, dump to Python, ``json.dumps``) versus
+  pydantic-core dumping the records straight to JSON bytes.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from benchmarks import write_report
+from proxyfarm.config import get_config
+from proxyfarm.core import modem as modem_module
+from proxyfarm.core import sim
+from proxyfarm.core.modem import modem_manager
+from proxyfarm.core.state import BearerRecord, ModemRecord, modem_list_json
+from proxyfarm.schemas import Bearer, Modem, ModemListResponse, ModemState
+from proxyfarm.services.monitor import MonitorService
+
+
+def _values(rng: random.Random, modem_id: int) -> tuple[dict, dict]:
+    ip = f"100.64.{rng.randrange(256)}.{rng.randrange(1, 254)}"
+    bearer = {
+        "id": modem_id,
+        "interface": f"wwan{modem_id}",
+        "ip_address": ip,
+        "gateway": f"100.64.0.{rng.randrange(1, 254)}",
+        "dns": ["10.200.0.1", "10.200.0.2"],
+    }
+    modem = {
+        "id": modem_id,
+        "manufacturer": "Simulated",
+        "model": "SIM-LTE",
+        "device_id": f"sim{modem_id:04d}",
+        "primary_port": f"cdc-wdm{modem_id}",
+        "state": ModemState.CONNECTED,
+        "signal_quality": rng.randrange(100),
+        "operator_name": "SimTel",
+        "operator_id": "25099",
+        "interface": f"wwan{modem_id}",
+        "ip_address": ip,
+    }
+    return modem, bearer
+
+
+def _measure(fn: Callable[[], object], rounds: int) -> dict:
+    fn()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    elapsed = (time.perf_counter() - started) / rounds
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"time_us": elapsed * 1e6, "allocated_kib": peak / 1024}
+
+
+async def _measure_async(fn: Callable[[], Awaitable[object]], rounds: int) -> dict:
+    await fn()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await fn()
+    elapsed = (time.perf_counter() - started) / rounds
+
+    tracemalloc.start()
+    await fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"time_us": elapsed * 1e6, "allocated_kib": peak / 1024}
+
+
+async def _monitor_cycle(args: argparse.Namespace) -> dict:
+    config = get_config().simulation
+    config.modems = args.modems
+    config.seed = args.seed
+    config.latency = {}
+    config.failure_rates = {}
+    backend = sim.install(config)
+    modem_ids = sorted(backend.modems)
+    monitor = MonitorService()
+    schema_inventory: dict[int, Modem] = {}
+
+    async def record_cycle() -> None:
+        monitor._update_inventory(await modem_manager.get_modems(modem_ids))
+
+    async def schema_cycle() -> None:
+        nonlocal schema_inventory
+        modem_module.ModemRecord, modem_module.BearerRecord = Modem, Bearer
+        try:
+            modems = await modem_manager.get_modems(modem_ids)
+        finally:
+            modem_module.ModemRecord, modem_module.BearerRecord = ModemRecord, BearerRecord
+        schema_inventory = {modem.id: modem for modem in modems}
+
+    try:
+        # Alternate, so warm-up and allocator state favour neither side
+        runs: dict[str, list[dict]] = {"schema": [], "record": []}
+        for _ in range(args.repeats):
+            runs["schema"].append(await _measure_async(schema_cycle, args.rounds // 10))
+            runs["record"].append(await _measure_async(record_cycle, args.rounds // 10))
+    finally:
+        sim.uninstall()
+    return {
+        side: {key: statistics.median(run[key] for run in results) for key in results[0]}
+        for side, results in runs.items()
+    }
+
+
+def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    polls = [_values(rng, modem_id) for modem_id in range(args.modems)]
+    models = [Modem(**modem, bearer=Bearer(**bearer)) for modem, bearer in polls]
+    records = [ModemRecord(**modem, bearer=BearerRecord(**bearer)) for modem, bearer in polls]
+
+    def schema_response() -> bytes:
+        response = ModemListResponse.model_validate(
+            {"modems": models, "count": len(models)}
+        )
+        return json.dumps(response.model_dump(mode="json")).encode()
+
+    def record_response() -> bytes:
+        return modem_list_json(records)
+
+    assert json.loads(schema_response()) == json.loads(record_response())
+    cycle = asyncio.run(_monitor_cycle(args))
+    response = {
+        "schema": _measure(schema_response, args.rounds),
+        "record": _measure(record_response, args.rounds),
+    }
+    return {
+        "modems": args.modems,
+        "monitor_cycle": cycle,
+        "response": response,
+        "cycle_speedup": cycle["schema"]["time_us"] / cycle["record"]["time_us"],
+        "response_speedup": response["schema"]["time_us"] / response["record"]["time_us"],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modems", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--repeats", type=int, default=5, help="Alternating cycle runs")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", type=Path, help="Save report to this file")
+    args = parser.parse_args()
+    write_report(run(args), args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""Latency under upload load through an emulated modem, with and without shaping.
+
+    sudo python -m benchmarks.shaping --rate-kbit 8000 --duration 10
+
+Needs root, ``ip``, ``tc`` and ``nsenter``. Builds three network namespaces:
+the bench itself (standing in for the host, with ``wwan0``), a "modem" that
+forwards through a slow link with a deep FIFO (tbf, like an LTE modem's
+buffer), and a sink running a discard and an echo server. A heavy client
+uploads over ``--streams`` TCP streams while a light one round-trips small
+messages; both mark their sockets the way the SOCKS listener does.
+
+Phases: ``idle`` (light client alone), ``unshaped`` (the bufferbloat
+baseline), ``shaped`` (the shaper's HTB at ``rate_fraction`` of the link
+with a class per client) and ``capped`` (the heavy client limited to
+``--cap-kbit``). The light client's round trips under load should drop
+sharply once shaped, and the capped client should stay under its cap.
+"""
+
+import argparse
+import asyncio
+import ctypes
+import logging
+import os
+import socket
+import struct
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+from benchmarks import compare_reports, latency_summary, write_report
+from proxyfarm.config import get_config
+from proxyfarm.core.shaping import ClientClass, TrafficShaper, mark_socket
+
+_CLONE_NEWNET = 0x40000000
+_HOST_IP = "10.201.0.2"
+_MODEM_HOST_SIDE = "10.201.0.1"
+_MODEM_SINK_SIDE = "10.202.0.1"
+_SINK_IP = "10.202.0.2"
+_DISCARD_PORT = 5001
+_ECHO_PORT = 5002
+_HEAVY, _LIGHT = 2, 3
+_MESSAGE = 64
+_CHUNK = 64 * 1024
+
+
+def _enter_namespace() -> None:
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.unshare(_CLONE_NEWNET) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, f"unshare(CLONE_NEWNET): {os.strerror(error)}")
+
+
+def _run(*commands: str, pid: int = 0) -> None:
+    prefix = ["nsenter", "-t", str(pid), "-n"] if pid else []
+    for command in commands:
+        subprocess.run(prefix + command.split(), check=True, capture_output=True)
+
+
+def _build(modem_pid: int, sink_pid: int, rate_kbit: int, buffer_ms: int) -> None:
+    """host wwan0 <-> m0 modem m1 (slow, deep FIFO) <-> s0 sink."""
+    _run(
+        "ip link set lo up",
+        f"ip link add wwan0 type veth peer name m0 netns {modem_pid}",
+        f"ip addr add {_HOST_IP}/24 dev wwan0",
+        "ip link set wwan0 up",
+        f"ip route add default via {_MODEM_HOST_SIDE}",
+    )
+    _run(
+        "ip link set lo up",
+        f"ip addr add {_MODEM_HOST_SIDE}/24 dev m0",
+        "ip link set m0 up",
+        f"ip link add m1 type veth peer name s0 netns {sink_pid}",
+        f"ip addr add {_MODEM_SINK_SIDE}/24 dev m1",
+        "ip link set m1 up",
+        "sysctl -w net.ipv4.ip_forward=1",
+        f"tc qdisc add dev m1 root tbf rate {rate_kbit}kbit burst 16kb latency {buffer_ms}ms",
+        pid=modem_pid,
+    )
+    _run(
+        "ip link set lo up",
+        f"ip addr add {_SINK_IP}/24 dev s0",
+        "ip link set s0 up",
+        f"ip route add default via {_MODEM_SINK_SIDE}",
+        pid=sink_pid,
+    )
+
+
+# Sink side (runs in its own namespace, started with --sink)
+
+async def _sink() -> None:
+    async def discard(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        total = 0
+        while chunk := await reader.read(_CHUNK):
+            total += len(chunk)
+        writer.write(struct.pack("!Q", total))
+        await writer.drain()
+        writer.close()
+
+    async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while data := await reader.read(_CHUNK):
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    discard_server = await asyncio.start_server(discard, "0.0.0.0", _DISCARD_PORT)
+    echo_server = await asyncio.start_server(echo, "0.0.0.0", _ECHO_PORT)
+    async with discard_server, echo_server:
+        await asyncio.Event().wait()
+
+
+# Bench side
+
+def _class(minor: int, cap_kbit: Optional[int] = None) -> ClientClass:
+    return ClientClass(minor, get_config().shaping.mark_base + minor, cap_kbit)
+
+
+async def _connect(port: int, client_class: ClientClass) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    mark_socket(sock, client_class)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    await asyncio.get_running_loop().sock_connect(sock, (_SINK_IP, port))
+    return sock
+
+
+async def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    loop = asyncio.get_running_loop()
+    data = b""
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+async def _upload(stop: asyncio.Event) -> tuple[int, float]:
+    """Bytes the sink received from one stream, and seconds until it said so."""
+    loop = asyncio.get_running_loop()
+    sock = await _connect(_DISCARD_PORT, _class(_HEAVY))
+    payload = bytes(_CHUNK)
+    started = time.perf_counter()
+    try:
+        while not stop.is_set():
+            await loop.sock_sendall(sock, payload)
+        sock.shutdown(socket.SHUT_WR)
+        (total,) = struct.unpack("!Q", await _recv_exactly(sock, 8))
+        return total, time.perf_counter() - started
+    finally:
+        sock.close()
+
+
+async def _round_trips(duration: float, interval: float) -> list[float]:
+    loop = asyncio.get_running_loop()
+    sock = await _connect(_ECHO_PORT, _class(_LIGHT))
+    message = bytes(_MESSAGE)
+    samples = []
+    try:
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            await loop.sock_sendall(sock, message)
+            await _recv_exactly(sock, _MESSAGE)
+            samples.append(time.perf_counter() - started)
+            await asyncio.sleep(interval)
+    finally:
+        sock.close()
+    return samples
+
+
+async def _phase(args: argparse.Namespace, load: bool) -> dict:
+    stop = asyncio.Event()
+    uploads = [asyncio.create_task(_upload(stop)) for _ in range(args.streams if load else 0)]
+    if load:
+        await asyncio.sleep(args.warmup)
+    samples = await _round_trips(args.duration, args.interval)
+    stop.set()
+    result = {"round_trips": len(samples), **latency_summary(samples)}
+    if uploads:
+        done = await asyncio.gather(*uploads)
+        total = sum(received for received, _ in done)
+        elapsed = max(seconds for _, seconds in done)
+        result["heavy_kbit"] = total * 8 / 1000 / elapsed
+    return result
+
+
+async def _shape(rate_kbit: int, cap_kbit: Optional[int] = None) -> None:
+    classes = [_class(_HEAVY, cap_kbit), _class(_LIGHT)]
+    error = await TrafficShaper.apply_interface("wwan0", rate_kbit, classes)
+    if error:
+        raise RuntimeError(f"Shaping wwan0 failed: {error}")
+
+
+async def run(args: argparse.Namespace) -> dict:
+    config = get_config().shaping
+    config.qdisc = args.leaf
+    config.classifier = args.classifier
+    shaped_rate = int(args.rate_kbit * config.rate_fraction)
+    report: dict = {
+        "rate_kbit": args.rate_kbit,
+        "shaped_rate_kbit": shaped_rate,
+        "leaf": args.leaf,
+        "phases": {},
+    }
+    phases = report["phases"]
+    phases["idle"] = await _phase(args, load=False)
+    phases["unshaped"] = await _phase(args, load=True)
+    await _shape(shaped_rate)
+    phases["shaped"] = await _phase(args, load=True)
+    await _shape(shaped_rate, args.cap_kbit)
+    phases["capped"] = await _phase(args, load=True)
+    phases["capped"]["cap_kbit"] = args.cap_kbit
+    report["latency_reduced"] = phases["shaped"]["p90_ms"] < phases["unshaped"]["p90_ms"]
+    report["cap_held"] = phases["capped"]["heavy_kbit"] <= args.cap_kbit * 1.1
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate-kbit", type=int, default=8000, help="Emulated uplink rate")
+    parser.add_argument("--buffer-ms", type=int, default=1000, help="Modem buffer depth")
+    parser.add_argument("--streams", type=int, default=4, help="Heavy client's uploads")
+    parser.add_argument("--cap-kbit", type=int, default=2000)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--leaf", default="fq_codel", help="Leaf qdisc (shaping.qdisc)")
+    parser.add_argument(
+        "--classifier", default="fw", choices=["fw", "u32", "none"],
+        help="none: only SO_PRIORITY selects the class",
+    )
+    parser.add_argument("--sink", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--json", type=Path, help="Save report to this file")
+    parser.add_argument("--compare", type=Path, help="Baseline report to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.sink:
+        asyncio.run(_sink())
+        return
+
+    logging.getLogger().setLevel(logging.WARNING)
+    _enter_namespace()
+    modem = subprocess.Popen(["unshare", "-n", "sleep", "infinity"])
+    sink = subprocess.Popen(
+        ["unshare", "-n", sys.executable, "-m", "benchmarks.shaping", "--sink"]
+    )
+    try:
+        # Let both processes reach their namespaces
+        time.sleep(0.5)
+        _build(modem.pid, sink.pid, args.rate_kbit, args.buffer_ms)
+        report = asyncio.run(run(args))
+    finally:
+        for process in (modem, sink):
+            process.kill()
+            process.wait()
+    write_report(report, args.json)
+
+    if not (report["latency_reduced"] and report["cap_held"]):
+        print("Shaping did not cut latency or hold the cap", file=sys.stderr)
+        sys.exit(1)
+    if args.compare:
+        regressions = compare_reports(
+            report,
+            args.compare,
+            [("phases", "shaped", "p90_ms"), ("phases", "shaped", "p99_ms")],
+            args.tolerance,
+        )
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""Load the SOCKS5 listener with many concurrent streams on loopback.
+
+    python -m benchmarks.socks --streams 2000 --bytes 262144 --buffer-size 4096 65536
+
+Starts the listener, an echo server and a UDP echo server in one process.
+Each simulated modem gets its own loopback source address. Every stream
+logs in as a proxy user, CONNECTs to the echo server and pushes ``--bytes``
+through and back; all streams run at once. Then ``--udp-clients`` UDP
+ASSOCIATE sessions each round-trip ``--datagrams`` datagrams. The TCP phase
+runs once per ``--buffer-size`` so relay buffer sizes can be compared.
+"""
+
+import argparse
+import asyncio
+import logging
+import resource
+import socket
+import struct
+import sys
+import time
+from pathlib import Path
+
+from benchmarks import compare_reports, latency_summary, write_report
+from proxyfarm.config import get_config
+from proxyfarm.core.connector import hedged_connector
+from proxyfarm.core.proxyauth import proxy_auth
+from proxyfarm.core.socks import SocksServer, decode_address, encode_address
+from proxyfarm.core.state import ModemRecord
+
+_SOURCE_BASE = 10
+_PASSWORD = "secret"
+
+
+def _source_ip(modem_id: int) -> str:
+    return f"127.0.0.{_SOURCE_BASE + modem_id}"
+
+
+async def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    loop = asyncio.get_running_loop()
+    data = b""
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+async def _echo(listener: socket.socket) -> None:
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def serve(conn: socket.socket) -> None:
+        buffer = memoryview(bytearray(65536))
+        try:
+            while n := await loop.sock_recv_into(conn, buffer):
+                await loop.sock_sendall(conn, buffer[:n])
+        except ConnectionError:
+            pass
+        finally:
+            conn.close()
+
+    while True:
+        conn, _ = await loop.sock_accept(listener)
+        conn.setblocking(False)
+        task = asyncio.create_task(serve(conn))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+class _UdpEcho(asyncio.DatagramProtocol):
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        self.transport.sendto(data, addr)
+
+
+async def _open(proxy: tuple, user: str, request: bytes) -> tuple[socket.socket, bytes]:
+    """Log in and send one request; returns the socket and the reply."""
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    await loop.sock_connect(sock, proxy)
+    name, password = user.encode(), _PASSWORD.encode()
+    await loop.sock_sendall(
+        sock,
+        b"\x05\x01\x02" + bytes((1, len(name))) + name + bytes((len(password),)) + password
+        + request,
+    )
+    method, login = await _recv_exactly(sock, 2), await _recv_exactly(sock, 2)
+    if method != b"\x05\x02" or login != b"\x01\x00":
+        raise ConnectionError("Login refused")
+    reply = await _recv_exactly(sock, 4)
+    if reply[1] != 0:
+        raise ConnectionError(f"Request failed with reply {reply[1]}")
+    rest = await _recv_exactly(sock, 6 if reply[3] == 1 else 18)
+    return sock, reply[3:] + rest
+
+
+async def _stream(proxy: tuple, echo: tuple, user: str, size: int, chunk: int) -> float:
+    """One CONNECT carrying ``size`` bytes each way; returns the handshake time."""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    sock, _ = await _open(proxy, user, b"\x05\x01\x00" + encode_address(*echo))
+    handshake = time.perf_counter() - started
+    payload = memoryview(bytearray(chunk))
+    received = memoryview(bytearray(chunk))
+
+    async def send() -> None:
+        left = size
+        while left:
+            n = min(left, chunk)
+            await loop.sock_sendall(sock, payload[:n])
+            left -= n
+
+    try:
+        sender = asyncio.create_task(send())
+        got = 0
+        while got < size:
+            n = await loop.sock_recv_into(sock, received)
+            if not n:
+                raise ConnectionError("Stream closed early")
+            got += n
+        await sender
+    finally:
+        sock.close()
+    return handshake
+
+
+async def _tcp_phase(args: argparse.Namespace, echo: tuple, buffer_size: int) -> dict:
+    config = get_config().socks
+    config.buffer_size = buffer_size
+    server = SocksServer()
+    await server.start()
+    try:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            _stream(server.address, echo, f"user{i % args.users}", args.bytes, args.chunk)
+            for i in range(args.streams)
+        ), return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        stats = server.stats()
+    finally:
+        await server.stop()
+
+    handshakes = [r for r in results if isinstance(r, float)]
+    failures = [r for r in results if not isinstance(r, float)]
+    if failures:
+        print(f"{len(failures)} stream(s) failed, first: {failures[0]!r}", file=sys.stderr)
+    relayed = stats.bytes_up + stats.bytes_down
+    return {
+        "buffer_size": buffer_size,
+        "streams": args.streams,
+        "failures": len(failures),
+        "elapsed_s": elapsed,
+        "relayed_mb": relayed / 1e6,
+        "throughput_mb_s": relayed / 1e6 / elapsed,
+        "handshake": latency_summary(handshakes),
+        "pooled_buffers": stats.pooled_buffers,
+    }
+
+
+async def _udp_client(proxy: tuple, target: tuple, user: str, count: int) -> list[float]:
+    loop = asyncio.get_running_loop()
+    control, bound = await _open(proxy, user, b"\x05\x03\x00" + encode_address("0.0.0.0", 0))
+    relay_host, relay_port, _ = decode_address(bound)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    sock.bind(("127.0.0.1", 0))
+    header = b"\x00\x00\x00" + encode_address(*target)
+    rtts = []
+    try:
+        for seq in range(count):
+            started = time.perf_counter()
+            await loop.sock_sendto(sock, header + struct.pack("!I", seq), (relay_host, relay_port))
+            data = await asyncio.wait_for(loop.sock_recv(sock, 2048), 2.0)
+            if struct.unpack("!I", data[-4:])[0] == seq:
+                rtts.append(time.perf_counter() - started)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        sock.close()
+        control.close()
+    return rtts
+
+
+async def _udp_phase(args: argparse.Namespace, target: tuple) -> dict:
+    server = SocksServer()
+    await server.start()
+    try:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            _udp_client(server.address, target, f"user{i % args.users}", args.datagrams)
+            for i in range(args.udp_clients)
+        ))
+        elapsed = time.perf_counter() - started
+    finally:
+        await server.stop()
+    rtts = [rtt for client in results for rtt in client]
+    return {
+        "clients": args.udp_clients,
+        "datagrams": args.udp_clients * args.datagrams,
+        "answered": len(rtts),
+        "datagrams_per_second": len(rtts) / elapsed if elapsed else 0.0,
+        "rtt": latency_summary(rtts),
+    }
+
+
+async def _setup(args: argparse.Namespace) -> None:
+    config = get_config()
+    config.socks.enabled = True
+    config.socks.host = "127.0.0.1"
+    config.socks.port = 0
+    config.socks.max_connections = args.streams + args.udp_clients
+    config.proxy_auth.enabled = False
+    config.proxy_auth.hash_iterations = 1000
+
+    modems = [
+        ModemRecord(id=m, interface=f"bench{m}", ip_address=_source_ip(m))
+        for m in range(args.modems)
+    ]
+    for modem in modems:
+        hedged_connector.set_target(modem.id, None, modem.ip_address)
+    await proxy_auth.start()
+    proxy_auth.update_modems(modems, {modem.id: 1 for modem in modems})
+    for i in range(args.users):
+        await proxy_auth.set_user(f"user{i}", _PASSWORD, [], True)
+        # First logins pay for PBKDF2; keep that out of the compared phases
+        await proxy_auth.authenticate(f"user{i}", _PASSWORD)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # Four descriptors per stream: client, accepted, upstream and echo side
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    await _setup(args)
+
+    loop = asyncio.get_running_loop()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(4096)
+    listener.setblocking(False)
+    echo = listener.getsockname()
+    echo_task = asyncio.create_task(_echo(listener))
+    udp, _ = await loop.create_datagram_endpoint(_UdpEcho, local_addr=("127.0.0.1", 0))
+
+    report = {"modems": args.modems, "bytes_per_stream": args.bytes, "tcp": {}}
+    try:
+        for buffer_size in args.buffer_size:
+            report["tcp"][str(buffer_size)] = await _tcp_phase(args, echo, buffer_size)
+        if args.udp_clients:
+            report["udp"] = await _udp_phase(args, udp.get_extra_info("sockname"))
+    finally:
+        echo_task.cancel()
+        listener.close()
+        udp.close()
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modems", type=int, default=4)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--streams", type=int, default=2000)
+    parser.add_argument("--bytes", type=int, default=256 * 1024, help="Bytes per stream each way")
+    parser.add_argument("--chunk", type=int, default=16384, help="Client write size")
+    parser.add_argument("--buffer-size", type=int, nargs="+", default=[4096, 65536])
+    parser.add_argument("--udp-clients", type=int, default=50)
+    parser.add_argument("--datagrams", type=int, default=100)
+    parser.add_argument("--json", type=Path, help="Save report to this file")
+    parser.add_argument("--compare", type=Path, help="Baseline report to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    write_report(report, args.json)
+
+    if args.compare:
+        size = str(args.buffer_size[-1])
+        regressions = compare_reports(
+            report,
+            args.compare,
+            [("tcp", size, "handshake", "p99_ms"), ("tcp", size, "elapsed_s")],
+            args.tolerance,
+        )
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
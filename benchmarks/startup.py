@@ -0,0 +1,159 @@
+"""Time from process start to ``/health`` and ``/ready``, cold and warm.
+
+    python -m benchmarks.startup --runs 5 --modems 8
+    python -m benchmarks.startup --config /etc/proxyfarm/config.yaml
+
+Starts the server (``python -m proxyfarm.main``) ``--runs`` times with an
+empty state store (cold) and as many times with the store the previous run
+left (warm), polling both endpoints until ``/ready`` answers 200. Without
+``--config`` the modem farm is simulated; with it, the given config is used
+as is (real modems, Squid) except for the store, run directory and port,
+which are private to the bench. Time to ready is the metric to track on
+the target board.
+"""
+
+import argparse
+import logging
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import yaml
+
+from benchmarks import compare_reports, write_report
+
+
+def _write_config(args: argparse.Namespace, workdir: Path) -> Path:
+    config = yaml.safe_load(args.config.read_text()) if args.config else None
+    if config is None:
+        config = {
+            "simulation": {"enabled": True, "modems": args.modems},
+            "socks": {"enabled": False},
+            "dns": {"enabled": False},
+            "usage": {"access_log": str(workdir / "access.log")},
+        }
+    config.setdefault("api", {}).update(run_dir=str(workdir / "run"), workers=1)
+    config.setdefault("store", {}).update(path=str(workdir / "state.db"))
+    path = workdir / "config.yaml"
+    path.write_text(yaml.safe_dump(config))
+    return path
+
+
+def _start_once(config: Path, port: int, timeout: float) -> dict:
+    """Seconds from spawning the server until each endpoint answered 200."""
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "proxyfarm.main", "--config", str(config), "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    result: dict = {"ready": False}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=1.0) as client:
+            while time.perf_counter() - started < timeout:
+                try:
+                    if "health_s" not in result and client.get("/health").status_code == 200:
+                        result["health_s"] = time.perf_counter() - started
+                    response = client.get("/ready")
+                except httpx.TransportError:
+                    time.sleep(0.02)
+                    continue
+                if response.status_code == 200:
+                    result["ready_s"] = time.perf_counter() - started
+                    result["ready"] = True
+                    startup = response.json()["startup"]
+                    result["reported_ready_s"] = startup["time_to_ready"]
+                    result["warm_start"] = startup["warm_start"]
+                    result["phases"] = startup["phases"]
+                    result["milestones"] = startup["milestones"]
+                    break
+                time.sleep(0.02)
+    finally:
+        # A clean stop flushes the store the next warm run starts from
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+    return result
+
+
+def _summary(runs: list[dict]) -> dict:
+    ready = [run for run in runs if run["ready"]]
+    summary: dict = {"runs": len(runs), "ready": len(ready)}
+    for key in ("health_s", "ready_s", "reported_ready_s"):
+        values = [run[key] for run in ready if key in run]
+        if values:
+            summary[f"{key[:-2]}_median_s"] = statistics.median(values)
+            summary[f"{key[:-2]}_max_s"] = max(values)
+    if ready:
+        phases = ready[-1]["phases"]
+        summary["phases_median_s"] = {
+            name: statistics.median(run["phases"].get(name, 0.0) for run in ready)
+            for name in phases
+        }
+        summary["milestones_median_s"] = {
+            name: statistics.median(run["milestones"].get(name, 0.0) for run in ready)
+            for name in ready[-1]["milestones"]
+        }
+    return summary
+
+
+def run(args: argparse.Namespace) -> dict:
+    report: dict = {"simulated": args.config is None, "modems": args.modems}
+    with tempfile.TemporaryDirectory(prefix="proxyfarm-startup-") as workdir:
+        workdir = Path(workdir)
+        config = _write_config(args, workdir)
+        for mode in ("cold", "warm"):
+            runs = []
+            for _ in range(args.runs):
+                if mode == "cold":
+                    for path in workdir.glob("state.db*"):
+                        path.unlink()
+                elif not runs:
+                    # The first warm run needs a store left by a run that got ready
+                    _start_once(config, args.port, args.timeout)
+                runs.append(_start_once(config, args.port, args.timeout))
+            report[mode] = _summary(runs)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", type=Path, help="Base config (default: simulated farm)")
+    parser.add_argument("--modems", type=int, default=8, help="Simulated modems")
+    parser.add_argument("--runs", type=int, default=3, help="Starts per mode")
+    parser.add_argument("--port", type=int, default=18480)
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds to wait for ready")
+    parser.add_argument("--json", type=Path, help="Save report to this file")
+    parser.add_argument("--compare", type=Path, help="Baseline report to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    report = run(args)
+    write_report(report, args.json)
+
+    if report["cold"]["ready"] < args.runs or report["warm"]["ready"] < args.runs:
+        print("Not every start got ready in time", file=sys.stderr)
+        sys.exit(1)
+    if args.compare:
+        regressions = compare_reports(
+            report,
+            args.compare,
+            [("cold", "ready_median_s"), ("warm", "ready_median_s")],
+            args.tolerance,
+        )
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
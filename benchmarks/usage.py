@@ -0,0 +1,81 @@
+"""Measure access log accounting throughput on a synthetic Squid log.
+
+    python -m benchmarks.usage --lines 500000
+"""
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks import write_report
+from proxyfarm.config import get_config
+from proxyfarm.services.usage import UsageTracker
+
+_METHODS = ["GET", "GET", "GET", "POST", "CONNECT", "CONNECT"]
+_CODES = ["TCP_MISS/200", "TCP_TUNNEL/200", "TCP_MISS/304", "TCP_DENIED/403", "TCP_MISS/502"]
+
+
+def synthetic_line(rng: random.Random, clients: int, domains: int, modems: int) -> str:
+    """One access log line in the ``proxyfarm`` logformat."""
+    method = rng.choice(_METHODS)
+    domain = f"host{rng.randrange(domains)}.example.com"
+    url = f"{domain}:443" if method == "CONNECT" else f"http://{domain}/path?q={rng.random()}"
+    return (
+        f"{time.time():.3f} {rng.randrange(5000):6d} 10.8.0.{rng.randrange(clients) + 2} "
+        f"{rng.choice(_CODES)} {rng.randrange(100, 2_000_000)} {method} {url} - "
+        f"HIER_DIRECT/93.184.216.34 text/html 100.64.0.{rng.randrange(modems) + 1}"
+    )
+
+
+def write_log(path: Path, lines: int, clients: int, domains: int, modems: int) -> None:
+    rng = random.Random(1)
+    with open(path, "w") as f:
+        for _ in range(lines):
+            f.write(synthetic_line(rng, clients, domains, modems) + "\n")
+
+
+async def run(args: argparse.Namespace) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        log = Path(tmp) / "access.log"
+        write_log(log, args.lines, args.clients, args.domains, args.modems)
+
+        get_config().usage.from_start = True
+        tracker = UsageTracker()
+        for counters in (tracker.clients, tracker.domains, tracker.outgoing):
+            counters.max_keys = args.max_keys
+        tracker.follow(log)
+
+        started = time.perf_counter()
+        await tracker.catch_up()
+        elapsed = time.perf_counter() - started
+
+    return {
+        "lines": tracker.lines,
+        "parse_errors": tracker.errors,
+        "elapsed_s": elapsed,
+        "lines_per_second": tracker.lines / elapsed if elapsed else 0.0,
+        "tracked_keys": {
+            "clients": len(tracker.clients.entries),
+            "domains": len(tracker.domains.entries),
+            "outgoing": len(tracker.outgoing.entries),
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=200_000)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--domains", type=int, default=5000)
+    parser.add_argument("--modems", type=int, default=8)
+    parser.add_argument("--max-keys", type=int, default=1000)
+    parser.add_argument("--json", type=Path, help="Save report to this file")
+    args = parser.parse_args()
+    write_report(asyncio.run(run(args)), args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,21 @@ SQUID_PORT=3128
 VPN_NETWORK="10.8.0.0/24"  # OpenVPN default network
 SQUID_CONF="/etc/squid/squid.conf"
 SQUID_CONF_TEMPLATE="/etc/squid/squid.conf.template"
+# ProxyFarm's caching resolver (dns.listen_host) first, public DNS as backup
+DNS_NAMESERVERS="${DNS_NAMESERVERS:-127.0.1.53 8.8.8.8}"
+PROXYFARM_PYTHON="${PROXYFARM_PYTHON:-/opt/proxyfarm/venv/bin/python}"
+# PROXY_AUTH=1: require proxy users, checked by ProxyFarm's helper, and send
+# each user through the modem it picks from the user's group. ProxyFarm
+# passes it when it re-runs this script; otherwise it follows
+# proxy_auth.enabled in ProxyFarm's config (0 if ProxyFarm isn't installed)
+if [ -z "$PROXY_AUTH" ]; then
+    PROXY_AUTH=$("$PROXYFARM_PYTHON" -c \
+        'from proxyfarm.config import get_config; print(int(get_config().proxy_auth.enabled))' \
+        2>/dev/null || echo 0)
+fi
+AUTH_HELPER="${AUTH_HELPER:-$PROXYFARM_PYTHON -m proxyfarm.helper}"
+# Per-client tcp_outgoing_mark rules, maintained by ProxyFarm (shaping.squid_include)
+SHAPING_CONF="${SHAPING_CONF:-/etc/squid/proxyfarm-shaping.conf}"
 
 # Install Squid if not present
 if ! command -v squid &> /dev/null; then
@@ -74,6 +89,37 @@ EOF
 
 echo "acl vpn_network src $VPN_NETWORK" >> "$SQUID_CONF"
 
+if [ "$PROXY_AUTH" = "1" ]; then
+    cat >> "$SQUID_CONF" <<EOF
+
+# Proxy users. The helper answers OK tag=<interface>; users are re-checked
+# every 30 seconds so modem changes reach them quickly.
+auth_param basic program $AUTH_HELPER
+auth_param basic children 2 startup=1 idle=1 concurrency=500
+auth_param basic realm ProxyFarm
+auth_param basic credentialsttl 30 seconds
+acl pf_users proxy_auth REQUIRED
+http_access allow localhost manager
+http_access deny !pf_users
+EOF
+
+    # One tag ACL per modem, pinned to its address and, through a source
+    # routing rule, to its interface
+    for i in "${!WWAN_IPS[@]}"; do
+        IFACE="${WWAN_IFACES[$i]}"
+        TABLE=$((100 + ${IFACE#wwan}))
+        echo "acl pf_$IFACE tag $IFACE" >> "$SQUID_CONF"
+        echo "tcp_outgoing_address ${WWAN_IPS[$i]} pf_$IFACE" >> "$SQUID_CONF"
+        while ip rule del table "$TABLE" 2>/dev/null; do :; done
+        ip rule add from "${WWAN_IPS[$i]}" table "$TABLE"
+        ip route replace default dev "$IFACE" table "$TABLE"
+    done
+fi
+
+# Client marks for ProxyFarm's uplink shaping; empty until it writes them
+[ -f "$SHAPING_CONF" ] || echo "# Written by ProxyFarm" > "$SHAPING_CONF"
+printf '\n# Traffic shaping classes\ninclude %s\n' "$SHAPING_CONF" >> "$SQUID_CONF"
+
 cat >> "$SQUID_CONF" <<'EOF'
 
 # Access rules
@@ -118,7 +164,10 @@ via off
 
 # Cache and logs
 cache_dir ufs /var/spool/squid 100 16 256
-access_log /var/log/squid/access.log squid
+# Native squid format plus the local (outgoing) address, which ProxyFarm
+# uses to attribute traffic to modems
+logformat proxyfarm %ts.%03tu %6tr %>a %Ss/%03>Hs %<st %rm %ru %[un %Sh/%<a %mt %<la
+access_log /var/log/squid/access.log proxyfarm
 cache_log /var/log/squid/cache.log
 cache_store_log none
 
@@ -133,8 +182,12 @@ refresh_pattern ^gopher:        1440    0%      1440
 refresh_pattern -i (/cgi-bin/|\?) 0     0%      0
 refresh_pattern .               0       20%     4320
 
-# Fast DNS with Google DNS
-dns_nameservers 8.8.8.8 8.8.4.4
+EOF
+
+# DNS via ProxyFarm's per-modem caching resolver (carrier DNS over LTE)
+echo "dns_nameservers $DNS_NAMESERVERS" >> "$SQUID_CONF"
+
+cat >> "$SQUID_CONF" <<'EOF'
 positive_dns_ttl 6 hours
 negative_dns_ttl 1 minute
 fqdncache_size 2048
@@ -0,0 +1,246 @@
+"""Admission control for expensive endpoints.
+
+Each limited endpoint gets a concurrency slot, optionally refined by
+per-modem and per-client slots. Requests that cannot be admitted wait in a
+bounded FIFO queue; when the queue is full or the wait times out the client
+gets ``429 Too Many Requests`` with a ``Retry-After`` header.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, Optional
+
+from fastapi import Depends, HTTPException, Request, status
+
+from .auth import verify_api_key
+from .config import LimitConfig, get_config
+
+logger = logging.getLogger(__name__)
+
+
+class _Slot:
+    """Counting semaphore with a bounded FIFO wait queue."""
+
+    def __init__(self, limit: int, queue_size: int):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def idle(self) -> bool:
+        return self.active == 0 and not self._waiters
+
+    async def acquire(self, timeout: float) -> Optional[str]:
+        """Acquire the slot, returning a rejection reason on failure."""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return None
+
+        if len(self._waiters) >= self.queue_size or timeout <= 0:
+            return "queue_full"
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            done, _ = await asyncio.wait({fut}, timeout=timeout)
+        except asyncio.CancelledError:
+            self._abandon(fut)
+            raise
+
+        if not done:
+            self._abandon(fut)
+            return "timeout"
+        return None
+
+    def _abandon(self, fut: asyncio.Future) -> None:
+        """Drop a waiter, giving back the slot if it was already handed over."""
+        if fut.done() and not fut.cancelled():
+            self.release()
+            return
+        fut.cancel()
+        try:
+            self._waiters.remove(fut)
+        except ValueError:
+            pass
+
+    def release(self) -> None:
+        """Release the slot, handing it directly to the next waiter."""
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+
+class _EndpointStats:
+    def __init__(self):
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds = 0.0
+
+
+class Ticket:
+    """Handle for an admitted request; release it when the request is done."""
+
+    def __init__(self, controller: "AdmissionController", keys: list[tuple]):
+        self._controller = controller
+        self._keys = keys
+
+    def release(self) -> None:
+        keys, self._keys = self._keys, []
+        for key in reversed(keys):
+            self._controller._release(key)
+
+
+class AdmissionController:
+    """Per-endpoint, per-modem and per-client concurrency limits."""
+
+    def __init__(self):
+        self._slots: dict[tuple, _Slot] = {}
+        self._stats: dict[str, _EndpointStats] = {}
+
+    def _limit(self, endpoint: str) -> Optional[LimitConfig]:
+        config = get_config()
+        if not config.admission.enabled:
+            return None
+        return config.admission.limits.get(endpoint)
+
+    def _slot(self, key: tuple, limit: int, queue_size: int) -> _Slot:
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _Slot(limit, queue_size)
+        else:
+            # Pick up limit changes without dropping in-flight counters
+            slot.limit = limit
+            slot.queue_size = queue_size
+        return slot
+
+    def _release(self, key: tuple) -> None:
+        slot = self._slots.get(key)
+        if slot is None:
+            return
+        slot.release()
+        # Per-modem and per-client slots are created on demand; drop them
+        # once idle so the table doesn't grow with every client address.
+        if len(key) > 1 and slot.idle:
+            del self._slots[key]
+
+    async def acquire(
+        self,
+        endpoint: str,
+        modem_id: Optional[int] = None,
+        client: Optional[str] = None,
+    ) -> Ticket:
+        """Admit a request or raise HTTP 429."""
+        limit = self._limit(endpoint)
+        if limit is None:
+            return Ticket(self, [])
+
+        stats = self._stats.setdefault(endpoint, _EndpointStats())
+
+        # Narrowest scope first, so a client queued behind its own requests
+        # doesn't hold a global slot while it waits.
+        wanted: list[tuple[tuple, int]] = []
+        if limit.per_client is not None and client is not None:
+            wanted.append(((endpoint, "client", client), limit.per_client))
+        if limit.per_modem is not None and modem_id is not None:
+            wanted.append(((endpoint, "modem", modem_id), limit.per_modem))
+        wanted.append(((endpoint,), limit.max_concurrent))
+
+        started = time.monotonic()
+        deadline = started + limit.queue_timeout
+        acquired: list[tuple] = []
+        for key, max_concurrent in wanted:
+            slot = self._slot(key, max_concurrent, limit.queue_size)
+            reason = await slot.acquire(deadline - time.monotonic())
+            if reason is not None:
+                Ticket(self, acquired).release()
+                if reason == "timeout":
+                    stats.timed_out += 1
+                stats.rejected += 1
+                logger.warning(
+                    f"Rejected {endpoint} request (client={client}, "
+                    f"modem={modem_id}): {reason} on {'/'.join(map(str, key))}"
+                )
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail=f"Too many concurrent {endpoint} requests",
+                    headers={"Retry-After": str(limit.retry_after)},
+                )
+            acquired.append(key)
+
+        stats.admitted += 1
+        stats.wait_seconds += time.monotonic() - started
+        return Ticket(self, acquired)
+
+    def stats(self) -> dict:
+        """Snapshot of slot occupancy and rejection counters."""
+        config = get_config()
+        result = {}
+        for endpoint, limit in config.admission.limits.items():
+            stats = self._stats.get(endpoint, _EndpointStats())
+            slot = self._slots.get((endpoint,))
+            scoped = [
+                {
+                    "scope": key[1],
+                    "key": str(key[2]),
+                    "active": s.active,
+                    "waiting": s.waiting,
+                }
+                for key, s in self._slots.items()
+                if key[0] == endpoint and len(key) > 1
+            ]
+            result[endpoint] = {
+                "limit": limit.max_concurrent,
+                "queue_size": limit.queue_size,
+                "active": slot.active if slot else 0,
+                "waiting": (slot.waiting if slot else 0)
+                + sum(e["waiting"] for e in scoped),
+                "admitted": stats.admitted,
+                "rejected": stats.rejected,
+                "timed_out": stats.timed_out,
+                "avg_wait_seconds": (
+                    stats.wait_seconds / stats.admitted if stats.admitted else 0.0
+                ),
+                "scoped": scoped,
+            }
+        return result
+
+
+# Global instance
+admission_controller = AdmissionController()
+
+
+def admission(endpoint: str) -> Callable[..., AsyncIterator[None]]:
+    """Build a FastAPI dependency enforcing the limits for ``endpoint``.
+
+    Authentication runs first, so unauthenticated requests never hold a slot.
+    """
+
+    async def dependency(
+        request: Request, _: str = Depends(verify_api_key)
+    ) -> AsyncIterator[None]:
+        modem_id = request.path_params.get("modem_id")
+        try:
+            modem_id = int(modem_id) if modem_id is not None else None
+        except ValueError:
+            # Path validation rejects the request with 422; don't take a slot
+            yield
+            return
+        client = request.client.host if request.client else None
+        ticket = await admission_controller.acquire(endpoint, modem_id=modem_id, client=client)
+        try:
+            yield
+        finally:
+            ticket.release()
+
+    return dependency
@@ -0,0 +1,85 @@
+"""Aggregator API endpoints for multi-node deployments."""
+
+from fastapi import APIRouter, Depends, HTTPException, status
+
+from ..auth import verify_api_key
+from ..core.cluster import NodeError, cluster_manager
+from ..schemas import (
+    ClusterInventoryResponse,
+    ClusterNodeStatus,
+    ErrorResponse,
+    RotationResult,
+    USSDRequest,
+    USSDResponse,
+)
+
+router = APIRouter(prefix="/cluster", tags=["cluster"])
+
+
+async def require_aggregator(_: str = Depends(verify_api_key)) -> None:
+    """Reject cluster calls when aggregator mode is off."""
+    if not cluster_manager.enabled:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Aggregator mode is disabled",
+        )
+
+
+def _node_error(e: NodeError) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+
+
+@router.get(
+    "/nodes",
+    response_model=list[ClusterNodeStatus],
+    dependencies=[Depends(require_aggregator)],
+)
+async def list_nodes(refresh: bool = False) -> list[ClusterNodeStatus]:
+    """Get reachability of every node in the cluster."""
+    return await cluster_manager.nodes(refresh=refresh)
+
+
+@router.get(
+    "/modems",
+    response_model=ClusterInventoryResponse,
+    dependencies=[Depends(require_aggregator)],
+)
+async def list_cluster_modems(refresh: bool = False) -> ClusterInventoryResponse:
+    """Get the merged modem inventory of all nodes."""
+    modems = await cluster_manager.inventory(refresh=refresh)
+    nodes = await cluster_manager.nodes()
+    return ClusterInventoryResponse(modems=modems, count=len(modems), nodes=nodes)
+
+
+@router.post(
+    "/modems/{global_id}/rotate",
+    response_model=RotationResult,
+    responses={404: {"model": ErrorResponse}, 502: {"model": ErrorResponse}},
+    dependencies=[Depends(require_aggregator)],
+)
+async def rotate_cluster_modem(global_id: str) -> RotationResult:
+    """Rotate IP of a modem addressed as ``<node>:<modem_id>``."""
+    try:
+        return await cluster_manager.rotate(global_id)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except NodeError as e:
+        raise _node_error(e)
+
+
+@router.post(
+    "/modems/{global_id}/ussd",
+    response_model=USSDResponse,
+    responses={404: {"model": ErrorResponse}, 502: {"model": ErrorResponse}},
+    dependencies=[Depends(require_aggregator)],
+)
+async def send_cluster_ussd(global_id: str, request: USSDRequest) -> USSDResponse:
+    """Send USSD to a modem addressed as ``<node>:<modem_id>``."""
+    try:
+        return await cluster_manager.send_ussd(
+            global_id, request.command, request.use_cache
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except NodeError as e:
+        raise _node_error(e)
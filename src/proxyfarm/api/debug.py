@@ -0,0 +1,67 @@
+"""Instrumentation endpoints, guarded by the admin key."""
+
+from typing import Literal
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.responses import PlainTextResponse
+
+from ..auth import verify_admin_key
+from ..config import get_config
+from ..diagnostics import collapsed, flamegraph, list_tasks, loop_monitor, sampling_profiler
+from ..schemas import ErrorResponse, LoopReport, ProfileReport, TaskInfo
+
+router = APIRouter(
+    prefix="/debug", tags=["debug"], dependencies=[Depends(verify_admin_key)]
+)
+
+
+@router.get("/loop", response_model=LoopReport)
+async def get_loop_health(
+    recent: int = Query(10, ge=0, le=100, description="Recent stalls to include"),
+) -> LoopReport:
+    """Get event loop lag percentiles and the latest stalls with their stacks."""
+    return loop_monitor.report(recent)
+
+
+@router.get("/tasks", response_model=list[TaskInfo])
+async def get_tasks() -> list[TaskInfo]:
+    """List every asyncio task with what it is awaiting and where."""
+    return list_tasks()
+
+
+@router.post(
+    "/profile",
+    response_model=ProfileReport,
+    responses={
+        200: {"content": {"text/plain": {}, "image/svg+xml": {}}},
+        409: {"model": ErrorResponse},
+        422: {"model": ErrorResponse},
+    },
+)
+async def run_profile(
+    seconds: float = Query(10.0, gt=0, description="Sampling window"),
+    interval: float = Query(0.005, ge=0.001, le=1.0, description="Seconds between samples"),
+    format: Literal["collapsed", "svg", "json"] = Query("collapsed"),
+    threads: Literal["loop", "all"] = Query("loop", description="Event loop thread or all"),
+):
+    """
+    Sample stacks for a time window and return them as collapsed stacks (for
+    flamegraph.pl or speedscope), an SVG flamegraph or JSON. The loop keeps
+    serving while the profiler samples from its own thread.
+    """
+    limit = get_config().diagnostics.max_profile_seconds
+    if seconds > limit:
+        raise HTTPException(
+            status_code=422, detail=f"seconds must not exceed {limit:g} (diagnostics)"
+        )
+    try:
+        report = await sampling_profiler.profile(seconds, interval, threads == "all")
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    if format == "collapsed":
+        return PlainTextResponse(collapsed(report.stacks))
+    if format == "svg":
+        title = f"ProxyFarm, {threads} thread(s), {report.duration_seconds:.1f}s"
+        return Response(content=flamegraph(report.stacks, title), media_type="image/svg+xml")
+    return report
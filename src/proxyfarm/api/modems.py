@@ -1,34 +1,153 @@
 """Modem API endpoints."""
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from datetime import datetime, timezone
+from typing import Optional
 
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+
+from ..admission import admission
 from ..auth import verify_api_key
+from ..core.conntrack import conntrack_tracker
 from ..core.modem import modem_manager
+from ..core.quota import quota_tracker
+from ..core.radio import radio_optimizer
+from ..core.recovery import recovery_manager
 from ..core.rotation import ip_rotator
-from ..schemas import ErrorResponse, Modem, ModemListResponse, RotationResult
+from ..core.speedtest import speed_tester
+from ..core.state import modem_json, modem_list_json
+from ..core.store import state_store
+from ..schemas import (
+    EgressFlows,
+    ErrorResponse,
+    Modem,
+    ModemListResponse,
+    ProbeRecord,
+    QuotaStatus,
+    RadioOptimization,
+    RadioStatus,
+    RecoveryReport,
+    RotationRecord,
+    RotationResult,
+    SpeedtestResult,
+)
+from ..services.monitor import monitor_service
 
 router = APIRouter(prefix="/modems", tags=["modems"])
 
 
+def _epoch(value: Optional[datetime]) -> Optional[float]:
+    """Convert a query datetime to epoch seconds, treating naive values as UTC."""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _split(value: Optional[str]) -> list[str]:
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+
+def _parse_fields(value: Optional[str]) -> Optional[set[str]]:
+    if value is None:
+        return None
+    fields = set(_split(value))
+    unknown = fields - set(Modem.model_fields)
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unknown modem fields: {', '.join(sorted(unknown))}",
+        )
+    return fields
+
+
+def _parse_ids(value: Optional[str]) -> Optional[list[int]]:
+    if value is None:
+        return None
+    try:
+        return [int(item) for item in _split(value)]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="ids must be a comma-separated list of modem IDs",
+        )
+
+
+def _json(content: bytes) -> Response:
+    return Response(content=content, media_type="application/json")
+
+
+def _not_quarantined(modem_id: int) -> None:
+    """Keep commands away from a modem whose circuit breaker is open."""
+    if modem_id in recovery_manager.quarantined():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Modem {modem_id} is quarantined by recovery, see /modems/recovery",
+        )
+
+
 @router.get(
     "",
     response_model=ModemListResponse,
-    responses={500: {"model": ErrorResponse}},
+    responses={422: {"model": ErrorResponse}, 500: {"model": ErrorResponse}},
 )
-async def list_modems(_: str = Depends(verify_api_key)) -> ModemListResponse:
-    """Get list of all modems."""
-    modems = await modem_manager.list_modems()
-    return ModemListResponse(modems=modems, count=len(modems))
+async def list_modems(
+    fields: Optional[str] = Query(
+        None, description="Comma-separated fields to return (id is always included)"
+    ),
+    ids: Optional[str] = Query(None, description="Comma-separated modem IDs"),
+    lite: bool = Query(
+        False, description="Serve the monitor's last known state without querying modems"
+    ),
+    _: str = Depends(verify_api_key),
+) -> Response:
+    """Get list of all modems.
+
+    Only what ``fields`` asks for is looked up: the bearer query is skipped
+    unless ``bearer``, ``interface`` or ``ip_address`` is requested, and
+    ``ids`` skips listing modems. ``lite`` runs no commands at all.
+    Quarantined modems (see ``/modems/recovery``) are left out.
+    """
+    field_set = _parse_fields(fields)
+    modem_ids = _parse_ids(ids)
+    quarantined = recovery_manager.quarantined()
+
+    if lite:
+        modems = [
+            modem
+            for modem_id, modem in sorted(monitor_service.inventory.items())
+            if (modem_ids is None or modem_id in modem_ids) and modem_id not in quarantined
+        ]
+    else:
+        if modem_ids is None:
+            modem_ids = await modem_manager.list_modem_ids()
+        modems = await modem_manager.get_modems(
+            [modem_id for modem_id in modem_ids if modem_id not in quarantined], field_set
+        )
+    return _json(modem_list_json(modems, field_set))
+
+
+@router.get("/quota", response_model=list[QuotaStatus])
+async def get_quota_usage(_: str = Depends(verify_api_key)) -> list[QuotaStatus]:
+    """Get data usage in the current billing period for every modem."""
+    return quota_tracker.status()
+
+
+@router.get("/recovery", response_model=RecoveryReport)
+async def get_recovery_status(_: str = Depends(verify_api_key)) -> RecoveryReport:
+    """Get recovery state and circuit breakers per modem, and MTTR per action."""
+    return recovery_manager.status()
 
 
 @router.get(
     "/{modem_id}",
     response_model=Modem,
-    responses={404: {"model": ErrorResponse}},
+    responses={404: {"model": ErrorResponse}, 503: {"model": ErrorResponse}},
+    dependencies=[Depends(_not_quarantined)],
 )
 async def get_modem(
     modem_id: int, _: str = Depends(verify_api_key)
-) -> Modem:
+) -> Response:
     """Get detailed information about a specific modem."""
     modem = await modem_manager.get_modem(modem_id)
     if not modem:
@@ -36,18 +155,26 @@ async def get_modem(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Modem {modem_id} not found",
         )
-    return modem
+    return _json(modem_json(modem))
 
 
 @router.post(
     "/{modem_id}/rotate",
     response_model=RotationResult,
-    responses={404: {"model": ErrorResponse}},
+    responses={
+        404: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
+        503: {"model": ErrorResponse},
+    },
+    dependencies=[Depends(_not_quarantined), Depends(admission("rotate"))],
 )
 async def rotate_ip(
     modem_id: int, _: str = Depends(verify_api_key)
 ) -> RotationResult:
-    """Rotate IP address for a modem by reconnecting."""
+    """
+    Rotate IP address for a modem by reconnecting. Waits for a recovery
+    action already running on the modem to finish first.
+    """
     # Verify modem exists
     modem = await modem_manager.get_modem(modem_id)
     if not modem:
@@ -62,7 +189,8 @@ async def rotate_ip(
 @router.post(
     "/{modem_id}/enable",
     response_model=dict,
-    responses={404: {"model": ErrorResponse}},
+    responses={404: {"model": ErrorResponse}, 503: {"model": ErrorResponse}},
+    dependencies=[Depends(_not_quarantined)],
 )
 async def enable_modem(
     modem_id: int, _: str = Depends(verify_api_key)
@@ -80,7 +208,8 @@ async def enable_modem(
 @router.post(
     "/{modem_id}/disable",
     response_model=dict,
-    responses={404: {"model": ErrorResponse}},
+    responses={404: {"model": ErrorResponse}, 503: {"model": ErrorResponse}},
+    dependencies=[Depends(_not_quarantined)],
 )
 async def disable_modem(
     modem_id: int, _: str = Depends(verify_api_key)
@@ -93,3 +222,159 @@ async def disable_modem(
             detail=f"Failed to disable modem {modem_id}",
         )
     return {"success": True, "modem_id": modem_id}
+
+
+@router.post(
+    "/{modem_id}/speedtest",
+    response_model=SpeedtestResult,
+    responses={
+        404: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
+        503: {"model": ErrorResponse},
+    },
+    dependencies=[Depends(_not_quarantined), Depends(admission("speedtest"))],
+)
+async def run_speedtest(
+    modem_id: int, _: str = Depends(verify_api_key)
+) -> SpeedtestResult:
+    """Measure download/upload throughput, latency and jitter through a modem.
+
+    Tests run one at a time across the farm; this waits for any test in
+    progress. A failed test is returned (and kept) with ``success=false``.
+    """
+    modem = await modem_manager.get_modem(modem_id)
+    if not modem:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Modem {modem_id} not found",
+        )
+    return await speed_tester.run(modem)
+
+
+@router.get("/{modem_id}/speedtests", response_model=list[SpeedtestResult])
+async def get_speedtest_history(
+    modem_id: int,
+    limit: int = Query(100, ge=1, le=1000),
+    _: str = Depends(verify_api_key),
+) -> list[SpeedtestResult]:
+    """Get speed test results for a modem, newest first."""
+    return speed_tester.history(modem_id, limit)
+
+
+@router.get(
+    "/{modem_id}/flows",
+    response_model=EgressFlows,
+    responses={404: {"model": ErrorResponse}},
+)
+async def get_modem_flows(modem_id: int, _: str = Depends(verify_api_key)) -> EgressFlows:
+    """Get the connections a modem carries and its current byte rates."""
+    flows = conntrack_tracker.modem_flows(modem_id)
+    if flows is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No flow counters for modem {modem_id}",
+        )
+    return flows
+
+
+@router.get(
+    "/{modem_id}/radio",
+    response_model=RadioStatus,
+    responses={404: {"model": ErrorResponse}, 503: {"model": ErrorResponse}},
+    dependencies=[Depends(_not_quarantined)],
+)
+async def get_radio_status(modem_id: int, _: str = Depends(verify_api_key)) -> RadioStatus:
+    """Get a modem's radio modes and bands, the best settings found for its
+    location and the last tuning run."""
+    modem = await modem_manager.get_modem(modem_id, fields=set())
+    if not modem:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Modem {modem_id} not found",
+        )
+    info = await modem_manager.get_radio(modem_id)
+    return RadioStatus(
+        info=info,
+        profile=radio_optimizer.profile(modem, info.location) if info else None,
+        last_optimization=radio_optimizer.last_run(modem_id),
+    )
+
+
+@router.post(
+    "/{modem_id}/radio/optimize",
+    response_model=RadioOptimization,
+    responses={
+        404: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
+        503: {"model": ErrorResponse},
+    },
+    dependencies=[Depends(_not_quarantined), Depends(admission("radio"))],
+)
+async def optimize_radio(
+    modem_id: int,
+    wait: bool = Query(False, description="Block until the run finishes"),
+    _: str = Depends(verify_api_key),
+) -> RadioOptimization:
+    """Try the modem's supported modes and bands and keep the fastest.
+
+    The modem drops its connection for every trial. Until the run ends it
+    gets no new proxy logins or SOCKS sessions and is left out of the
+    default route; connections already open through it are cut by the
+    trials. This ignores the low-traffic window. If a run is already queued
+    or running on the modem, that run is returned.
+    """
+    modem = await modem_manager.get_modem(modem_id, fields=set())
+    if not modem:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Modem {modem_id} not found",
+        )
+    run, _started = radio_optimizer.start(modem_id)
+    if wait:
+        run = await radio_optimizer.wait(modem_id)
+    return run
+
+
+@router.get("/{modem_id}/rotations", response_model=list[RotationRecord])
+async def get_rotation_history(
+    modem_id: int,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    _: str = Depends(verify_api_key),
+) -> list[RotationRecord]:
+    """Get rotation history for a modem, newest first."""
+    return await state_store.rotation_history(
+        modem_id, _epoch(since), _epoch(until), limit
+    )
+
+
+@router.get("/{modem_id}/probes", response_model=list[ProbeRecord])
+async def get_probe_history(
+    modem_id: int,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    _: str = Depends(verify_api_key),
+) -> list[ProbeRecord]:
+    """Get connectivity probe history for a modem, newest first."""
+    return await state_store.probe_history(
+        modem_id, _epoch(since), _epoch(until), limit
+    )
+
+
+@router.post(
+    "/{modem_id}/recovery/reset",
+    response_model=dict,
+    responses={404: {"model": ErrorResponse}},
+)
+async def reset_recovery(
+    modem_id: int, _: str = Depends(verify_api_key)
+) -> dict:
+    """Close a modem's circuit breaker and restart its recovery ladder."""
+    if not recovery_manager.reset(modem_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No recovery state for modem {modem_id}",
+        )
+    return {"success": True, "modem_id": modem_id}
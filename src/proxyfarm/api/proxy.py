@@ -1,12 +1,30 @@
 """Proxy (Squid) management endpoints."""
 
+import ipaddress
 import logging
+from datetime import datetime
 from typing import Dict
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 
 from ..auth import verify_api_key
+from ..core.proxyauth import proxy_auth
+from ..core.shaping import traffic_shaper
 from ..core.squid import squid_manager
+from ..schemas import (
+    ClientLimit,
+    ClientLimitRequest,
+    ErrorResponse,
+    ModemTagsRequest,
+    ProxyGroup,
+    ProxyUser,
+    ProxyUserRequest,
+    ShapingStatus,
+    UsageEntry,
+    UsageReport,
+)
+from ..services.monitor import monitor_service
+from ..services.usage import counters_to_entry, usage_tracker
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +34,8 @@ router = APIRouter(prefix="/proxy", tags=["proxy"])
 @router.get("/status", response_model=Dict)
 async def get_proxy_status(_: str = Depends(verify_api_key)):
     """
-    Get Squid proxy status including service state and configured outgoing IPs.
+    Get Squid proxy status including service state, configured outgoing IPs
+    and live runtime statistics from the cache manager (cached briefly).
     """
     status = await squid_manager.get_status()
     return status
@@ -44,3 +63,154 @@ async def reconfigure_proxy(_: str = Depends(verify_api_key)):
             "message": "Squid reconfiguration failed",
             "error": "Check logs for details",
         }
+
+
+@router.get("/usage", response_model=UsageReport)
+async def get_proxy_usage(
+    top: int = Query(50, ge=1, le=1000),
+    _: str = Depends(verify_api_key),
+) -> UsageReport:
+    """
+    Get traffic per client, destination domain and outgoing address (modem),
+    aggregated from the Squid access log.
+    """
+    modem_by_ip = {
+        modem.ip_address: modem.id
+        for modem in monitor_service.inventory.values()
+        if modem.ip_address
+    }
+
+    def entries(counters, with_modem: bool = False) -> list[UsageEntry]:
+        result = []
+        for key, values in counters.top(top):
+            entry = UsageEntry(**counters_to_entry(key, values))
+            if with_modem:
+                entry.modem_id = modem_by_ip.get(key)
+            result.append(entry)
+        return result
+
+    return UsageReport(
+        since=datetime.utcfromtimestamp(usage_tracker.started_at),
+        lines=usage_tracker.lines,
+        parse_errors=usage_tracker.errors,
+        clients=entries(usage_tracker.clients),
+        domains=entries(usage_tracker.domains),
+        outgoing=entries(usage_tracker.outgoing, with_modem=True),
+    )
+
+
+def _check_names(names: list[str]) -> None:
+    invalid = [name for name in names if not proxy_auth.valid_name(name)]
+    if invalid:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Invalid names: {', '.join(invalid)} (letters, digits, _.@- only)",
+        )
+
+
+@router.get("/users", response_model=list[ProxyUser])
+async def list_proxy_users(_: str = Depends(verify_api_key)) -> list[ProxyUser]:
+    """Get proxy users, their groups and the modem each is sent through."""
+    return proxy_auth.users()
+
+
+@router.put(
+    "/users/{name}",
+    response_model=ProxyUser,
+    responses={422: {"model": ErrorResponse}},
+)
+async def set_proxy_user(
+    name: str, request: ProxyUserRequest, _: str = Depends(verify_api_key)
+) -> ProxyUser:
+    """
+    Create or update a proxy user. Takes effect in Squid's auth helpers
+    immediately, without a reconfigure.
+    """
+    _check_names([name, *request.groups])
+    try:
+        return await proxy_auth.set_user(name, request.password, request.groups, request.enabled)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@router.delete(
+    "/users/{name}",
+    response_model=dict,
+    responses={404: {"model": ErrorResponse}},
+)
+async def delete_proxy_user(name: str, _: str = Depends(verify_api_key)) -> dict:
+    """Delete a proxy user."""
+    if not proxy_auth.delete_user(name):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Proxy user {name} not found",
+        )
+    return {"success": True, "name": name}
+
+
+@router.get("/groups", response_model=list[ProxyGroup])
+async def list_proxy_groups(_: str = Depends(verify_api_key)) -> list[ProxyGroup]:
+    """Get modem groups with their modems and users."""
+    return proxy_auth.groups()
+
+
+@router.put(
+    "/modems/{modem_id}/tags",
+    response_model=dict,
+    responses={422: {"model": ErrorResponse}},
+)
+async def set_modem_tags(
+    modem_id: int, request: ModemTagsRequest, _: str = Depends(verify_api_key)
+) -> dict:
+    """Set the tags of a modem; each tag names a group the modem serves."""
+    _check_names(request.tags)
+    return {"modem_id": modem_id, "tags": proxy_auth.set_tags(modem_id, request.tags)}
+
+
+@router.get("/shaping", response_model=ShapingStatus)
+async def get_shaping_status(_: str = Depends(verify_api_key)) -> ShapingStatus:
+    """Get the uplink rate and client classes set up on each modem, and the
+    client limits."""
+    return traffic_shaper.status()
+
+
+def _check_client(client: str) -> None:
+    if not proxy_auth.valid_name(client):
+        try:
+            ipaddress.ip_network(client, strict=False)
+        except ValueError:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Invalid client {client!r}: a proxy user name or an address/network",
+            )
+
+
+@router.put(
+    "/limits/{client:path}",
+    response_model=ClientLimit,
+    responses={422: {"model": ErrorResponse}},
+)
+async def set_client_limit(
+    client: str, request: ClientLimitRequest, _: str = Depends(verify_api_key)
+) -> ClientLimit:
+    """
+    Give a client (proxy user, or client address/network) its own shaping
+    class, with an upload cap if given. Applied to every modem right away.
+    """
+    _check_client(client)
+    return await traffic_shaper.set_limit(client, request.upload_kbit)
+
+
+@router.delete(
+    "/limits/{client:path}",
+    response_model=dict,
+    responses={404: {"model": ErrorResponse}},
+)
+async def delete_client_limit(client: str, _: str = Depends(verify_api_key)) -> dict:
+    """Remove a client's limit."""
+    if not await traffic_shaper.delete_limit(client):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No limit for client {client}",
+        )
+    return {"success": True, "client": client}
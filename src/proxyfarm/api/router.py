@@ -2,6 +2,8 @@
 
 from fastapi import APIRouter
 
+from .cluster import router as cluster_router
+from .debug import router as debug_router
 from .modems import router as modems_router
 from .proxy import router as proxy_router
 from .system import health_router, router as system_router
@@ -13,6 +15,8 @@ api_router.include_router(modems_router)
 api_router.include_router(ussd_router)
 api_router.include_router(system_router)
 api_router.include_router(proxy_router)
+api_router.include_router(cluster_router)
+api_router.include_router(debug_router)
 
 # Health check at root level (no version prefix, no auth)
 root_router = APIRouter()
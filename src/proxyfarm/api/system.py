@@ -4,19 +4,40 @@ import asyncio
 import time
 from datetime import datetime
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import JSONResponse
 
 from .. import __version__
+from ..admission import admission, admission_controller
 from ..auth import verify_api_key
 from ..config import get_config
+from ..core.bringup import modem_bringup
+from ..core.connector import hedged_connector
+from ..core.conntrack import conntrack_tracker
+from ..core.dns import dns_resolver
+from ..core.egress import egress_balancer
 from ..core.modem import modem_manager, run_command
+from ..core.socks import socks_server
 from ..schemas import (
+    AdmissionEndpointStats,
+    BringupJob,
+    ConnectorStats,
+    ConntrackStats,
+    DNSReport,
+    EgressWeight,
     ErrorResponse,
     HealthResponse,
     ModemState,
+    ReadinessResponse,
     ReinitializeResponse,
+    ReloadResult,
+    ReloadStatus,
+    SocksStats,
     SystemStatus,
 )
+from ..reload import ReloadError, config_reloader
+from ..services.monitor import monitor_service
+from ..startup import startup_tracker
 
 router = APIRouter(prefix="/system", tags=["system"])
 
@@ -43,10 +64,62 @@ async def get_system_status(_: str = Depends(verify_api_key)) -> SystemStatus:
 @router.post(
     "/reinitialize",
     response_model=ReinitializeResponse,
-    responses={500: {"model": ErrorResponse}},
+    responses={500: {"model": ErrorResponse}, 429: {"model": ErrorResponse}},
+    dependencies=[Depends(admission("reinitialize"))],
 )
-async def reinitialize_modems(_: str = Depends(verify_api_key)) -> ReinitializeResponse:
-    """Reinitialize all modems by running setup script."""
+async def reinitialize_modems(
+    wait: bool = Query(False, description="Block until the bring-up job finishes"),
+    _: str = Depends(verify_api_key),
+) -> ReinitializeResponse:
+    """
+    Bring up all modems: enable them, create or update their connections and
+    activate them in parallel. Returns a job to poll; if a job is already
+    running, that job is returned instead of starting another.
+    """
+    if not get_config().bringup.enabled:
+        return await _run_setup_script()
+
+    job, started = modem_bringup.start()
+    if wait:
+        job = await modem_bringup.wait(job.id)
+        return ReinitializeResponse(
+            success=job.status == "completed",
+            message=f"Bring-up {job.status}",
+            error=job.error,
+            job=job,
+        )
+
+    return ReinitializeResponse(
+        success=True,
+        message="Bring-up started" if started else "Bring-up already running",
+        job=job,
+    )
+
+
+@router.get("/reinitialize/jobs", response_model=list[BringupJob])
+async def list_bringup_jobs(_: str = Depends(verify_api_key)) -> list[BringupJob]:
+    """List the running and recent bring-up jobs, newest first."""
+    return modem_bringup.jobs()
+
+
+@router.get(
+    "/reinitialize/jobs/{job_id}",
+    response_model=BringupJob,
+    responses={404: {"model": ErrorResponse}},
+)
+async def get_bringup_job(job_id: str, _: str = Depends(verify_api_key)) -> BringupJob:
+    """Get progress of a bring-up job."""
+    job = modem_bringup.get_job(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job {job_id} not found",
+        )
+    return job
+
+
+async def _run_setup_script() -> ReinitializeResponse:
+    """Reinitialize all modems by running the legacy setup script."""
     config = get_config()
     script_path = config.scripts.setup_modems
 
@@ -82,6 +155,83 @@ async def reinitialize_modems(_: str = Depends(verify_api_key)) -> ReinitializeR
         )
 
 
+@router.get("/admission", response_model=dict[str, AdmissionEndpointStats])
+async def get_admission_stats(
+    _: str = Depends(verify_api_key),
+) -> dict[str, AdmissionEndpointStats]:
+    """Get concurrency, queue depth and rejection counters per limited endpoint."""
+    return admission_controller.stats()
+
+
+@router.get("/egress", response_model=list[EgressWeight])
+async def get_egress_weights(_: str = Depends(verify_api_key)) -> list[EgressWeight]:
+    """Get multipath route weights and the factors behind them per modem."""
+    modems = list(monitor_service.inventory.values())
+    weights = egress_balancer.weights(modems)
+    return [
+        EgressWeight(
+            modem_id=modem.id,
+            interface=modem.interface,
+            weight=weights.get(modem.id, 0),
+            factors=egress_balancer.factors(modem.id),
+        )
+        for modem in modems
+    ]
+
+
+@router.get("/dns", response_model=DNSReport)
+async def get_dns_stats(_: str = Depends(verify_api_key)) -> DNSReport:
+    """Get DNS cache hit rates and sizes per modem."""
+    return dns_resolver.stats()
+
+
+@router.post("/dns/flush", response_model=dict)
+async def flush_dns_cache(_: str = Depends(verify_api_key)) -> dict:
+    """Drop all cached DNS answers."""
+    return {"success": True, "removed": dns_resolver.flush()}
+
+
+@router.get("/connector", response_model=ConnectorStats)
+async def get_connector_stats(_: str = Depends(verify_api_key)) -> ConnectorStats:
+    """Get hedged connect counters, retry budget and connect latency per modem."""
+    return hedged_connector.stats()
+
+
+@router.get("/socks", response_model=SocksStats)
+async def get_socks_stats(_: str = Depends(verify_api_key)) -> SocksStats:
+    """Get SOCKS5 listener connection, byte and datagram counters."""
+    return socks_server.stats()
+
+
+@router.get("/conntrack", response_model=ConntrackStats)
+async def get_conntrack_stats(_: str = Depends(verify_api_key)) -> ConntrackStats:
+    """Get live flow counts and byte rates per egress interface."""
+    return conntrack_tracker.stats()
+
+
+@router.post(
+    "/reload",
+    response_model=ReloadResult,
+    responses={422: {"model": ErrorResponse}},
+)
+async def reload_config(_: str = Depends(verify_api_key)) -> ReloadResult:
+    """
+    Re-read the config file and apply it to the running services. An invalid
+    file is rejected and the running config kept; only components whose
+    settings changed are restarted or re-timed.
+    """
+    try:
+        return await config_reloader.reload("api")
+    except ReloadError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@router.get("/reload", response_model=ReloadStatus)
+async def get_reload_status(_: str = Depends(verify_api_key)) -> ReloadStatus:
+    """Get the watched config file, reload counters and the last result."""
+    return config_reloader.status()
+
+
 # Health check endpoint (no auth required)
 health_router = APIRouter(tags=["health"])
 
@@ -90,3 +240,19 @@ health_router = APIRouter(tags=["health"])
 async def health_check() -> HealthResponse:
     """Health check endpoint for monitoring."""
     return HealthResponse(status="healthy", timestamp=datetime.utcnow())
+
+
+@health_router.get(
+    "/ready",
+    response_model=ReadinessResponse,
+    responses={503: {"model": ReadinessResponse}},
+)
+async def readiness_check() -> ReadinessResponse:
+    """Readiness for load balancers: 503 until modems, routing and proxy are verified."""
+    report = await startup_tracker.check()
+    if not report.ready:
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content=report.model_dump(mode="json"),
+        )
+    return report
@@ -2,10 +2,17 @@
 
 from fastapi import APIRouter, Depends, HTTPException, status
 
+from ..admission import admission
 from ..auth import verify_api_key
 from ..core.modem import modem_manager
 from ..core.ussd import ussd_handler
-from ..schemas import ErrorResponse, USSDRequest, USSDResponse
+from ..schemas import (
+    ErrorResponse,
+    USSDBatchRequest,
+    USSDBatchResponse,
+    USSDRequest,
+    USSDResponse,
+)
 
 router = APIRouter(tags=["ussd"])
 
@@ -13,7 +20,8 @@ router = APIRouter(tags=["ussd"])
 @router.post(
     "/modems/{modem_id}/ussd",
     response_model=USSDResponse,
-    responses={404: {"model": ErrorResponse}},
+    responses={404: {"model": ErrorResponse}, 429: {"model": ErrorResponse}},
+    dependencies=[Depends(admission("ussd"))],
 )
 async def send_ussd(
     modem_id: int,
@@ -29,4 +37,30 @@ async def send_ussd(
             detail=f"Modem {modem_id} not found",
         )
 
-    return await ussd_handler.send(modem_id, request.command)
+    return await ussd_handler.send(modem_id, request.command, request.use_cache)
+
+
+@router.post(
+    "/ussd/batch",
+    response_model=USSDBatchResponse,
+    responses={429: {"model": ErrorResponse}},
+    dependencies=[Depends(admission("ussd_batch"))],
+)
+async def send_ussd_batch(
+    request: USSDBatchRequest,
+    _: str = Depends(verify_api_key),
+) -> USSDBatchResponse:
+    """Send the same USSD command to all (or the selected) modems in parallel."""
+    modem_ids = request.modem_ids
+    if modem_ids is None:
+        modem_ids = await modem_manager.list_modem_ids()
+
+    results = await ussd_handler.send_many(
+        modem_ids, request.command, request.use_cache
+    )
+    return USSDBatchResponse(
+        command=request.command,
+        results=results,
+        count=len(results),
+        succeeded=sum(1 for r in results if r.success),
+    )
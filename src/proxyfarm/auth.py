@@ -25,3 +25,28 @@ async def verify_api_key(api_key: str = Security(API_KEY_HEADER)) -> str:
         )
 
     return api_key
+
+
+async def verify_admin_key(api_key: str = Security(API_KEY_HEADER)) -> str:
+    """Verify the admin key guarding the instrumentation endpoints."""
+    admin_key = get_config().api.admin_key
+
+    if not admin_key:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Instrumentation is disabled (api.admin_key is not set)",
+        )
+
+    if not api_key:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Missing API key",
+        )
+
+    if api_key != admin_key:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin key required",
+        )
+
+    return api_key
@@ -1,7 +1,8 @@
 """Configuration management."""
 
+import os
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Union
 
 import yaml
 from pydantic import BaseModel, Field
@@ -11,6 +12,15 @@ class APIConfig(BaseModel):
     host: str = "0.0.0.0"
     port: int = 8080
     api_key: str = "change-me"
+    # Key for the /debug instrumentation endpoints; unset disables them
+    admin_key: Optional[str] = None
+    # With several workers one elected owner runs the background services
+    # and the others forward API calls to it (see proxyfarm.workers)
+    workers: int = 1
+    run_dir: str = "/run/proxyfarm"
+    failover_interval: float = 1.0
+    # Forwarded calls include rotations and USSD sessions
+    forward_timeout: float = 300.0
 
 
 class ModemsConfig(BaseModel):
@@ -26,23 +36,426 @@ class MonitorConfig(BaseModel):
     health_check_url: str = "http://ifconfig.me"
 
 
+def _default_recovery_actions() -> list[str]:
+    return ["reconnect", "bearer_reset", "modem_reset", "usb_reset"]
+
+
+class RecoveryConfig(BaseModel):
+    enabled: bool = True
+    # Escalation ladder, mildest first
+    actions: list[str] = Field(default_factory=_default_recovery_actions)
+    attempts_per_action: int = 2
+    # Delay before the next attempt doubles per attempt, up to backoff_max
+    backoff_base: float = 30.0
+    backoff_max: float = 600.0
+    # Once the ladder is exhausted the breaker opens; the modem is left alone
+    # until a probe after open_duration (doubling, up to open_max) succeeds.
+    open_duration: float = 900.0
+    open_max: float = 21600.0
+
+
 class ScriptsConfig(BaseModel):
     setup_modems: str = "/opt/proxyfarm/scripts/setup_modems.sh"
 
 
+class BringupConfig(BaseModel):
+    # When disabled, reinitialize runs scripts.setup_modems instead
+    enabled: bool = True
+    # Modems brought up at the same time
+    concurrency: int = 8
+    # Start a bring-up job when the service starts
+    on_startup: bool = False
+    enable_timeout: float = 60.0
+    connect_timeout: float = 90.0
+    # Finished jobs kept for GET /system/reinitialize/jobs
+    history: int = 10
+
+
+class USSDConfig(BaseModel):
+    timeout: float = 60.0
+    cache_ttl: int = 300
+    cacheable_commands: list[str] = Field(default_factory=lambda: ["*100#"])
+
+
+class LimitConfig(BaseModel):
+    max_concurrent: int = 1
+    per_modem: Optional[int] = None
+    per_client: Optional[int] = None
+    queue_size: int = 0
+    queue_timeout: float = 10.0
+    retry_after: int = 30
+
+
+def _default_limits() -> dict[str, LimitConfig]:
+    return {
+        "reinitialize": LimitConfig(max_concurrent=1, queue_size=0, retry_after=300),
+        "rotate": LimitConfig(
+            max_concurrent=4, per_modem=1, per_client=2,
+            queue_size=8, queue_timeout=60.0, retry_after=60,
+        ),
+        "ussd": LimitConfig(
+            max_concurrent=16, per_modem=4, per_client=4,
+            queue_size=16, queue_timeout=60.0, retry_after=60,
+        ),
+        "ussd_batch": LimitConfig(max_concurrent=2, queue_size=2, retry_after=60),
+        "speedtest": LimitConfig(
+            max_concurrent=1, per_modem=1, queue_size=4, queue_timeout=120.0, retry_after=60,
+        ),
+        "radio": LimitConfig(max_concurrent=2, per_modem=1, queue_size=0, retry_after=300),
+    }
+
+
+class AdmissionConfig(BaseModel):
+    enabled: bool = True
+    limits: dict[str, LimitConfig] = Field(default_factory=_default_limits)
+
+
+class SquidConfig(BaseModel):
+    host: str = "127.0.0.1"
+    port: int = 3128
+    conf_path: str = "/etc/squid/squid.conf"
+    mgr_timeout: float = 2.0
+    status_ttl: float = 2.0
+
+
+def _default_fallback_dns() -> list[str]:
+    return ["8.8.8.8", "8.8.4.4"]
+
+
+class DNSConfig(BaseModel):
+    enabled: bool = True
+    # Squid can only use port 53, so listen on a dedicated loopback address
+    listen_host: str = "127.0.1.53"
+    listen_port: int = 53
+    timeout: float = 2.0
+    # Cached answers per modem
+    max_entries: int = 10000
+    max_ttl: int = 86400
+    # Upper bound for caching NXDOMAIN/NODATA answers
+    negative_ttl: int = 300
+    # Refresh names hit this often once less than this fraction of TTL is left
+    prefetch_hits: int = 3
+    prefetch_fraction: float = 0.1
+    # Used through the default route when no modem has carrier DNS
+    fallback_servers: list[str] = Field(default_factory=_default_fallback_dns)
+
+
+class ConnectorConfig(BaseModel):
+    # Race a second modem when a connect is slow (never for sticky clients)
+    hedging: bool = True
+    connect_timeout: float = 10.0
+    # Hedge after this modem's recent connect-time percentile, within bounds;
+    # hedge_delay applies until a modem has min_samples connects
+    hedge_percentile: float = 90.0
+    hedge_delay: float = 0.5
+    min_hedge_delay: float = 0.05
+    max_hedge_delay: float = 2.0
+    latency_window: int = 200
+    min_samples: int = 20
+    # Attempts per connect, counting hedges and retries
+    max_attempts: int = 3
+    # Extra attempts may add at most budget_ratio of the connect rate,
+    # plus a burst of budget_burst
+    budget_ratio: float = 0.1
+    budget_burst: float = 10.0
+
+
+class SocksConfig(BaseModel):
+    # SOCKS5 listener (CONNECT and UDP ASSOCIATE) relaying through modems
+    enabled: bool = False
+    host: str = "0.0.0.0"
+    port: int = 1080
+    backlog: int = 4096
+    # Require a proxy user login (see proxy_auth); the user's group decides
+    # the modem. Without it, connects go through any usable modem, hedged.
+    auth: bool = True
+    handshake_timeout: float = 10.0
+    max_connections: int = 10000
+    # Relay buffer per direction of a stream; up to pool_buffers idle
+    # buffers are kept for reuse
+    buffer_size: int = 65536
+    pool_buffers: int = 512
+
+
+class ShapingConfig(BaseModel):
+    # Queueing on each modem's uplink (tc, needs CAP_NET_ADMIN): an HTB
+    # class per client under the link rate, each with a fair queue
+    enabled: bool = False
+    # Leaf qdisc per client class: fq_codel, cake or any other tc qdisc spec
+    qdisc: str = "fq_codel"
+    # Link rate: this share of the last measured upload, so the queue forms
+    # here and not in the modem's buffer; default_rate_kbit without a speed
+    # test (0 leaves the link unshaped, classes only split it)
+    rate_fraction: float = 0.85
+    default_rate_kbit: int = 0
+    min_rate_kbit: int = 256
+    # fw looks marks up in a hash; u32 (marks matched in turn) is for kernels
+    # built without cls_fw; none leaves only the SOCKS listener's sockets,
+    # which name their class in SO_PRIORITY, classified
+    classifier: str = "fw"
+    # Every proxy user gets a class (fair share), not only those with a cap
+    per_user_classes: bool = True
+    # Client classes are selected by fwmark mark_base + class number, set by
+    # Squid (tcp_outgoing_mark, written to squid_include) and the SOCKS listener
+    mark_base: int = 0x50000
+    squid_include: str = "/etc/squid/proxyfarm-shaping.conf"
+
+
+class ConntrackConfig(BaseModel):
+    # Live flow counts per modem from netfilter conntrack (needs CAP_NET_ADMIN)
+    enabled: bool = True
+    # Kernel receive buffer for the event socket; events lost when it fills
+    # up trigger a full re-read of the table
+    receive_buffer: int = 8 * 1024 * 1024
+    # Seconds between full re-reads as a safety net; 0 disables
+    resync_interval: float = 3600.0
+    # Flows that predate every conntrack listener never report their end, so
+    # while any found at start are still counted the table is re-read this
+    # often instead
+    stale_resync_interval: float = 60.0
+    # Byte rates from interface counters, sampled this often and smoothed
+    # with this factor (1 = no smoothing)
+    rate_interval: float = 1.0
+    rate_smoothing: float = 0.5
+
+
+class SpeedtestConfig(BaseModel):
+    # Download (GET) and upload (POST) targets; latency and jitter come from
+    # TCP connects to the download host
+    download_url: str = "https://speed.cloudflare.com/__down?bytes=25000000"
+    upload_url: str = "https://speed.cloudflare.com/__up"
+    # Each leg stops after duration seconds or its byte count
+    duration: float = 10.0
+    download_bytes: int = 25_000_000
+    upload_bytes: int = 10_000_000
+    latency_samples: int = 10
+    timeout: float = 10.0
+    # Results kept per modem
+    history: int = 50
+    # Scheduled tests from the monitor, one modem at a time; 0 disables
+    interval: float = 0.0
+    # Egress factor: median download of a modem's last `window` tests
+    # relative to the fastest modem's, floored at min_factor; results older
+    # than max_age no longer count
+    weighting: bool = True
+    window: int = 3
+    min_factor: float = 0.2
+    max_age: float = 86400.0
+
+
+class RadioConfig(BaseModel):
+    # Scheduled tuning from the monitor; POST /modems/{id}/radio/optimize
+    # works either way
+    enabled: bool = False
+    # Local hours [window_start, window_end) when tuning may run, wrapping
+    # past midnight; equal values mean any time
+    window_start: int = Field(3, ge=0, le=23)
+    window_end: int = Field(6, ge=0, le=23)
+    # ... and only while the modem moves less than this many bytes/s, as
+    # measured by quota sampling or else conntrack; unmeasured modems wait
+    max_traffic: float = 50_000.0
+    # Seconds between checks of a modem; the best settings found for a
+    # location are re-evaluated once older than reevaluate_after
+    check_interval: float = 3600.0
+    reevaluate_after: float = 7 * 86400.0
+    # Access technologies to try; supported mode combinations are tried if
+    # they only allow these
+    modes: list[str] = Field(default_factory=lambda: ["3g", "4g", "5g"])
+    # After the modes, lock the best one to single bands in turn; an empty
+    # list tries every supported band
+    band_locks: bool = True
+    bands: list[str] = Field(default_factory=list)
+    max_trials: int = 12
+    # Seconds to wait for connectivity after a change before rolling back
+    settle_timeout: float = 90.0
+    # Score: download Mbps, scaled down by latency above latency_target_ms
+    latency_target_ms: float = 100.0
+    # New settings must beat the current ones by this fraction
+    min_gain: float = 0.1
+
+
+class ProxyAuthConfig(BaseModel):
+    # Feed for the Squid auth helper (python -m proxyfarm.helper); the paths
+    # are the helper's --socket and --state defaults
+    enabled: bool = True
+    socket_path: str = "/run/proxyfarm/helper.sock"
+    state_path: str = "/run/proxyfarm/helper-state.json"
+    # Squid runs the helper as its cache_effective_user, which must be able
+    # to connect to the socket and read the state file: both get this group
+    # and mode (None keeps root's group)
+    socket_group: Optional[str] = "proxy"
+    file_mode: int = 0o660
+    hash_iterations: int = 100_000
+
+
+class DiagnosticsConfig(BaseModel):
+    # Event loop lag and stall detection, cheap enough to leave on: a timer
+    # ticks every lag_interval seconds and a watchdog thread captures the
+    # loop's stack when a tick is more than slow_callback seconds late
+    enabled: bool = True
+    lag_interval: float = 0.05
+    slow_callback: float = 0.1
+    # Seconds of lag samples kept for percentiles, and stalls kept
+    window: float = 60.0
+    keep_stalls: int = 50
+    max_profile_seconds: float = 60.0
+
+
+class ReloadConfig(BaseModel):
+    # Apply config file changes as soon as they are saved (inotify, or
+    # polling where inotify is unavailable); POST /system/reload always works
+    watch: bool = True
+    # Wait this long after the last change, so editors finish writing
+    debounce: float = 0.5
+    poll_interval: float = 5.0
+
+
+class StartupConfig(BaseModel):
+    # Connected, routable modems needed before /ready reports ready
+    min_modems: int = 1
+    # Also require Squid to accept connections (and SOCKS to listen, if enabled)
+    check_proxy: bool = True
+    proxy_timeout: float = 1.0
+    # Seconds a readiness verdict is reused, so probes don't hammer the proxy
+    cache_ttl: float = 2.0
+    # Start conntrack and usage accounting only once ready (or after the timeout)
+    defer_services: bool = True
+    defer_timeout: float = 120.0
+
+
+class StoreConfig(BaseModel):
+    enabled: bool = True
+    path: str = "/var/lib/proxyfarm/state.db"
+    flush_interval: float = 2.0
+    batch_size: int = 200
+    retention_days: int = 30
+
+
+class UsageConfig(BaseModel):
+    enabled: bool = True
+    access_log: str = "/var/log/squid/access.log"
+    poll_interval: float = 1.0
+    chunk_size: int = 1024 * 1024
+    max_keys: int = 1000
+    save_interval: float = 30.0
+    # Without a saved offset, count the existing log instead of only new lines
+    from_start: bool = False
+
+
+class QuotaLimit(BaseModel):
+    limit_gb: Optional[float] = None
+    billing_day: int = Field(1, ge=1, le=28)
+
+
+class QuotaConfig(BaseModel):
+    enabled: bool = True
+    sysfs_root: str = "/sys/class/net"
+    default: QuotaLimit = Field(default_factory=QuotaLimit)
+    # Per modem, by device ID (stays with the modem) or modem ID
+    modems: dict[Union[int, str], QuotaLimit] = Field(default_factory=dict)
+    # Egress weight starts dropping at soft_threshold of the quota and
+    # reaches zero at hard_threshold
+    soft_threshold: float = 0.8
+    hard_threshold: float = 0.98
+
+
+class EgressConfig(BaseModel):
+    # Rewrite the multipath default route with computed weights
+    enabled: bool = False
+    max_weight: int = 10
+
+
+class NodeConfig(BaseModel):
+    name: str
+    url: str
+    api_key: str = "change-me"
+    timeout: float = 5.0
+
+
+class ClusterConfig(BaseModel):
+    enabled: bool = False
+    nodes: list[NodeConfig] = Field(default_factory=list)
+    inventory_ttl: float = 10.0
+    max_connections: int = 10
+    # Rotation and USSD calls on a node can take a minute
+    action_timeout: float = 120.0
+
+
+def _default_sim_latency() -> dict[str, float]:
+    return {
+        "mmcli": 0.08,
+        "nmcli": 0.15,
+        "ip": 0.005,
+        "curl": 0.4,
+        "systemctl": 0.01,
+        "tc": 0.01,
+        "ussd": 3.0,
+        "connect": 1.5,
+        "speedtest": 3.0,
+        "radio": 5.0,
+        "enable": 2.0,
+        "script": 2.0,
+    }
+
+
+class SimulationConfig(BaseModel):
+    enabled: bool = False
+    modems: int = 2
+    seed: Optional[int] = None
+    # Seconds per command kind; actual latency varies by +/- jitter fraction
+    latency: dict[str, float] = Field(default_factory=_default_sim_latency)
+    jitter: float = 0.2
+    # Probability of a command failing, per command kind ("default" for all)
+    failure_rates: dict[str, float] = Field(default_factory=dict)
+    ip_pool: str = "100.64.0.0/16"
+    # Probability a reconnect hands back the previous IP
+    ip_reuse_probability: float = 0.0
+    disconnected: list[int] = Field(default_factory=list)
+    # Bands every modem supports, and ones with no cell in range
+    bands: list[str] = Field(default_factory=lambda: [
+        "utran-1", "utran-8", "eutran-1", "eutran-3", "eutran-7", "eutran-20",
+    ])
+    dead_bands: list[str] = Field(default_factory=list)
+
+
 class Config(BaseModel):
     api: APIConfig = Field(default_factory=APIConfig)
     modems: ModemsConfig = Field(default_factory=ModemsConfig)
     monitor: MonitorConfig = Field(default_factory=MonitorConfig)
+    recovery: RecoveryConfig = Field(default_factory=RecoveryConfig)
     scripts: ScriptsConfig = Field(default_factory=ScriptsConfig)
+    bringup: BringupConfig = Field(default_factory=BringupConfig)
+    admission: AdmissionConfig = Field(default_factory=AdmissionConfig)
+    ussd: USSDConfig = Field(default_factory=USSDConfig)
+    cluster: ClusterConfig = Field(default_factory=ClusterConfig)
+    startup: StartupConfig = Field(default_factory=StartupConfig)
+    reload: ReloadConfig = Field(default_factory=ReloadConfig)
+    diagnostics: DiagnosticsConfig = Field(default_factory=DiagnosticsConfig)
+    store: StoreConfig = Field(default_factory=StoreConfig)
+    squid: SquidConfig = Field(default_factory=SquidConfig)
+    proxy_auth: ProxyAuthConfig = Field(default_factory=ProxyAuthConfig)
+    socks: SocksConfig = Field(default_factory=SocksConfig)
+    dns: DNSConfig = Field(default_factory=DNSConfig)
+    connector: ConnectorConfig = Field(default_factory=ConnectorConfig)
+    conntrack: ConntrackConfig = Field(default_factory=ConntrackConfig)
+    shaping: ShapingConfig = Field(default_factory=ShapingConfig)
+    speedtest: SpeedtestConfig = Field(default_factory=SpeedtestConfig)
+    radio: RadioConfig = Field(default_factory=RadioConfig)
+    usage: UsageConfig = Field(default_factory=UsageConfig)
+    quota: QuotaConfig = Field(default_factory=QuotaConfig)
+    egress: EgressConfig = Field(default_factory=EgressConfig)
+    simulation: SimulationConfig = Field(default_factory=SimulationConfig)
 
 
 _config: Optional[Config] = None
+# File the current configuration came from (None: built-in defaults)
+_config_path: Optional[Path] = None
 
 
-def load_config(path: Optional[Path] = None) -> Config:
-    """Load configuration from YAML file."""
-    global _config
+def find_config(path: Optional[Path] = None) -> Optional[Path]:
+    """The config file to use: ``path``, $PROXYFARM_CONFIG or a default location."""
+    if path is None and os.environ.get("PROXYFARM_CONFIG"):
+        path = Path(os.environ["PROXYFARM_CONFIG"])
 
     if path is None:
         # Try default locations
@@ -56,16 +469,47 @@ def load_config(path: Optional[Path] = None) -> Config:
                 path = candidate
                 break
 
-    if path and path.exists():
-        with open(path) as f:
-            data = yaml.safe_load(f) or {}
-        _config = Config(**data)
-    else:
-        _config = Config()
+    return path if path and path.exists() else None
+
 
+def read_config(path: Optional[Path]) -> Config:
+    """Parse and validate a config file without applying it.
+
+    Raises OSError, yaml.YAMLError or pydantic.ValidationError.
+    """
+    if path is None:
+        return Config()
+    with open(path) as f:
+        data = yaml.safe_load(f) or {}
+    return Config(**data)
+
+
+def load_config(path: Optional[Path] = None) -> Config:
+    """Load configuration from YAML file."""
+    global _config, _config_path
+
+    _config_path = find_config(path)
+    _config = read_config(_config_path)
     return _config
 
 
+def set_config(config: Config, path: Optional[Path] = None) -> None:
+    """Replace the current configuration (hot reload).
+
+    Code reads settings through get_config() when it uses them, so the swap
+    is atomic: each operation sees either the old or the new config.
+    """
+    global _config, _config_path
+    _config = config
+    if path is not None:
+        _config_path = path
+
+
+def config_path() -> Optional[Path]:
+    """File the current configuration was loaded from."""
+    return _config_path
+
+
 def get_config() -> Config:
     """Get current configuration."""
     global _config
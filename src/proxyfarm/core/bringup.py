@@ -0,0 +1,272 @@
+"""Modem bring-up: enable modems and activate their connections in parallel.
+
+Replaces the sequential setup script. Each modem is taken through
+enable -> NetworkManager connection -> activation, skipping steps that are
+already in the desired state, so running a bring-up on a healthy farm only
+costs a few status queries.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
+from ..config import get_config
+from ..schemas import BringupJob, ModemBringupStatus, ModemState
+from .modem import modem_manager
+from .network import network_manager
+from .squid import squid_manager
+from .store import state_store
+from .state import ModemRecord
+
+logger = logging.getLogger(__name__)
+
+_LAST_JOB_KEY = "bringup.last"
+_POLL_INTERVAL = 1.0
+
+# States in which the modem still has to be enabled
+_DISABLED_STATES = {ModemState.DISABLED, ModemState.DISABLING, ModemState.UNKNOWN}
+# Transitional states while enabling and registering on the network
+_ENABLING_STATES = {ModemState.ENABLING, ModemState.ENABLED, ModemState.SEARCHING}
+
+
+class BringupError(Exception):
+    """A modem could not be brought up."""
+
+
+class ModemBringup:
+    """Runs bring-up jobs; at most one at a time."""
+
+    def __init__(self):
+        self._jobs: OrderedDict[str, BringupJob] = OrderedDict()
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._current: Optional[str] = None
+
+    @property
+    def current(self) -> Optional[BringupJob]:
+        """The running job, if any."""
+        return self._jobs.get(self._current) if self._current else None
+
+    def get_job(self, job_id: str) -> Optional[BringupJob]:
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> list[BringupJob]:
+        """Running and recent jobs, newest first."""
+        return list(reversed(self._jobs.values()))
+
+    def start(self) -> tuple[BringupJob, bool]:
+        """Start a bring-up job, or return the one already running.
+
+        Returns the job and whether it was newly started.
+        """
+        current = self.current
+        if current is not None:
+            return current, False
+
+        job = BringupJob(id=uuid.uuid4().hex[:12], started_at=datetime.utcnow())
+        self._jobs[job.id] = job
+        self._current = job.id
+        self._trim_history()
+        self._tasks[job.id] = asyncio.create_task(self._run(job))
+        return job, True
+
+    async def wait(self, job_id: str) -> Optional[BringupJob]:
+        """Wait for a job to finish."""
+        task = self._tasks.get(job_id)
+        if task is not None:
+            await asyncio.shield(task)
+        return self._jobs.get(job_id)
+
+    async def stop(self) -> None:
+        """Cancel a running job (on shutdown)."""
+        for task in list(self._tasks.values()):
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def _trim_history(self) -> None:
+        limit = max(1, get_config().bringup.history)
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= limit:
+                break
+            if job_id != self._current:
+                del self._jobs[job_id]
+
+    async def _run(self, job: BringupJob) -> None:
+        config = get_config()
+        started = time.monotonic()
+        logger.info(f"Bring-up job {job.id} started")
+        try:
+            modem_ids = await modem_manager.list_modem_ids()
+            job.modems = [
+                ModemBringupStatus(modem_id=modem_id, connection=self._connection_name(modem_id))
+                for modem_id in modem_ids
+            ]
+            job.modems_total = len(job.modems)
+
+            semaphore = asyncio.Semaphore(max(1, config.bringup.concurrency))
+
+            async def bring_up(status: ModemBringupStatus) -> None:
+                async with semaphore:
+                    await self._bring_up(status)
+                if status.status in ("ready", "skipped"):
+                    job.modems_ready += 1
+                    elapsed = time.monotonic() - started
+                    if job.time_to_first_ready is None:
+                        job.time_to_first_ready = elapsed
+                    if job.modems_ready == job.modems_total:
+                        job.time_to_capacity = elapsed
+
+            await asyncio.gather(*(bring_up(status) for status in job.modems))
+
+            if any("activated" in status.actions for status in job.modems):
+                await network_manager.flush_routes()
+                if not await squid_manager.reconfigure():
+                    logger.warning("Squid reconfiguration failed after bring-up")
+
+            failed = [status.modem_id for status in job.modems if status.status == "failed"]
+            if not job.modems:
+                job.status = "failed"
+                job.error = "No modems found"
+            elif failed:
+                job.status = "failed"
+                job.error = f"Modems failed: {', '.join(map(str, failed))}"
+            else:
+                job.status = "completed"
+        except asyncio.CancelledError:
+            job.status = "failed"
+            job.error = "Cancelled"
+            raise
+        except Exception as e:
+            logger.exception(f"Bring-up job {job.id} failed")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = datetime.utcnow()
+            self._current = None
+            self._tasks.pop(job.id, None)
+            state_store.set_value(_LAST_JOB_KEY, job.model_dump(mode="json"))
+            logger.info(
+                f"Bring-up job {job.id} {job.status}: {job.modems_ready}/{job.modems_total} "
+                f"modems ready in {time.monotonic() - started:.1f}s"
+            )
+
+    @staticmethod
+    def _connection_name(modem_id: int) -> str:
+        return f"{get_config().modems.connection_prefix}{modem_id + 1}"
+
+    async def _bring_up(self, status: ModemBringupStatus) -> None:
+        started = time.monotonic()
+        status.status = "running"
+        try:
+            modem = await self._get_modem(status.modem_id)
+            modem = await self._ensure_enabled(status, modem)
+            await self._ensure_connection(status, modem)
+            modem = await self._ensure_connected(status, modem)
+            status.ip_address = modem.ip_address
+            status.status = "ready" if status.actions else "skipped"
+        except BringupError as e:
+            logger.error(f"Bring-up of modem {status.modem_id} failed: {e}")
+            status.status = "failed"
+            status.error = str(e)
+        except Exception as e:
+            # A command timing out or failing to run is this modem's failure;
+            # letting it out of gather() would abandon the other modems
+            logger.exception(f"Bring-up of modem {status.modem_id} failed")
+            status.status = "failed"
+            status.error = str(e) or type(e).__name__
+        finally:
+            status.duration_seconds = time.monotonic() - started
+
+    async def _get_modem(self, modem_id: int) -> ModemRecord:
+        modem = await modem_manager.get_modem(modem_id)
+        if modem is None:
+            raise BringupError("Modem not found")
+        return modem
+
+    async def _wait_for(self, modem_id: int, done, timeout: float) -> Optional[ModemRecord]:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            modem = await modem_manager.get_modem(modem_id)
+            if modem is not None and done(modem):
+                return modem
+            await asyncio.sleep(_POLL_INTERVAL)
+        return None
+
+    async def _ensure_enabled(
+        self, status: ModemBringupStatus, modem: ModemRecord
+    ) -> ModemRecord:
+        if modem.state == ModemState.FAILED:
+            raise BringupError("Modem is in failed state (SIM missing or locked?)")
+        if modem.state in _DISABLED_STATES:
+            if not await modem_manager.enable(modem.id):
+                raise BringupError("Failed to enable modem")
+            status.actions.append("enabled")
+        elif modem.state not in _ENABLING_STATES:
+            return modem
+
+        modem = await self._wait_for(
+            modem.id,
+            lambda m: m.state not in _DISABLED_STATES | _ENABLING_STATES,
+            get_config().bringup.enable_timeout,
+        )
+        if modem is None:
+            raise BringupError("Timeout waiting for network registration")
+        return modem
+
+    async def _ensure_connection(self, status: ModemBringupStatus, modem: ModemRecord) -> None:
+        if not modem.primary_port:
+            raise BringupError("Modem has no primary port")
+
+        desired = {
+            "gsm.apn": get_config().modems.apn,
+            "connection.interface-name": modem.primary_port,
+        }
+        current = await network_manager.get_connection_settings(
+            status.connection, list(desired)
+        )
+        if current is None:
+            if not await network_manager.add_gsm_connection(
+                status.connection, modem.primary_port, desired["gsm.apn"]
+            ):
+                raise BringupError(f"Failed to create connection {status.connection}")
+            status.actions.append("created connection")
+            return
+
+        changed = {key: value for key, value in desired.items() if current.get(key) != value}
+        if changed:
+            if not await network_manager.modify_connection(status.connection, changed):
+                raise BringupError(f"Failed to update connection {status.connection}")
+            status.actions.append("updated connection")
+
+    async def _ensure_connected(
+        self, status: ModemBringupStatus, modem: ModemRecord
+    ) -> ModemRecord:
+        # A changed connection has to be re-activated to take effect
+        reactivate = "updated connection" in status.actions
+        if modem.state == ModemState.CONNECTED and modem.ip_address and not reactivate:
+            return modem
+
+        if not await network_manager.connection_up(
+            status.connection, get_config().bringup.connect_timeout
+        ):
+            raise BringupError(f"Failed to activate {status.connection}")
+        status.actions.append("activated")
+
+        modem = await self._wait_for(
+            modem.id,
+            lambda m: m.state == ModemState.CONNECTED and m.ip_address is not None,
+            get_config().bringup.connect_timeout,
+        )
+        if modem is None:
+            raise BringupError("Timeout waiting for IP address")
+        return modem
+
+
+# Global instance
+modem_bringup = ModemBringup()
@@ -0,0 +1,255 @@
+"""Aggregator mode: federate several ProxyFarm nodes behind one API."""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Optional
+
+import httpx
+
+from ..config import NodeConfig, get_config
+from ..schemas import (
+    ClusterModem,
+    ClusterNodeStatus,
+    RotationResult,
+    USSDResponse,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class NodeError(Exception):
+    """A node request failed; carries the HTTP status to report upstream."""
+
+    def __init__(
+        self,
+        node: str,
+        status_code: int,
+        detail: str,
+        headers: Optional[dict[str, str]] = None,
+    ):
+        super().__init__(f"{node}: {detail}")
+        self.node = node
+        self.status_code = status_code
+        self.detail = detail
+        self.headers = headers
+
+
+def make_global_id(node: str, modem_id: int) -> str:
+    """Build a cluster-wide modem ID, e.g. ``pi-2:0``."""
+    return f"{node}:{modem_id}"
+
+
+def parse_global_id(global_id: str) -> tuple[str, int]:
+    """Split a global modem ID into node name and node-local modem ID."""
+    node, sep, modem_id = global_id.rpartition(":")
+    if not sep or not node or not modem_id.isdigit():
+        raise ValueError(f"Invalid global modem ID: {global_id}")
+    return node, int(modem_id)
+
+
+class ClusterManager:
+    """Keeps pooled connections to node agents and a merged modem inventory."""
+
+    def __init__(self):
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._inventory: dict[str, list[ClusterModem]] = {}
+        self._status: dict[str, ClusterNodeStatus] = {}
+        self._fetched_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._retiring: set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return get_config().cluster.enabled
+
+    def _nodes(self) -> dict[str, NodeConfig]:
+        return {node.name: node for node in get_config().cluster.nodes}
+
+    def _node(self, name: str) -> NodeConfig:
+        node = self._nodes().get(name)
+        if node is None:
+            raise NodeError(name, 404, f"Unknown node {name}")
+        return node
+
+    def _client(self, node: NodeConfig) -> httpx.AsyncClient:
+        client = self._clients.get(node.name)
+        if client is None:
+            max_connections = get_config().cluster.max_connections
+            client = httpx.AsyncClient(
+                base_url=node.url.rstrip("/"),
+                headers={"X-API-Key": node.api_key},
+                timeout=node.timeout,
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                    keepalive_expiry=60.0,
+                ),
+            )
+            self._clients[node.name] = client
+        return client
+
+    async def _request(
+        self,
+        node: NodeConfig,
+        method: str,
+        path: str,
+        timeout: Optional[float] = None,
+        **kwargs: Any,
+    ) -> Any:
+        timeout = timeout or node.timeout
+        try:
+            response = await asyncio.wait_for(
+                self._client(node).request(method, path, timeout=timeout, **kwargs),
+                timeout=timeout,
+            )
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            raise NodeError(node.name, 504, f"Node {node.name} timed out")
+        except httpx.HTTPError as e:
+            raise NodeError(node.name, 502, f"Node {node.name} unreachable: {e}")
+
+        if response.status_code >= 400:
+            try:
+                detail = response.json().get("detail", response.text)
+            except ValueError:
+                detail = response.text
+            headers = None
+            if "retry-after" in response.headers:
+                headers = {"Retry-After": response.headers["retry-after"]}
+            raise NodeError(node.name, response.status_code, str(detail), headers)
+
+        try:
+            return response.json()
+        except ValueError:
+            raise NodeError(node.name, 502, f"Node {node.name} sent a response that is not JSON")
+
+    async def _fetch_node(self, node: NodeConfig) -> None:
+        started = time.monotonic()
+        try:
+            data = await self._request(node, "GET", "/api/v1/modems")
+            modems = [
+                ClusterModem(
+                    **modem,
+                    node=node.name,
+                    global_id=make_global_id(node.name, modem["id"]),
+                )
+                for modem in data.get("modems", [])
+            ]
+        except (NodeError, ValueError, KeyError, TypeError, AttributeError) as e:
+            # A node answering garbage (ValidationError is a ValueError) is as
+            # unusable as one not answering; keep its last good inventory
+            error = e.detail if isinstance(e, NodeError) else f"Malformed inventory: {e!r}"
+            logger.warning(f"Cluster inventory fetch from {node.name} failed: {error}")
+            previous = self._status.get(node.name)
+            self._status[node.name] = ClusterNodeStatus(
+                name=node.name,
+                url=node.url,
+                reachable=False,
+                modems=len(self._inventory.get(node.name, [])),
+                error=error,
+                updated_at=previous.updated_at if previous else None,
+            )
+            return
+
+        self._inventory[node.name] = modems
+        self._status[node.name] = ClusterNodeStatus(
+            name=node.name,
+            url=node.url,
+            reachable=True,
+            modems=len(modems),
+            latency_ms=(time.monotonic() - started) * 1000,
+            updated_at=datetime.utcnow(),
+        )
+
+    async def _refresh_all(self) -> None:
+        nodes = self._nodes()
+        await asyncio.gather(*(self._fetch_node(node) for node in nodes.values()))
+        # Forget nodes removed from the config
+        for name in list(self._inventory):
+            if name not in nodes:
+                self._inventory.pop(name, None)
+                self._status.pop(name, None)
+        self._fetched_at = time.monotonic()
+
+    async def refresh(self) -> None:
+        """Query all nodes concurrently; concurrent callers share one fan-out."""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_all())
+        await asyncio.shield(self._refresh_task)
+
+    async def inventory(self, refresh: bool = False) -> list[ClusterModem]:
+        """Get the merged modem inventory, refreshing it when stale."""
+        ttl = get_config().cluster.inventory_ttl
+        if refresh or time.monotonic() - self._fetched_at > ttl:
+            await self.refresh()
+        return [modem for modems in self._inventory.values() for modem in modems]
+
+    async def nodes(self, refresh: bool = False) -> list[ClusterNodeStatus]:
+        """Get reachability and latency of every configured node."""
+        await self.inventory(refresh=refresh)
+        return [
+            self._status.get(name)
+            or ClusterNodeStatus(name=name, url=node.url, reachable=False)
+            for name, node in self._nodes().items()
+        ]
+
+    def _invalidate(self) -> None:
+        self._fetched_at = 0.0
+
+    async def rotate(self, global_id: str) -> RotationResult:
+        """Rotate a modem on whichever node owns it."""
+        name, modem_id = parse_global_id(global_id)
+        node = self._node(name)
+        data = await self._request(
+            node,
+            "POST",
+            f"/api/v1/modems/{modem_id}/rotate",
+            timeout=get_config().cluster.action_timeout,
+        )
+        self._invalidate()
+        return RotationResult(**data)
+
+    async def send_ussd(
+        self, global_id: str, command: str, use_cache: bool = True
+    ) -> USSDResponse:
+        """Send a USSD command to a modem on whichever node owns it."""
+        name, modem_id = parse_global_id(global_id)
+        node = self._node(name)
+        data = await self._request(
+            node,
+            "POST",
+            f"/api/v1/modems/{modem_id}/ussd",
+            timeout=get_config().cluster.action_timeout,
+            json={"command": command, "use_cache": use_cache},
+        )
+        return USSDResponse(**data)
+
+    def reset_clients(self) -> None:
+        """Reconnect with the current node settings (config reload).
+
+        Old clients are closed once requests already using them are done.
+        """
+        clients, self._clients = self._clients, {}
+        self._fetched_at = 0.0
+        if clients:
+            delay = max((node.timeout for node in get_config().cluster.nodes), default=5.0)
+            task = asyncio.create_task(self._close_later(list(clients.values()), delay))
+            self._retiring.add(task)
+            task.add_done_callback(self._retiring.discard)
+
+    @staticmethod
+    async def _close_later(clients: list[httpx.AsyncClient], delay: float) -> None:
+        await asyncio.sleep(delay)
+        for client in clients:
+            await client.aclose()
+
+    async def close(self) -> None:
+        """Close pooled node connections."""
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+
+# Global instance
+cluster_manager = ClusterManager()
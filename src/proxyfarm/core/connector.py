@@ -0,0 +1,398 @@
+"""Outbound TCP/TLS connects through modems, hedged against slow modems.
+
+A connect goes out through one modem. If it hasn't completed within that
+modem's recent connect-latency percentile, a second attempt is raced through
+another healthy modem and the first to finish wins; a failed attempt is
+retried the same way. Attempts given up on (a lost race, a timeout) count
+towards the latency percentile with the time they had taken so far, so
+slow modems aren't judged by their fast connects alone. Extra attempts draw
+from a retry budget that grows with the number of connects, so hedging can't
+multiply load on a farm that is slow across the board. Sticky clients (which
+must keep their egress IP) are never hedged.
+"""
+
+import asyncio
+import ipaddress
+import logging
+import random
+import socket
+import ssl
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from ..config import get_config
+from ..schemas import ConnectorModemStats, ConnectorStats
+from .dns import dns_resolver
+from .state import ModemRecord
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectError(OSError):
+    """No attempt managed to connect."""
+
+
+@dataclass
+class Connection:
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    modem_id: int
+    # Whether a second attempt was started, and whether it won
+    hedged: bool = False
+    hedge_won: bool = False
+
+
+@dataclass
+class SocketConnection:
+    """A connected non-blocking socket, for callers relaying bytes themselves."""
+    sock: socket.socket
+    modem_id: int
+    hedged: bool = False
+    hedge_won: bool = False
+
+
+@dataclass
+class _Target:
+    interface: Optional[str]
+    source_ip: Optional[str]
+
+
+class RetryBudget:
+    """Token bucket limiting extra attempts to a fraction of connects.
+
+    Each connect deposits ``ratio`` tokens (up to ``burst``); each hedge or
+    retry withdraws one.
+    """
+
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def deposit(self) -> None:
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def _percentile(samples: deque, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+def _is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def _family(address: str) -> socket.AddressFamily:
+    try:
+        version = ipaddress.ip_address(address).version
+    except ValueError:
+        return socket.AF_INET
+    return socket.AF_INET6 if version == 6 else socket.AF_INET
+
+
+async def connect_bound(
+    address: str, port: int, interface: Optional[str], source_ip: Optional[str]
+) -> socket.socket:
+    """Connect a non-blocking TCP socket leaving through ``interface`` from ``source_ip``.
+
+    The socket takes the family of ``address``; ``source_ip`` is only bound
+    when it is of the same family, the interface still pins the route.
+    """
+    loop = asyncio.get_running_loop()
+    family = _family(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        if interface:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode())
+        if source_ip and _family(source_ip) == family:
+            sock.bind((source_ip, 0))
+        await loop.sock_connect(sock, (address, port))
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+class HedgedConnector:
+    """Opens connections through modems with hedging and retries."""
+
+    def __init__(self):
+        self._targets: dict[int, _Target] = {}
+        self._weights: dict[int, int] = {}
+        self._latency: dict[int, deque] = {}
+        self._budget: Optional[RetryBudget] = None
+        self.counters: Counter = Counter()
+
+    @property
+    def budget(self) -> RetryBudget:
+        if self._budget is None:
+            config = get_config().connector
+            self._budget = RetryBudget(config.budget_ratio, config.budget_burst)
+        return self._budget
+
+    def update_modems(self, modems: list[ModemRecord], weights: dict[int, int]) -> None:
+        """Refresh the usable modems; ones with zero egress weight are skipped."""
+        self._targets = {
+            modem.id: _Target(modem.interface, modem.ip_address)
+            for modem in modems
+            if modem.interface and modem.ip_address and weights.get(modem.id, 0) > 0
+        }
+        self._weights = weights
+
+    def set_target(self, modem_id: int, interface: Optional[str], source_ip: Optional[str]):
+        """Register a target directly (tools and benchmarks)."""
+        self._targets[modem_id] = _Target(interface, source_ip)
+
+    def target(self, modem_id: int) -> Optional[tuple[Optional[str], Optional[str]]]:
+        """Interface and source IP outgoing sockets of a usable modem bind to."""
+        target = self._targets.get(modem_id)
+        return (target.interface, target.source_ip) if target else None
+
+    def choose(self) -> Optional[int]:
+        """A usable modem picked by egress weight."""
+        return self._pick(set())
+
+    def _pick(self, exclude: set[int]) -> Optional[int]:
+        candidates = [modem_id for modem_id in self._targets if modem_id not in exclude]
+        if not candidates:
+            return None
+        return random.choices(
+            candidates, [max(1, self._weights.get(modem_id, 1)) for modem_id in candidates]
+        )[0]
+
+    def threshold(self, modem_id: int) -> float:
+        """Seconds to wait for a modem before hedging."""
+        config = get_config().connector
+        samples = self._latency.get(modem_id)
+        if not samples or len(samples) < config.min_samples:
+            delay = config.hedge_delay
+        else:
+            delay = _percentile(samples, config.hedge_percentile)
+        return min(config.max_hedge_delay, max(config.min_hedge_delay, delay))
+
+    def _record(self, modem_id: int, seconds: float) -> None:
+        samples = self._latency.get(modem_id)
+        if samples is None:
+            samples = self._latency[modem_id] = deque(maxlen=get_config().connector.latency_window)
+        samples.append(seconds)
+
+    async def connect(
+        self,
+        host: str,
+        port: int,
+        modem_id: Optional[int] = None,
+        sticky: bool = False,
+        ssl_context: Optional[ssl.SSLContext] = None,
+    ) -> Connection:
+        """Connect to ``host:port``, through ``modem_id`` if given.
+
+        With ``sticky`` the connection only ever goes through that modem.
+        """
+        (reader, writer), modem_id, hedged, hedge_won = await self._establish(
+            host, port, modem_id, sticky, ssl_context, raw=False
+        )
+        return Connection(reader, writer, modem_id, hedged, hedge_won)
+
+    async def open_socket(
+        self, host: str, port: int, modem_id: Optional[int] = None, sticky: bool = False
+    ) -> SocketConnection:
+        """Like :meth:`connect`, but hand back the bare TCP socket."""
+        sock, modem_id, hedged, hedge_won = await self._establish(
+            host, port, modem_id, sticky, None, raw=True
+        )
+        return SocketConnection(sock, modem_id, hedged, hedge_won)
+
+    async def _establish(
+        self,
+        host: str,
+        port: int,
+        modem_id: Optional[int],
+        sticky: bool,
+        ssl_context: Optional[ssl.SSLContext],
+        raw: bool,
+    ) -> tuple[Any, int, bool, bool]:
+        config = get_config().connector
+        self.counters["connects"] += 1
+        self.budget.deposit()
+
+        primary = modem_id if modem_id is not None else self._pick(set())
+        if primary is None:
+            self.counters["failures"] += 1
+            raise ConnectError("No modem available")
+
+        if sticky or not config.hedging:
+            try:
+                result = await asyncio.wait_for(
+                    self._attempt(primary, host, port, ssl_context, raw), config.connect_timeout
+                )
+            except (OSError, asyncio.TimeoutError) as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self._record(primary, config.connect_timeout)
+                self.counters["failures"] += 1
+                raise ConnectError(f"Connect via modem {primary} failed: {e}") from e
+            return result, primary, False, False
+
+        return await self._hedged(primary, host, port, ssl_context, raw)
+
+    async def _hedged(
+        self,
+        primary: int,
+        host: str,
+        port: int,
+        ssl_context: Optional[ssl.SSLContext],
+        raw: bool,
+    ) -> tuple[Any, int, bool, bool]:
+        config = get_config().connector
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + config.connect_timeout
+        tasks: dict[asyncio.Task, int] = {}
+        launched: dict[asyncio.Task, float] = {}
+        tried: set[int] = set()
+        errors: list[str] = []
+        hedged = hedge_checked = False
+
+        def launch(modem_id: int) -> None:
+            tried.add(modem_id)
+            task = asyncio.create_task(self._attempt(modem_id, host, port, ssl_context, raw))
+            tasks[task] = modem_id
+            launched[task] = time.monotonic()
+
+        def extra_attempt(reason: str) -> bool:
+            if len(tried) >= config.max_attempts:
+                return False
+            modem_id = self._pick(tried)
+            if modem_id is None:
+                return False
+            if not self.budget.withdraw():
+                self.counters["budget_exhausted"] += 1
+                return False
+            self.counters[reason] += 1
+            launch(modem_id)
+            return True
+
+        launch(primary)
+        hedge_at = loop.time() + self.threshold(primary)
+        try:
+            while tasks:
+                now = loop.time()
+                if now >= deadline:
+                    break
+                wake = deadline if hedge_checked else min(hedge_at, deadline)
+                done, _ = await asyncio.wait(
+                    tasks, timeout=max(0.0, wake - now), return_when=asyncio.FIRST_COMPLETED
+                )
+
+                for task in done:
+                    modem_id = tasks.pop(task)
+                    if task.exception() is not None:
+                        errors.append(f"modem {modem_id}: {task.exception()}")
+                        continue
+                    hedge_won = hedged and modem_id != primary
+                    if hedge_won:
+                        self.counters["hedge_wins"] += 1
+                    return task.result(), modem_id, hedged, hedge_won
+
+                if done and not tasks:
+                    # Every attempt so far failed: retry through another modem
+                    extra_attempt("retries")
+                elif not done and not hedge_checked:
+                    hedge_checked = True
+                    hedged = extra_attempt("hedges")
+        finally:
+            now = time.monotonic()
+            for task, modem_id in tasks.items():
+                # Still connecting: it would have taken at least this long
+                self._record(modem_id, now - launched[task])
+                self._discard(task)
+
+        self.counters["failures"] += 1
+        raise ConnectError(
+            f"Connect to {host}:{port} failed: " + ("; ".join(errors) or "timed out")
+        )
+
+    @staticmethod
+    def _discard(task: asyncio.Task) -> None:
+        """Cancel a losing attempt, closing its connection if it already won."""
+        def close(task: asyncio.Task) -> None:
+            if not task.cancelled() and task.exception() is None:
+                result = task.result()
+                (result if isinstance(result, socket.socket) else result[1]).close()
+
+        task.cancel()
+        task.add_done_callback(close)
+
+    async def _attempt(
+        self,
+        modem_id: int,
+        host: str,
+        port: int,
+        ssl_context: Optional[ssl.SSLContext],
+        raw: bool = False,
+    ) -> Any:
+        """Connect through one modem: a socket if ``raw``, else a stream pair."""
+        target = self._targets.get(modem_id)
+        if target is None:
+            raise ConnectError(f"Modem {modem_id} is not usable")
+
+        started = time.monotonic()
+        if _is_ip(host):
+            addresses = [host]
+        else:
+            addresses = await dns_resolver.lookup(host, modem_id)
+            if not addresses:
+                raise ConnectError(f"Cannot resolve {host}")
+
+        sock = await connect_bound(addresses[0], port, target.interface, target.source_ip)
+        if raw:
+            result = sock
+        else:
+            try:
+                result = await asyncio.open_connection(
+                    sock=sock,
+                    ssl=ssl_context,
+                    server_hostname=host if ssl_context else None,
+                )
+            except BaseException:
+                sock.close()
+                raise
+        self._record(modem_id, time.monotonic() - started)
+        return result
+
+    def stats(self) -> ConnectorStats:
+        """Attempt counters and per-modem connect latency."""
+        modems = []
+        for modem_id, samples in sorted(self._latency.items()):
+            modems.append(ConnectorModemStats(
+                modem_id=modem_id,
+                samples=len(samples),
+                p50_ms=_percentile(samples, 50) * 1000,
+                p90_ms=_percentile(samples, 90) * 1000,
+                hedge_threshold_ms=self.threshold(modem_id) * 1000,
+            ))
+        return ConnectorStats(
+            connects=self.counters["connects"],
+            failures=self.counters["failures"],
+            hedges=self.counters["hedges"],
+            hedge_wins=self.counters["hedge_wins"],
+            retries=self.counters["retries"],
+            budget_exhausted=self.counters["budget_exhausted"],
+            budget_tokens=self.budget.tokens,
+            modems=modems,
+        )
+
+
+# Global instance
+hedged_connector = HedgedConnector()
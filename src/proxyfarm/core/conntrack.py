@@ -0,0 +1,601 @@
+"""Live flow counts per modem from netfilter conntrack.
+
+Talks ctnetlink directly: one full dump of the conntrack table at start,
+then the NEW and DESTROY event groups keep the counts current, so each flow
+costs one event when it starts and one when it ends and nothing is
+re-read per poll. A flow belongs to the modem whose IP is its original
+source (Squid and the SOCKS listener bind outgoing sockets to it) or its
+reply destination (traffic masqueraded out of the modem); flows on no
+modem are not kept.
+
+If the kernel drops events because the socket buffer filled up, counts
+may have drifted, so the table is read again; ``resync_interval`` re-reads
+it periodically as a safety net. The kernel only sends events for flows
+created while some listener existed, so flows found by the first dump may
+end silently: until they are all gone the table is re-read every
+``stale_resync_interval``. Flows only report bytes when they end
+(and only with ``nf_conntrack_acct=1``), so live byte rates come from the
+interface counters instead.
+
+The module also builds create/delete requests (what ``conntrack -I/-D``
+send) so flows can be injected in a network namespace without traffic;
+see ``benchmarks.conntrack``.
+"""
+
+import asyncio
+import errno
+import ipaddress
+import logging
+import socket
+import struct
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from ..config import get_config
+from ..schemas import ConntrackStats, EgressFlows
+from .quota import read_counters
+from .state import ModemRecord
+
+logger = logging.getLogger(__name__)
+
+NETLINK_NETFILTER = 12
+# Not exported by the socket module
+_SO_RCVBUFFORCE = 33
+
+_NLMSG_ERROR = 2
+_NLMSG_DONE = 3
+_NLM_F_REQUEST = 0x1
+_NLM_F_ACK = 0x4
+_NLM_F_DUMP = 0x300
+_NLM_F_EXCL = 0x200
+_NLM_F_CREATE = 0x400
+
+_NFNL_SUBSYS_CTNETLINK = 1
+IPCTNL_MSG_CT_NEW = 0
+IPCTNL_MSG_CT_GET = 1
+IPCTNL_MSG_CT_DELETE = 2
+
+# Multicast groups (bit N-1 for group N)
+_NFNLGRP_CONNTRACK_NEW = 1
+_NFNLGRP_CONNTRACK_DESTROY = 3
+
+_NLA_F_NESTED = 0x8000
+_NLA_TYPE_MASK = 0x3FFF
+
+_CTA_TUPLE_ORIG = 1
+_CTA_TUPLE_REPLY = 2
+_CTA_STATUS = 3
+_CTA_TIMEOUT = 7
+_CTA_COUNTERS_ORIG = 9
+_CTA_COUNTERS_REPLY = 10
+
+_CTA_TUPLE_IP = 1
+_CTA_TUPLE_PROTO = 2
+_CTA_IP_V4_SRC = 1
+_CTA_IP_V4_DST = 2
+_CTA_IP_V6_SRC = 3
+_CTA_IP_V6_DST = 4
+_SOURCES = (_CTA_IP_V4_SRC, _CTA_IP_V6_SRC)
+_DESTINATIONS = (_CTA_IP_V4_DST, _CTA_IP_V6_DST)
+_CTA_PROTO_NUM = 1
+_CTA_PROTO_SRC_PORT = 2
+_CTA_PROTO_DST_PORT = 3
+_CTA_COUNTERS_BYTES = 2
+
+# IPS_CONFIRMED: required for entries created over netlink
+_IPS_CONFIRMED = 1 << 3
+
+_NLMSG = struct.Struct("=IHHII")
+_NFGEN = struct.Struct("=BBH")
+_NLA = struct.Struct("=HH")
+_U32 = struct.Struct("!I")
+_U64 = struct.Struct("!Q")
+_ERRNO = struct.Struct("=i")
+_HEADER_SIZE = _NLMSG.size + _NFGEN.size
+
+_ACCT_PATH = Path("/proc/sys/net/netfilter/nf_conntrack_acct")
+_RECV_SIZE = 256 * 1024
+# Seconds between attempts to re-open the event socket or re-read the
+# table after a failure, doubling up to the maximum
+_RETRY_MIN = 1.0
+_RETRY_MAX = 60.0
+_EVENT_GROUPS = 1 << (_NFNLGRP_CONNTRACK_NEW - 1) | 1 << (_NFNLGRP_CONNTRACK_DESTROY - 1)
+
+
+def _attrs(buf, start: int, end: int):
+    """Yield (type, payload start, payload end) of the attributes in a span."""
+    while start + 4 <= end:
+        length, kind = _NLA.unpack_from(buf, start)
+        if length < 4:
+            return
+        yield kind & _NLA_TYPE_MASK, start + 4, start + length
+        start += (length + 3) & ~3
+
+
+def _tuple_address(buf, start: int, end: int, source: bool) -> Optional[bytes]:
+    for kind, a, b in _attrs(buf, start, end):
+        if kind == _CTA_TUPLE_IP:
+            wanted = _SOURCES if source else _DESTINATIONS
+            for ip_kind, x, y in _attrs(buf, a, b):
+                if ip_kind in wanted:
+                    return bytes(buf[x:y])
+    return None
+
+
+def parse_flow(buf, start: int, end: int) -> tuple:
+    """Original tuple, original source, reply destination and total bytes of
+    a flow message (``None`` for what it lacks).
+
+    The encoded original tuple identifies the flow: ``CTA_ID`` is derived
+    from kernel pointers and changes when the entry grows extensions.
+    """
+    key = source = reply_destination = None
+    total = 0
+    for kind, a, b in _attrs(buf, start, end):
+        if kind == _CTA_TUPLE_ORIG:
+            key = bytes(buf[a:b])
+            source = _tuple_address(buf, a, b, source=True)
+        elif kind == _CTA_TUPLE_REPLY:
+            reply_destination = _tuple_address(buf, a, b, source=False)
+        elif kind in (_CTA_COUNTERS_ORIG, _CTA_COUNTERS_REPLY):
+            for counter, x, _ in _attrs(buf, a, b):
+                if counter == _CTA_COUNTERS_BYTES:
+                    total += _U64.unpack_from(buf, x)[0]
+    return key, source, reply_destination, total
+
+
+def _attr(kind: int, payload: bytes) -> bytes:
+    length = 4 + len(payload)
+    return _NLA.pack(length, kind) + payload + b"\0" * (-length % 4)
+
+
+def _nested(kind: int, *attrs: bytes) -> bytes:
+    return _attr(kind | _NLA_F_NESTED, b"".join(attrs))
+
+
+def _message(msg_type: int, flags: int, seq: int, family: int, payload: bytes = b"") -> bytes:
+    kind = (_NFNL_SUBSYS_CTNETLINK << 8) | msg_type
+    return (
+        _NLMSG.pack(_HEADER_SIZE + len(payload), kind, flags, seq, 0)
+        + _NFGEN.pack(family, 0, 0)
+        + payload
+    )
+
+
+def flow_message(
+    msg_type: int,
+    seq: int,
+    source: str,
+    destination: str,
+    source_port: int,
+    destination_port: int,
+    protocol: int = socket.IPPROTO_UDP,
+    timeout: int = 120,
+    ack: bool = True,
+) -> bytes:
+    """A request creating (``IPCTNL_MSG_CT_NEW``) or deleting a flow entry.
+
+    Without ``ack`` the kernel only answers on errors.
+    """
+    src, dst = ipaddress.ip_address(source), ipaddress.ip_address(destination)
+    family = socket.AF_INET if src.version == 4 else socket.AF_INET6
+    src_kind, dst_kind = (
+        (_CTA_IP_V4_SRC, _CTA_IP_V4_DST) if src.version == 4
+        else (_CTA_IP_V6_SRC, _CTA_IP_V6_DST)
+    )
+
+    def tuple_attr(kind: int, a, b, a_port: int, b_port: int) -> bytes:
+        return _nested(
+            kind,
+            _nested(_CTA_TUPLE_IP, _attr(src_kind, a.packed), _attr(dst_kind, b.packed)),
+            _nested(
+                _CTA_TUPLE_PROTO,
+                _attr(_CTA_PROTO_NUM, bytes((protocol,))),
+                _attr(_CTA_PROTO_SRC_PORT, struct.pack("!H", a_port)),
+                _attr(_CTA_PROTO_DST_PORT, struct.pack("!H", b_port)),
+            ),
+        )
+
+    payload = tuple_attr(_CTA_TUPLE_ORIG, src, dst, source_port, destination_port)
+    flags = _NLM_F_REQUEST | (_NLM_F_ACK if ack else 0)
+    if msg_type == IPCTNL_MSG_CT_NEW:
+        payload += tuple_attr(_CTA_TUPLE_REPLY, dst, src, destination_port, source_port)
+        payload += _attr(_CTA_STATUS, _U32.pack(_IPS_CONFIRMED))
+        payload += _attr(_CTA_TIMEOUT, _U32.pack(timeout))
+        flags |= _NLM_F_CREATE | _NLM_F_EXCL
+    return _message(msg_type, flags, seq, family, payload)
+
+
+def open_socket(groups: int = 0, receive_buffer: int = 0) -> socket.socket:
+    """A non-blocking ctnetlink socket, subscribed to ``groups`` (a bitmask)."""
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_NETFILTER)
+    try:
+        if receive_buffer:
+            try:
+                # SO_RCVBUFFORCE goes past net.core.rmem_max (needs CAP_NET_ADMIN)
+                sock.setsockopt(socket.SOL_SOCKET, _SO_RCVBUFFORCE, receive_buffer)
+            except OSError:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        sock.bind((0, groups))
+        sock.setblocking(False)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def check_reply(buf, size: int) -> bool:
+    """Raise on a netlink error in a reply; True once a dump is done."""
+    offset = 0
+    done = False
+    while offset + _NLMSG.size <= size:
+        length, kind, _, _, _ = _NLMSG.unpack_from(buf, offset)
+        if length < _NLMSG.size:
+            break
+        if kind == _NLMSG_ERROR:
+            code = _ERRNO.unpack_from(buf, offset + _NLMSG.size)[0]
+            if code:
+                raise OSError(-code, f"ctnetlink: {errno.errorcode.get(-code, -code)}")
+        elif kind == _NLMSG_DONE:
+            done = True
+        offset += (length + 3) & ~3
+    return done
+
+
+@dataclass(slots=True)
+class _Egress:
+    interface: str
+    modem_id: Optional[int] = None
+    active: int = 0
+    opened: int = 0
+    closed: int = 0
+    closed_bytes: int = 0
+    rx_rate: float = 0.0
+    tx_rate: float = 0.0
+    # Whether the rates come from at least two counter readings
+    rated: bool = False
+    # Last interface counters and when they were read
+    rx: Optional[int] = None
+    tx: Optional[int] = None
+    sampled_at: float = 0.0
+
+
+class ConntrackTracker:
+    """Keeps per-egress flow counters current from conntrack events."""
+
+    def __init__(self):
+        self._sock: Optional[socket.socket] = None
+        self._tasks: list[asyncio.Task] = []
+        # Packed modem IP -> egress interface
+        self._addresses: dict[bytes, str] = {}
+        self._egress: dict[str, _Egress] = {}
+        # Flow (encoded original tuple) -> egress interface, for flows
+        # through a modem
+        self._flows: dict[bytes, str] = {}
+        # Flows from the first dump never seen in an event: their end may
+        # not be reported
+        self._stale: set[bytes] = set()
+        # Events seen while a table read is in progress, replayed onto what
+        # it found before that replaces the flows above
+        self._replay: Optional[list[tuple[bytes, Optional[str]]]] = None
+        self._lost = asyncio.Event()
+        self._events = 0
+        self._dumps = 0
+        self._overruns = 0
+        self._accounting = False
+        # Why counts may be stale right now, cleared once tracking recovers
+        self._error: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return (
+            self._sock is not None
+            and self._error is None
+            and all(not task.done() for task in self._tasks)
+        )
+
+    async def start(self) -> None:
+        config = get_config().conntrack
+        if not config.enabled:
+            logger.info("Conntrack tracking disabled in config")
+            return
+        self._error = None
+        try:
+            self._sock = open_socket(_EVENT_GROUPS, config.receive_buffer)
+        except OSError as e:
+            logger.warning(f"Conntrack events unavailable, flow counts disabled: {e}")
+            return
+        try:
+            self._accounting = _ACCT_PATH.read_text().strip() == "1"
+        except OSError:
+            self._accounting = False
+        self._tasks = [
+            asyncio.create_task(self._listen()),
+            asyncio.create_task(self._resync()),
+            asyncio.create_task(self._sample_rates()),
+        ]
+        for task in self._tasks:
+            task.add_done_callback(self._task_done)
+        logger.info("Conntrack tracking started")
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        # The loops handle their errors; this is for anything they missed
+        if task.cancelled() or task.exception() is None:
+            return
+        self._error = f"{task.get_name()} stopped: {task.exception()!r}"
+        logger.error(f"Conntrack tracking stopped: {task.exception()!r}", exc_info=task.exception())
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def update_modems(self, modems: list[ModemRecord]) -> None:
+        """Map modem IPs to their interfaces from the current inventory."""
+        addresses = {}
+        for modem in modems:
+            if not (modem.interface and modem.ip_address):
+                continue
+            try:
+                addresses[ipaddress.ip_address(modem.ip_address).packed] = modem.interface
+            except ValueError:
+                continue
+            egress = self._egress.get(modem.interface)
+            if egress is None:
+                egress = self._egress[modem.interface] = _Egress(modem.interface)
+            egress.modem_id = modem.id
+        self._addresses = addresses
+        current = set(addresses.values())
+        for interface, egress in list(self._egress.items()):
+            if interface not in current:
+                egress.modem_id = None
+                if not egress.active:
+                    del self._egress[interface]
+
+    # Events
+
+    def _opened(self, flow: bytes, interface: str) -> None:
+        if self._replay is not None:
+            self._replay.append((flow, interface))
+        if flow in self._flows:
+            return
+        self._flows[flow] = interface
+        egress = self._egress.get(interface)
+        if egress is None:
+            egress = self._egress[interface] = _Egress(interface)
+        egress.active += 1
+        egress.opened += 1
+
+    def _closed(self, flow: bytes, total: int) -> None:
+        if self._replay is not None:
+            self._replay.append((flow, None))
+        self._stale.discard(flow)
+        interface = self._flows.pop(flow, None)
+        if interface is None:
+            return
+        egress = self._egress[interface]
+        egress.active -= 1
+        egress.closed += 1
+        egress.closed_bytes += total
+
+    def handle(self, buf, size: int, dumped: Optional[dict[bytes, str]] = None) -> bool:
+        """Apply the conntrack messages in a buffer, or collect the flows of a
+        table read into ``dumped``; True on the end of a dump."""
+        addresses = self._addresses
+        offset = 0
+        done = False
+        while offset + _HEADER_SIZE <= size:
+            length, kind, _, _, _ = _NLMSG.unpack_from(buf, offset)
+            if length < _NLMSG.size or offset + length > size:
+                break
+            if kind >> 8 == _NFNL_SUBSYS_CTNETLINK:
+                flow, source, reply_destination, total = parse_flow(
+                    buf, offset + _HEADER_SIZE, offset + length
+                )
+                if dumped is None:
+                    self._events += 1
+                if flow is None:
+                    pass
+                elif kind & 0xFF == IPCTNL_MSG_CT_DELETE:
+                    self._closed(flow, total)
+                else:
+                    interface = addresses.get(source) or addresses.get(reply_destination)
+                    if interface is None:
+                        pass
+                    elif dumped is not None:
+                        dumped[flow] = interface
+                    else:
+                        self._opened(flow, interface)
+            elif kind == _NLMSG_DONE:
+                done = True
+            elif kind == _NLMSG_ERROR:
+                check_reply(buf[offset:offset + length], length)
+            offset += (length + 3) & ~3
+        return done
+
+    async def _dump(self) -> None:
+        """Rebuild the flow table from a full read of conntrack.
+
+        Events keep being applied meanwhile, so counts stay current; they are
+        replayed onto the result, since the read may have passed a flow
+        before or after it started or ended.
+        """
+        loop = asyncio.get_running_loop()
+        sock = open_socket()
+        buf = bytearray(_RECV_SIZE)
+        dumped: dict[bytes, str] = {}
+        self._replay = replay = []
+        try:
+            await loop.sock_sendall(sock, _message(
+                IPCTNL_MSG_CT_GET, _NLM_F_REQUEST | _NLM_F_DUMP, 1, socket.AF_UNSPEC
+            ))
+            while True:
+                size = await loop.sock_recv_into(sock, buf)
+                if self.handle(buf, size, dumped):
+                    break
+        finally:
+            self._replay = None
+            sock.close()
+        for flow, interface in replay:
+            if interface is None:
+                dumped.pop(flow, None)
+            else:
+                dumped.setdefault(flow, interface)
+        self._flows = dumped
+        for egress in self._egress.values():
+            egress.active = 0
+        for interface in dumped.values():
+            egress = self._egress.get(interface)
+            if egress is None:
+                egress = self._egress[interface] = _Egress(interface)
+            egress.active += 1
+        if self._dumps == 0:
+            self._stale = set(dumped)
+        else:
+            self._stale.intersection_update(dumped)
+        self._dumps += 1
+        logger.debug(f"Conntrack dump: {len(dumped)} flow(s) through modems")
+
+    async def _listen(self) -> None:
+        loop = asyncio.get_running_loop()
+        buf = bytearray(_RECV_SIZE)
+        retry = _RETRY_MIN
+        while True:
+            if self._sock is None:
+                await asyncio.sleep(retry)
+                retry = min(retry * 2, _RETRY_MAX)
+                try:
+                    self._sock = open_socket(_EVENT_GROUPS, get_config().conntrack.receive_buffer)
+                except OSError as e:
+                    self._error = f"Event socket: {e}"
+                    logger.warning(f"Re-opening the conntrack event socket failed: {e}")
+                    continue
+                logger.info("Conntrack event socket re-opened, re-reading the table")
+                # Events were missed meanwhile; the read clears the error
+                self._lost.set()
+            try:
+                size = await loop.sock_recv_into(self._sock, buf)
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    self._overruns += 1
+                    logger.warning("Conntrack events lost, re-reading the table")
+                    self._lost.set()
+                    continue
+                self._error = f"Event socket: {e}"
+                logger.error(f"Conntrack event socket failed, re-opening it: {e}")
+                self._sock.close()
+                self._sock = None
+                continue
+            retry = _RETRY_MIN
+            try:
+                self.handle(buf, size)
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning(f"Skipping a bad conntrack event message: {e!r}")
+
+    async def _resync(self) -> None:
+        """Read the table at start, after lost events and periodically."""
+        retry = _RETRY_MIN
+        while True:
+            config = get_config().conntrack
+            # Events are subscribed to before the read, so no flow starts
+            # or ends unseen in between
+            self._lost.clear()
+            try:
+                await self._dump()
+            except (OSError, ValueError, struct.error) as e:
+                self._error = f"Table read: {e}"
+                logger.error(f"Reading the conntrack table failed, retrying in {retry:.0f}s: {e}")
+                await asyncio.sleep(retry)
+                retry = min(retry * 2, _RETRY_MAX)
+                continue
+            retry = _RETRY_MIN
+            if self._sock is not None:
+                self._error = None
+            interval = (
+                config.stale_resync_interval if self._stale else config.resync_interval
+            )
+            try:
+                await asyncio.wait_for(self._lost.wait(), interval if interval > 0 else None)
+            except asyncio.TimeoutError:
+                pass
+
+    # Byte rates
+
+    async def _sample_rates(self) -> None:
+        while True:
+            config = get_config().conntrack
+            now = time.monotonic()
+            for egress in list(self._egress.values()):
+                self._sample(egress, now, config.rate_smoothing)
+            await asyncio.sleep(config.rate_interval)
+
+    @staticmethod
+    def _sample(egress: _Egress, now: float, smoothing: float) -> None:
+        counters = read_counters(egress.interface)
+        if counters is None:
+            return
+        rx, tx = counters
+        if egress.rx is not None and rx >= egress.rx and tx >= egress.tx:
+            elapsed = now - egress.sampled_at
+            if elapsed > 0:
+                egress.rx_rate += smoothing * ((rx - egress.rx) / elapsed - egress.rx_rate)
+                egress.tx_rate += smoothing * ((tx - egress.tx) / elapsed - egress.tx_rate)
+                egress.rated = True
+        egress.rx, egress.tx, egress.sampled_at = rx, tx, now
+
+    # Reporting
+
+    @staticmethod
+    def _report(egress: _Egress) -> EgressFlows:
+        return EgressFlows(
+            interface=egress.interface,
+            modem_id=egress.modem_id,
+            active_flows=egress.active,
+            opened=egress.opened,
+            closed=egress.closed,
+            closed_bytes=egress.closed_bytes,
+            rx_bytes_per_second=egress.rx_rate,
+            tx_bytes_per_second=egress.tx_rate,
+        )
+
+    def active_flows(self, modem_id: int) -> int:
+        """Flows currently going out through a modem."""
+        return sum(e.active for e in self._egress.values() if e.modem_id == modem_id)
+
+    def rate(self, modem_id: int) -> Optional[float]:
+        """Bytes per second through a modem's interface, once it was measured."""
+        for egress in self._egress.values():
+            if egress.modem_id == modem_id and egress.rated:
+                return egress.rx_rate + egress.tx_rate
+        return None
+
+    def modem_flows(self, modem_id: int) -> Optional[EgressFlows]:
+        for egress in self._egress.values():
+            if egress.modem_id == modem_id:
+                return self._report(egress)
+        return None
+
+    def stats(self) -> ConntrackStats:
+        return ConntrackStats(
+            running=self.running,
+            error=self._error,
+            accounting=self._accounting,
+            tracked_flows=len(self._flows),
+            events=self._events,
+            dumps=self._dumps,
+            overruns=self._overruns,
+            egress=[self._report(e) for _, e in sorted(self._egress.items())],
+        )
+
+
+# Global instance
+conntrack_tracker = ConntrackTracker()
@@ -0,0 +1,589 @@
+"""Caching DNS resolver that queries each modem's carrier DNS through that modem.
+
+Squid (or anything else) sends queries to the local listener over UDP or
+TCP. Upstream queries go to the DNS servers the carrier handed out on the
+bearer, over a socket bound to the modem's interface, so answers match the
+network the traffic will leave through. Each modem has its own cache with
+negative caching (RFC 2308) and prefetch of popular names shortly before
+their TTL runs out.
+
+Code that knows the egress modem (SOCKS, the hedged connector, speed
+tests) calls ``resolve``/``lookup`` with its ID, so answers match the
+network the connection actually uses. Queries to the listener come from
+Squid and carry no client: Squid resolves a name once for every client,
+and each client's connection leaves by the kernel's per-flow multipath
+route or, with proxy users, by the user's group. So they can't follow the
+egress modem. They all go through one primary modem instead: the heaviest
+egress weight, so the most flows leave where the answer came from, and
+kept while it stays usable, so its cache stays warm instead of being
+split across modems.
+"""
+
+import asyncio
+import logging
+import random
+import socket
+import struct
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+from ..config import get_config
+from ..schemas import DNSReport, DNSUpstreamStats
+from .state import ModemRecord
+
+logger = logging.getLogger(__name__)
+
+_TYPE_A = 1
+_TYPE_SOA = 6
+_TYPE_OPT = 41
+_CLASS_IN = 1
+_RCODE_NXDOMAIN = 3
+_RCODE_SERVFAIL = 2
+_FLAG_QR = 0x8000
+_FLAG_TC = 0x0200
+_FLAG_RD = 0x0100
+_FLAG_RA = 0x0080
+_TCP_IDLE_TIMEOUT = 10.0
+
+# Key of the cache used when no modem can carry DNS (fallback servers)
+FALLBACK = None
+
+# What parse_message raises on malformed input
+_MALFORMED = (ValueError, IndexError, struct.error)
+# An upstream server failing: no answer, a cut-off TCP reply or garbage
+_UPSTREAM_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) + _MALFORMED
+
+CacheKey = tuple[str, int, int]
+
+
+@dataclass
+class DNSMessage:
+    """The parts of a DNS message the resolver needs."""
+
+    id: int
+    flags: int
+    key: CacheKey
+    question_end: int
+    answers: int
+    # Offsets of the TTL field of every record except OPT
+    ttl_offsets: list[int] = field(default_factory=list)
+    answer_ttl: Optional[int] = None
+    # min(SOA TTL, SOA minimum) from the authority section
+    negative_ttl: Optional[int] = None
+    # Advertised UDP payload size (EDNS), if any
+    udp_size: Optional[int] = None
+    addresses: list[str] = field(default_factory=list)
+
+    @property
+    def rcode(self) -> int:
+        return self.flags & 0x000F
+
+
+def _read_name(data: bytes, offset: int) -> tuple[str, int]:
+    """Decode a (possibly compressed) name; returns it and the offset after it."""
+    labels = []
+    end = None
+    for _ in range(128):
+        length = data[offset]
+        if length == 0:
+            return ".".join(labels), end if end is not None else offset + 1
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+        labels.append(data[offset + 1:offset + 1 + length].decode("ascii", "replace"))
+        offset += length + 1
+    raise ValueError("name compression loop")
+
+
+def parse_message(data: bytes) -> DNSMessage:
+    """Parse a query or response with exactly one question.
+
+    Raises ValueError (or IndexError/struct.error) on malformed input.
+    """
+    msg_id, flags, qdcount, ancount, nscount, arcount = struct.unpack_from("!6H", data)
+    if qdcount != 1:
+        raise ValueError("expected exactly one question")
+    name, offset = _read_name(data, 12)
+    qtype, qclass = struct.unpack_from("!HH", data, offset)
+    offset += 4
+    message = DNSMessage(
+        id=msg_id,
+        flags=flags,
+        key=(name.lower(), qtype, qclass),
+        question_end=offset,
+        answers=ancount,
+    )
+
+    for section, count in enumerate((ancount, nscount, arcount)):
+        for _ in range(count):
+            _, offset = _read_name(data, offset)
+            rtype, rclass, ttl, rdlength = struct.unpack_from("!HHIH", data, offset)
+            rdata = offset + 10
+            if rdata + rdlength > len(data):
+                raise ValueError("truncated record")
+            if rtype == _TYPE_OPT:
+                message.udp_size = rclass
+            else:
+                message.ttl_offsets.append(offset + 4)
+                if section == 0:
+                    if message.answer_ttl is None or ttl < message.answer_ttl:
+                        message.answer_ttl = ttl
+                    if rtype == _TYPE_A and rdlength == 4:
+                        message.addresses.append(socket.inet_ntoa(data[rdata:rdata + 4]))
+                elif section == 1 and rtype == _TYPE_SOA and rdlength >= 4:
+                    (minimum,) = struct.unpack_from("!I", data, rdata + rdlength - 4)
+                    message.negative_ttl = min(ttl, minimum)
+            offset = rdata + rdlength
+    return message
+
+
+def build_query(name: str, qtype: int = _TYPE_A) -> bytes:
+    """Encode a recursive query for ``name``."""
+    qname = b"".join(
+        bytes([len(label)]) + label.encode("ascii")
+        for label in name.rstrip(".").split(".")
+    ) + b"\x00"
+    header = struct.pack("!6H", random.getrandbits(16), _FLAG_RD, 1, 0, 0, 0)
+    return header + qname + struct.pack("!HH", qtype, _CLASS_IN)
+
+
+def error_response(query: bytes, message: DNSMessage, rcode: int) -> bytes:
+    """Answer ``query`` with an empty response carrying ``rcode``."""
+    flags = _FLAG_QR | _FLAG_RA | (message.flags & _FLAG_RD) | rcode
+    header = struct.pack("!6H", message.id, flags, 1, 0, 0, 0)
+    return header + query[12:message.question_end]
+
+
+def _truncated(response: bytes, message: DNSMessage) -> bytes:
+    """Header and question only, with TC set, so the client retries over TCP."""
+    header = struct.pack("!6H", message.id, message.flags | _FLAG_TC, 1, 0, 0, 0)
+    return header + response[12:message.question_end]
+
+
+@dataclass
+class _Entry:
+    response: bytes
+    ttl_offsets: list[int]
+    ttl: int
+    stored_at: float
+    negative: bool
+    hits: int = 0
+    prefetching: bool = False
+
+    @property
+    def expires_at(self) -> float:
+        return self.stored_at + self.ttl
+
+
+@dataclass
+class _Target:
+    """Where queries for one modem (or the fallback) go."""
+
+    interface: Optional[str]
+    servers: list[str]
+
+
+class _UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, txid: bytes):
+        self.txid = txid
+        self.future = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if data[:2] == self.txid and not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc: Exception) -> None:
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class _ListenerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, resolver: "DNSResolver"):
+        self.resolver = resolver
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self.resolver._spawn(self._answer(data, addr))
+
+    async def _answer(self, data: bytes, addr) -> None:
+        response = await self.resolver.handle(data, udp=True)
+        if response and self.transport is not None:
+            self.transport.sendto(response, addr)
+
+
+class DNSResolver:
+    """Per-modem caching forwarder with a local UDP/TCP listener."""
+
+    def __init__(self):
+        self._targets: dict[int, _Target] = {}
+        self._weights: dict[int, int] = {}
+        # Modem listener queries go through (None: fallback servers)
+        self._primary: Optional[int] = FALLBACK
+        self._caches: dict[Optional[int], OrderedDict[CacheKey, _Entry]] = {}
+        self._stats: dict[Optional[int], Counter] = {}
+        self._inflight: dict[tuple[Optional[int], CacheKey], asyncio.Future] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._udp: Optional[asyncio.DatagramTransport] = None
+        self._tcp: Optional[asyncio.AbstractServer] = None
+        self._clients: set[asyncio.StreamWriter] = set()
+
+    @property
+    def listening(self) -> bool:
+        return self._udp is not None
+
+    async def start(self) -> None:
+        """Start the local listener."""
+        config = get_config().dns
+        if not config.enabled:
+            logger.info("DNS resolver disabled in config")
+            return
+
+        loop = asyncio.get_running_loop()
+        try:
+            self._udp, _ = await loop.create_datagram_endpoint(
+                lambda: _ListenerProtocol(self),
+                local_addr=(config.listen_host, config.listen_port),
+            )
+            self._tcp = await asyncio.start_server(
+                self._handle_tcp, config.listen_host, config.listen_port
+            )
+        except OSError as e:
+            logger.error(
+                f"DNS resolver failed to listen on {config.listen_host}:{config.listen_port}: {e}"
+            )
+            await self.stop()
+            return
+        logger.info(f"DNS resolver listening on {config.listen_host}:{config.listen_port}")
+
+    async def stop(self) -> None:
+        """Stop listening and cancel background lookups."""
+        if self._udp is not None:
+            self._udp.close()
+            self._udp = None
+        if self._tcp is not None:
+            self._tcp.close()
+            for writer in list(self._clients):
+                writer.close()
+            # Let the connection handlers see EOF and finish
+            await asyncio.sleep(0.1)
+            await self._tcp.wait_closed()
+            self._tcp = None
+        for task in list(self._tasks):
+            task.cancel()
+        self._tasks.clear()
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def update_modems(self, modems: list[ModemRecord], weights: dict[int, int]) -> None:
+        """Refresh per-modem upstreams from the current inventory."""
+        targets = {}
+        for modem in modems:
+            if modem.interface and modem.ip_address and modem.bearer and modem.bearer.dns:
+                targets[modem.id] = _Target(modem.interface, list(modem.bearer.dns))
+        for modem_id in set(self._caches) - set(targets) - {FALLBACK}:
+            # Carrier changed or modem gone: its answers no longer apply
+            self._caches.pop(modem_id, None)
+        self._targets = targets
+        self._weights = weights
+
+    def _pick(self) -> Optional[int]:
+        """The primary modem for listener queries; see the module docstring."""
+        candidates = [
+            modem_id for modem_id in self._targets if self._weights.get(modem_id, 1) > 0
+        ]
+        if self._primary not in candidates:
+            self._primary = (
+                max(candidates, key=lambda modem_id: (self._weights.get(modem_id, 1), -modem_id))
+                if candidates else FALLBACK
+            )
+        return self._primary
+
+    def _target(self, modem_id: Optional[int]) -> _Target:
+        target = self._targets.get(modem_id) if modem_id is not FALLBACK else None
+        if target is None:
+            return _Target(None, get_config().dns.fallback_servers)
+        return target
+
+    async def handle(self, query: bytes, udp: bool = False) -> Optional[bytes]:
+        """Answer a query received by the listener (None if unparseable)."""
+        try:
+            message = parse_message(query)
+        except _MALFORMED:
+            return None
+        if message.flags & _FLAG_QR:
+            return None
+
+        response = await self.resolve(query, self._pick(), message)
+        if udp:
+            limit = max(512, message.udp_size or 512)
+            if len(response) > limit:
+                response = _truncated(response, parse_message(response))
+        return response
+
+    async def _handle_tcp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._clients.add(writer)
+        try:
+            while True:
+                # Idle connections are closed, as recommended by RFC 7766
+                prefix = await asyncio.wait_for(reader.readexactly(2), _TCP_IDLE_TIMEOUT)
+                (length,) = struct.unpack("!H", prefix)
+                query = await reader.readexactly(length)
+                response = await self.handle(query)
+                if response is None:
+                    break
+                writer.write(struct.pack("!H", len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+    async def resolve(
+        self,
+        query: bytes,
+        modem_id: Optional[int],
+        message: Optional[DNSMessage] = None,
+    ) -> bytes:
+        """Answer a wire-format query through ``modem_id`` (FALLBACK for none)."""
+        message = message or parse_message(query)
+        stats = self._stats.setdefault(modem_id, Counter())
+        stats["queries"] += 1
+
+        cached = self._from_cache(modem_id, message)
+        if cached is not None:
+            return cached
+        stats["misses"] += 1
+
+        inflight_key = (modem_id, message.key)
+        future = self._inflight.get(inflight_key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(modem_id, query, message.key))
+            self._inflight[inflight_key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(inflight_key, None))
+        try:
+            response = await asyncio.shield(future)
+        except _UPSTREAM_ERRORS as e:
+            stats["errors"] += 1
+            logger.debug(f"DNS lookup of {message.key[0]} via modem {modem_id} failed: {e}")
+            return error_response(query, message, _RCODE_SERVFAIL)
+        return struct.pack("!H", message.id) + response[2:]
+
+    async def lookup(self, host: str, modem_id: Optional[int] = None) -> list[str]:
+        """IPv4 addresses of ``host`` as seen through ``modem_id`` ([] on failure)."""
+        query = build_query(host)
+        response = await self.resolve(query, modem_id if modem_id is not None else self._pick())
+        try:
+            return parse_message(response).addresses
+        except _MALFORMED:
+            return []
+
+    def _from_cache(self, modem_id: Optional[int], message: DNSMessage) -> Optional[bytes]:
+        cache = self._caches.get(modem_id)
+        entry = cache.get(message.key) if cache else None
+        if entry is None:
+            return None
+        now = time.time()
+        if now >= entry.expires_at:
+            del cache[message.key]
+            return None
+
+        cache.move_to_end(message.key)
+        entry.hits += 1
+        stats = self._stats[modem_id]
+        stats["negative_hits" if entry.negative else "hits"] += 1
+
+        config = get_config().dns
+        if (
+            not entry.prefetching
+            and not entry.negative
+            and entry.hits >= config.prefetch_hits
+            and entry.expires_at - now < entry.ttl * config.prefetch_fraction
+        ):
+            entry.prefetching = True
+            stats["prefetches"] += 1
+            self._spawn(self._prefetch(modem_id, message.key))
+
+        age = int(now - entry.stored_at)
+        response = bytearray(entry.response)
+        struct.pack_into("!H", response, 0, message.id)
+        for offset in entry.ttl_offsets:
+            (ttl,) = struct.unpack_from("!I", response, offset)
+            struct.pack_into("!I", response, offset, max(0, ttl - age))
+        return bytes(response)
+
+    async def _prefetch(self, modem_id: Optional[int], key: CacheKey) -> None:
+        name, qtype, _ = key
+        try:
+            await self._fetch(modem_id, build_query(name, qtype), key)
+        except _UPSTREAM_ERRORS as e:
+            logger.debug(f"DNS prefetch of {name} failed: {e}")
+
+    async def _fetch(self, modem_id: Optional[int], query: bytes, key: CacheKey) -> bytes:
+        target = self._target(modem_id)
+        error: Exception = OSError("no DNS servers")
+        for server in target.servers:
+            try:
+                response = await self._query_server(server, target.interface, query)
+            except _UPSTREAM_ERRORS as e:
+                error = e
+                continue
+            self._store(modem_id, key, response)
+            return response
+        raise error
+
+    def _store(self, modem_id: Optional[int], key: CacheKey, response: bytes) -> None:
+        message = parse_message(response)
+        config = get_config().dns
+        if message.flags & _FLAG_TC:
+            return
+        if message.rcode == _RCODE_NXDOMAIN or (message.rcode == 0 and not message.answers):
+            negative = True
+            ttl = min(
+                message.negative_ttl if message.negative_ttl is not None else config.negative_ttl,
+                config.negative_ttl,
+            )
+        elif message.rcode == 0:
+            negative = False
+            ttl = min(message.answer_ttl or 0, config.max_ttl)
+        else:
+            return
+        if ttl <= 0:
+            return
+
+        cache = self._caches.setdefault(modem_id, OrderedDict())
+        cache[key] = _Entry(
+            response=response,
+            ttl_offsets=message.ttl_offsets,
+            ttl=ttl,
+            stored_at=time.time(),
+            negative=negative,
+        )
+        cache.move_to_end(key)
+        while len(cache) > config.max_entries:
+            cache.popitem(last=False)
+
+    def _socket(self, server: str, kind: int, interface: Optional[str]) -> socket.socket:
+        family = socket.AF_INET6 if ":" in server else socket.AF_INET
+        sock = socket.socket(family, kind)
+        sock.setblocking(False)
+        if interface:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode())
+            except OSError:
+                sock.close()
+                raise
+        return sock
+
+    async def _query_server(self, server: str, interface: Optional[str], query: bytes) -> bytes:
+        timeout = get_config().dns.timeout
+        # Fresh transaction ID and source port per upstream query
+        txid = struct.pack("!H", random.getrandbits(16))
+        query = txid + query[2:]
+        response = await asyncio.wait_for(
+            self._query_udp(server, interface, query, txid), timeout
+        )
+        if parse_message(response).flags & _FLAG_TC:
+            response = await asyncio.wait_for(
+                self._query_tcp(server, interface, query), timeout
+            )
+        if parse_message(response).key != parse_message(query).key:
+            raise ValueError("response does not match question")
+        return response
+
+    async def _query_udp(
+        self, server: str, interface: Optional[str], query: bytes, txid: bytes
+    ) -> bytes:
+        loop = asyncio.get_running_loop()
+        sock = self._socket(server, socket.SOCK_DGRAM, interface)
+        try:
+            sock.connect((server, 53))
+        except OSError:
+            sock.close()
+            raise
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: _UpstreamProtocol(txid), sock=sock
+        )
+        try:
+            transport.sendto(query)
+            return await protocol.future
+        finally:
+            transport.close()
+
+    async def _query_tcp(self, server: str, interface: Optional[str], query: bytes) -> bytes:
+        loop = asyncio.get_running_loop()
+        sock = self._socket(server, socket.SOCK_STREAM, interface)
+        try:
+            await loop.sock_connect(sock, (server, 53))
+        except OSError:
+            sock.close()
+            raise
+        reader, writer = await asyncio.open_connection(sock=sock)
+        try:
+            writer.write(struct.pack("!H", len(query)) + query)
+            await writer.drain()
+            (length,) = struct.unpack("!H", await reader.readexactly(2))
+            return await reader.readexactly(length)
+        finally:
+            writer.close()
+
+    def flush(self) -> int:
+        """Drop all cached answers; returns the number of entries removed."""
+        removed = sum(len(cache) for cache in self._caches.values())
+        self._caches.clear()
+        return removed
+
+    def stats(self) -> DNSReport:
+        """Hit rates and cache sizes per upstream."""
+        config = get_config().dns
+        upstreams = []
+        totals: Counter = Counter()
+        for modem_id in sorted(self._stats, key=lambda m: -1 if m is FALLBACK else m):
+            stats = self._stats[modem_id]
+            totals.update(stats)
+            target = (
+                self._target(FALLBACK) if modem_id is FALLBACK
+                else self._targets.get(modem_id, _Target(None, []))
+            )
+            upstreams.append(DNSUpstreamStats(
+                modem_id=modem_id,
+                interface=target.interface,
+                servers=target.servers,
+                queries=stats["queries"],
+                hits=stats["hits"],
+                negative_hits=stats["negative_hits"],
+                misses=stats["misses"],
+                prefetches=stats["prefetches"],
+                errors=stats["errors"],
+                entries=len(self._caches.get(modem_id, ())),
+                hit_rate=_hit_rate(stats),
+            ))
+        return DNSReport(
+            enabled=config.enabled,
+            listening=self.listening,
+            listen=f"{config.listen_host}:{config.listen_port}",
+            primary_modem_id=self._primary,
+            queries=totals["queries"],
+            hit_rate=_hit_rate(totals),
+            upstreams=upstreams,
+        )
+
+
+def _hit_rate(stats: Counter) -> Optional[float]:
+    if not stats["queries"]:
+        return None
+    return (stats["hits"] + stats["negative_hits"]) / stats["queries"]
+
+
+# Global instance
+dns_resolver = DNSResolver()
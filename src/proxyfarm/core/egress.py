@@ -0,0 +1,122 @@
+"""Egress weighting across modems.
+
+Other components (quota tracking, health, throughput) contribute a factor in
+[0, 1] per modem. The product of a modem's factors scales its weight in the
+multipath default route; a modem whose factor reaches zero is left out.
+"""
+
+import logging
+from typing import Optional
+
+from ..config import get_config
+from ..schemas import ModemState
+from .network import network_manager
+from .state import ModemRecord
+
+logger = logging.getLogger(__name__)
+
+
+def _same_route(a: list[tuple[str, str, int]], b: list[tuple[str, str, int]]) -> bool:
+    """Whether two sorted hop lists are the same route.
+
+    The kernel keeps no weight for a single nexthop, so it is not compared.
+    """
+    if len(a) == 1 and len(b) == 1:
+        return a[0][:2] == b[0][:2]
+    return a == b
+
+
+class EgressBalancer:
+    """Turns per-modem factors into multipath route weights."""
+
+    def __init__(self):
+        self._factors: dict[int, dict[str, float]] = {}
+        self._applied: Optional[list[tuple[str, str, int]]] = None
+        self._modems: list[ModemRecord] = []
+
+    @property
+    def routes(self) -> list[tuple[str, str, int]]:
+        """(gateway, interface, weight) of the default route last installed."""
+        return list(self._applied or [])
+
+    def set_factor(self, modem_id: int, source: str, value: float) -> None:
+        """Set one source's factor for a modem (clamped to [0, 1])."""
+        self._factors.setdefault(modem_id, {})[source] = min(1.0, max(0.0, value))
+
+    def clear_factor(self, modem_id: int, source: str) -> None:
+        self._factors.get(modem_id, {}).pop(source, None)
+
+    def factors(self, modem_id: int) -> dict[str, float]:
+        return dict(self._factors.get(modem_id, {}))
+
+    def factor(self, modem_id: int) -> float:
+        result = 1.0
+        for value in self._factors.get(modem_id, {}).values():
+            result *= value
+        return result
+
+    def weights(self, modems: list[ModemRecord]) -> dict[int, int]:
+        """Route weight per usable modem; 0 means excluded."""
+        max_weight = get_config().egress.max_weight
+        weights = {}
+        for modem in modems:
+            if not self._routable(modem):
+                continue
+            weights[modem.id] = round(self.factor(modem.id) * max_weight)
+        # Never take the farm offline because every modem is near a limit
+        if weights and not any(weights.values()):
+            weights = {modem_id: 1 for modem_id in weights}
+        return weights
+
+    @staticmethod
+    def _routable(modem: ModemRecord) -> bool:
+        return (
+            modem.state == ModemState.CONNECTED
+            and modem.interface is not None
+            and modem.bearer is not None
+            and modem.bearer.gateway is not None
+        )
+
+    async def apply(self, modems: list[ModemRecord]) -> bool:
+        """Update the default route if the weights changed."""
+        self._modems = modems
+        if not get_config().egress.enabled:
+            return False
+
+        weights = self.weights(modems)
+        nexthops = sorted(
+            (modem.bearer.gateway, modem.interface, weights[modem.id])
+            for modem in modems
+            if weights.get(modem.id)
+        )
+        if not nexthops:
+            return False
+        # Compare with the kernel rather than what was last applied: the
+        # routing timer (scripts/setup/routing.sh) or a NetworkManager
+        # dispatcher hook may have replaced the route with equal weights
+        installed = await network_manager.get_default_multipath()
+        if installed is None:
+            installed = self._applied
+        elif self._applied and not _same_route(installed, self._applied):
+            logger.warning("Default route was replaced outside ProxyFarm, restoring weights")
+        if installed and _same_route(installed, nexthops):
+            self._applied = nexthops
+            return False
+
+        logger.info(
+            "Updating egress weights: "
+            + ", ".join(f"{iface}={weight}" for _, iface, weight in nexthops)
+        )
+        if await network_manager.set_default_multipath(nexthops):
+            self._applied = nexthops
+            await network_manager.flush_routes()
+            return True
+        return False
+
+    async def refresh(self) -> bool:
+        """Apply changed factors now, to the modems of the last update."""
+        return await self.apply(self._modems)
+
+
+# Global instance
+egress_balancer = EgressBalancer()
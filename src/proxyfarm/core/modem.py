@@ -3,15 +3,45 @@
 import asyncio
 import logging
 import re
-from typing import Optional
+from collections import Counter
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
 
-from ..schemas import Bearer, Modem, ModemState
+from ..schemas import ModemState, RadioInfo, RadioMode, RadioSettings
+from .state import BearerRecord, ModemRecord
 
 logger = logging.getLogger(__name__)
 
+CommandBackend = Callable[[list[str]], Awaitable[tuple[str, str, int]]]
+
+# Replacement for real subprocesses, installed by the simulation backend
+_command_backend: Optional[CommandBackend] = None
+
+# Number of commands run, keyed by executable
+command_counts: Counter[str] = Counter()
+
+
+def set_command_backend(backend: Optional[CommandBackend]) -> None:
+    """Route run_command through ``backend`` instead of spawning processes."""
+    global _command_backend
+    _command_backend = backend
+
+
+def is_simulated() -> bool:
+    """Whether commands are served by a simulation backend."""
+    return _command_backend is not None
+
 
 async def run_command(cmd: list[str], timeout: float = 30.0) -> tuple[str, str, int]:
     """Run a shell command asynchronously."""
+    command_counts[cmd[0]] += 1
+    if _command_backend is not None:
+        try:
+            return await asyncio.wait_for(_command_backend(cmd), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Command timed out: {' '.join(cmd)}")
+            raise
+
     try:
         proc = await asyncio.create_subprocess_exec(
             *cmd,
@@ -47,6 +77,48 @@ def parse_mmcli_output(output: str) -> dict[str, str]:
     return result
 
 
+def parse_mmcli_keyvalue(output: str) -> dict[str, object]:
+    """Parse ``mmcli -K`` output; list values (``key.value[N]``) become lists."""
+    result: dict[str, object] = {}
+    for line in output.split("\n"):
+        key, sep, value = line.partition(":")
+        if not sep:
+            continue
+        key, value = key.strip(), value.strip()
+        if value == "--":
+            value = ""
+        list_match = re.fullmatch(r"(.+)\.value\[\d+\]", key)
+        if list_match:
+            items = result.setdefault(list_match.group(1), [])
+            if value and isinstance(items, list):
+                items.append(value)
+        elif not key.endswith(".length"):
+            result[key] = value
+    return result
+
+
+def parse_radio_mode(value: str) -> Optional[RadioMode]:
+    """Parse a mode combination like ``allowed: 3g, 4g; preferred: 4g``."""
+    parts = dict(
+        part.strip().partition(":")[::2] for part in value.split(";") if ":" in part
+    )
+    allowed = [mode.strip() for mode in parts.get("allowed", "").split(",") if mode.strip()]
+    if not allowed:
+        return None
+    preferred = parts.get("preferred", "").strip()
+    return RadioMode(
+        allowed=allowed, preferred=preferred if preferred not in ("", "none") else None
+    )
+
+
+def band_technology(band: str) -> str:
+    """Access technology of a ModemManager band name (``eutran-3`` -> ``4g``)."""
+    for prefix, technology in (("ngran-", "5g"), ("eutran-", "4g"), ("utran-", "3g")):
+        if band.startswith(prefix):
+            return technology
+    return "2g"
+
+
 def state_from_string(state_str: str) -> ModemState:
     """Convert state string to ModemState enum."""
     state_map = {
@@ -65,6 +137,10 @@ def state_from_string(state_str: str) -> ModemState:
     return state_map.get(state_str.lower(), ModemState.UNKNOWN)
 
 
+# Modem fields that need the bearer lookup (an extra mmcli call)
+BEARER_FIELDS = frozenset({"bearer", "interface", "ip_address"})
+
+
 class ModemManager:
     """Wrapper for ModemManager CLI (mmcli)."""
 
@@ -81,8 +157,14 @@ class ModemManager:
             modem_ids.append(int(match.group(1)))
         return modem_ids
 
-    async def get_modem(self, modem_id: int) -> Optional[Modem]:
-        """Get detailed information about a modem."""
+    async def get_modem(
+        self, modem_id: int, fields: Optional[set[str]] = None
+    ) -> Optional[ModemRecord]:
+        """Get detailed information about a modem.
+
+        With ``fields``, the bearer lookup is skipped unless one of them
+        needs it; bearer-derived fields are then left empty.
+        """
         stdout, stderr, rc = await run_command(["mmcli", "-m", str(modem_id)])
         if rc != 0:
             logger.error(f"Failed to get modem {modem_id}: {stderr}")
@@ -95,8 +177,9 @@ class ModemManager:
         signal_match = re.search(r"(\d+)%", signal_str)
         signal_quality = int(signal_match.group(1)) if signal_match else None
 
-        # Get bearer info
-        bearer = await self.get_bearer(modem_id)
+        bearer = None
+        if fields is None or fields & BEARER_FIELDS:
+            bearer = await self.get_bearer(modem_id, stdout)
 
         # Determine interface from bearer or primary port
         interface = None
@@ -110,7 +193,7 @@ class ModemManager:
                 if num:
                     interface = f"wwan{num.group()}"
 
-        return Modem(
+        return ModemRecord(
             id=modem_id,
             manufacturer=data.get("manufacturer"),
             model=data.get("model"),
@@ -125,14 +208,21 @@ class ModemManager:
             ip_address=bearer.ip_address if bearer else None,
         )
 
-    async def get_bearer(self, modem_id: int) -> Optional[Bearer]:
-        """Get bearer information for a modem."""
-        # First get modem info to find bearer ID
-        stdout, stderr, rc = await run_command(["mmcli", "-m", str(modem_id)])
-        if rc != 0:
-            return None
-
-        bearer_match = re.search(r"Bearer/(\d+)", stdout)
+    async def get_bearer(
+        self, modem_id: int, modem_output: Optional[str] = None
+    ) -> Optional[BearerRecord]:
+        """Get bearer information for a modem.
+
+        ``modem_output`` is the modem's ``mmcli -m`` output, if the caller
+        already has it.
+        """
+        if modem_output is None:
+            # First get modem info to find bearer ID
+            modem_output, stderr, rc = await run_command(["mmcli", "-m", str(modem_id)])
+            if rc != 0:
+                return None
+
+        bearer_match = re.search(r"Bearer/(\d+)", modem_output)
         if not bearer_match:
             return None
 
@@ -149,7 +239,7 @@ class ModemManager:
         dns_str = data.get("dns", "")
         dns_servers = [d.strip() for d in dns_str.split(",") if d.strip()]
 
-        return Bearer(
+        return BearerRecord(
             id=bearer_id,
             interface=data.get("interface"),
             ip_address=data.get("address"),
@@ -157,12 +247,17 @@ class ModemManager:
             dns=dns_servers,
         )
 
-    async def list_modems(self) -> list[Modem]:
+    async def list_modems(self) -> list[ModemRecord]:
         """Get list of all modems with details."""
-        modem_ids = await self.list_modem_ids()
+        return await self.get_modems(await self.list_modem_ids())
+
+    async def get_modems(
+        self, modem_ids: list[int], fields: Optional[set[str]] = None
+    ) -> list[ModemRecord]:
+        """Get details of the given modems, leaving out ones that fail."""
         modems = []
         for mid in modem_ids:
-            modem = await self.get_modem(mid)
+            modem = await self.get_modem(mid, fields)
             if modem:
                 modems.append(modem)
         return modems
@@ -183,12 +278,48 @@ class ModemManager:
             return False
         return True
 
-    async def send_ussd(self, modem_id: int, command: str) -> tuple[bool, str]:
+    async def simple_disconnect(self, modem_id: int) -> bool:
+        """Disconnect and drop all bearers of a modem."""
+        stdout, stderr, rc = await run_command(
+            ["mmcli", "-m", str(modem_id), "--simple-disconnect"]
+        )
+        if rc != 0:
+            logger.error(f"Failed to disconnect modem {modem_id}: {stderr}")
+            return False
+        return True
+
+    async def usb_reset(self, modem_id: int) -> bool:
+        """Power-cycle the modem's USB port by de- and re-authorizing the device.
+
+        The modem disappears from ModemManager and comes back, usually with a
+        new modem ID.
+        """
+        stdout, stderr, rc = await run_command(["mmcli", "-m", str(modem_id)])
+        if rc != 0:
+            return False
+        physdev = parse_mmcli_output(stdout).get("physdev")
+        if not physdev:
+            logger.error(f"Modem {modem_id} has no physical device path")
+            return False
+
+        authorized = Path(physdev) / "authorized"
+        try:
+            await asyncio.to_thread(authorized.write_text, "0")
+            await asyncio.sleep(2)
+            await asyncio.to_thread(authorized.write_text, "1")
+        except OSError as e:
+            logger.error(f"USB reset of modem {modem_id} ({physdev}) failed: {e}")
+            return False
+        return True
+
+    async def send_ussd(
+        self, modem_id: int, command: str, timeout: float = 60.0
+    ) -> tuple[bool, str]:
         """Send USSD command to a modem."""
         # First initiate USSD session
         stdout, stderr, rc = await run_command(
             ["mmcli", "-m", str(modem_id), "--3gpp-ussd-initiate", command],
-            timeout=60.0,
+            timeout=timeout,
         )
 
         if rc != 0:
@@ -202,6 +333,89 @@ class ModemManager:
 
         return True, stdout
 
+    async def get_radio(self, modem_id: int) -> Optional[RadioInfo]:
+        """Get supported and current radio modes and bands of a modem.
+
+        Read from the ``-K`` (key-value) output: the human-readable one wraps
+        mode and band lists over several lines.
+        """
+        stdout, stderr, rc = await run_command(["mmcli", "-m", str(modem_id), "-K"])
+        if rc != 0:
+            logger.error(f"Failed to get radio settings of modem {modem_id}: {stderr}")
+            return None
+
+        data = parse_mmcli_keyvalue(stdout)
+
+        def values(key: str) -> list[str]:
+            value = data.get(key)
+            return value if isinstance(value, list) else []
+
+        current = parse_radio_mode(str(data.get("modem.generic.current-modes", "")))
+        if current is None:
+            return None
+        supported_modes = [
+            mode for mode in map(parse_radio_mode, values("modem.generic.supported-modes"))
+            if mode is not None
+        ]
+        supported_bands = values("modem.generic.supported-bands")
+        bands = values("modem.generic.current-bands")
+        if set(bands) >= set(supported_bands):
+            bands = []
+        return RadioInfo(
+            modem_id=modem_id,
+            current=RadioSettings(modes=current, bands=bands),
+            supported_modes=supported_modes,
+            supported_bands=supported_bands,
+            access_technologies=values("modem.generic.access-technologies"),
+            location=await self._location(
+                modem_id, str(data.get("modem.3gpp.operator-code", ""))
+            ),
+        )
+
+    async def _location(self, modem_id: int, operator_id: str) -> str:
+        """Operator and tracking (or location) area, as far as known."""
+        stdout, stderr, rc = await run_command(
+            ["mmcli", "-m", str(modem_id), "--location-get", "-K"]
+        )
+        data = parse_mmcli_keyvalue(stdout) if rc == 0 else {}
+        if not operator_id:
+            operator_id = "".join(
+                str(data.get(f"modem.location.3gpp.{key}", "")) for key in ("mcc", "mnc")
+            )
+        area = data.get("modem.location.3gpp.tac") or data.get("modem.location.3gpp.lac")
+        location = operator_id or "unknown"
+        return f"{location}/{area}" if area else location
+
+    async def set_allowed_modes(
+        self, modem_id: int, allowed: list[str], preferred: Optional[str] = None
+    ) -> bool:
+        """Restrict the access technologies a modem may use."""
+        cmd = ["mmcli", "-m", str(modem_id), f"--set-allowed-modes={'|'.join(allowed)}"]
+        if preferred:
+            cmd.append(f"--set-preferred-mode={preferred}")
+        stdout, stderr, rc = await run_command(cmd)
+        if rc != 0:
+            logger.error(f"Failed to set allowed modes of modem {modem_id}: {stderr}")
+            return False
+        return True
+
+    async def set_current_bands(self, modem_id: int, bands: list[str]) -> bool:
+        """Restrict the bands a modem may use; an empty list allows all."""
+        stdout, stderr, rc = await run_command(
+            ["mmcli", "-m", str(modem_id), f"--set-current-bands={'|'.join(bands) or 'any'}"]
+        )
+        if rc != 0:
+            logger.error(f"Failed to set bands of modem {modem_id}: {stderr}")
+            return False
+        return True
+
+    async def cancel_ussd(self, modem_id: int) -> bool:
+        """Cancel an ongoing USSD session on a modem."""
+        stdout, stderr, rc = await run_command(
+            ["mmcli", "-m", str(modem_id), "--3gpp-ussd-cancel"]
+        )
+        return rc == 0
+
 
 # Global instance
 modem_manager = ModemManager()
@@ -31,11 +31,49 @@ class NetworkManager:
             return None
         return stdout.strip() if stdout else None
 
-    async def connection_up(self, connection_name: str) -> bool:
+    async def get_connection_settings(
+        self, connection_name: str, fields: list[str]
+    ) -> Optional[dict[str, str]]:
+        """Get selected settings of a connection, or None if it doesn't exist."""
+        stdout, stderr, rc = await run_command([
+            "nmcli", "-g", ",".join(fields), "connection", "show", connection_name
+        ])
+        if rc != 0:
+            return None
+        values = stdout.split("\n")
+        return {field: (values[i].strip() if i < len(values) else "")
+                for i, field in enumerate(fields)}
+
+    async def add_gsm_connection(
+        self, connection_name: str, interface: str, apn: str
+    ) -> bool:
+        """Create a GSM connection bound to a modem control port."""
+        stdout, stderr, rc = await run_command([
+            "nmcli", "connection", "add", "type", "gsm", "ifname", interface,
+            "con-name", connection_name, "gsm.apn", apn,
+            "connection.autoconnect", "yes",
+        ])
+        if rc != 0:
+            logger.error(f"Failed to create connection {connection_name}: {stderr}")
+            return False
+        return True
+
+    async def modify_connection(self, connection_name: str, settings: dict[str, str]) -> bool:
+        """Update settings of an existing connection."""
+        cmd = ["nmcli", "connection", "modify", connection_name]
+        for key, value in settings.items():
+            cmd += [key, value]
+        stdout, stderr, rc = await run_command(cmd)
+        if rc != 0:
+            logger.error(f"Failed to modify connection {connection_name}: {stderr}")
+            return False
+        return True
+
+    async def connection_up(self, connection_name: str, timeout: float = 60.0) -> bool:
         """Activate a NetworkManager connection."""
         stdout, stderr, rc = await run_command([
             "nmcli", "connection", "up", connection_name
-        ], timeout=60.0)
+        ], timeout=timeout)
         if rc != 0:
             logger.error(f"Failed to activate connection {connection_name}: {stderr}")
             return False
@@ -102,6 +140,50 @@ class NetworkManager:
             logger.error(f"Connectivity check failed for {interface}: {e}")
             return False, None
 
+    async def set_default_multipath(
+        self, nexthops: list[tuple[str, str, int]]
+    ) -> bool:
+        """Replace the default route with weighted (gateway, interface, weight) hops."""
+        if not nexthops:
+            return False
+        cmd = ["ip", "route", "replace", "default", "scope", "global"]
+        for gateway, interface, weight in nexthops:
+            cmd += ["nexthop", "via", gateway, "dev", interface, "weight", str(weight)]
+        stdout, stderr, rc = await run_command(cmd)
+        if rc != 0:
+            logger.error(f"Failed to set default route: {stderr}")
+            return False
+        return True
+
+    async def get_default_multipath(self) -> Optional[list[tuple[str, str, int]]]:
+        """Sorted (gateway, interface, weight) hops of the default route.
+
+        Only the route without a metric counts, the one set_default_multipath
+        installs; backup routes have one. A plain route is one hop of weight
+        1. Returns [] if there is no such route, None if it can't be read.
+        """
+        stdout, stderr, rc = await run_command(["ip", "route", "show", "default"])
+        if rc != 0:
+            return None
+
+        # One route per unindented line, its nexthops on the indented ones
+        routes: list[str] = []
+        for line in stdout.splitlines():
+            if line[:1].isspace() and routes:
+                routes[-1] += " " + line.strip()
+            elif line.strip():
+                routes.append(line.strip())
+        for route in routes:
+            if " metric " in f" {route} ":
+                continue
+            hops = re.findall(r"nexthop\s+via\s+(\S+)\s+dev\s+(\S+)\s+weight\s+(\d+)", route)
+            if hops:
+                return sorted((gateway, iface, int(weight)) for gateway, iface, weight in hops)
+            match = re.search(r"via\s+(\S+)\s+dev\s+(\S+)", route)
+            if match:
+                return [(match.group(1), match.group(2), 1)]
+        return []
+
     async def flush_routes(self) -> bool:
         """Flush route cache."""
         stdout, stderr, rc = await run_command(["ip", "route", "flush", "cache"])
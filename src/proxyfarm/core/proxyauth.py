@@ -0,0 +1,299 @@
+"""Proxy users, modem groups and the live feed for the Squid auth helper.
+
+Users log in to Squid with basic auth, checked by ``proxyfarm.helper``.
+Each user belongs to groups; a group is the set of modems tagged with its
+name. Users and tags are kept in the state store. Whenever they change, or
+the usable modems change (a modem starts rotating, or a monitor cycle sees
+modems come and go), the whole table is pushed to every connected helper
+and written to the state file that newly started helpers read first.
+
+The SOCKS5 listener checks logins here directly, against the same table.
+"""
+
+import asyncio
+import grp
+import json
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Optional
+
+from ..config import get_config
+from ..helper import CredentialCache, hash_password, pick_modem, verify_password
+from ..schemas import ProxyGroup, ProxyUser
+from .state import ModemRecord
+from .store import state_store
+
+logger = logging.getLogger(__name__)
+
+_USERS_KEY = "proxy.users"
+_TAGS_KEY = "proxy.modem_tags"
+
+# Usernames and tags end up in helper replies and Squid ACL names
+_NAME = re.compile(r"^[A-Za-z0-9_.@-]{1,64}$")
+
+
+def _share_with_helper(fd_or_path) -> None:
+    """Give a file the helper must open the configured group and mode."""
+    config = get_config().proxy_auth
+    gid = -1
+    if config.socket_group:
+        try:
+            gid = grp.getgrnam(config.socket_group).gr_gid
+        except KeyError:
+            logger.warning(f"Group {config.socket_group} not found, helper may lack access")
+    if isinstance(fd_or_path, int):
+        os.fchown(fd_or_path, -1, gid)
+        os.fchmod(fd_or_path, config.file_mode)
+    else:
+        os.chown(fd_or_path, -1, gid)
+        os.chmod(fd_or_path, config.file_mode)
+
+
+class ProxyAuth:
+    """Owns proxy users and modem tags, and feeds them to Squid's helpers."""
+
+    def __init__(self):
+        # name -> {"password": <hash>, "groups": [...], "enabled": bool}
+        self._users: dict[str, dict] = {}
+        self._tags: dict[int, list[str]] = {}
+        self._modems: dict[int, dict] = {}
+        self._draining: set[int] = set()
+        # User -> traffic shaping class, named in the helper's replies
+        self._classes: dict[str, int] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._socket_path: Optional[Path] = None
+        self._clients: set[asyncio.StreamWriter] = set()
+        self._state: bytes = b""
+        # What the helpers see, for logins checked in-process (SOCKS5)
+        self._credentials = CredentialCache()
+
+    @staticmethod
+    def valid_name(name: str) -> bool:
+        return bool(_NAME.match(name))
+
+    async def start(self) -> None:
+        """Load users and tags, and start serving the helper feed."""
+        config = get_config().proxy_auth
+        self._users = await state_store.get_value(_USERS_KEY, {})
+        self._tags = {
+            int(modem_id): tags
+            for modem_id, tags in (await state_store.get_value(_TAGS_KEY, {})).items()
+        }
+        self._publish()
+        if not config.enabled:
+            return
+
+        socket_path = Path(config.socket_path)
+        try:
+            socket_path.parent.mkdir(parents=True, exist_ok=True)
+            socket_path.unlink(missing_ok=True)
+            self._server = await asyncio.start_unix_server(self._handle, path=str(socket_path))
+        except OSError as e:
+            logger.error(f"Proxy auth feed failed to listen on {socket_path}: {e}")
+            return
+        try:
+            # Connecting needs write permission on the socket
+            _share_with_helper(socket_path)
+        except OSError as e:
+            logger.warning(f"Failed to set helper access on {socket_path}: {e}")
+        self._socket_path = socket_path
+        self._publish()
+        logger.info(f"Proxy auth feed listening on {socket_path}")
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in list(self._clients):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+        # The path bound at start, which a reloaded config may have changed
+        self._socket_path.unlink(missing_ok=True)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._clients.add(writer)
+        try:
+            writer.write(self._state)
+            await writer.drain()
+            # Helpers never send anything; EOF means they went away
+            await reader.read()
+        except ConnectionError:
+            pass
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+    def _publish(self) -> None:
+        state = {
+            "users": self._users,
+            "modems": self._published_modems(),
+            "classes": self._classes,
+        }
+        self._state = json.dumps(state, separators=(",", ":")).encode() + b"\n"
+        self._credentials.load(state)
+        if self._server is None:
+            return
+
+        path = Path(get_config().proxy_auth.state_path)
+        tmp = path.with_suffix(".tmp")
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            _share_with_helper(fd)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._state)
+            tmp.replace(path)
+        except OSError as e:
+            logger.warning(f"Failed to write helper state file {path}: {e}")
+
+        for writer in list(self._clients):
+            if writer.transport.get_write_buffer_size() > 1 << 20:
+                # A helper that stopped reading gets dropped, not buffered forever
+                writer.close()
+                continue
+            writer.write(self._state)
+
+    def update_modems(self, modems: list[ModemRecord], weights: dict[int, int]) -> None:
+        """Refresh usable modems; ones with zero egress weight are left out."""
+        current = {
+            modem.id: {
+                "id": modem.id,
+                "interface": modem.interface,
+                "usable": weights.get(modem.id, 0) > 0 and modem.id not in self._draining,
+            }
+            for modem in modems
+        }
+        if current != self._modems:
+            self._modems = current
+            self._publish()
+
+    def set_classes(self, classes: dict[str, int]) -> None:
+        """Users' traffic shaping classes, for Squid to mark their connections by."""
+        if classes != self._classes:
+            self._classes = classes
+            self._publish()
+
+    def set_draining(self, modem_id: int, draining: bool) -> None:
+        """Steer new logins away from a modem while it is being rotated."""
+        if draining:
+            self._draining.add(modem_id)
+        else:
+            self._draining.discard(modem_id)
+        modem = self._modems.get(modem_id)
+        if modem is not None and draining and modem["usable"]:
+            modem["usable"] = False
+            self._publish()
+        # Becoming usable again waits for the next monitor cycle to confirm
+
+    async def authenticate(self, name: str, password: str) -> bool:
+        """Check a login the way the helper does, PBKDF2 off the event loop."""
+        known = self._credentials.cached(name, password)
+        if known is not None:
+            return known
+        record = self._credentials.users.get(name)
+        if record is None:
+            return False
+        encoded = record["password"]
+        ok = await asyncio.to_thread(verify_password, password, encoded)
+        if ok:
+            self._credentials.remember(name, encoded, password)
+        return ok and name in self._credentials.users
+
+    def modem_for(self, name: str) -> Optional[int]:
+        """The modem a logged-in user's traffic leaves through, if any is usable."""
+        record = self._credentials.users.get(name)
+        if record is None:
+            return None
+        modem = pick_modem(name, record["groups"], self._credentials.modems)
+        return modem["id"] if modem else None
+
+    def _save(self) -> None:
+        state_store.set_value(_USERS_KEY, self._users)
+        state_store.set_value(_TAGS_KEY, {str(k): v for k, v in self._tags.items()})
+        self._publish()
+
+    def _user(self, name: str) -> ProxyUser:
+        record = self._users[name]
+        modem = pick_modem(name, record["groups"], self._published_modems())
+        return ProxyUser(
+            name=name,
+            groups=record["groups"],
+            enabled=record["enabled"],
+            modem_id=modem["id"] if modem else None,
+        )
+
+    def _published_modems(self) -> list[dict]:
+        return [
+            {**modem, "tags": self._tags.get(modem_id, [])}
+            for modem_id, modem in sorted(self._modems.items())
+        ]
+
+    def users(self) -> list[ProxyUser]:
+        return [self._user(name) for name in sorted(self._users)]
+
+    def get_user(self, name: str) -> Optional[ProxyUser]:
+        return self._user(name) if name in self._users else None
+
+    async def set_user(
+        self, name: str, password: Optional[str], groups: list[str], enabled: bool
+    ) -> ProxyUser:
+        """Create or update a user; the password is kept unless given."""
+        record = self._users.get(name)
+        if record is None and password is None:
+            raise ValueError("A new user needs a password")
+        if password is not None:
+            encoded = await asyncio.to_thread(
+                hash_password, password, get_config().proxy_auth.hash_iterations
+            )
+        else:
+            encoded = record["password"]
+        self._users[name] = {
+            "password": encoded,
+            "groups": sorted(set(groups)),
+            "enabled": enabled,
+        }
+        self._save()
+        return self._user(name)
+
+    def delete_user(self, name: str) -> bool:
+        if self._users.pop(name, None) is None:
+            return False
+        self._save()
+        return True
+
+    def set_tags(self, modem_id: int, tags: list[str]) -> list[str]:
+        """Replace the tags (group names) of a modem."""
+        if tags:
+            self._tags[modem_id] = sorted(set(tags))
+        else:
+            self._tags.pop(modem_id, None)
+        self._save()
+        return self._tags.get(modem_id, [])
+
+    def groups(self) -> list[ProxyGroup]:
+        """Modems and users per group."""
+        names = {tag for tags in self._tags.values() for tag in tags}
+        names.update(group for user in self._users.values() for group in user["groups"])
+        return [
+            ProxyGroup(
+                name=name,
+                modem_ids=sorted(
+                    modem_id for modem_id, tags in self._tags.items() if name in tags
+                ),
+                usable_modem_ids=sorted(
+                    modem_id
+                    for modem_id, modem in self._modems.items()
+                    if modem["usable"] and name in self._tags.get(modem_id, [])
+                ),
+                users=sorted(
+                    user for user, record in self._users.items() if name in record["groups"]
+                ),
+            )
+            for name in sorted(names)
+        ]
+
+
+# Global instance
+proxy_auth = ProxyAuth()
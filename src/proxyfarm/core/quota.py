@@ -0,0 +1,186 @@
+"""Per-modem data quota tracking from interface byte counters."""
+
+import logging
+import os
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+from ..config import QuotaLimit, get_config
+from ..schemas import QuotaStatus
+from .egress import egress_balancer
+from .store import state_store
+from .state import ModemRecord, device_key
+
+logger = logging.getLogger(__name__)
+
+# Usage per device
+_STATE_KEY = "quota.devices"
+# Interface counters are the kernel's unsigned long
+_COUNTER_BITS = 64 if "64" in os.uname().machine else 32
+
+
+def counter_delta(previous: int, current: int, bits: int = _COUNTER_BITS) -> int:
+    """Bytes transferred between two counter readings.
+
+    A decrease means the interface was recreated and the counter restarted
+    from zero, except that 32-bit counters also wrap around: a decrease from
+    the upper half of their range is taken as a wrap. 64-bit counters don't
+    wrap in practice.
+    """
+    if current >= previous:
+        return current - previous
+    if bits == 32 and 2**31 < previous < 2**32:
+        return current + 2**32 - previous
+    return current
+
+
+def period_start(billing_day: int, today: Optional[date] = None) -> date:
+    """First day of the billing period containing ``today``."""
+    today = today or date.today()
+    if today.day >= billing_day:
+        return today.replace(day=billing_day)
+    last_month = today.replace(day=1) - timedelta(days=1)
+    return last_month.replace(day=billing_day)
+
+
+def read_counters(interface: str) -> Optional[tuple[int, int]]:
+    """An interface's (rx_bytes, tx_bytes) from sysfs."""
+    stats = Path(get_config().quota.sysfs_root) / interface / "statistics"
+    try:
+        rx = int((stats / "rx_bytes").read_text())
+        tx = int((stats / "tx_bytes").read_text())
+    except (OSError, ValueError):
+        return None
+    return rx, tx
+
+
+class QuotaTracker:
+    """Accumulates per-modem traffic per billing period.
+
+    Samples ``rx_bytes``/``tx_bytes`` from sysfs (two small file reads per
+    modem, no subprocesses), persists usage across restarts and feeds the
+    egress balancer so modems near their cap get less traffic. Usage is
+    kept per device (see ``device_key``), so it stays with the modem when
+    modem IDs change.
+    """
+
+    def __init__(self):
+        # device -> {"modem_id", "interface", "rx", "tx", "used", "period"}
+        self._state: dict[str, dict] = {}
+        self._sampled_at: Optional[float] = None
+        # modem_id -> bytes/s over the last sample interval
+        self._rates: dict[int, float] = {}
+
+    @staticmethod
+    def _limit(device: str, modem_id: int) -> QuotaLimit:
+        config = get_config().quota
+        limit = config.modems.get(device)
+        return limit if limit is not None else config.modems.get(modem_id, config.default)
+
+    async def load(self) -> None:
+        """Restore usage counters persisted by a previous run."""
+        self._state = await state_store.get_value(_STATE_KEY, {})
+
+    def sample(self, modems: list[ModemRecord]) -> None:
+        """Read interface counters and account the traffic since last sample."""
+        config = get_config().quota
+        if not config.enabled:
+            return
+
+        now = time.time()
+        elapsed = now - self._sampled_at if self._sampled_at else None
+        for modem in modems:
+            if not modem.interface:
+                continue
+            counters = read_counters(modem.interface)
+            if counters is None:
+                continue
+            rx, tx = counters
+            device = device_key(modem)
+            period = period_start(self._limit(device, modem.id).billing_day).isoformat()
+
+            entry = self._state.get(device)
+            if entry is None or entry.get("interface") != modem.interface:
+                # New modem or the modem moved to another interface: take a
+                # baseline without attributing the existing counter value.
+                used = entry["used"] if entry and entry.get("period") == period else 0
+                self._state[device] = {
+                    "modem_id": modem.id,
+                    "interface": modem.interface,
+                    "rx": rx,
+                    "tx": tx,
+                    "used": used,
+                    "period": period,
+                }
+                continue
+
+            self._state[device] = entry
+            entry["modem_id"] = modem.id
+            if entry["period"] != period:
+                logger.info(f"New billing period for modem {modem.id}, resetting usage")
+                entry["period"] = period
+                entry["used"] = 0
+
+            delta = counter_delta(entry["rx"], rx) + counter_delta(entry["tx"], tx)
+            entry["used"] += delta
+            entry["rx"], entry["tx"] = rx, tx
+            if elapsed:
+                self._rates[modem.id] = delta / elapsed
+
+        self._sampled_at = now
+        state_store.set_value(_STATE_KEY, self._state)
+        self._update_weights(modems)
+
+    def rate(self, modem_id: int) -> Optional[float]:
+        """Bytes per second through a modem over the last sample interval."""
+        return self._rates.get(modem_id)
+
+    def _usage_ratio(self, device: str) -> Optional[float]:
+        entry = self._state.get(device)
+        if entry is None:
+            return None
+        limit = self._limit(device, entry["modem_id"])
+        if not limit.limit_gb:
+            return None
+        return entry["used"] / (limit.limit_gb * 1e9)
+
+    def _update_weights(self, modems: list[ModemRecord]) -> None:
+        # Factors go to the modem IDs the devices have now
+        config = get_config().quota
+        span = max(config.hard_threshold - config.soft_threshold, 1e-6)
+        for modem in modems:
+            ratio = self._usage_ratio(device_key(modem))
+            if ratio is None:
+                egress_balancer.clear_factor(modem.id, "quota")
+                continue
+            egress_balancer.set_factor(
+                modem.id, "quota", (config.hard_threshold - ratio) / span
+            )
+
+    def status(self) -> list[QuotaStatus]:
+        """Usage against quota for every tracked device, by last known modem ID."""
+        result = []
+        entries = sorted(self._state.items(), key=lambda item: (item[1]["modem_id"], item[0]))
+        for device, entry in entries:
+            limit = self._limit(device, entry["modem_id"])
+            result.append(QuotaStatus(
+                modem_id=entry["modem_id"],
+                device_id=device,
+                interface=entry.get("interface"),
+                period_start=entry["period"],
+                used_bytes=entry["used"],
+                limit_bytes=int(limit.limit_gb * 1e9) if limit.limit_gb else None,
+                usage_ratio=self._usage_ratio(device),
+                weight_factor=egress_balancer.factors(entry["modem_id"]).get("quota", 1.0),
+                sampled_at=(
+                    datetime.utcfromtimestamp(self._sampled_at)
+                    if self._sampled_at else None
+                ),
+            ))
+        return result
+
+
+# Global instance
+quota_tracker = QuotaTracker()
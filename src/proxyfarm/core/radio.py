@@ -0,0 +1,484 @@
+"""Radio mode and band tuning driven by measured throughput.
+
+Modems left to themselves camp on whatever cell is strongest, which is
+often 3G or a congested LTE band. A tuning run measures the current
+settings, then each allowed mode combination the modem supports, then the
+best mode locked to one band at a time (keeping the other technologies'
+bands as fallback). Every trial is a speed test taken once the modem
+carries traffic again; if it does not within ``settle_timeout``, the
+original settings are restored before anything else happens. The winner
+is kept if it beats the original settings by ``min_gain``.
+
+The best settings are remembered per modem (by device ID) and location
+(operator plus tracking area), so a modem that moves gets settings for
+where it is. While settings change the modem is kept out of proxy logins
+and, through a zero egress factor, out of the default route. Scheduled
+runs only happen inside the low-traffic window, on modems measured to be
+quiet (quota sampling, else conntrack's interface rates).
+Settings being tried are persisted until the run ends; a run cut short by
+a restart is rolled back on the next monitor cycle.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from ..config import get_config
+from ..schemas import (
+    ModemState,
+    RadioInfo,
+    RadioMode,
+    RadioOptimization,
+    RadioProfile,
+    RadioSettings,
+    RadioTrial,
+)
+from .conntrack import conntrack_tracker
+from .egress import egress_balancer
+from .modem import band_technology, modem_manager
+from .network import network_manager
+from .proxyauth import proxy_auth
+from .quota import quota_tracker
+from .recovery import recovery_manager
+from .speedtest import speed_tester
+from .state import ModemRecord, device_key
+from .store import state_store
+
+logger = logging.getLogger(__name__)
+
+_PROFILES_KEY = "radio.profiles"
+_PENDING_KEY = "radio.pending"
+_POLL_INTERVAL = 2.0
+
+
+class RadioError(Exception):
+    """Radio settings could not be applied or restored."""
+
+
+def _generation(technology: str) -> int:
+    return int(technology[0]) if technology[:1].isdigit() else 0
+
+
+def _same(a: RadioSettings, b: RadioSettings) -> bool:
+    return (
+        set(a.modes.allowed) == set(b.modes.allowed)
+        and a.modes.preferred == b.modes.preferred
+        and set(a.bands) == set(b.bands)
+    )
+
+
+def score(download_mbps: Optional[float], latency_ms: Optional[float]) -> Optional[float]:
+    """Download Mbps, scaled down by latency above ``latency_target_ms``."""
+    if not download_mbps:
+        return None
+    target = get_config().radio.latency_target_ms
+    if latency_ms and latency_ms > target:
+        return download_mbps * target / latency_ms
+    return download_mbps
+
+
+class RadioOptimizer:
+    """Tries radio settings on modems, one run at a time."""
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        # device -> location -> best settings found there
+        self._profiles: dict[str, dict[str, RadioProfile]] = {}
+        # device -> settings to restore, while a run may have changed them
+        self._pending: dict[str, RadioSettings] = {}
+        self._runs: dict[int, RadioOptimization] = {}
+        # modem_id -> latest run or check task; _background holds them all
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._background: set[asyncio.Task] = set()
+        # modem_id -> monotonic time of the last scheduled check
+        self._checked: dict[int, float] = {}
+
+    async def load(self) -> None:
+        """Restore profiles and unfinished runs persisted by a previous run."""
+        profiles = await state_store.get_value(_PROFILES_KEY, {})
+        self._profiles = {
+            device: {
+                location: RadioProfile.model_validate(profile)
+                for location, profile in locations.items()
+            }
+            for device, locations in profiles.items()
+        }
+        pending = await state_store.get_value(_PENDING_KEY, {})
+        self._pending = {
+            device: RadioSettings.model_validate(settings) for device, settings in pending.items()
+        }
+        if self._pending:
+            logger.warning(
+                f"Radio tuning was interrupted on {len(self._pending)} modem(s), "
+                "original settings will be restored"
+            )
+
+    async def stop(self) -> None:
+        for task in list(self._background):
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def busy(self, modem_id: int) -> bool:
+        """Whether a run on this modem is queued or changing its settings."""
+        task = self._tasks.get(modem_id)
+        return task is not None and not task.done()
+
+    def last_run(self, modem_id: int) -> Optional[RadioOptimization]:
+        return self._runs.get(modem_id)
+
+    def profile(self, modem: ModemRecord, location: str) -> Optional[RadioProfile]:
+        return self._profiles.get(device_key(modem), {}).get(location)
+
+    def _save_profiles(self) -> None:
+        state_store.set_value(_PROFILES_KEY, {
+            device: {
+                location: profile.model_dump(mode="json")
+                for location, profile in locations.items()
+            }
+            for device, locations in self._profiles.items()
+        })
+
+    def _save_pending(self) -> None:
+        state_store.set_value(_PENDING_KEY, {
+            device: settings.model_dump(mode="json") for device, settings in self._pending.items()
+        })
+
+    # Candidates
+
+    def mode_candidates(self, info: RadioInfo) -> list[RadioSettings]:
+        """Supported mode combinations allowing only configured technologies.
+
+        A combination allowing several technologies is tried without a
+        preference or preferring the newest of them, never an older one.
+        """
+        wanted = set(get_config().radio.modes)
+        candidates = []
+        for mode in info.supported_modes:
+            newest = max(mode.allowed, key=_generation)
+            if set(mode.allowed) <= wanted and mode.preferred in (None, newest):
+                candidates.append(RadioSettings(modes=mode))
+        return candidates
+
+    def band_candidates(self, info: RadioInfo, mode: RadioMode) -> list[RadioSettings]:
+        """``mode`` locked to each band of its main technology in turn."""
+        config = get_config().radio
+        main = mode.preferred or max(mode.allowed, key=_generation)
+        bands = [
+            band for band in info.supported_bands
+            if band_technology(band) == main and (not config.bands or band in config.bands)
+        ]
+        if len(bands) < 2:
+            return []
+        # Other allowed technologies keep all their bands as a fallback
+        fallback = [
+            band for band in info.supported_bands
+            if band_technology(band) in mode.allowed and band_technology(band) != main
+        ]
+        return [RadioSettings(modes=mode, bands=[band] + fallback) for band in bands]
+
+    # Running
+
+    def start(self, modem_id: int) -> tuple[RadioOptimization, bool]:
+        """Start a tuning run, or return the one queued or running on the modem.
+
+        Returns the run and whether it was newly started.
+        """
+        run = self._runs.get(modem_id)
+        if run is not None and run.status in ("pending", "running"):
+            return run, False
+        run = self._new_run(modem_id)
+        self._spawn(modem_id, self._run(run))
+        return run, True
+
+    def _spawn(self, modem_id: int, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks[modem_id] = task
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _new_run(self, modem_id: int) -> RadioOptimization:
+        run = RadioOptimization(modem_id=modem_id, started_at=datetime.utcnow())
+        self._runs[modem_id] = run
+        return run
+
+    async def wait(self, modem_id: int) -> Optional[RadioOptimization]:
+        """Wait for the modem's run to finish."""
+        task = self._tasks.get(modem_id)
+        if task is not None:
+            await asyncio.shield(task)
+        return self._runs.get(modem_id)
+
+    @staticmethod
+    async def _drain(modem_id: int, draining: bool) -> None:
+        """Keep a modem out of proxy logins and the default route, or put it back."""
+        proxy_auth.set_draining(modem_id, draining)
+        if draining:
+            egress_balancer.set_factor(modem_id, "radio", 0)
+        else:
+            egress_balancer.clear_factor(modem_id, "radio")
+        await egress_balancer.refresh()
+
+    async def _run(self, run: RadioOptimization) -> None:
+        async with self._lock:
+            run.status = "running"
+            try:
+                await self._optimize(run)
+                run.status = "completed"
+            except (RadioError, OSError, asyncio.TimeoutError) as e:
+                run.status = "failed"
+                run.error = str(e)
+                logger.error(f"Radio tuning of modem {run.modem_id} failed: {e}")
+            except asyncio.CancelledError:
+                run.status = "failed"
+                run.error = "Cancelled"
+                raise
+            finally:
+                run.finished_at = datetime.utcnow()
+
+    async def _optimize(self, run: RadioOptimization) -> None:
+        config = get_config().radio
+        modem = await modem_manager.get_modem(run.modem_id)
+        if not modem or modem.state != ModemState.CONNECTED or not modem.ip_address:
+            raise RadioError("Modem is not connected")
+        info = await modem_manager.get_radio(run.modem_id)
+        if info is None:
+            raise RadioError("Radio settings unavailable")
+        run.location = info.location
+        original = info.current
+        device = device_key(modem)
+
+        logger.info(f"Radio tuning of modem {modem.id} at {info.location} started")
+        self._pending[device] = original
+        self._save_pending()
+        await self._drain(modem.id, True)
+        current = original
+        try:
+            run.baseline = best = await self._measure(modem, original)
+
+            async def attempt(settings: RadioSettings) -> None:
+                nonlocal best, current
+                if len(run.trials) >= config.max_trials or any(
+                    _same(settings, tried) for tried in (current, original)
+                ):
+                    return
+                trial = await self._try(modem.id, settings)
+                current = settings
+                run.trials.append(trial)
+                if trial.settle_seconds is None:
+                    # Lost connectivity: restore before trying anything else
+                    run.rolled_back = True
+                    await self._restore(modem.id, original)
+                    current = original
+                elif (trial.score or 0) > (best.score or 0):
+                    best = trial
+
+            for settings in self.mode_candidates(info):
+                await attempt(settings)
+            if config.band_locks:
+                for settings in self.band_candidates(info, best.settings.modes):
+                    await attempt(settings)
+
+            keep = best is not run.baseline and (
+                (best.score or 0) >= (run.baseline.score or 0) * (1 + config.min_gain)
+            )
+            if keep and not _same(best.settings, current):
+                current = best.settings
+                if await self._apply(modem.id, best.settings) is None:
+                    run.rolled_back = True
+                    keep = False
+            if not keep:
+                best = run.baseline
+                if not _same(current, original):
+                    await self._restore(modem.id, original)
+                    current = original
+        except RadioError:
+            # Restoring failed; the pending entry makes the next cycle retry
+            raise
+        except BaseException:
+            # Cancelled or failed mid-run: leave the modem as it was
+            if not _same(current, original):
+                await asyncio.shield(self._restore(modem.id, original))
+            raise
+        finally:
+            await self._drain(modem.id, False)
+
+        run.applied = current
+        run.changed = not _same(current, original)
+        self._pending.pop(device, None)
+        self._save_pending()
+        if best.score is not None:
+            self._profiles.setdefault(device, {})[info.location] = RadioProfile(
+                location=info.location,
+                settings=current,
+                score=best.score,
+                evaluated_at=datetime.utcnow(),
+            )
+            self._save_profiles()
+        logger.info(
+            f"Radio tuning of modem {modem.id} done after {len(run.trials)} trial(s), "
+            f"{'switched' if run.changed else 'kept current settings'}"
+        )
+
+    async def _measure(self, modem: ModemRecord, settings: RadioSettings) -> RadioTrial:
+        result = await speed_tester.run(modem, keep=False)
+        return RadioTrial(
+            settings=settings,
+            success=result.success,
+            download_mbps=result.download_mbps,
+            upload_mbps=result.upload_mbps,
+            latency_ms=result.latency_ms,
+            score=score(result.download_mbps, result.latency_ms),
+            error=result.error,
+        )
+
+    async def _try(self, modem_id: int, settings: RadioSettings) -> RadioTrial:
+        started = time.monotonic()
+        modem = await self._apply(modem_id, settings)
+        if modem is None:
+            return RadioTrial(
+                settings=settings, success=False, error="No connectivity after the change"
+            )
+        settled = time.monotonic() - started
+        trial = await self._measure(modem, settings)
+        trial.settle_seconds = settled
+        return trial
+
+    async def _apply(self, modem_id: int, settings: RadioSettings) -> Optional[ModemRecord]:
+        """Apply settings and wait for connectivity; the modem, if it came back."""
+        applied = await modem_manager.set_allowed_modes(
+            modem_id, settings.modes.allowed, settings.modes.preferred
+        ) and await modem_manager.set_current_bands(modem_id, settings.bands)
+        if not applied:
+            return None
+        return await self._settle(modem_id)
+
+    async def _settle(self, modem_id: int) -> Optional[ModemRecord]:
+        """Wait until the modem carries traffic, reconnecting it once registered."""
+        config = get_config()
+        connection_name = f"{config.modems.connection_prefix}{modem_id + 1}"
+        deadline = time.monotonic() + config.radio.settle_timeout
+        reconnected = False
+        while time.monotonic() < deadline:
+            await asyncio.sleep(_POLL_INTERVAL)
+            modem = await modem_manager.get_modem(modem_id)
+            if modem is None:
+                continue
+            if modem.state == ModemState.CONNECTED and modem.ip_address and modem.interface:
+                connected, _ = await network_manager.check_internet_connectivity(
+                    modem.interface, config.monitor.health_check_url
+                )
+                if connected:
+                    return modem
+            elif modem.state == ModemState.REGISTERED and not reconnected:
+                # NetworkManager may not re-activate the connection by itself
+                reconnected = await network_manager.connection_up(connection_name)
+        return None
+
+    async def _restore(self, modem_id: int, settings: RadioSettings) -> None:
+        """Put settings back; raises RadioError if the modem stays offline."""
+        logger.warning(f"Restoring radio settings of modem {modem_id}")
+        if await self._apply(modem_id, settings) is None:
+            recovery_manager.report(modem_id, False, "No connectivity after radio rollback")
+            raise RadioError("Modem has no connectivity after restoring its radio settings")
+
+    async def _restore_pending(self, modem: ModemRecord) -> None:
+        device = device_key(modem)
+        async with self._lock:
+            settings = self._pending[device]
+            info = await modem_manager.get_radio(modem.id)
+            try:
+                if info is None or not _same(info.current, settings) or (
+                    modem.state != ModemState.CONNECTED
+                ):
+                    await self._restore(modem.id, settings)
+            except RadioError as e:
+                logger.error(f"Modem {modem.id}: {e}")
+                return
+            self._pending.pop(device, None)
+            self._save_pending()
+
+    async def _maintain(self, modem: ModemRecord) -> None:
+        """Apply the settings found for the modem's location, or look for them."""
+        config = get_config().radio
+        info = await modem_manager.get_radio(modem.id)
+        if info is None:
+            return
+        profile = self.profile(modem, info.location)
+        age = (datetime.utcnow() - profile.evaluated_at) if profile else None
+        if age is None or age >= timedelta(seconds=config.reevaluate_after):
+            await self._run(self._new_run(modem.id))
+            return
+        if _same(info.current, profile.settings):
+            return
+        logger.info(f"Applying radio settings found for modem {modem.id} at {info.location}")
+        device = device_key(modem)
+        async with self._lock:
+            self._pending[device] = info.current
+            self._save_pending()
+            await self._drain(modem.id, True)
+            try:
+                if await self._apply(modem.id, profile.settings) is None:
+                    await self._restore(modem.id, info.current)
+            except RadioError as e:
+                logger.error(f"Modem {modem.id}: {e}")
+                return
+            finally:
+                await self._drain(modem.id, False)
+            self._pending.pop(device, None)
+            self._save_pending()
+
+    # Scheduling
+
+    def in_window(self, now: Optional[datetime] = None) -> bool:
+        """Whether the local time is inside the low-traffic window."""
+        config = get_config().radio
+        hour = (now or datetime.now()).hour
+        start, end = config.window_start, config.window_end
+        if start == end:
+            return True
+        if start < end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def schedule(self, modems: list[ModemRecord]) -> None:
+        """Restore interrupted runs, then check one due modem in the window."""
+        config = get_config().radio
+        if self._background:
+            return
+
+        # Left over from a run cut short: restore even outside the window
+        for modem in modems:
+            if device_key(modem) in self._pending:
+                self._spawn(modem.id, self._restore_pending(modem))
+                return
+
+        if not config.enabled or not self.in_window():
+            return
+        now = time.monotonic()
+        due = []
+        for modem in modems:
+            if modem.state != ModemState.CONNECTED or not modem.ip_address:
+                continue
+            checked = self._checked.get(modem.id)
+            if checked is not None and now - checked < config.check_interval:
+                continue
+            rate = quota_tracker.rate(modem.id)
+            if rate is None:
+                rate = conntrack_tracker.rate(modem.id)
+            # Without a measured rate the modem can't be known to be quiet
+            if rate is None or rate > config.max_traffic:
+                continue
+            due.append((checked if checked is not None else float("-inf"), modem.id, modem))
+        if due:
+            modem = min(due)[2]
+            self._checked[modem.id] = now
+            self._spawn(modem.id, self._maintain(modem))
+
+
+# Global instance
+radio_optimizer = RadioOptimizer()
@@ -0,0 +1,293 @@
+"""Escalating recovery of unhealthy modems with a per-modem circuit breaker.
+
+Each failing modem climbs a ladder of increasingly disruptive actions
+(``recovery.actions``), with exponential backoff between attempts. When the
+ladder is exhausted the breaker opens: the modem is taken out of the egress
+route and skipped by the monitor until a probe after ``open_duration``
+(one more try of the mildest action) succeeds. Time from the first failed
+check to recovery is recorded for the last action taken, giving the mean
+time to recovery per action. Actions hold the modem's rotation lock, so an
+operator's rotation waits for them rather than racing them.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+
+from ..config import get_config
+from ..schemas import ModemRecoveryStatus, RecoveryActionStats, RecoveryReport
+from .bringup import modem_bringup
+from .egress import egress_balancer
+from .modem import modem_manager
+from .network import network_manager
+from .rotation import ip_rotator
+from .store import state_store
+
+logger = logging.getLogger(__name__)
+
+_STATS_KEY = "recovery.stats"
+# Recoveries that happened without any action
+_NO_ACTION = "none"
+
+
+@dataclass
+class ModemRecovery:
+    modem_id: int
+    breaker: str = "closed"
+    # Index into recovery.actions of the next action, and attempts made at it
+    step: int = 0
+    attempts: int = 0
+    total_attempts: int = 0
+    incident_started: Optional[float] = None
+    next_attempt_at: float = 0.0
+    open_until: Optional[float] = None
+    open_count: int = 0
+    # Whether the half-open trial action has run since the breaker opened
+    probed: bool = False
+    last_action: Optional[str] = None
+    last_error: Optional[str] = None
+
+
+def _timestamp(value: Optional[float]) -> Optional[datetime]:
+    return datetime.utcfromtimestamp(value) if value else None
+
+
+class RecoveryManager:
+    """Tracks modem health reports and runs recovery actions."""
+
+    def __init__(self):
+        self._modems: dict[int, ModemRecovery] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        # action -> {"attempts", "failures", "recoveries", "recovery_time"}
+        self._stats: dict[str, dict[str, float]] = {}
+        # Run with the modem's rotation lock held
+        self._actions: dict[str, Callable[[int], Awaitable[bool]]] = {
+            "reconnect": self._reconnect,
+            "bearer_reset": self._bearer_reset,
+            "modem_reset": self._modem_reset,
+            "usb_reset": self._usb_reset,
+        }
+
+    async def load(self) -> None:
+        """Restore per-action statistics from the store."""
+        self._stats = await state_store.get_value(_STATS_KEY, {})
+
+    async def stop(self) -> None:
+        """Cancel running recovery actions."""
+        for task in list(self._tasks.values()):
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks.clear()
+
+    def _is_quarantined(self, state: ModemRecovery, now: float) -> bool:
+        return state.breaker == "open" and now < state.open_until
+
+    def quarantined(self) -> set[int]:
+        """Modems with an open breaker whose next probe isn't due yet."""
+        now = time.time()
+        return {
+            modem_id
+            for modem_id, state in self._modems.items()
+            if self._is_quarantined(state, now)
+        }
+
+    def prune(self, modem_ids: list[int]) -> None:
+        """Forget modems that are gone (e.g. re-enumerated after a USB reset)."""
+        for modem_id in set(self._modems) - set(modem_ids):
+            if modem_id not in self._tasks:
+                del self._modems[modem_id]
+                egress_balancer.clear_factor(modem_id, "recovery")
+
+    def report(self, modem_id: int, healthy: bool, error: Optional[str] = None) -> None:
+        """Feed the result of a health check; may start a recovery action."""
+        state = self._modems.get(modem_id)
+        now = time.time()
+        if healthy:
+            if state is not None and state.incident_started is not None:
+                self._recovered(state, now)
+            return
+
+        if state is None:
+            state = self._modems[modem_id] = ModemRecovery(modem_id=modem_id)
+        if state.incident_started is None:
+            state.incident_started = now
+            state.next_attempt_at = now
+        state.last_error = error
+
+        config = get_config()
+        if modem_id in self._tasks or self._is_quarantined(state, now):
+            return
+        if not (config.recovery.enabled and config.monitor.auto_reconnect):
+            return
+        if now < state.next_attempt_at:
+            return
+
+        if state.breaker == "open":
+            # Half-open: one trial of the mildest action, judged by the next check
+            if state.probed:
+                logger.warning(f"Probe of modem {modem_id} failed, keeping circuit open")
+                self._open(state, now)
+            elif config.recovery.actions:
+                state.probed = True
+                self._tasks[modem_id] = asyncio.create_task(self._run_action(
+                    state, config.recovery.actions[0], config.recovery.backoff_base
+                ))
+            return
+
+        actions = config.recovery.actions
+        if state.step >= len(actions):
+            self._open(state, now)
+            return
+
+        action = actions[state.step]
+        state.attempts += 1
+        if state.attempts >= config.recovery.attempts_per_action:
+            state.step += 1
+            state.attempts = 0
+        state.total_attempts += 1
+        backoff = min(
+            config.recovery.backoff_base * 2 ** (state.total_attempts - 1),
+            config.recovery.backoff_max,
+        )
+        self._tasks[modem_id] = asyncio.create_task(self._run_action(state, action, backoff))
+
+    async def _run_action(self, state: ModemRecovery, action: str, backoff: float) -> None:
+        logger.info(f"Recovering modem {state.modem_id}: {action}")
+        stats = self._action_stats(action)
+        success = False
+        try:
+            handler = self._actions.get(action)
+            if handler is None:
+                logger.error(f"Unknown recovery action: {action}")
+            else:
+                async with ip_rotator.lock(state.modem_id):
+                    success = await handler(state.modem_id)
+        except Exception as e:
+            logger.exception(f"Recovery action {action} for modem {state.modem_id} failed")
+            state.last_error = str(e)
+        finally:
+            stats["attempts"] += 1
+            if not success:
+                stats["failures"] += 1
+            state.last_action = action
+            # Backoff counts from the end of the action, which may be long
+            state.next_attempt_at = time.time() + backoff
+            self._tasks.pop(state.modem_id, None)
+
+    def _action_stats(self, action: str) -> dict[str, float]:
+        return self._stats.setdefault(
+            action, {"attempts": 0, "failures": 0, "recoveries": 0, "recovery_time": 0.0}
+        )
+
+    def _open(self, state: ModemRecovery, now: float) -> None:
+        config = get_config().recovery
+        duration = min(config.open_duration * 2 ** state.open_count, config.open_max)
+        state.breaker = "open"
+        state.open_until = now + duration
+        state.open_count += 1
+        state.probed = False
+        egress_balancer.set_factor(state.modem_id, "recovery", 0.0)
+        logger.warning(
+            f"Modem {state.modem_id} did not recover, circuit open for {duration:.0f}s"
+        )
+
+    def _recovered(self, state: ModemRecovery, now: float) -> None:
+        elapsed = now - state.incident_started
+        action = state.last_action or _NO_ACTION
+        stats = self._action_stats(action)
+        stats["recoveries"] += 1
+        stats["recovery_time"] += elapsed
+        state_store.set_value(_STATS_KEY, self._stats)
+        logger.info(
+            f"Modem {state.modem_id} recovered after {elapsed:.0f}s (last action: {action})"
+        )
+
+        self._modems[state.modem_id] = ModemRecovery(modem_id=state.modem_id)
+        egress_balancer.clear_factor(state.modem_id, "recovery")
+
+    def reset(self, modem_id: int) -> bool:
+        """Close a modem's breaker and restart its ladder (operator override)."""
+        if modem_id not in self._modems:
+            return False
+        self._modems[modem_id] = ModemRecovery(modem_id=modem_id)
+        egress_balancer.clear_factor(modem_id, "recovery")
+        return True
+
+    def status(self) -> RecoveryReport:
+        """Breaker state per modem and time to recovery per action."""
+        actions = get_config().recovery.actions
+        now = time.time()
+        modems = []
+        for modem_id, state in sorted(self._modems.items()):
+            breaker = state.breaker
+            if breaker == "open" and not self._is_quarantined(state, now):
+                breaker = "half_open"
+            modems.append(ModemRecoveryStatus(
+                modem_id=modem_id,
+                breaker=breaker,
+                next_action=actions[state.step] if state.step < len(actions) else None,
+                attempts=state.total_attempts,
+                in_progress=modem_id in self._tasks,
+                incident_started=_timestamp(state.incident_started),
+                next_attempt_at=_timestamp(
+                    state.next_attempt_at if state.incident_started else None
+                ),
+                open_until=_timestamp(state.open_until),
+                last_action=state.last_action,
+                last_error=state.last_error,
+            ))
+        return RecoveryReport(
+            modems=modems,
+            actions=[
+                RecoveryActionStats(
+                    action=action,
+                    attempts=int(stats["attempts"]),
+                    failures=int(stats["failures"]),
+                    recoveries=int(stats["recoveries"]),
+                    mean_time_to_recovery=(
+                        stats["recovery_time"] / stats["recoveries"]
+                        if stats["recoveries"] else None
+                    ),
+                )
+                for action, stats in sorted(self._stats.items())
+            ],
+        )
+
+    @staticmethod
+    def _connection_name(modem_id: int) -> str:
+        return f"{get_config().modems.connection_prefix}{modem_id + 1}"
+
+    async def _reconnect(self, modem_id: int) -> bool:
+        result = await ip_rotator.rotate_locked(modem_id)
+        return result.success
+
+    async def _bearer_reset(self, modem_id: int) -> bool:
+        await modem_manager.simple_disconnect(modem_id)
+        return await network_manager.connection_up(self._connection_name(modem_id))
+
+    async def _modem_reset(self, modem_id: int) -> bool:
+        await modem_manager.disable(modem_id)
+        await asyncio.sleep(2)
+        if not await modem_manager.enable(modem_id):
+            return False
+        return await network_manager.connection_up(self._connection_name(modem_id))
+
+    async def _usb_reset(self, modem_id: int) -> bool:
+        if not await modem_manager.usb_reset(modem_id):
+            return False
+        # The modem re-enumerates, possibly under a new ID: let the bring-up
+        # job find it and restore its connection.
+        await asyncio.sleep(10)
+        job, _ = modem_bringup.start()
+        job = await modem_bringup.wait(job.id)
+        return job.status == "completed"
+
+
+# Global instance
+recovery_manager = RecoveryManager()
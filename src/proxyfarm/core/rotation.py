@@ -9,7 +9,10 @@ from ..config import get_config
 from ..schemas import RotationResult
 from .modem import modem_manager
 from .network import network_manager
+from .proxyauth import proxy_auth
+from .shaping import traffic_shaper
 from .squid import squid_manager
+from .store import state_store
 
 logger = logging.getLogger(__name__)
 
@@ -17,8 +20,44 @@ logger = logging.getLogger(__name__)
 class IPRotator:
     """Handles IP rotation for modems."""
 
+    def __init__(self):
+        self._locks: dict[int, asyncio.Lock] = {}
+
+    def lock(self, modem_id: int) -> asyncio.Lock:
+        """Held while a modem's connection is being changed.
+
+        Rotations and recovery actions take it, so an operator's rotation
+        and an automatic recovery never drive the same modem at once.
+        """
+        return self._locks.setdefault(modem_id, asyncio.Lock())
+
     async def rotate(self, modem_id: int) -> RotationResult:
         """Rotate IP address for a modem by reconnecting."""
+        async with self.lock(modem_id):
+            return await self.rotate_locked(modem_id)
+
+    async def rotate_locked(self, modem_id: int) -> RotationResult:
+        """Rotate with the modem's lock already held (see ``lock``)."""
+        # Imported here: radio tuning depends on recovery, which rotates
+        from .radio import radio_optimizer
+
+        if radio_optimizer.busy(modem_id):
+            # Reconnecting would cut a trial short and skew its measurement
+            return RotationResult(
+                modem_id=modem_id,
+                success=False,
+                error="Radio tuning in progress",
+                duration_seconds=0.0,
+            )
+        proxy_auth.set_draining(modem_id, True)
+        try:
+            result = await self._rotate(modem_id)
+        finally:
+            proxy_auth.set_draining(modem_id, False)
+        state_store.record_rotation(result)
+        return result
+
+    async def _rotate(self, modem_id: int) -> RotationResult:
         start_time = time.time()
         config = get_config()
         connection_name = f"{config.modems.connection_prefix}{modem_id + 1}"
@@ -78,6 +117,9 @@ class IPRotator:
             if not squid_reconfigured:
                 logger.warning("Squid reconfiguration failed, but IP rotation was successful")
 
+            # Step 6: Queueing on the uplink may not have survived the reconnect
+            await traffic_shaper.reapply(modem.interface)
+
             return RotationResult(
                 modem_id=modem_id,
                 success=True,
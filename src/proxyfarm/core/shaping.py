@@ -0,0 +1,504 @@
+"""Per-client traffic shaping on the modems' uplinks.
+
+An LTE uplink is slow and the modem buffers generously, so one client
+uploading flat out queues everybody else's packets behind its own. Each
+modem interface therefore gets an HTB root whose top class runs just under
+the modem's measured upload rate: the queue forms here, where it can be
+ordered, instead of in the modem. Under it every client (a proxy user, or
+a client address given a limit) has a class with an equal guaranteed
+share, capped at its upload limit if it has one, and its own fq_codel or
+cake so one client's flows don't hurt each other either. Traffic without a
+client mark goes to a default class of its own.
+
+Clients are told apart by fwmark: Squid marks a user's outgoing
+connections with ``tcp_outgoing_mark`` (rules written to an include file)
+and a ``fw`` filter maps each mark to its class. Proxy users' marks are
+keyed on the auth helper's reply, which carries the user's class number
+next to its modem tag; the include file holds a rule per class number, in
+blocks of ``_RULE_BLOCK``, so adding or changing users needs no Squid
+reconfigure. The SOCKS listener sets the mark too, plus ``SO_PRIORITY``
+naming the class, which HTB honours before consulting any filter.
+
+An interface's setup goes to the kernel in one ``tc -batch`` run, and only
+when something changed: the link rate, the clients, or the interface
+itself (a modem that re-enumerates comes back with a new ifindex and no
+qdisc). Changes are made in place (classes changed, added or deleted under
+the existing root), so other clients' queues are not reset; a full
+rebuild is the fallback.
+"""
+
+import asyncio
+import ipaddress
+import logging
+import os
+import socket
+import statistics
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+from ..config import get_config
+from ..helper import SHAPE_NOTE
+from ..schemas import ClientLimit, ShapedInterface, ShapingStatus
+from .modem import is_simulated, run_command
+from .proxyauth import proxy_auth
+from .speedtest import speed_tester
+from .state import ModemRecord
+from .store import state_store
+
+logger = logging.getLogger(__name__)
+
+_LIMITS_KEY = "shaping.limits"
+_CLASSES_KEY = "shaping.classes"
+
+_LINK_CLASS = 0x1
+_DEFAULT_CLASS = 0xFFFE
+_FIRST_CLIENT_CLASS = 0x2
+# HTB needs a rate even when the link is not shaped
+_UNSHAPED_KBIT = 10_000_000
+# Equal quanta, so clients borrow spare capacity in equal parts
+_QUANTUM = 1514
+# Squid mark rules for user classes are written this many class numbers at
+# a time, so new users rarely need a reconfigure
+_RULE_BLOCK = 64
+
+_LEAVES = {
+    "fq_codel": "fq_codel",
+    "cake": "cake unlimited besteffort",
+}
+
+
+@dataclass(frozen=True)
+class ClientClass:
+    minor: int
+    mark: int
+    ceil_kbit: Optional[int] = None
+
+    @property
+    def key(self) -> tuple[int, int]:
+        """What a class is known by in tc; the cap can change in place."""
+        return self.minor, self.mark
+
+    @property
+    def priority(self) -> int:
+        """skb priority selecting this class under the 1: root directly."""
+        return 1 << 16 | self.minor
+
+
+def mark_socket(sock: socket.socket, client_class: ClientClass) -> None:
+    """Send a socket's traffic through a client's class."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_MARK, client_class.mark)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_PRIORITY, client_class.priority)
+
+
+def _filter(dev: str, c: ClientClass, classifier: str) -> Optional[str]:
+    if classifier == "u32":
+        match = f"u32 match mark {c.mark:#x} 0xffffffff flowid"
+    elif classifier == "fw":
+        match = f"handle {c.mark:#x} fw classid"
+    else:
+        return None
+    return f"filter add {dev} parent 1: protocol all prio 1 {match} 1:{c.minor:x}"
+
+
+def in_place(
+    previous: list[ClientClass], classes: list[ClientClass], classifier: str
+) -> bool:
+    """Whether ``classes`` can replace ``previous`` without a rebuild.
+
+    u32 filters get kernel-chosen handles, so one can't be deleted alone.
+    """
+    return classifier != "u32" or {c.key for c in previous} <= {c.key for c in classes}
+
+
+def tc_batch(
+    interface: str,
+    rate_kbit: Optional[int],
+    classes: list[ClientClass],
+    qdisc: str,
+    classifier: str = "fw",
+    previous: Optional[list[ClientClass]] = None,
+) -> list[str]:
+    """``tc -batch`` lines setting up an interface.
+
+    Without ``previous`` the HTB root replaces whatever root qdisc is there
+    and every class is added. With ``previous`` (the classes last applied
+    under the same root) classes are changed in place: kept ones get the new
+    rates, gone ones are deleted and new ones added.
+    """
+    link = rate_kbit or _UNSHAPED_KBIT
+    share = max(link // (len(classes) + 1), 8)
+    leaf = _LEAVES.get(qdisc, qdisc)
+    dev = f"dev {interface}"
+    kept = {c.key for c in classes} & {c.key for c in previous or []}
+    lines = []
+    if previous is None:
+        lines += [
+            f"qdisc replace {dev} root handle 1: htb default {_DEFAULT_CLASS:x}",
+            f"class add {dev} parent 1: classid 1:{_LINK_CLASS:x} htb rate {link}kbit",
+        ]
+    else:
+        for c in previous:
+            if c.key in kept:
+                continue
+            # A class can't be deleted while a filter points at it
+            if classifier == "fw":
+                lines.append(
+                    f"filter del {dev} parent 1: protocol all prio 1 handle {c.mark:#x} fw"
+                )
+            lines.append(f"class del {dev} classid 1:{c.minor:x}")
+        lines.append(
+            f"class change {dev} parent 1: classid 1:{_LINK_CLASS:x} htb rate {link}kbit"
+        )
+
+    default = ClientClass(_DEFAULT_CLASS, 0)
+    for c in [default] + classes:
+        ceil = min(c.ceil_kbit or link, link)
+        spec = (
+            f"parent 1:{_LINK_CLASS:x} classid 1:{c.minor:x} htb"
+            f" rate {min(share, ceil)}kbit ceil {ceil}kbit quantum {_QUANTUM}"
+        )
+        if previous is not None and (c is default or c.key in kept):
+            lines.append(f"class change {dev} {spec}")
+            continue
+        lines += [
+            f"class add {dev} {spec}",
+            f"qdisc add {dev} parent 1:{c.minor:x} handle {c.minor:x}: {leaf}",
+        ]
+        if c is not default:
+            line = _filter(dev, c, classifier)
+            if line:
+                lines.append(line)
+    return lines
+
+
+def _network(client: str) -> Optional[ipaddress.IPv4Network | ipaddress.IPv6Network]:
+    try:
+        return ipaddress.ip_network(client, strict=False)
+    except ValueError:
+        return None
+
+
+def _ifindex(interface: str) -> Optional[int]:
+    try:
+        return int(Path(f"/sys/class/net/{interface}/ifindex").read_text())
+    except (OSError, ValueError):
+        return None
+
+
+async def _run_batch(lines: list[str]) -> Optional[str]:
+    with tempfile.NamedTemporaryFile("w", suffix=".tc", delete=False) as batch:
+        batch.write("\n".join(lines) + "\n")
+    try:
+        _, stderr, rc = await run_command(["tc", "-batch", batch.name])
+    finally:
+        os.unlink(batch.name)
+    if rc != 0:
+        return stderr or f"tc exited with {rc}"
+    return None
+
+
+class TrafficShaper:
+    """Keeps each modem's uplink qdiscs in line with clients and link rate."""
+
+    def __init__(self):
+        # Client -> upload cap in kbit/s (None: fair share only)
+        self._limits: dict[str, Optional[int]] = {}
+        # Client -> HTB class number, kept stable so marks don't move
+        self._classes: dict[str, int] = {}
+        self._networks: list[tuple[ipaddress.IPv4Network | ipaddress.IPv6Network, str]] = []
+        self._modems: list[ModemRecord] = []
+        # Interface -> (ifindex, setup) last applied
+        self._applied: dict[str, tuple] = {}
+        self._interfaces: dict[str, ShapedInterface] = {}
+        self._squid_rules: Optional[str] = None
+        self._lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        self._limits = await state_store.get_value(_LIMITS_KEY, {})
+        self._classes = await state_store.get_value(_CLASSES_KEY, {})
+        self._index_networks()
+        self._share_classes()
+
+    def _index_networks(self) -> None:
+        networks = [(_network(client), client) for client in self._limits]
+        # Most specific network first
+        self._networks = sorted(
+            ((network, client) for network, client in networks if network is not None),
+            key=lambda item: -item[0].prefixlen,
+        )
+
+    # Clients
+
+    def _clients(self) -> list[str]:
+        clients = set(self._limits)
+        if get_config().shaping.per_user_classes:
+            clients.update(user.name for user in proxy_auth.users() if user.enabled)
+        return sorted(clients)
+
+    def _assign(self) -> list[ClientClass]:
+        """Classes for the current clients, numbering new ones."""
+        config = get_config().shaping
+        clients = self._clients()
+        classes = {client: self._classes[client] for client in clients if client in self._classes}
+        used = set(classes.values())
+        minor = _FIRST_CLIENT_CLASS
+        for client in clients:
+            if client in classes:
+                continue
+            while minor in used:
+                minor += 1
+            if minor >= _DEFAULT_CLASS:
+                logger.warning(f"Out of shaping classes, {client} shares the default one")
+                continue
+            classes[client] = minor
+            used.add(minor)
+        if classes != self._classes:
+            self._classes = classes
+            state_store.set_value(_CLASSES_KEY, classes)
+        self._share_classes()
+        return [
+            ClientClass(minor, config.mark_base + minor, self._limits.get(client))
+            for client, minor in sorted(classes.items(), key=lambda item: item[1])
+        ]
+
+    def _share_classes(self) -> None:
+        """Let the auth helper name each user's class in its replies."""
+        enabled = get_config().shaping.enabled
+        proxy_auth.set_classes({
+            client: minor
+            for client, minor in self._classes.items()
+            if enabled and _network(client) is None
+        })
+
+    def classify(
+        self, user: Optional[str] = None, address: Optional[str] = None
+    ) -> Optional[ClientClass]:
+        """A client's class: by proxy user, else by address."""
+        config = get_config().shaping
+        if not config.enabled:
+            return None
+        client = user if user is not None and user in self._classes else None
+        if client is None and address is not None and self._networks:
+            try:
+                ip = ipaddress.ip_address(address)
+            except ValueError:
+                return None
+            client = next(
+                (c for network, c in self._networks if ip in network and c in self._classes),
+                None,
+            )
+        if client is None:
+            return None
+        minor = self._classes[client]
+        return ClientClass(minor, config.mark_base + minor, self._limits.get(client))
+
+    def _limit(self, client: str) -> ClientLimit:
+        minor = self._classes.get(client)
+        return ClientLimit(
+            client=client,
+            upload_kbit=self._limits.get(client),
+            mark=get_config().shaping.mark_base + minor if minor is not None else None,
+        )
+
+    def limits(self) -> list[ClientLimit]:
+        return [self._limit(client) for client in sorted(self._limits)]
+
+    async def set_limit(self, client: str, upload_kbit: Optional[int]) -> ClientLimit:
+        """Set a client's upload cap (None: fair share only) and apply it."""
+        self._limits[client] = upload_kbit
+        self._save()
+        await self.refresh()
+        return self._limit(client)
+
+    async def delete_limit(self, client: str) -> bool:
+        if client not in self._limits:
+            return False
+        del self._limits[client]
+        self._save()
+        await self.refresh()
+        return True
+
+    def _save(self) -> None:
+        state_store.set_value(_LIMITS_KEY, self._limits)
+        self._index_networks()
+
+    # Applying
+
+    def _link_rate(self, modem: ModemRecord) -> tuple[Optional[int], Optional[str]]:
+        """Rate to shape a modem's uplink to, and where it came from."""
+        config = get_config()
+        cutoff = datetime.utcnow() - timedelta(seconds=config.speedtest.max_age)
+        uploads = [
+            result.upload_mbps for result in speed_tester.history(modem.id, config.speedtest.window)
+            if result.success and result.upload_mbps and result.timestamp >= cutoff
+        ]
+        if uploads:
+            rate = statistics.median(uploads) * 1000 * config.shaping.rate_fraction
+            return max(config.shaping.min_rate_kbit, int(rate)), "speedtest"
+        if config.shaping.default_rate_kbit > 0:
+            return config.shaping.default_rate_kbit, "config"
+        return None, None
+
+    async def apply(self, modems: list[ModemRecord]) -> None:
+        """Bring every connected modem's qdiscs up to date (monitor cycle)."""
+        self._modems = modems
+        await self.refresh()
+
+    async def refresh(self, force: Optional[str] = None) -> None:
+        """Apply the current setup where it changed (or on ``force``'s interface)."""
+        config = get_config().shaping
+        if not config.enabled:
+            if self._interfaces or self._squid_rules is not None:
+                await self._clear()
+            return
+        async with self._lock:
+            classes = self._assign()
+            await self._write_squid_rules(classes)
+            current = set()
+            for modem in self._modems:
+                if not (modem.interface and modem.ip_address):
+                    continue
+                current.add(modem.interface)
+                rate, source = self._link_rate(modem)
+                setup = (rate, config.qdisc, config.classifier, tuple(classes))
+                key = (_ifindex(modem.interface), setup)
+                applied = self._applied.get(modem.interface)
+                if applied == key and modem.interface != force:
+                    continue
+                previous = None
+                if (
+                    applied is not None
+                    and applied[0] == key[0]
+                    and applied[1][1:3] == setup[1:3]
+                    and modem.interface != force
+                ):
+                    previous = list(applied[1][3])
+                error = await self.apply_interface(modem.interface, rate, classes, previous)
+                if error is None:
+                    self._applied[modem.interface] = key
+                else:
+                    self._applied.pop(modem.interface, None)
+                    logger.warning(f"Shaping {modem.interface} failed: {error}")
+                self._interfaces[modem.interface] = ShapedInterface(
+                    interface=modem.interface,
+                    modem_id=modem.id,
+                    rate_kbit=rate,
+                    rate_source=source,
+                    classes=len(classes),
+                    applied_at=datetime.utcnow() if error is None else None,
+                    error=error,
+                )
+            for interface in set(self._interfaces) - current:
+                del self._interfaces[interface]
+                self._applied.pop(interface, None)
+
+    async def _clear(self) -> None:
+        """Remove the qdiscs and Squid marks once shaping is switched off."""
+        async with self._lock:
+            for interface in list(self._interfaces):
+                await run_command(["tc", "qdisc", "del", "dev", interface, "root"])
+                logger.info(f"Removed shaping from {interface}")
+            self._interfaces.clear()
+            self._applied.clear()
+            await self._write_squid_rules([])
+            self._squid_rules = None
+            self._share_classes()
+
+    async def reapply(self, interface: Optional[str]) -> None:
+        """Set an interface up again, e.g. after its modem reconnected."""
+        if interface:
+            await self.refresh(force=interface)
+
+    @staticmethod
+    async def apply_interface(
+        interface: str,
+        rate: Optional[int],
+        classes: list[ClientClass],
+        previous: Optional[list[ClientClass]] = None,
+    ) -> Optional[str]:
+        """Bring an interface's qdiscs up to date; the error, if any.
+
+        ``previous`` are the classes last applied to the interface, which are
+        then changed in place. Should that fail (the qdiscs were changed
+        behind our back, or are an older setup of ours), the interface is
+        set up from scratch.
+        """
+        config = get_config().shaping
+        qdisc = config.qdisc
+        if previous is not None and not in_place(previous, classes, config.classifier):
+            previous = None
+        lines = tc_batch(interface, rate, classes, qdisc, config.classifier, previous)
+        error = await _run_batch(lines)
+        if error is not None:
+            logger.debug(f"Rebuilding {interface}, updating it failed: {error}")
+            # Fails harmlessly when only the default qdisc is there
+            await run_command(["tc", "qdisc", "del", "dev", interface, "root"])
+            error = await _run_batch(tc_batch(interface, rate, classes, qdisc, config.classifier))
+        if error is not None:
+            return error
+        logger.info(
+            f"Shaped {interface}: {f'{rate} kbit/s' if rate else 'unshaped link'}, "
+            f"{len(classes)} client class(es), {qdisc}"
+        )
+        return None
+
+    async def _write_squid_rules(self, classes: list[ClientClass]) -> None:
+        """Point Squid's tcp_outgoing_mark at the client classes.
+
+        Users' rules match the class the helper names in its reply and are
+        written for whole blocks of class numbers, whoever holds them, so
+        they only change when the number of classes outgrows a block.
+        """
+        config = get_config()
+        by_minor = {minor: client for client, minor in self._classes.items()}
+        lines = ["# Generated by ProxyFarm traffic shaping - DO NOT EDIT MANUALLY"]
+        if config.shaping.enabled and config.proxy_auth.enabled:
+            top = max(
+                (c.minor for c in classes if _network(by_minor[c.minor]) is None), default=0
+            )
+            end = min((top // _RULE_BLOCK + 1) * _RULE_BLOCK, _DEFAULT_CLASS)
+            for minor in range(_FIRST_CLIENT_CLASS, end):
+                name = f"pf_shape_{minor:x}"
+                lines += [
+                    f"acl {name} note {SHAPE_NOTE} {minor:x}",
+                    f"tcp_outgoing_mark {config.shaping.mark_base + minor:#x} {name}",
+                ]
+        for client_class in classes:
+            client = by_minor[client_class.minor]
+            if _network(client) is None:
+                continue
+            name = f"pf_shape_{client_class.minor:x}_src"
+            lines += [
+                f"acl {name} src {client}",
+                f"tcp_outgoing_mark {client_class.mark:#x} {name}",
+            ]
+        rules = "\n".join(lines) + "\n"
+        if rules == self._squid_rules:
+            return
+        self._squid_rules = rules
+        path = Path(config.shaping.squid_include)
+        if not is_simulated():
+            try:
+                path.write_text(rules)
+            except OSError as e:
+                logger.warning(f"Cannot write Squid shaping rules to {path}: {e}")
+                return
+        _, stderr, rc = await run_command(["squid", "-k", "reconfigure"])
+        if rc != 0:
+            logger.warning(f"Squid did not reload shaping rules: {stderr}")
+
+    def status(self) -> ShapingStatus:
+        config = get_config().shaping
+        return ShapingStatus(
+            enabled=config.enabled,
+            qdisc=config.qdisc,
+            interfaces=[self._interfaces[name] for name in sorted(self._interfaces)],
+            clients=self.limits(),
+        )
+
+
+# Global instance
+traffic_shaper = TrafficShaper()
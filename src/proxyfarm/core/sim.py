@@ -0,0 +1,597 @@
+"""Simulated modem farm for running without hardware.
+
+The backend answers the mmcli/nmcli/ip/curl/systemctl commands that
+ModemManager, NetworkManager and SquidManager run, so the real parsing and
+orchestration code is exercised end to end. Latency, failure rates and IP
+assignment are configured through ``simulation`` in the config.
+"""
+
+import asyncio
+import ipaddress
+import itertools
+import logging
+import random
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+from ..config import SimulationConfig, get_config
+from .modem import band_technology, set_command_backend
+from .speedtest import speed_tester
+from .state import ModemRecord
+
+logger = logging.getLogger(__name__)
+
+_MODEM_PATH = "/org/freedesktop/ModemManager1/Modem/{}"
+_BEARER_PATH = "/org/freedesktop/ModemManager1/Bearer/{}"
+
+# Mode combinations every simulated modem supports: (allowed, preferred)
+_SUPPORTED_MODES = [
+    (("3g",), None),
+    (("4g",), None),
+    (("3g", "4g"), "3g"),
+    (("3g", "4g"), "4g"),
+]
+_ACCESS_TECHNOLOGY = {"2g": "gsm", "3g": "umts", "4g": "lte", "5g": "5gnr"}
+
+
+@dataclass
+class SimulatedModem:
+    id: int
+    bearer_id: int
+    signal_quality: int
+    enabled: bool = True
+    connected: bool = True
+    ip_address: Optional[str] = None
+    ussd_active: bool = False
+    # Radio: allowed/preferred modes and bands (empty = all)
+    allowed_modes: tuple[str, ...] = ("3g", "4g")
+    preferred_mode: Optional[str] = "4g"
+    bands: list[str] = field(default_factory=list)
+    # No usable cell for the current radio settings
+    searching: bool = False
+    # Per band: how strong the cell is (decides where the modem camps) and
+    # how much throughput it gives
+    band_strength: dict[str, float] = field(default_factory=dict)
+    band_capacity: dict[str, float] = field(default_factory=dict)
+
+    @property
+    def interface(self) -> str:
+        return f"wwan{self.id}"
+
+    @property
+    def primary_port(self) -> str:
+        return f"cdc-wdm{self.id}"
+
+    @property
+    def gateway(self) -> Optional[str]:
+        if not self.ip_address:
+            return None
+        return str(ipaddress.ip_address(self.ip_address) + 1)
+
+    @property
+    def state(self) -> str:
+        if not self.enabled:
+            return "disabled"
+        if self.searching:
+            return "searching"
+        return "connected" if self.connected else "registered"
+
+
+def _tc_line(setup: list[str], words: list[str]) -> Optional[str]:
+    """Apply one ``tc -batch`` line to an interface's setup, as the kernel would."""
+    line = " ".join(words)
+
+    def classid(other: str) -> Optional[str]:
+        words = other.split()
+        return words[words.index("classid") + 1] if "classid" in words else None
+
+    def find(kind: str, key: str) -> Optional[int]:
+        found = (
+            i for i, other in enumerate(setup)
+            if other.startswith(kind) and classid(other) == key
+        )
+        return next(found, None)
+
+    kind, action = words[0], words[1]
+    if kind == "qdisc" and "root" in words:
+        if action == "replace" and not setup:
+            setup.append(line)
+        elif action == "add" and setup:
+            return "RTNETLINK answers: File exists"
+        elif action == "add":
+            setup.append(line)
+        return None
+    key = classid(line)
+    if kind == "class":
+        index = find(kind, key)
+        if action == "add":
+            if index is not None:
+                return "RTNETLINK answers: File exists"
+            setup.append(line)
+        elif action == "change":
+            if index is None:
+                return "RTNETLINK answers: No such file or directory"
+            setup[index] = line
+        elif action == "del":
+            if index is None:
+                return "RTNETLINK answers: No such file or directory"
+            # The class goes with its leaf qdisc
+            setup[:] = [
+                other for other in setup
+                if classid(other) != key and f"parent {key} " not in other
+            ]
+        return None
+    if kind == "filter":
+        handle = words[words.index("handle") + 1] if "handle" in words else None
+        if action == "del":
+            setup[:] = [
+                other for other in setup
+                if not (other.startswith("filter") and handle in other.split())
+            ]
+        else:
+            setup.append(line)
+    else:
+        setup.append(line)
+    return None
+
+
+class SimulatedBackend:
+    """Command backend emulating N modems behind ModemManager/NetworkManager."""
+
+    def __init__(self, config: SimulationConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self._pool = ipaddress.ip_network(config.ip_pool)
+        self._used_ips: set[str] = set()
+        self.default_route: list[str] = []
+        # Interface -> tc batch lines last applied
+        self.qdiscs: dict[str, list[str]] = {}
+        self.modems: dict[int, SimulatedModem] = {}
+        # NetworkManager connection profiles: name -> settings
+        self.connections: dict[str, dict[str, str]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        modems_config = get_config().modems
+        # Separate generator so radio properties don't shift the IP sequence
+        radio_rng = random.Random(config.seed)
+        for modem_id in range(config.modems):
+            modem = SimulatedModem(
+                id=modem_id,
+                bearer_id=modem_id,
+                signal_quality=self.rng.randint(20, 95),
+            )
+            for band in config.bands:
+                modem.band_strength[band] = radio_rng.random()
+                low, high = (0.3, 1.2) if band_technology(band) in ("4g", "5g") else (0.08, 0.2)
+                modem.band_capacity[band] = radio_rng.uniform(low, high)
+            if modem_id in config.disconnected:
+                modem.connected = False
+            else:
+                modem.ip_address = self._assign_ip()
+            self.modems[modem_id] = modem
+            self.connections[f"{modems_config.connection_prefix}{modem_id + 1}"] = {
+                "gsm.apn": modems_config.apn,
+                "connection.interface-name": modem.primary_port,
+            }
+
+    def _assign_ip(self, previous: Optional[str] = None) -> str:
+        if previous and self.rng.random() < self.config.ip_reuse_probability:
+            return previous
+        while True:
+            offset = self.rng.randrange(2, self._pool.num_addresses - 2)
+            ip = str(self._pool.network_address + offset)
+            if ip not in self._used_ips:
+                self._used_ips.add(ip)
+                if previous:
+                    self._used_ips.discard(previous)
+                return ip
+
+    async def _delay(self, kind: str) -> None:
+        base = self.config.latency.get(kind, 0.0)
+        if base > 0:
+            jitter = self.config.jitter
+            await asyncio.sleep(base * self.rng.uniform(1 - jitter, 1 + jitter))
+
+    def _fails(self, kind: str) -> bool:
+        rates = self.config.failure_rates
+        rate = rates.get(kind, rates.get("default", 0.0))
+        return rate > 0 and self.rng.random() < rate
+
+    def _modem_for_connection(self, name: str) -> Optional[SimulatedModem]:
+        prefix = get_config().modems.connection_prefix
+        if not name.startswith(prefix) or not name[len(prefix):].isdigit():
+            return None
+        return self.modems.get(int(name[len(prefix):]) - 1)
+
+    def _modem_for_interface(self, interface: str) -> Optional[SimulatedModem]:
+        match = re.fullmatch(r"wwan(\d+)", interface)
+        return self.modems.get(int(match.group(1))) if match else None
+
+    async def __call__(self, cmd: list[str]) -> tuple[str, str, int]:
+        program = cmd[0]
+        if program == "env":
+            # Variable assignments, then the command
+            rest = list(itertools.dropwhile(lambda arg: "=" in arg, cmd[1:]))
+            return await self(rest) if rest else ("", "", 0)
+        if program == "mmcli":
+            return await self._mmcli(cmd[1:])
+        if program == "nmcli":
+            return await self._nmcli(cmd[1:])
+        if program == "ip":
+            return await self._ip(cmd[1:])
+        if program == "curl":
+            return await self._curl(cmd[1:])
+        if program == "tc":
+            return await self._tc(cmd[1:])
+        if program == "systemctl":
+            await self._delay("systemctl")
+            return "active", "", 0
+        if program == "squid":
+            await self._delay("systemctl")
+            return "", "", 0
+        if program.endswith(".sh") or program == "bash":
+            await self._delay("script")
+            if self._fails("script"):
+                return "", "simulated script failure", 1
+            return "done", "", 0
+        return "", f"{program}: not supported by simulation", 127
+
+    async def _mmcli(self, args: list[str]) -> tuple[str, str, int]:
+        await self._delay("mmcli")
+        if self._fails("mmcli"):
+            return "", "error: simulated mmcli failure", 1
+
+        if args == ["-L"]:
+            lines = [
+                f"    {_MODEM_PATH.format(m.id)} [Simulated] SIM-LTE"
+                for m in self.modems.values()
+            ]
+            return "\n".join(lines) or "No modems were found", "", 0
+
+        if len(args) >= 2 and args[0] == "-b":
+            modem = self.modems.get(int(args[1])) if args[1].isdigit() else None
+            if modem is None or not modem.connected:
+                return "", f"error: couldn't find bearer {args[1]}", 1
+            return self._bearer_output(modem), "", 0
+
+        if len(args) >= 2 and args[0] == "-m":
+            modem = self.modems.get(int(args[1])) if args[1].isdigit() else None
+            if modem is None:
+                return "", f"error: couldn't find modem {args[1]}", 1
+            return await self._modem_action(modem, args[2:])
+
+        return "", "error: unsupported mmcli invocation", 1
+
+    async def _modem_action(
+        self, modem: SimulatedModem, args: list[str]
+    ) -> tuple[str, str, int]:
+        if not args:
+            return self._modem_output(modem), "", 0
+        action = args[0]
+        if action == "-e":
+            await self._delay("enable")
+            modem.enabled = True
+            return "successfully enabled the modem", "", 0
+        if action == "-d":
+            modem.enabled = False
+            modem.connected = False
+            return "successfully disabled the modem", "", 0
+        if action == "-K":
+            return self._modem_keyvalue(modem), "", 0
+        if action == "--location-get":
+            return "\n".join([
+                "modem.location.3gpp.mcc : 250",
+                "modem.location.3gpp.mnc : 99",
+                "modem.location.3gpp.lac : --",
+                f"modem.location.3gpp.tac : {0x1A2B + modem.id % 2:06X}",
+                f"modem.location.3gpp.cid : {0x100000 + modem.id:08X}",
+            ]), "", 0
+        if action.startswith("--set-allowed-modes="):
+            return self._set_modes(modem, args)
+        if action.startswith("--set-current-bands="):
+            return self._set_bands(modem, action.partition("=")[2])
+        if action == "--simple-disconnect":
+            modem.connected = False
+            return "successfully disconnected all bearers in the modem", "", 0
+        if action == "--3gpp-ussd-initiate":
+            if modem.ussd_active:
+                return "", "error: USSD session already in progress", 1
+            modem.ussd_active = True
+            try:
+                await self._delay("ussd")
+            finally:
+                modem.ussd_active = False
+            if self._fails("ussd"):
+                return "", "error: USSD request failed", 1
+            balance = self.rng.uniform(0, 500)
+            return f"response: 'Balance: {balance:.2f} RUB'", "", 0
+        if action == "--3gpp-ussd-cancel":
+            modem.ussd_active = False
+            return "successfully cancelled ongoing USSD session", "", 0
+        return "", f"error: unsupported modem action {action}", 1
+
+    def _modem_output(self, modem: SimulatedModem) -> str:
+        lines = [
+            "  -----------------------------",
+            f"  General  |                path: {_MODEM_PATH.format(modem.id)}",
+            f"           |           device-id: sim{modem.id:04d}",
+            "  Hardware |        manufacturer: Simulated",
+            "           |               model: SIM-LTE",
+            f"  System   |             physdev: /sys/devices/simulated/usb1/1-{modem.id + 1}",
+            f"           |        primary port: {modem.primary_port}",
+            f"  Status   |               state: {modem.state}",
+            f"           |      signal quality: {modem.signal_quality}% (recent)",
+            "  3GPP     |         operator id: 25099",
+            "           |       operator name: SimTel",
+        ]
+        if modem.connected:
+            lines.append(
+                f"  Bearer   |               paths: {_BEARER_PATH.format(modem.bearer_id)}"
+            )
+        return "\n".join(lines)
+
+    def _modem_keyvalue(self, modem: SimulatedModem) -> str:
+        def listing(key: str, values: list[str]) -> list[str]:
+            return [f"{key}.length : {len(values)}"] + [
+                f"{key}.value[{i}] : {value}" for i, value in enumerate(values, 1)
+            ]
+
+        def mode(allowed: tuple[str, ...], preferred: Optional[str]) -> str:
+            return f"allowed: {', '.join(allowed)}; preferred: {preferred or 'none'}"
+
+        band = self._camped_band(modem)
+        technologies = [_ACCESS_TECHNOLOGY[band_technology(band)]] if band else []
+        return "\n".join([
+            f"modem.dbus-path : {_MODEM_PATH.format(modem.id)}",
+            f"modem.generic.device-identifier : sim{modem.id:04d}",
+            f"modem.generic.state : {modem.state}",
+            *listing("modem.generic.access-technologies", technologies),
+            *listing("modem.generic.supported-modes", [
+                mode(allowed, preferred) for allowed, preferred in _SUPPORTED_MODES
+            ]),
+            f"modem.generic.current-modes : {mode(modem.allowed_modes, modem.preferred_mode)}",
+            *listing("modem.generic.supported-bands", self.config.bands),
+            *listing("modem.generic.current-bands", modem.bands or self.config.bands),
+            "modem.3gpp.operator-code : 25099",
+            "modem.3gpp.operator-name : SimTel",
+        ])
+
+    def _camped_band(self, modem: SimulatedModem) -> Optional[str]:
+        """The strongest live band of the most preferred technology allowed."""
+        usable = [
+            band for band in modem.bands or self.config.bands
+            if band not in self.config.dead_bands
+            and band_technology(band) in modem.allowed_modes
+        ]
+        # Preferred technology first, then the newest
+        order = sorted(
+            modem.allowed_modes,
+            key=lambda technology: (technology != modem.preferred_mode, -int(technology[0])),
+        )
+        for technology in order:
+            bands = [band for band in usable if band_technology(band) == technology]
+            if bands:
+                return max(bands, key=lambda band: modem.band_strength.get(band, 0.0))
+        return None
+
+    def _set_modes(self, modem: SimulatedModem, args: list[str]) -> tuple[str, str, int]:
+        allowed = tuple(args[0].partition("=")[2].split("|"))
+        preferred = None
+        for arg in args[1:]:
+            if arg.startswith("--set-preferred-mode="):
+                preferred = arg.partition("=")[2]
+        if (allowed, preferred) not in _SUPPORTED_MODES:
+            return "", "error: couldn't set current modes: Unsupported mode combination", 1
+        modem.allowed_modes, modem.preferred_mode = allowed, preferred
+        self._reregister(modem)
+        return "successfully set current modes in the modem", "", 0
+
+    def _set_bands(self, modem: SimulatedModem, value: str) -> tuple[str, str, int]:
+        bands = [] if value == "any" else value.split("|")
+        if any(band not in self.config.bands for band in bands):
+            return "", "error: couldn't set current bands: Unsupported band", 1
+        modem.bands = [] if set(bands) >= set(self.config.bands) else bands
+        self._reregister(modem)
+        return "successfully set current bands in the modem", "", 0
+
+    def _reregister(self, modem: SimulatedModem) -> None:
+        """Drop the data connection and search for a cell with the new settings."""
+        modem.connected = False
+        modem.searching = True
+
+        async def register() -> None:
+            await self._delay("radio")
+            modem.searching = self._camped_band(modem) is None
+
+        task = asyncio.create_task(register())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _default_route_output(self) -> str:
+        # As the kernel prints it: a single nexthop becomes a plain route
+        hops = [
+            self.default_route[i + 2:i + 7:2]
+            for i, word in enumerate(self.default_route)
+            if word == "nexthop"
+        ]
+        if not hops:
+            return ""
+        if len(hops) == 1:
+            gateway, interface, _ = hops[0]
+            return f"default via {gateway} dev {interface}"
+        return "default proto static\n" + "\n".join(
+            f"\tnexthop via {gateway} dev {interface} weight {weight}"
+            for gateway, interface, weight in hops
+        )
+
+    def _bearer_output(self, modem: SimulatedModem) -> str:
+        return "\n".join([
+            "  ------------------------------------",
+            f"  Status             |       interface: {modem.interface}",
+            "                     |       connected: yes",
+            "  IPv4 configuration |          method: static",
+            f"                     |         address: {modem.ip_address}",
+            "                     |          prefix: 30",
+            f"                     |         gateway: {modem.gateway}",
+            "                     |             dns: 10.200.0.1, 10.200.0.2",
+        ])
+
+    async def _nmcli(self, args: list[str]) -> tuple[str, str, int]:
+        if args[:2] == ["connection", "up"]:
+            await self._delay("connect")
+        else:
+            await self._delay("nmcli")
+
+        if args[:2] == ["connection", "add"]:
+            return self._nmcli_add(args[2:])
+
+        name = args[2] if args[:2] == ["connection", "modify"] else args[-1]
+        modem = self._modem_for_connection(name)
+        if modem is None or name not in self.connections:
+            return "", f"Error: unknown connection '{name}'.", 10
+
+        if args[:2] == ["connection", "modify"]:
+            settings = args[3:]
+            self.connections[name].update(zip(settings[::2], settings[1::2]))
+            return "", "", 0
+
+        if args[:2] == ["connection", "up"]:
+            if not modem.enabled or modem.searching or self._fails("connect"):
+                return "", f"Error: Connection activation failed: {name}", 4
+            modem.connected = True
+            modem.ip_address = self._assign_ip(modem.ip_address)
+            return f"Connection '{name}' successfully activated", "", 0
+
+        if args[:2] == ["connection", "down"]:
+            modem.connected = False
+            return f"Connection '{name}' successfully deactivated", "", 0
+
+        if args[0] == "-g":
+            values = []
+            for field in args[1].split(","):
+                if field == "GENERAL.STATE":
+                    values.append("activated" if modem.connected else "")
+                elif field == "GENERAL.DEVICES":
+                    values.append(modem.primary_port if modem.connected else "")
+                else:
+                    values.append(self.connections[name].get(field, ""))
+            return "\n".join(values), "", 0
+
+        return "", "Error: unsupported nmcli invocation", 2
+
+    def _nmcli_add(self, args: list[str]) -> tuple[str, str, int]:
+        options = dict(zip(args[::2], args[1::2]))
+        name = options.get("con-name", "")
+        if self._modem_for_connection(name) is None:
+            return "", f"Error: simulation has no modem for connection '{name}'.", 2
+        self.connections[name] = {
+            "gsm.apn": options.get("gsm.apn", ""),
+            "connection.interface-name": options.get("ifname", ""),
+        }
+        return f"Connection '{name}' successfully added.", "", 0
+
+    async def _tc(self, args: list[str]) -> tuple[str, str, int]:
+        await self._delay("tc")
+        if args[:2] == ["qdisc", "del"]:
+            self.qdiscs.pop(args[3], None)
+            return "", "", 0
+        if args[:1] == ["-batch"]:
+            lines = Path(args[1]).read_text().splitlines()
+            applied = {name: list(setup) for name, setup in self.qdiscs.items()}
+            for line in filter(str.strip, lines):
+                words = line.split()
+                interface = words[3]
+                if self._modem_for_interface(interface) is None:
+                    return "", f'Cannot find device "{interface}"', 1
+                error = _tc_line(applied.setdefault(interface, []), words)
+                if error:
+                    return "", f"{error}\nCommand failed {args[1]}", 1
+            self.qdiscs = applied
+            return "", "", 0
+        return "", f"tc {' '.join(args)}: not supported by simulation", 1
+
+    async def _ip(self, args: list[str]) -> tuple[str, str, int]:
+        await self._delay("ip")
+        if args[:3] == ["route", "flush", "cache"]:
+            return "", "", 0
+        if args[:3] == ["route", "replace", "default"]:
+            self.default_route = args[3:]
+            return "", "", 0
+        if args[:3] == ["route", "show", "default"]:
+            return self._default_route_output(), "", 0
+        if args[:2] == ["link", "show"]:
+            lines = [
+                f"{m.id + 3}: {m.interface}: <POINTOPOINT,NOARP,UP,LOWER_UP> mtu 1500"
+                for m in self.modems.values()
+            ]
+            return "\n".join(lines), "", 0
+        if args[:3] == ["-4", "addr", "show"]:
+            modem = self._modem_for_interface(args[3])
+            if modem is None:
+                return "", f'Device "{args[3]}" does not exist.', 1
+            if not modem.connected:
+                return "", "", 0
+            return f"    inet {modem.ip_address}/30 scope global {modem.interface}", "", 0
+        if args[:3] == ["route", "show", "dev"]:
+            modem = self._modem_for_interface(args[3])
+            if modem is None:
+                return "", f'Cannot find device "{args[3]}"', 1
+            if not modem.connected:
+                return "", "", 0
+            return f"default via {modem.gateway} proto static metric 700", "", 0
+        return "", "unsupported ip invocation", 1
+
+    async def _curl(self, args: list[str]) -> tuple[str, str, int]:
+        await self._delay("curl")
+        interface = args[args.index("--interface") + 1] if "--interface" in args else None
+        modem = self._modem_for_interface(interface) if interface else None
+        if modem is None or not modem.connected or self._fails("curl"):
+            return "", "", 28
+        return modem.ip_address or "", "", 0
+
+    async def speedtest(self, record: ModemRecord) -> dict:
+        """Synthetic speed test: throughput follows signal quality and band."""
+        await self._delay("speedtest")
+        modem = self.modems.get(record.id)
+        band = self._camped_band(modem) if modem else None
+        if modem is None or not modem.connected or not band or self._fails("speedtest"):
+            raise ConnectionError("Simulated speed test failure")
+        quality = modem.signal_quality / 100
+        download = 100.0 * quality * modem.band_capacity[band] * self.rng.uniform(0.85, 1.05)
+        upload = download / 4 * self.rng.uniform(0.8, 1.2)
+        duration = get_config().speedtest.duration
+        return {
+            "download_mbps": download,
+            "upload_mbps": upload,
+            "latency_ms": (
+                (25 + 60 * (1 - quality) + (40 if band_technology(band) == "3g" else 0))
+                * self.rng.uniform(0.9, 1.3)
+            ),
+            "jitter_ms": self.rng.uniform(1.0, 8.0),
+            "downloaded_bytes": int(download * 1e6 / 8 * duration),
+            "uploaded_bytes": int(upload * 1e6 / 8 * duration),
+        }
+
+
+# Active backend, if simulation is installed
+simulated_backend: Optional[SimulatedBackend] = None
+
+
+def install(config: Optional[SimulationConfig] = None) -> SimulatedBackend:
+    """Replace real commands with a simulated modem farm."""
+    global simulated_backend
+    config = config or get_config().simulation
+    simulated_backend = SimulatedBackend(config)
+    set_command_backend(simulated_backend)
+    speed_tester.set_backend(simulated_backend.speedtest)
+    logger.warning(f"Simulation backend active with {config.modems} modem(s)")
+    return simulated_backend
+
+
+def uninstall() -> None:
+    """Go back to running real commands."""
+    global simulated_backend
+    simulated_backend = None
+    set_command_backend(None)
+    speed_tester.set_backend(None)
@@ -0,0 +1,499 @@
+"""SOCKS5 listener relaying client streams and datagrams through modems.
+
+Supports CONNECT and UDP ASSOCIATE (RFC 1928) with username/password login
+(RFC 1929) against the proxy users of ``proxy_auth``. A logged-in user is
+pinned to the modem their group maps to, exactly as through Squid; without
+auth, connects go through the hedged connector's pick of usable modems.
+Outgoing sockets are bound to the modem's interface and current IP.
+
+Streams are relayed on bare sockets with ``sock_recv_into`` into fixed-size
+buffers drawn from a shared pool, so a busy relay allocates nothing per
+chunk and idle connections hold no buffers beyond their own two.
+"""
+
+import asyncio
+import ipaddress
+import logging
+import socket
+import struct
+from collections import Counter
+from typing import Callable, Optional
+
+from ..config import get_config
+from ..schemas import SocksStats
+from .connector import ConnectError, hedged_connector
+from .dns import dns_resolver
+from .proxyauth import proxy_auth
+from .shaping import ClientClass, mark_socket, traffic_shaper
+
+logger = logging.getLogger(__name__)
+
+_VERSION = 5
+_NO_AUTH = 0x00
+_USER_PASS = 0x02
+_NO_METHOD = 0xFF
+
+_CONNECT = 0x01
+_UDP_ASSOCIATE = 0x03
+
+_IPV4 = 0x01
+_DOMAIN = 0x03
+_IPV6 = 0x04
+
+# Reply codes
+_SUCCEEDED = 0x00
+_GENERAL_FAILURE = 0x01
+_NETWORK_UNREACHABLE = 0x03
+_HOST_UNREACHABLE = 0x04
+_CONNECTION_REFUSED = 0x05
+_COMMAND_NOT_SUPPORTED = 0x07
+_ADDRESS_NOT_SUPPORTED = 0x08
+
+_PORT = struct.Struct("!H")
+
+
+class SocksError(Exception):
+    """A request that gets a failure reply; ``code`` is the SOCKS reply code."""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+def encode_address(host: str, port: int) -> bytes:
+    """ATYP, address and port as they appear in requests, replies and datagrams."""
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        name = host.encode("idna")
+        return bytes((_DOMAIN, len(name))) + name + _PORT.pack(port)
+    atyp = _IPV4 if address.version == 4 else _IPV6
+    return bytes((atyp,)) + address.packed + _PORT.pack(port)
+
+
+def decode_address(data: bytes, offset: int = 0) -> tuple[str, int, int]:
+    """Host, port and end offset of an address at ``offset``; raises on bad data."""
+    atyp = data[offset]
+    if atyp == _IPV4:
+        end = offset + 5
+        host = socket.inet_ntop(socket.AF_INET, data[offset + 1:end])
+    elif atyp == _IPV6:
+        end = offset + 17
+        host = socket.inet_ntop(socket.AF_INET6, data[offset + 1:end])
+    elif atyp == _DOMAIN:
+        end = offset + 2 + data[offset + 1]
+        host = data[offset + 2:end].decode("idna")
+    else:
+        raise SocksError(_ADDRESS_NOT_SUPPORTED, f"Address type {atyp} not supported")
+    if len(data) < end + 2:
+        raise ValueError("Truncated address")
+    return host, _PORT.unpack_from(data, end)[0], end + 2
+
+
+def _reply(code: int, host: str = "0.0.0.0", port: int = 0) -> bytes:
+    return bytes((_VERSION, code, 0)) + encode_address(host, port)
+
+
+def _failure_code(error: ConnectError) -> int:
+    cause = error.__cause__
+    if isinstance(cause, ConnectionRefusedError):
+        return _CONNECTION_REFUSED
+    if isinstance(cause, (asyncio.TimeoutError, OSError)):
+        return _HOST_UNREACHABLE
+    return _GENERAL_FAILURE
+
+
+class BufferPool:
+    """Fixed-size relay buffers reused across connections."""
+
+    def __init__(self, size: int, keep: int):
+        self.size = size
+        self.keep = keep
+        self._free: list[memoryview] = []
+
+    def __len__(self) -> int:
+        return len(self._free)
+
+    def acquire(self) -> memoryview:
+        return self._free.pop() if self._free else memoryview(bytearray(self.size))
+
+    def release(self, buffer: memoryview) -> None:
+        if len(self._free) < self.keep:
+            self._free.append(buffer)
+
+
+class _Datagrams(asyncio.DatagramProtocol):
+    def __init__(self, handler: Callable[[bytes, tuple], None]):
+        self.handler = handler
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        self.handler(data, addr)
+
+
+class _UdpAssociation:
+    """Client-facing and modem-bound UDP sockets of one UDP ASSOCIATE."""
+
+    def __init__(self, server: "SocksServer", client_host: str, modem_id: int):
+        self.server = server
+        self.client_host = client_host
+        self.modem_id = modem_id
+        self.client_addr: Optional[tuple] = None
+        self.client: Optional[asyncio.DatagramTransport] = None
+        self.remote: Optional[asyncio.DatagramTransport] = None
+        self._resolved: dict[str, str] = {}
+        self._lookups: set[asyncio.Task] = set()
+
+    async def open(
+        self,
+        local_host: str,
+        interface: Optional[str],
+        source_ip: Optional[str],
+        shaping_class: Optional[ClientClass] = None,
+    ):
+        loop = asyncio.get_running_loop()
+        self.client, _ = await loop.create_datagram_endpoint(
+            lambda: _Datagrams(self.from_client), local_addr=(local_host, 0)
+        )
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            if interface:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode())
+            if shaping_class is not None:
+                mark_socket(sock, shaping_class)
+            sock.bind((source_ip or "0.0.0.0", 0))
+            self.remote, _ = await loop.create_datagram_endpoint(
+                lambda: _Datagrams(self.from_remote), sock=sock
+            )
+        except BaseException:
+            sock.close()
+            self.close()
+            raise
+
+    def close(self) -> None:
+        for task in self._lookups:
+            task.cancel()
+        for transport in (self.client, self.remote):
+            if transport is not None:
+                transport.close()
+
+    def from_client(self, data: bytes, addr: tuple) -> None:
+        # Only the client that asked for the association may use it
+        if addr[0] != self.client_host or len(data) < 4:
+            return
+        # Fragments are not supported; RFC 1928 allows dropping them
+        if data[2] != 0:
+            return
+        try:
+            host, port, offset = decode_address(data, 3)
+        except (SocksError, ValueError, IndexError, UnicodeError):
+            return
+        self.client_addr = addr
+        payload = data[offset:]
+
+        address = host if _is_ipv4(host) else self._resolved.get(host)
+        if address is not None:
+            self._send(payload, address, port)
+        elif not _is_ip(host):
+            task = asyncio.create_task(self._resolve_and_send(host, port, payload))
+            self._lookups.add(task)
+            task.add_done_callback(self._lookups.discard)
+
+    async def _resolve_and_send(self, host: str, port: int, payload: bytes) -> None:
+        addresses = await dns_resolver.lookup(host, self.modem_id)
+        if not addresses:
+            return
+        if len(self._resolved) >= 256:
+            self._resolved.clear()
+        self._resolved[host] = addresses[0]
+        self._send(payload, addresses[0], port)
+
+    def _send(self, payload: bytes, address: str, port: int) -> None:
+        self.remote.sendto(payload, (address, port))
+        self.server.counters["datagrams_up"] += 1
+
+    def from_remote(self, data: bytes, addr: tuple) -> None:
+        if self.client_addr is None:
+            return
+        header = b"\x00\x00\x00" + encode_address(addr[0], addr[1])
+        self.client.sendto(header + data, self.client_addr)
+        self.server.counters["datagrams_down"] += 1
+
+
+def _is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def _is_ipv4(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(host).version == 4
+    except ValueError:
+        return False
+
+
+async def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    loop = asyncio.get_running_loop()
+    data = b""
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            raise ConnectionError("Client closed the connection during the handshake")
+        data += chunk
+    return data
+
+
+class SocksServer:
+    """SOCKS5 listener managed by the ProxyFarm service."""
+
+    def __init__(self):
+        self._listener: Optional[socket.socket] = None
+        self._accept_task: Optional[asyncio.Task] = None
+        self._connections: set[asyncio.Task] = set()
+        self._buffers: Optional[BufferPool] = None
+        self.address: Optional[tuple[str, int]] = None
+        self.counters: Counter = Counter()
+
+    async def start(self) -> None:
+        config = get_config().socks
+        if not config.enabled:
+            return
+        self._buffers = BufferPool(config.buffer_size, config.pool_buffers)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((config.host, config.port))
+            listener.listen(config.backlog)
+        except OSError as e:
+            listener.close()
+            logger.error(f"SOCKS5 listener failed to bind {config.host}:{config.port}: {e}")
+            return
+        listener.setblocking(False)
+        self._listener = listener
+        self.address = listener.getsockname()
+        self._accept_task = asyncio.create_task(self._accept())
+        logger.info(f"SOCKS5 listener on {self.address[0]}:{self.address[1]}")
+
+    async def stop(self) -> None:
+        if self._listener is None:
+            return
+        self._accept_task.cancel()
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(self._accept_task, *self._connections, return_exceptions=True)
+        self._listener.close()
+        self._listener = None
+        self.address = None
+
+    async def _accept(self) -> None:
+        loop = asyncio.get_running_loop()
+        config = get_config().socks
+        while True:
+            try:
+                client, addr = await loop.sock_accept(self._listener)
+            except OSError as e:
+                # Out of descriptors and the like: back off instead of spinning
+                logger.warning(f"SOCKS5 accept failed: {e}")
+                await asyncio.sleep(0.1)
+                continue
+            if len(self._connections) >= config.max_connections:
+                self.counters["rejected"] += 1
+                client.close()
+                continue
+            self.counters["connections"] += 1
+            task = asyncio.create_task(self._serve(client, addr))
+            self._connections.add(task)
+            task.add_done_callback(self._connections.discard)
+
+    async def _serve(self, client: socket.socket, addr: tuple) -> None:
+        client.setblocking(False)
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        loop = asyncio.get_running_loop()
+        remote: Optional[socket.socket] = None
+        try:
+            try:
+                command, host, port, user, modem_id = await asyncio.wait_for(
+                    self._handshake(client), get_config().socks.handshake_timeout
+                )
+                # Outgoing traffic goes to the client's shaping class
+                shaping_class = traffic_shaper.classify(user, addr[0])
+                if command == _CONNECT:
+                    remote = await self._connect(host, port, modem_id)
+                    if shaping_class is not None:
+                        mark_socket(remote, shaping_class)
+                    reply = _reply(_SUCCEEDED, *remote.getsockname()[:2])
+                else:
+                    association = await self._associate(
+                        client, addr[0], modem_id, shaping_class
+                    )
+            except SocksError as e:
+                logger.debug(f"SOCKS5 request from {addr[0]} failed: {e}")
+                await loop.sock_sendall(client, _reply(e.code))
+                return
+
+            if command == _CONNECT:
+                await loop.sock_sendall(client, reply)
+                await self._relay(client, remote)
+                return
+            try:
+                await loop.sock_sendall(
+                    client, _reply(_SUCCEEDED, *association.client.get_extra_info("sockname")[:2])
+                )
+                # The association lasts as long as the control connection
+                while await loop.sock_recv(client, 256):
+                    pass
+            finally:
+                association.close()
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        except OSError as e:
+            logger.debug(f"SOCKS5 connection from {addr[0]} failed: {e}")
+        finally:
+            client.close()
+            if remote is not None:
+                remote.close()
+
+    async def _handshake(
+        self, client: socket.socket
+    ) -> tuple[int, str, int, Optional[str], Optional[int]]:
+        """Method negotiation, login and request; returns what to do, for
+        which user and via which modem."""
+        loop = asyncio.get_running_loop()
+        auth = get_config().socks.auth
+
+        version, count = await _recv_exactly(client, 2)
+        if version != _VERSION:
+            raise ConnectionError(f"Not a SOCKS5 client (version {version})")
+        methods = await _recv_exactly(client, count)
+        method = _USER_PASS if auth else _NO_AUTH
+        if method not in methods:
+            await loop.sock_sendall(client, bytes((_VERSION, _NO_METHOD)))
+            raise ConnectionError("No acceptable authentication method")
+        await loop.sock_sendall(client, bytes((_VERSION, method)))
+
+        user = modem_id = None
+        if auth:
+            user, modem_id = await self._login(client)
+
+        version, command, _, atyp = await _recv_exactly(client, 4)
+        if atyp == _IPV4:
+            raw = await _recv_exactly(client, 4)
+        elif atyp == _IPV6:
+            raw = await _recv_exactly(client, 16)
+        elif atyp == _DOMAIN:
+            (length,) = await _recv_exactly(client, 1)
+            raw = bytes((length,)) + await _recv_exactly(client, length)
+        else:
+            raise SocksError(_ADDRESS_NOT_SUPPORTED, f"Address type {atyp} not supported")
+        try:
+            host, port, _ = decode_address(bytes((atyp,)) + raw + await _recv_exactly(client, 2))
+        except UnicodeError:
+            raise SocksError(_GENERAL_FAILURE, "Bad domain name")
+        if command not in (_CONNECT, _UDP_ASSOCIATE):
+            raise SocksError(_COMMAND_NOT_SUPPORTED, f"Command {command} not supported")
+        return command, host, port, user, modem_id
+
+    async def _login(self, client: socket.socket) -> tuple[str, int]:
+        """RFC 1929 login; returns the user and their modem."""
+        loop = asyncio.get_running_loop()
+        _, length = await _recv_exactly(client, 2)
+        name = (await _recv_exactly(client, length)).decode(errors="replace")
+        (length,) = await _recv_exactly(client, 1)
+        password = (await _recv_exactly(client, length)).decode(errors="replace")
+
+        if not await proxy_auth.authenticate(name, password):
+            self.counters["auth_failures"] += 1
+            await loop.sock_sendall(client, b"\x01\x01")
+            raise ConnectionError(f"Login failed for {name!r}")
+        await loop.sock_sendall(client, b"\x01\x00")
+
+        modem_id = proxy_auth.modem_for(name)
+        if modem_id is None:
+            raise SocksError(_NETWORK_UNREACHABLE, f"No modem available for {name}")
+        return name, modem_id
+
+    async def _connect(self, host: str, port: int, modem_id: Optional[int]) -> socket.socket:
+        try:
+            # A logged-in user keeps their modem's IP; anonymous connects may be hedged
+            connection = await hedged_connector.open_socket(
+                host, port, modem_id, sticky=modem_id is not None
+            )
+        except ConnectError as e:
+            self.counters["connect_failures"] += 1
+            raise SocksError(_failure_code(e), str(e))
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection.sock
+
+    async def _associate(
+        self,
+        client: socket.socket,
+        client_host: str,
+        modem_id: Optional[int],
+        shaping_class: Optional[ClientClass] = None,
+    ) -> _UdpAssociation:
+        if modem_id is None:
+            modem_id = hedged_connector.choose()
+        target = hedged_connector.target(modem_id) if modem_id is not None else None
+        if target is None:
+            raise SocksError(_NETWORK_UNREACHABLE, "No modem available")
+        association = _UdpAssociation(self, client_host, modem_id)
+        try:
+            await association.open(client.getsockname()[0], *target, shaping_class)
+        except OSError as e:
+            raise SocksError(_GENERAL_FAILURE, f"UDP relay setup failed: {e}")
+        self.counters["udp_associations"] += 1
+        return association
+
+    async def _relay(self, client: socket.socket, remote: socket.socket) -> None:
+        """Copy both directions until both are done or either fails."""
+        tasks = [
+            asyncio.create_task(self._pipe(client, remote, "bytes_up")),
+            asyncio.create_task(self._pipe(remote, client, "bytes_down")),
+        ]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _pipe(self, source: socket.socket, sink: socket.socket, counter: str) -> None:
+        loop = asyncio.get_running_loop()
+        buffer = self._buffers.acquire()
+        try:
+            while n := await loop.sock_recv_into(source, buffer):
+                await loop.sock_sendall(sink, buffer[:n])
+                self.counters[counter] += n
+        finally:
+            self._buffers.release(buffer)
+        # Pass the half-close on, the other direction may still be busy
+        try:
+            sink.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    @property
+    def listening(self) -> bool:
+        return self._listener is not None
+
+    def stats(self) -> SocksStats:
+        return SocksStats(
+            listening=self.listening,
+            active_connections=len(self._connections),
+            connections=self.counters["connections"],
+            rejected=self.counters["rejected"],
+            auth_failures=self.counters["auth_failures"],
+            connect_failures=self.counters["connect_failures"],
+            udp_associations=self.counters["udp_associations"],
+            bytes_up=self.counters["bytes_up"],
+            bytes_down=self.counters["bytes_down"],
+            datagrams_up=self.counters["datagrams_up"],
+            datagrams_down=self.counters["datagrams_down"],
+            pooled_buffers=len(self._buffers) if self._buffers else 0,
+        )
+
+
+# Global instance
+socks_server = SocksServer()
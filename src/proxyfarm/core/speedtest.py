@@ -0,0 +1,380 @@
+"""Per-modem speed tests: download, upload, latency and jitter.
+
+A test opens its sockets bound to the modem's interface and IP, so it
+measures that modem alone, and only one test runs at a time across the
+farm: concurrent tests would share the host's USB bus and CPU and skew each
+other. Results are kept per modem (the last ``speedtest.history``, persisted
+in the state store) together with signal and operator at the time, so they
+can be compared across days. History belongs to the device (see
+``device_key``), not the modem ID, which changes when modems re-enumerate.
+The recent median download of each modem, relative to the fastest one,
+becomes its ``throughput`` egress factor.
+"""
+
+import asyncio
+import fcntl
+import ipaddress
+import logging
+import os
+import socket
+import ssl
+import statistics
+import termios
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+from urllib.parse import urlsplit
+
+from ..config import get_config
+from ..schemas import ModemState, SpeedtestResult
+from .connector import connect_bound
+from .dns import dns_resolver
+from .egress import egress_balancer
+from .state import ModemRecord, device_key
+from .store import state_store
+
+logger = logging.getLogger(__name__)
+
+# History per device
+_STATE_KEY = "speedtest.devices"
+_CHUNK = 64 * 1024
+
+# Measures one modem; returns the SpeedtestResult fields it determined
+SpeedtestBackend = Callable[[ModemRecord], Awaitable[dict]]
+
+
+def jitter(samples: list[float]) -> float:
+    """Mean absolute difference between consecutive samples (RFC 3550 style)."""
+    if len(samples) < 2:
+        return 0.0
+    return statistics.fmean(abs(b - a) for a, b in zip(samples, samples[1:]))
+
+
+def _unacked(writer: asyncio.StreamWriter) -> int:
+    """Bytes written but not yet acknowledged by the peer."""
+    pending = writer.transport.get_write_buffer_size()
+    sock = writer.get_extra_info("socket")
+    if sock is not None:
+        try:
+            pending += int.from_bytes(
+                fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0"), "little"
+            )
+        except OSError:
+            pass
+    return pending
+
+
+class _Endpoint:
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.tls = parts.scheme == "https"
+        self.host = parts.hostname or ""
+        self.port = parts.port or (443 if self.tls else 80)
+        self.path = parts.path or "/"
+        if parts.query:
+            self.path += f"?{parts.query}"
+
+    def request(self, method: str, extra: str = "") -> bytes:
+        return (
+            f"{method} {self.path} HTTP/1.1\r\nHost: {self.host}\r\n"
+            f"User-Agent: proxyfarm-speedtest\r\nConnection: close\r\n{extra}\r\n"
+        ).encode()
+
+
+class SpeedTester:
+    """Runs speed tests one at a time and keeps their history."""
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._history: dict[str, deque] = {}
+        # modem_id -> device it currently belongs to
+        self._devices: dict[int, str] = {}
+        self._backend: Optional[SpeedtestBackend] = None
+        self._task: Optional[asyncio.Task] = None
+        self._payload = os.urandom(_CHUNK)
+
+    def set_backend(self, backend: Optional[SpeedtestBackend]) -> None:
+        """Measure with ``backend`` instead of the network (simulation)."""
+        self._backend = backend
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def load(self) -> None:
+        """Restore results persisted by a previous run."""
+        saved = await state_store.get_value(_STATE_KEY, {})
+        limit = get_config().speedtest.history
+        self._history = {
+            device: deque(
+                (SpeedtestResult.model_validate(result) for result in results), maxlen=limit
+            )
+            for device, results in saved.items()
+        }
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _device(self, modem_id: int) -> str:
+        return self._devices.get(modem_id) or f"modem{modem_id}"
+
+    def _track(self, modems: list[ModemRecord]) -> None:
+        """Note which device each modem ID belongs to now."""
+        for modem in modems:
+            self._devices[modem.id] = device_key(modem)
+
+    def history(self, modem_id: int, limit: int = 100) -> list[SpeedtestResult]:
+        """Results for a modem's device, newest first."""
+        results = self._history.get(self._device(modem_id), ())
+        return list(reversed(results))[:limit]
+
+    def latest(self, modem_id: int) -> Optional[SpeedtestResult]:
+        results = self._history.get(self._device(modem_id))
+        return results[-1] if results else None
+
+    async def run(self, modem: ModemRecord, keep: bool = True) -> SpeedtestResult:
+        """Test one modem, after any test in progress has finished.
+
+        With ``keep=False`` the result stays out of the history and the
+        weighting (radio tuning trials of settings that may not stay).
+        """
+        async with self._lock:
+            started = time.monotonic()
+            fields: dict = {}
+            error = None
+            try:
+                if modem.state != ModemState.CONNECTED or not modem.ip_address:
+                    raise ConnectionError("Modem is not connected")
+                measure = self._backend or self._measure
+                fields = await measure(modem)
+            except (
+                OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ValueError,
+            ) as e:
+                error = str(e) or type(e).__name__
+                logger.warning(f"Speed test of modem {modem.id} failed: {error}")
+
+            result = SpeedtestResult(
+                timestamp=datetime.utcnow(),
+                modem_id=modem.id,
+                success=error is None,
+                interface=modem.interface,
+                signal_quality=modem.signal_quality,
+                operator_name=modem.operator_name,
+                duration_seconds=time.monotonic() - started,
+                error=error,
+                **fields,
+            )
+        if keep:
+            self._record(device_key(modem), result)
+        return result
+
+    def _record(self, device: str, result: SpeedtestResult) -> None:
+        config = get_config().speedtest
+        self._devices[result.modem_id] = device
+        results = self._history.get(device)
+        if results is None or results.maxlen != config.history:
+            results = deque(results or (), maxlen=config.history)
+            self._history[device] = results
+        results.append(result)
+        state_store.set_value(_STATE_KEY, {
+            device: [r.model_dump(mode="json") for r in results]
+            for device, results in self._history.items()
+        })
+        self._update_weights()
+
+    def _update_weights(self) -> None:
+        # Factors go to the modem IDs the devices have now
+        config = get_config().speedtest
+        cutoff = datetime.utcnow() - timedelta(seconds=config.max_age)
+        medians = {}
+        for modem_id, device in self._devices.items():
+            results = self._history.get(device, ())
+            recent = [
+                r.download_mbps for r in results
+                if r.success and r.download_mbps and r.timestamp >= cutoff
+            ][-config.window:]
+            if recent and config.weighting:
+                medians[modem_id] = statistics.median(recent)
+            else:
+                egress_balancer.clear_factor(modem_id, "throughput")
+
+        best = max(medians.values(), default=0.0)
+        for modem_id, median in medians.items():
+            egress_balancer.set_factor(
+                modem_id, "throughput", max(config.min_factor, median / best)
+            )
+
+    def schedule(self, modems: list[ModemRecord]) -> None:
+        """Start a test of the connected modem tested longest ago, if one is due."""
+        config = get_config().speedtest
+        self._track(modems)
+        # Results age out of the weighting even when no tests run
+        self._update_weights()
+        if config.interval <= 0 or self.running or (self._task and not self._task.done()):
+            return
+        now = datetime.utcnow()
+        due = []
+        for modem in modems:
+            if modem.state != ModemState.CONNECTED or not modem.ip_address:
+                continue
+            latest = self.latest(modem.id)
+            age = (now - latest.timestamp).total_seconds() if latest else float("inf")
+            if age >= config.interval:
+                due.append((age, modem.id, modem))
+        if due:
+            self._task = asyncio.create_task(self.run(max(due)[2]))
+
+    # Network measurement
+
+    async def _open(
+        self, modem: ModemRecord, endpoint: _Endpoint
+    ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        timeout = get_config().speedtest.timeout
+        sock = await asyncio.wait_for(self._connect(modem, endpoint), timeout)
+        context = ssl.create_default_context() if endpoint.tls else None
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(
+                    sock=sock, ssl=context,
+                    server_hostname=endpoint.host if context else None,
+                ),
+                timeout,
+            )
+        except BaseException:
+            sock.close()
+            raise
+
+    @staticmethod
+    async def _resolve(modem: ModemRecord, endpoint: _Endpoint) -> str:
+        try:
+            ipaddress.ip_address(endpoint.host)
+            return endpoint.host
+        except ValueError:
+            pass
+        addresses = await dns_resolver.lookup(endpoint.host, modem.id)
+        if not addresses:
+            raise ConnectionError(f"Cannot resolve {endpoint.host}")
+        return addresses[0]
+
+    async def _connect(
+        self, modem: ModemRecord, endpoint: _Endpoint, address: Optional[str] = None
+    ) -> socket.socket:
+        address = address or await self._resolve(modem, endpoint)
+        return await connect_bound(address, endpoint.port, modem.interface, modem.ip_address)
+
+    async def _measure(self, modem: ModemRecord) -> dict:
+        config = get_config().speedtest
+        download = _Endpoint(config.download_url)
+        upload = _Endpoint(config.upload_url)
+
+        # Resolve once so the samples time TCP handshakes only
+        address = await asyncio.wait_for(self._resolve(modem, download), config.timeout)
+        rtts = []
+        for _ in range(config.latency_samples):
+            started = time.perf_counter()
+            sock = await asyncio.wait_for(
+                self._connect(modem, download, address), config.timeout
+            )
+            rtts.append(time.perf_counter() - started)
+            sock.close()
+
+        downloaded, download_time = await self._download(modem, download)
+        uploaded, upload_time = await self._upload(modem, upload)
+        return {
+            "latency_ms": statistics.median(rtts) * 1000,
+            "jitter_ms": jitter(rtts) * 1000,
+            "download_mbps": downloaded * 8 / download_time / 1e6,
+            "upload_mbps": uploaded * 8 / upload_time / 1e6,
+            "downloaded_bytes": downloaded,
+            "uploaded_bytes": uploaded,
+        }
+
+    @staticmethod
+    async def _response_status(reader: asyncio.StreamReader) -> int:
+        timeout = get_config().speedtest.timeout
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        parts = head.split(b" ", 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise ValueError("Malformed HTTP response")
+        return int(parts[1])
+
+    async def _download(self, modem: ModemRecord, endpoint: _Endpoint) -> tuple[int, float]:
+        """Bytes received and seconds from the first body byte to the last."""
+        config = get_config().speedtest
+        reader, writer = await self._open(modem, endpoint)
+        try:
+            writer.write(endpoint.request("GET"))
+            status = await self._response_status(reader)
+            if status != 200:
+                raise ValueError(f"Download target answered HTTP {status}")
+            started = time.perf_counter()
+            deadline = started + config.duration
+            total = 0
+            while total < config.download_bytes:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    chunk = await asyncio.wait_for(reader.read(_CHUNK), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if not chunk:
+                    break
+                total += len(chunk)
+            elapsed = time.perf_counter() - started
+        finally:
+            writer.close()
+        if not total:
+            raise ValueError("Download target sent no data")
+        return total, elapsed
+
+    async def _upload(self, modem: ModemRecord, endpoint: _Endpoint) -> tuple[int, float]:
+        """Bytes acknowledged by the target and the seconds it took."""
+        config = get_config().speedtest
+        size = config.upload_bytes
+        reader, writer = await self._open(modem, endpoint)
+        try:
+            writer.write(endpoint.request(
+                "POST",
+                f"Content-Type: application/octet-stream\r\nContent-Length: {size}\r\n",
+            ))
+            started = time.perf_counter()
+            deadline = started + config.duration
+            sent = 0
+            while sent < size and time.perf_counter() < deadline:
+                n = min(_CHUNK, size - sent)
+                writer.write(self._payload[:n])
+                sent += n
+                remaining = deadline - time.perf_counter()
+                try:
+                    await asyncio.wait_for(writer.drain(), max(remaining, 0.001))
+                except asyncio.TimeoutError:
+                    break
+
+            if sent == size:
+                # The answer comes once the target has read the whole body
+                status = await self._response_status(reader)
+                if status >= 400:
+                    raise ValueError(f"Upload target answered HTTP {status}")
+                acked = size
+            else:
+                # Cut short: count only what the target acknowledged
+                acked = max(0, sent - _unacked(writer))
+            elapsed = time.perf_counter() - started
+        finally:
+            writer.close()
+        if not acked:
+            raise ValueError("Upload target accepted no data")
+        return acked, elapsed
+
+
+# Global instance
+speed_tester = SpeedTester()
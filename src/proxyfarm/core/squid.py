@@ -5,9 +5,15 @@ Handles dynamic reconfiguration of Squid based on active modem IPs.
 
 import asyncio
 import logging
+import re
+import time
 from pathlib import Path
 from typing import Optional
 
+import httpx
+
+from ..config import get_config
+from .modem import is_simulated, run_command
 from .network import NetworkManager
 
 logger = logging.getLogger(__name__)
@@ -19,7 +25,15 @@ class SquidManager:
     def __init__(self):
         self.network_manager = NetworkManager()
         self.setup_script = Path("/opt/proxyfarm/scripts/setup_squid.sh")
-        self.squid_conf = Path("/etc/squid/squid.conf")
+        self._mgr_client: Optional[httpx.AsyncClient] = None
+        self._conf_cache: Optional[tuple[float, list[str]]] = None
+        self._status: Optional[tuple[float, dict]] = None
+        self._status_task: Optional[asyncio.Task] = None
+        self._retiring: set[asyncio.Task] = set()
+
+    @property
+    def squid_conf(self) -> Path:
+        return Path(get_config().squid.conf_path)
 
     async def reconfigure(self) -> bool:
         """
@@ -29,31 +43,35 @@ class SquidManager:
         Returns:
             True if reconfiguration was successful, False otherwise.
         """
-        if not self.setup_script.exists():
+        if not is_simulated() and not self.setup_script.exists():
             logger.error(f"Squid setup script not found: {self.setup_script}")
             return False
 
         logger.info("Reconfiguring Squid proxy based on current modem IPs...")
 
         try:
-            process = await asyncio.create_subprocess_exec(
-                str(self.setup_script),
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
+            # The rendered config must match the running service, whatever
+            # the environment the script was first run with
+            config = get_config()
+            stdout, stderr, rc = await run_command(
+                [
+                    "env",
+                    f"PROXY_AUTH={int(config.proxy_auth.enabled)}",
+                    f"SHAPING_CONF={config.shaping.squid_include}",
+                    str(self.setup_script),
+                ],
+                timeout=300.0,
             )
 
-            stdout, stderr = await process.communicate()
-
-            if process.returncode != 0:
-                logger.error(
-                    f"Squid reconfiguration failed with exit code {process.returncode}"
-                )
-                logger.error(f"stdout: {stdout.decode()}")
-                logger.error(f"stderr: {stderr.decode()}")
+            if rc != 0:
+                logger.error(f"Squid reconfiguration failed with exit code {rc}")
+                logger.error(f"stdout: {stdout}")
+                logger.error(f"stderr: {stderr}")
                 return False
 
+            self.invalidate_status()
             logger.info("Squid reconfiguration completed successfully")
-            logger.debug(f"Output: {stdout.decode()}")
+            logger.debug(f"Output: {stdout}")
             return True
 
         except Exception as e:
@@ -63,54 +81,200 @@ class SquidManager:
     async def is_running(self) -> bool:
         """Check if Squid service is running."""
         try:
-            process = await asyncio.create_subprocess_exec(
-                "systemctl",
-                "is-active",
-                "squid",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-            )
-
-            stdout, _ = await process.communicate()
-            return stdout.decode().strip() == "active"
+            stdout, _, _ = await run_command(["systemctl", "is-active", "squid"])
+            return stdout == "active"
 
         except Exception as e:
             logger.error(f"Failed to check Squid status: {e}")
             return False
 
+    def _client(self) -> httpx.AsyncClient:
+        """Keep-alive client for Squid's cache manager interface."""
+        if self._mgr_client is None:
+            config = get_config().squid
+            self._mgr_client = httpx.AsyncClient(
+                base_url=f"http://{config.host}:{config.port}",
+                timeout=config.mgr_timeout,
+                limits=httpx.Limits(max_connections=2, max_keepalive_connections=2),
+            )
+        return self._mgr_client
+
+    async def _mgr(self, page: str) -> str:
+        response = await self._client().get(f"/squid-internal-mgr/{page}")
+        response.raise_for_status()
+        return response.text
+
+    async def get_runtime_stats(self) -> Optional[dict]:
+        """Query live load figures from the cache manager (None if unreachable)."""
+        try:
+            info, utilization, active = await asyncio.gather(
+                self._mgr("info"),
+                self._mgr("utilization"),
+                self._mgr("active_requests"),
+            )
+        except httpx.HTTPError as e:
+            logger.debug(f"Squid cache manager unavailable: {e}")
+            return None
+
+        stats = parse_mgr_info(info)
+        stats.update(parse_mgr_utilization(utilization))
+        stats["active_requests"] = sum(
+            1 for line in active.splitlines() if line.startswith("Connection:")
+        )
+        return stats
+
+    def _read_outgoing_ips(self) -> Optional[list[str]]:
+        """Outgoing IPs from squid.conf, re-parsed only when the file changes."""
+        try:
+            mtime = self.squid_conf.stat().st_mtime
+        except FileNotFoundError:
+            self._conf_cache = None
+            return None
+
+        if self._conf_cache is None or self._conf_cache[0] != mtime:
+            outgoing_ips = []
+            with open(self.squid_conf, "r") as f:
+                for line in f:
+                    # Extract tcp_outgoing_address lines
+                    if line.strip().startswith("tcp_outgoing_address"):
+                        parts = line.split()
+                        if len(parts) >= 2:
+                            outgoing_ips.append(parts[1])
+            self._conf_cache = (mtime, outgoing_ips)
+        return self._conf_cache[1]
+
+    async def _collect_status(self) -> dict:
+        runtime = await self.get_runtime_stats()
+        # A responding cache manager proves Squid is up; skip systemctl then
+        running = True if runtime is not None else await self.is_running()
+
+        try:
+            outgoing_ips = await asyncio.to_thread(self._read_outgoing_ips)
+        except Exception as e:
+            logger.warning(f"Failed to parse Squid config: {e}")
+            outgoing_ips = []
+
+        return {
+            "running": running,
+            "config_exists": outgoing_ips is not None,
+            "outgoing_ips": outgoing_ips or [],
+            "runtime": runtime,
+        }
+
     async def get_status(self) -> dict:
         """
-        Get current Squid status including configuration and service state.
+        Get current Squid status including configuration, service state and
+        live load from the cache manager.
+
+        Results are cached for ``squid.status_ttl`` seconds and concurrent
+        callers share one collection, so dashboards can poll cheaply.
 
         Returns:
             Dictionary with Squid status information.
         """
-        status = {
-            "running": await self.is_running(),
-            "config_exists": self.squid_conf.exists(),
-        }
-
-        # Get active outgoing IPs from config if available
-        if self.squid_conf.exists():
-            try:
-                with open(self.squid_conf, "r") as f:
-                    content = f.read()
-                    # Extract tcp_outgoing_address lines
-                    outgoing_ips = []
-                    for line in content.split("\n"):
-                        if line.strip().startswith("tcp_outgoing_address"):
-                            parts = line.split()
-                            if len(parts) >= 2:
-                                outgoing_ips.append(parts[1])
-                    status["outgoing_ips"] = outgoing_ips
-            except Exception as e:
-                logger.warning(f"Failed to parse Squid config: {e}")
-                status["outgoing_ips"] = []
-        else:
-            status["outgoing_ips"] = []
+        ttl = get_config().squid.status_ttl
+        if self._status is not None and time.monotonic() - self._status[0] < ttl:
+            return self._status[1]
 
+        if self._status_task is None or self._status_task.done():
+            self._status_task = asyncio.create_task(self._collect_status())
+        status = await asyncio.shield(self._status_task)
+        self._status = (time.monotonic(), status)
         return status
 
+    def invalidate_status(self) -> None:
+        """Forget the cached status, e.g. after a reconfigure."""
+        self._status = None
+
+    def reset_client(self) -> None:
+        """Use the current settings from the next request on (config reload).
+
+        The old client is closed once requests already using it are done.
+        """
+        client, self._mgr_client = self._mgr_client, None
+        self._status = None
+        if client is not None:
+            task = asyncio.create_task(_close_later(client, get_config().squid.mgr_timeout))
+            self._retiring.add(task)
+            task.add_done_callback(self._retiring.discard)
+
+    async def close(self) -> None:
+        if self._mgr_client is not None:
+            await self._mgr_client.aclose()
+            self._mgr_client = None
+
+
+async def _close_later(client: httpx.AsyncClient, delay: float) -> None:
+    await asyncio.sleep(delay)
+    await client.aclose()
+
+
+def _mgr_number(value: str) -> Optional[float]:
+    match = re.match(r"\s*(-?[\d.]+)", value)
+    return float(match.group(1)) if match else None
+
+
+def parse_mgr_info(text: str) -> dict:
+    """Extract load figures from ``mgr:info`` output."""
+    fields = {
+        "Number of clients accessing cache": "clients",
+        "Number of HTTP requests received": "http_requests_total",
+        "Average HTTP requests per minute since start": "http_requests_per_minute",
+        "Maximum number of file descriptors": "fd_max",
+        "Number of file desc currently in use": "fd_in_use",
+        "Available number of file descriptors": "fd_available",
+        "Largest file desc currently in use": "fd_largest",
+    }
+    median_rows = {
+        "HTTP Requests (All)": "http_all",
+        "Cache Misses": "cache_misses",
+        "Cache Hits": "cache_hits",
+        "DNS Lookups": "dns_lookups",
+    }
+    stats: dict = {"median_service_times": {}}
+    in_medians = False
+    for line in text.splitlines():
+        if line.startswith("Median Service Times"):
+            in_medians = True
+            continue
+        if line and not line[0].isspace():
+            in_medians = False
+        key, sep, value = line.strip().partition(":")
+        if not sep:
+            continue
+        if in_medians and key in median_rows:
+            numbers = value.split()
+            if len(numbers) >= 2:
+                stats["median_service_times"][median_rows[key]] = {
+                    "5min": float(numbers[0]),
+                    "60min": float(numbers[1]),
+                }
+        elif key in fields:
+            number = _mgr_number(value)
+            if number is not None:
+                stats[fields[key]] = int(number) if number.is_integer() else number
+    return stats
+
+
+def parse_mgr_utilization(text: str) -> dict:
+    """Extract 5-minute request and traffic rates from ``mgr:utilization``."""
+    wanted = {
+        "client_http.requests": "requests_per_second",
+        "client_http.kbytes_in": "client_kbytes_in_per_second",
+        "client_http.kbytes_out": "client_kbytes_out_per_second",
+        "server.all.requests": "server_requests_per_second",
+    }
+    stats: dict = {}
+    for line in text.splitlines():
+        key, sep, value = line.strip().partition("=")
+        key = key.strip()
+        # The first section is "Last 5 minutes"; keep the first value seen
+        if sep and key in wanted and wanted[key] not in stats:
+            number = _mgr_number(value.split("/")[0])
+            if number is not None:
+                stats[wanted[key]] = number
+    return stats
+
 
 # Global instance
 squid_manager = SquidManager()
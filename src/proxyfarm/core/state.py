@@ -0,0 +1,85 @@
+"""Internal modem state.
+
+The monitor polls every modem every few seconds, and most of what it reads
+never reaches an HTTP response. Internally modems are therefore plain slots
+dataclasses; the monitor updates its inventory records in place. The
+pydantic ``Modem``/``Bearer`` schemas only describe the API: responses are
+serialized straight from these records by pydantic-core, with no model
+instances built in between. Field names match the schemas one to one.
+"""
+
+from dataclasses import dataclass, field, fields
+from typing import Optional, Union
+
+from pydantic import TypeAdapter
+
+from ..schemas import ModemState
+
+
+@dataclass(slots=True)
+class BearerRecord:
+    id: int
+    interface: Optional[str] = None
+    ip_address: Optional[str] = None
+    gateway: Optional[str] = None
+    dns: list[str] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class ModemRecord:
+    id: int
+    manufacturer: Optional[str] = None
+    model: Optional[str] = None
+    device_id: Optional[str] = None
+    primary_port: Optional[str] = None
+    state: ModemState = ModemState.UNKNOWN
+    signal_quality: Optional[int] = None
+    operator_name: Optional[str] = None
+    operator_id: Optional[str] = None
+    bearer: Optional[BearerRecord] = None
+    interface: Optional[str] = None
+    ip_address: Optional[str] = None
+
+    def update(self, other: "ModemRecord") -> None:
+        """Copy every field of ``other`` into this record."""
+        for name in _MODEM_FIELDS:
+            setattr(self, name, getattr(other, name))
+
+
+def device_key(record: ModemRecord) -> str:
+    """What to key per-modem history by.
+
+    Modem IDs change when a modem re-enumerates; ModemManager's device ID
+    does not. Modems that don't report one fall back to their ID.
+    """
+    return record.device_id or f"modem{record.id}"
+
+
+@dataclass(slots=True)
+class ModemListing:
+    modems: list[ModemRecord]
+    count: int
+
+
+_MODEM_FIELDS = tuple(f.name for f in fields(ModemRecord))
+
+_modem_adapter = TypeAdapter(ModemRecord)
+_listing_adapter = TypeAdapter(ModemListing)
+
+
+def modem_json(record: ModemRecord) -> bytes:
+    """Serialize a modem the way the ``Modem`` schema describes it."""
+    return _modem_adapter.dump_json(record)
+
+
+def modem_list_json(records: list[ModemRecord], only: Optional[set[str]] = None) -> bytes:
+    """Serialize a ``ModemListResponse``, limited to ``only`` fields (and id)."""
+    include = None
+    if only is not None:
+        include = {"modems": {"__all__": only | {"id"}}, "count": True}
+    return _listing_adapter.dump_json(ModemListing(records, len(records)), include=include)
+
+
+def load_modem(data: Union[str, bytes]) -> ModemRecord:
+    """Parse a modem serialized with ``modem_json``."""
+    return _modem_adapter.validate_json(data)
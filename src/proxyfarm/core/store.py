@@ -0,0 +1,381 @@
+"""Persistent state store backed by SQLite in WAL mode.
+
+Writes are queued in memory and flushed in batches by a background task, so
+callers on the hot path never wait on disk. All database access happens on
+one dedicated thread to keep the event loop free.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional
+
+from ..config import get_config
+from ..schemas import ProbeRecord, RotationRecord, RotationResult
+from .state import ModemRecord, load_modem, modem_json
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS inventory (
+    modem_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rotations (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    modem_id INTEGER NOT NULL,
+    success INTEGER NOT NULL,
+    old_ip TEXT,
+    new_ip TEXT,
+    error TEXT,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rotations_modem_ts ON rotations (modem_id, ts);
+CREATE TABLE IF NOT EXISTS probes (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    modem_id INTEGER NOT NULL,
+    success INTEGER NOT NULL,
+    latency REAL,
+    external_ip TEXT
+);
+CREATE INDEX IF NOT EXISTS probes_modem_ts ON probes (modem_id, ts);
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Tables pruned by retention, with their timestamp column
+_HISTORY_TABLES = ("rotations", "probes")
+
+
+def _describe(
+    batch: list[tuple[str, tuple]],
+    inventory: Optional[list[tuple[int, str]]],
+    kv: dict[str, str],
+) -> str:
+    """What a write batch holds, e.g. ``3 rotations row(s), inventory of 4``."""
+    # Statements are all "INSERT INTO <table> ..."
+    tables = Counter(sql.split()[2] for sql, _ in batch)
+    parts = [f"{count} {table} row(s)" for table, count in tables.items()]
+    if inventory is not None:
+        parts.append(f"inventory of {len(inventory)}")
+    if kv:
+        parts.append(f"keys {', '.join(sorted(kv))}")
+    return ", ".join(parts)
+
+
+class StateStore:
+    """Embedded store for inventory snapshots, rotation and probe history."""
+
+    def __init__(self):
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: list[tuple[str, tuple]] = []
+        self._inventory: Optional[list[tuple[int, str]]] = None
+        self._kv: dict[str, str] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._last_prune = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    async def _call(self, fn: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _open(self, path: Path) -> sqlite3.Connection:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(_SCHEMA)
+        return db
+
+    async def start(self) -> None:
+        """Open the database and start the batch writer."""
+        config = get_config().store
+        if not config.enabled:
+            logger.info("State store disabled in config")
+            return
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+        try:
+            self._db = await self._call(self._open, Path(config.path))
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Failed to open state store {config.path}: {e}")
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            return
+
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"State store opened at {config.path}")
+
+    async def stop(self) -> None:
+        """Flush pending writes and close the database."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._db is not None:
+            await self.flush()
+            await self._call(self._db.close)
+            self._db = None
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def _run(self) -> None:
+        while True:
+            # Read every cycle, so a reloaded config applies
+            config = get_config().store
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=config.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if time.time() - self._last_prune > 3600:
+                try:
+                    await self._call(self._prune, config.retention_days)
+                except Exception as e:
+                    logger.exception(f"State store prune failed: {e}")
+                self._last_prune = time.time()
+
+    def _enqueue(self, sql: str, params: tuple) -> None:
+        if self._db is None:
+            return
+        self._pending.append((sql, params))
+        if len(self._pending) >= get_config().store.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> None:
+        """Write all queued rows in one transaction.
+
+        A batch that fails is logged and dropped, so the writer carries on
+        with the next one.
+        """
+        if self._db is None:
+            return
+        batch, self._pending = self._pending, []
+        inventory, self._inventory = self._inventory, None
+        kv, self._kv = self._kv, {}
+        if not (batch or inventory is not None or kv):
+            return
+        try:
+            await self._call(self._write, batch, inventory, kv)
+        except Exception as e:
+            logger.exception(
+                f"State store write failed, dropped {_describe(batch, inventory, kv)}: {e}"
+            )
+
+    def _write(
+        self,
+        batch: list[tuple[str, tuple]],
+        inventory: Optional[list[tuple[int, str]]],
+        kv: dict[str, str],
+    ) -> None:
+        db = self._db
+        now = time.time()
+        db.execute("BEGIN")
+        try:
+            # Rows come from a handful of statements; group them for executemany
+            grouped: dict[str, list[tuple]] = {}
+            for sql, params in batch:
+                grouped.setdefault(sql, []).append(params)
+            for sql, rows in grouped.items():
+                db.executemany(sql, rows)
+            if inventory is not None:
+                db.execute("DELETE FROM inventory")
+                db.executemany(
+                    "INSERT INTO inventory (modem_id, data, updated_at) VALUES (?, ?, ?)",
+                    [(modem_id, data, now) for modem_id, data in inventory],
+                )
+            if kv:
+                db.executemany(
+                    "INSERT OR REPLACE INTO kv (key, value, updated_at) VALUES (?, ?, ?)",
+                    [(key, value, now) for key, value in kv.items()],
+                )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def _prune(self, retention_days: int) -> None:
+        cutoff = time.time() - retention_days * 86400
+        for table in _HISTORY_TABLES:
+            self._db.execute(f"DELETE FROM {table} WHERE ts < ?", (cutoff,))
+
+    # Writers (non-blocking, batched)
+
+    def record_rotation(self, result: RotationResult) -> None:
+        """Queue a rotation result for persistence."""
+        self._enqueue(
+            "INSERT INTO rotations (ts, modem_id, success, old_ip, new_ip, error, duration)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                time.time(),
+                result.modem_id,
+                int(result.success),
+                result.old_ip,
+                result.new_ip,
+                result.error,
+                result.duration_seconds,
+            ),
+        )
+
+    def record_probe(
+        self,
+        modem_id: int,
+        success: bool,
+        latency: Optional[float],
+        external_ip: Optional[str],
+    ) -> None:
+        """Queue a connectivity probe sample for persistence."""
+        self._enqueue(
+            "INSERT INTO probes (ts, modem_id, success, latency, external_ip)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (time.time(), modem_id, int(success), latency, external_ip),
+        )
+
+    def save_inventory(self, modems: Iterable[ModemRecord]) -> None:
+        """Queue an inventory snapshot; only the latest one is written.
+
+        Records are serialized here, on the loop: the monitor keeps updating
+        them in place while the writer thread works through the queue.
+        """
+        if self._db is not None:
+            self._inventory = [(m.id, modem_json(m).decode()) for m in modems]
+
+    def set_value(self, key: str, value: Any) -> None:
+        """Queue a JSON-serializable value under ``key``."""
+        if self._db is not None:
+            self._kv[key] = json.dumps(value)
+
+    # Readers
+
+    async def load_inventory(self) -> tuple[list[ModemRecord], Optional[float]]:
+        """Load the last inventory snapshot and the time it was taken."""
+        if self._db is None:
+            return [], None
+
+        def query() -> list[tuple[str, float]]:
+            return self._db.execute(
+                "SELECT data, updated_at FROM inventory ORDER BY modem_id"
+            ).fetchall()
+
+        rows = await self._call(query)
+        modems = [load_modem(data) for data, _ in rows]
+        updated_at = max((ts for _, ts in rows), default=None)
+        return modems, updated_at
+
+    async def get_value(self, key: str, default: Any = None) -> Any:
+        """Read a value stored with set_value (pending writes included)."""
+        if key in self._kv:
+            return json.loads(self._kv[key])
+        if self._db is None:
+            return default
+
+        def query() -> Optional[tuple[str]]:
+            return self._db.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+
+        row = await self._call(query)
+        return json.loads(row[0]) if row else default
+
+    async def _history(
+        self,
+        table: str,
+        columns: str,
+        modem_id: int,
+        since: Optional[float],
+        until: Optional[float],
+        limit: int,
+    ) -> list[tuple]:
+        if self._db is None:
+            return []
+        # Make sure just-recorded rows are visible
+        await self.flush()
+
+        def query() -> list[tuple]:
+            return self._db.execute(
+                f"SELECT {columns} FROM {table}"
+                " WHERE modem_id = ? AND ts >= ? AND ts <= ?"
+                " ORDER BY ts DESC LIMIT ?",
+                (
+                    modem_id,
+                    since if since is not None else 0.0,
+                    until if until is not None else float("inf"),
+                    limit,
+                ),
+            ).fetchall()
+
+        return await self._call(query)
+
+    async def rotation_history(
+        self,
+        modem_id: int,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 100,
+    ) -> list[RotationRecord]:
+        """Rotation results for a modem in a time range, newest first."""
+        rows = await self._history(
+            "rotations",
+            "ts, modem_id, success, old_ip, new_ip, error, duration",
+            modem_id, since, until, limit,
+        )
+        return [
+            RotationRecord(
+                timestamp=ts,
+                modem_id=mid,
+                success=bool(success),
+                old_ip=old_ip,
+                new_ip=new_ip,
+                error=error,
+                duration_seconds=duration,
+            )
+            for ts, mid, success, old_ip, new_ip, error, duration in rows
+        ]
+
+    async def probe_history(
+        self,
+        modem_id: int,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 100,
+    ) -> list[ProbeRecord]:
+        """Connectivity probe samples for a modem in a time range, newest first."""
+        rows = await self._history(
+            "probes",
+            "ts, modem_id, success, latency, external_ip",
+            modem_id, since, until, limit,
+        )
+        return [
+            ProbeRecord(
+                timestamp=ts,
+                modem_id=mid,
+                success=bool(success),
+                latency_ms=latency * 1000 if latency is not None else None,
+                external_ip=external_ip,
+            )
+            for ts, mid, success, latency, external_ip in rows
+        ]
+
+
+# Global instance
+state_store = StateStore()
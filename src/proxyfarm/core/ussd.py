@@ -1,7 +1,11 @@
 """USSD command handling."""
 
+import asyncio
 import logging
+import time
+from typing import Optional
 
+from ..config import get_config
 from ..schemas import USSDResponse
 from .modem import modem_manager
 
@@ -9,20 +13,114 @@ logger = logging.getLogger(__name__)
 
 
 class USSDHandler:
-    """Handles USSD commands."""
+    """Handles USSD commands.
 
-    async def send(self, modem_id: int, command: str) -> USSDResponse:
+    Sessions are serialized per modem (a modem can only run one USSD session
+    at a time), identical commands already pending for a modem share one
+    session, and responses to idempotent commands are cached for
+    ``ussd.cache_ttl`` seconds.
+    """
+
+    def __init__(self):
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._pending: dict[tuple[int, str], asyncio.Task] = {}
+        self._cache: dict[tuple[int, str], tuple[float, USSDResponse]] = {}
+
+    def _cached(self, key: tuple[int, str]) -> Optional[USSDResponse]:
+        config = get_config()
+        if key[1] not in config.ussd.cacheable_commands:
+            return None
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        stored_at, response = entry
+        if time.monotonic() - stored_at > config.ussd.cache_ttl:
+            del self._cache[key]
+            return None
+        return response.model_copy(update={"cached": True})
+
+    def invalidate(self, modem_id: Optional[int] = None) -> None:
+        """Drop cached responses for one modem or for all modems."""
+        if modem_id is None:
+            self._cache.clear()
+            return
+        for key in [k for k in self._cache if k[0] == modem_id]:
+            del self._cache[key]
+
+    async def send(
+        self, modem_id: int, command: str, use_cache: bool = True
+    ) -> USSDResponse:
         """Send USSD command to a modem."""
-        logger.info(f"Sending USSD '{command}' to modem {modem_id}")
+        key = (modem_id, command)
+
+        if use_cache:
+            cached = self._cached(key)
+            if cached is not None:
+                logger.info(f"USSD '{command}' for modem {modem_id} served from cache")
+                return cached
+
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self._run(modem_id, command))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        else:
+            logger.info(f"Joining pending USSD '{command}' for modem {modem_id}")
 
-        success, response = await modem_manager.send_ussd(modem_id, command)
+        # Shield so a disconnecting caller doesn't cancel the session for
+        # everyone else waiting on it.
+        return await asyncio.shield(task)
+
+    async def send_many(
+        self, modem_ids: list[int], command: str, use_cache: bool = True
+    ) -> list[USSDResponse]:
+        """Send the same USSD command to several modems in parallel.
+
+        A modem whose session raises gets a failed response of its own; the
+        other modems' results are still returned.
+        """
+        results = await asyncio.gather(
+            *(self.send(mid, command, use_cache) for mid in modem_ids),
+            return_exceptions=True,
+        )
+        responses = []
+        for modem_id, result in zip(modem_ids, results):
+            if isinstance(result, BaseException):
+                if not isinstance(result, (Exception, asyncio.CancelledError)):
+                    raise result
+                error = str(result) or type(result).__name__
+                logger.error(f"USSD '{command}' for modem {modem_id} failed: {error}")
+                result = USSDResponse(
+                    modem_id=modem_id,
+                    command=command,
+                    response=error,
+                    success=False,
+                    error=error,
+                )
+            responses.append(result)
+        return responses
+
+    async def _run(self, modem_id: int, command: str) -> USSDResponse:
+        config = get_config()
+        lock = self._locks.setdefault(modem_id, asyncio.Lock())
+
+        async with lock:
+            logger.info(f"Sending USSD '{command}' to modem {modem_id}")
+            try:
+                success, response = await modem_manager.send_ussd(
+                    modem_id, command, timeout=config.ussd.timeout
+                )
+            except asyncio.TimeoutError:
+                # Leave the modem ready for the next queued session
+                await modem_manager.cancel_ussd(modem_id)
+                success, response = False, "USSD session timed out"
 
         if success:
             logger.info(f"USSD response from modem {modem_id}: {response}")
         else:
             logger.error(f"USSD failed for modem {modem_id}: {response}")
 
-        return USSDResponse(
+        result = USSDResponse(
             modem_id=modem_id,
             command=command,
             response=response,
@@ -30,6 +128,11 @@ class USSDHandler:
             error=None if success else response,
         )
 
+        if success and command in config.ussd.cacheable_commands:
+            self._cache[(modem_id, command)] = (time.monotonic(), result)
+
+        return result
+
 
 # Global instance
 ussd_handler = USSDHandler()
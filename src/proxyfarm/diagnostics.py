@@ -0,0 +1,394 @@
+"""Event loop health instrumentation and an on-demand sampling profiler.
+
+Always on (``diagnostics.enabled``): a timer on the loop ticks every
+``lag_interval`` seconds and records how late it ran, which is how long
+other work held the loop up. A watchdog thread checks the ticks; when one
+is more than ``slow_callback`` seconds overdue the loop is stuck in some
+callback, and the watchdog captures the loop thread's stack right then, so
+the stall report shows the blocking code (a synchronous read, a slow log
+handler) rather than where the loop resumed. Its duration is filled in
+when the loop gets to the tick, counted from when the previous tick ran:
+the loop was free then, so the block can't have started earlier, and the
+figure overstates it by at most one ``lag_interval``. Stalls shorter than ``slow_callback`` plus
+up to one ``lag_interval`` may go unseen; the cost is one timer callback
+per interval and one thread wakeup per half threshold.
+
+On demand: a sampling profiler that reads the loop thread's (or every
+thread's) stack from a timer signal at a fixed rate for a time window and returns collapsed
+stacks or a flamegraph, and a listing of what each task is awaiting.
+Everything is per process; with several workers the API shows the owner.
+"""
+
+import asyncio
+import html
+import logging
+import signal
+import sys
+import threading
+import time
+import traceback
+import zlib
+from collections import Counter, deque
+from datetime import datetime
+from types import CodeType, FrameType
+from typing import Optional
+
+from .config import get_config
+from .schemas import LoopLag, LoopReport, LoopStall, ProfileReport, TaskInfo
+
+logger = logging.getLogger(__name__)
+
+_MAX_STACK = 64
+
+
+def _percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+def _short_path(path: str) -> str:
+    """A file path relative to the sys.path entry it was imported from."""
+    best = ""
+    for entry in sys.path:
+        if entry and path.startswith(entry) and len(entry) > len(best):
+            best = entry
+    return path[len(best):].lstrip("/") if best else path
+
+
+def _frame_line(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({_short_path(code.co_filename)}:{frame.f_lineno})"
+
+
+class LoopMonitor:
+    """Measures event loop lag and catches stalls with their stack."""
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        # Monotonic time the next tick is due, and when the last one ran
+        self._due = 0.0
+        self._ran = 0.0
+        self._stall: Optional[tuple[float, LoopStall]] = None
+        self._lags: deque[float] = deque()
+        self.stalls: deque[LoopStall] = deque()
+        self.stall_count = 0
+
+    @property
+    def running(self) -> bool:
+        return self._handle is not None
+
+    def start(self) -> None:
+        """Start the lag timer on the running loop and the watchdog thread."""
+        config = get_config().diagnostics
+        if not config.enabled:
+            logger.info("Event loop diagnostics disabled in config")
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._lags = deque(maxlen=max(1, int(config.window / config.lag_interval)))
+        self.stalls = deque(maxlen=config.keep_stalls)
+        self._stopping.clear()
+        self._schedule(time.monotonic())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._stopping.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    def _schedule(self, now: float) -> None:
+        interval = get_config().diagnostics.lag_interval
+        self._ran = now
+        self._due = now + interval
+        self._handle = self._loop.call_at(self._due, self._tick)
+
+    def _tick(self) -> None:
+        now = time.monotonic()
+        self._lags.append(max(0.0, now - self._due))
+        with self._lock:
+            if self._stall is not None:
+                started, stall = self._stall
+                stall.duration_ms = (now - started) * 1000
+                self._stall = None
+        self._schedule(now)
+
+    def _watch(self) -> None:
+        while not self._stopping.wait(get_config().diagnostics.slow_callback / 2):
+            threshold = get_config().diagnostics.slow_callback
+            now = time.monotonic()
+            with self._lock:
+                if self._stall is not None or now - self._due < threshold:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is None:
+                    continue
+                stack = [
+                    f"{entry.name} ({_short_path(entry.filename)}:{entry.lineno})"
+                    for entry in traceback.extract_stack(frame, limit=_MAX_STACK)
+                ]
+                task = asyncio.current_task(self._loop)
+                stall = LoopStall(
+                    started_at=datetime.utcnow(),
+                    task=task.get_name() if task else None,
+                    stack=stack,
+                )
+                # The loop was last seen free when the previous tick ran
+                self._stall = (self._ran, stall)
+                self.stalls.append(stall)
+                self.stall_count += 1
+            logger.warning(
+                f"Event loop blocked for over {threshold * 1000:.0f} ms in "
+                f"{stack[-1] if stack else 'unknown code'}"
+            )
+
+    def report(self, recent: int = 10) -> LoopReport:
+        config = get_config().diagnostics
+        lag = None
+        if self._lags:
+            samples = list(self._lags)
+            lag = LoopLag(
+                interval_ms=config.lag_interval * 1000,
+                samples=len(samples),
+                current_ms=samples[-1] * 1000,
+                p50_ms=_percentile(samples, 50) * 1000,
+                p99_ms=_percentile(samples, 99) * 1000,
+                max_ms=max(samples) * 1000,
+            )
+        return LoopReport(
+            running=self.running,
+            lag=lag,
+            slow_callback_ms=config.slow_callback * 1000,
+            stalls=self.stall_count,
+            recent_stalls=list(self.stalls)[-recent:][::-1] if recent else [],
+            tasks=len(asyncio.all_tasks()),
+        )
+
+
+def _describe_waiter(waiter: Optional[asyncio.Future]) -> Optional[str]:
+    if waiter is None:
+        return None
+    if isinstance(waiter, asyncio.Task):
+        return f"task {waiter.get_name()}"
+    children = getattr(waiter, "_children", None)
+    if children is not None:
+        pending = sum(1 for child in children if not child.done())
+        return f"gather of {len(children)} ({pending} pending)"
+    return type(waiter).__name__ + (" (done)" if waiter.done() else " (pending)")
+
+
+def task_info(task: asyncio.Task) -> TaskInfo:
+    """What a task runs and where it is suspended."""
+    coro = task.get_coro()
+    stack = []
+    current = coro
+    while current is not None and len(stack) < _MAX_STACK:
+        frame = (
+            getattr(current, "cr_frame", None)
+            or getattr(current, "gi_frame", None)
+            or getattr(current, "ag_frame", None)
+        )
+        if frame is None:
+            break
+        stack.append(_frame_line(frame))
+        current = (
+            getattr(current, "cr_await", None)
+            or getattr(current, "gi_yieldfrom", None)
+            or getattr(current, "ag_await", None)
+        )
+    return TaskInfo(
+        name=task.get_name(),
+        coroutine=getattr(coro, "__qualname__", None),
+        done=task.done(),
+        awaiting=_describe_waiter(getattr(task, "_fut_waiter", None)),
+        stack=stack,
+    )
+
+
+def list_tasks() -> list[TaskInfo]:
+    """Every task on the running loop, by name."""
+    tasks = sorted(asyncio.all_tasks(), key=lambda task: task.get_name())
+    return [task_info(task) for task in tasks]
+
+
+def _collapse(frame: Optional[FrameType], labels: dict[CodeType, str]) -> list[str]:
+    """Labels of a stack, innermost first, by function rather than line."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        label = labels.get(code)
+        if label is None:
+            path = _short_path(code.co_filename)
+            label = labels[code] = f"{code.co_name} ({path}:{code.co_firstlineno})"
+        stack.append(label)
+        frame = frame.f_back
+    return stack
+
+
+class SamplingProfiler:
+    """Samples stacks at a fixed rate for a time window.
+
+    The loop thread is sampled from a SIGALRM interval timer, whose handler
+    runs on that thread between bytecodes, so samples land in the code
+    actually running. A sampler thread would only get the GIL when the loop
+    releases it, which is mostly in select(), and see little else. Other
+    threads are read from the handler too. When the loop is not on the main
+    thread (signals go there), a sampler thread is the fallback.
+    """
+
+    def __init__(self):
+        self._busy = threading.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._busy.locked()
+
+    async def profile(
+        self, seconds: float, interval: float, all_threads: bool = False
+    ) -> ProfileReport:
+        """Sample the loop thread (or every thread) without blocking the loop."""
+        if not self._busy.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+        try:
+            started = time.perf_counter()
+            if threading.current_thread() is threading.main_thread():
+                stacks, samples = await self._sample_signal(seconds, interval, all_threads)
+            else:
+                loop_thread = None if all_threads else threading.get_ident()
+                stacks, samples = await asyncio.to_thread(
+                    self._sample_thread, seconds, interval, loop_thread
+                )
+            duration = time.perf_counter() - started
+        finally:
+            self._busy.release()
+        return ProfileReport(
+            duration_seconds=duration,
+            interval_ms=interval * 1000,
+            samples=samples,
+            threads="all" if all_threads else "loop",
+            stacks=dict(stacks.most_common()),
+        )
+
+    @staticmethod
+    async def _sample_signal(
+        seconds: float, interval: float, all_threads: bool
+    ) -> tuple[Counter, int]:
+        if signal.getitimer(signal.ITIMER_REAL)[0]:
+            raise RuntimeError("The interval timer is in use")
+        own = threading.get_ident()
+        labels: dict[CodeType, str] = {}
+        stacks: Counter = Counter()
+        samples = 0
+
+        def sample(signum: int, frame: Optional[FrameType]) -> None:
+            nonlocal samples
+            samples += 1
+            if not all_threads:
+                stacks[";".join(reversed(_collapse(frame, labels)))] += 1
+                return
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, current in sys._current_frames().items():
+                stack = _collapse(frame if ident == own else current, labels)
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+
+        previous = signal.signal(signal.SIGALRM, sample)
+        signal.setitimer(signal.ITIMER_REAL, interval, interval)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+        return stacks, samples
+
+    @staticmethod
+    def _sample_thread(
+        seconds: float, interval: float, only: Optional[int]
+    ) -> tuple[Counter, int]:
+        own = threading.get_ident()
+        labels: dict[CodeType, str] = {}
+        stacks: Counter = Counter()
+        samples = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or (only is not None and ident != only):
+                    continue
+                stack = _collapse(frame, labels)
+                if only is None:
+                    stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(interval)
+        return stacks, samples
+
+
+def collapsed(stacks: dict[str, int]) -> str:
+    """Brendan Gregg's collapsed format, for flamegraph.pl and speedscope."""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.items())
+
+
+def flamegraph(
+    stacks: dict[str, int], title: str = "ProxyFarm profile", width: int = 1200
+) -> str:
+    """A self-contained SVG flamegraph of collapsed stacks."""
+    root: dict = {"count": 0, "children": {}}
+    depth = 0
+    for stack, count in stacks.items():
+        node = root
+        node["count"] += count
+        frames = stack.split(";")
+        depth = max(depth, len(frames))
+        for name in frames:
+            node = node["children"].setdefault(name, {"count": 0, "children": {}})
+            node["count"] += count
+
+    row, top = 17, 30
+    height = top + (depth + 1) * row
+    total = root["count"] or 1
+    rects = []
+
+    def draw(node: dict, name: str, x: float, level: int) -> None:
+        w = node["count"] / total * width
+        if w < 0.5:
+            return
+        y = height - (level + 1) * row
+        # Stable warm colour per frame name
+        hue = zlib.crc32(name.encode()) % 60
+        label = html.escape(name)
+        share = node["count"] / total * 100
+        text = html.escape(name[: int(w / 7)]) if w > 21 else ""
+        rects.append(
+            f'<g><title>{label} ({node["count"]} samples, {share:.1f}%)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row - 1}" '
+            f'fill="hsl({hue},85%,60%)" rx="2"/>'
+            f'<text x="{x + 3:.1f}" y="{y + 12}">{text}</text></g>'
+        )
+        for child_name, child in sorted(node["children"].items()):
+            draw(child, child_name, x, level + 1)
+            x += child["count"] / total * width
+
+    draw(root, "all", 0.0, 0)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'font-family="monospace" font-size="11">'
+        f'<text x="{width / 2}" y="18" text-anchor="middle" font-size="14">'
+        f'{html.escape(title)} ({root["count"]} samples)</text>'
+        + "".join(rects)
+        + "</svg>"
+    )
+
+
+# Global instances
+loop_monitor = LoopMonitor()
+sampling_profiler = SamplingProfiler()
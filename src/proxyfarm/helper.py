@@ -0,0 +1,250 @@
+"""Squid basic auth helper mapping proxy users to modem groups.
+
+    auth_param basic program /opt/proxyfarm/venv/bin/python -m proxyfarm.helper
+    auth_param basic children 2 startup=1 idle=1 concurrency=500
+
+Speaks Squid's concurrent helper protocol: each request line is
+``<channel-id> <user> <password>`` (URL-encoded) and the reply starts with
+the same channel ID, so one helper keeps many lookups in flight. A login
+that checks out is answered with ``OK tag=<interface>``, naming the modem
+the user's traffic leaves through; ``squid.sh`` turns each interface into
+a ``tag`` ACL for ``tcp_outgoing_address``. A user with a traffic shaping
+class also gets ``shape_=<class>``, an annotation the ``note`` ACLs in
+ProxyFarm's shaping include turn into a ``tcp_outgoing_mark``.
+
+Users, their groups and the modems carrying each group tag live in memory.
+ProxyFarm pushes the whole table over ``helper.sock`` whenever it changes
+(user edits, rotations, modems going down), so Squid never needs a
+reconfigure for them; the same table is kept in ``helper-state.json`` for
+helpers started while ProxyFarm is down. Stdlib only: Squid starts helpers
+often and they must come up fast.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import sys
+from typing import Optional
+from urllib.parse import unquote
+
+DEFAULT_SOCKET = "/run/proxyfarm/helper.sock"
+DEFAULT_STATE = "/run/proxyfarm/helper-state.json"
+
+_HASH_NAME = "pbkdf2_sha256"
+
+# Reply annotation naming a user's shaping class (hex class number)
+SHAPE_NOTE = "shape_"
+
+
+def hash_password(password: str, iterations: int = 100_000) -> str:
+    """Salted PBKDF2 hash in ``pbkdf2_sha256$<iterations>$<salt>$<hash>`` form."""
+    salt = os.urandom(16).hex()
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), iterations)
+    return f"{_HASH_NAME}${iterations}${salt}${digest.hex()}"
+
+
+def verify_password(password: str, encoded: str) -> bool:
+    """Check a password against a hash; a malformed hash matches nothing."""
+    try:
+        name, iterations, salt, expected = encoded.split("$")
+        if name != _HASH_NAME:
+            return False
+        digest = hashlib.pbkdf2_hmac(
+            "sha256", password.encode(), bytes.fromhex(salt), int(iterations)
+        )
+    except (AttributeError, ValueError, OverflowError):
+        return False
+    return hmac.compare_digest(digest.hex(), expected)
+
+
+def pick_modem(user: str, groups: list[str], modems: list[dict]) -> Optional[dict]:
+    """Choose the usable modem for a user among the modems of its groups.
+
+    A user without groups may use any modem. Rendezvous hashing keeps each
+    user on the same modem while it stays usable, and only moves the users
+    of a modem that goes away.
+    """
+    wanted = set(groups)
+    candidates = [
+        modem for modem in modems
+        if modem["usable"]
+        and modem["interface"]
+        and (not wanted or wanted & set(modem["tags"]))
+    ]
+    if not candidates:
+        return None
+    return max(
+        candidates,
+        key=lambda modem: hashlib.blake2b(
+            f"{user}\0{modem['interface']}".encode(), digest_size=8
+        ).digest(),
+    )
+
+
+class CredentialCache:
+    """In-memory users and modems, with verified passwords remembered.
+
+    PBKDF2 makes a password check slow on purpose, so a successful check is
+    remembered (as a SHA-256 of the password) until the user's stored hash
+    changes; repeated logins then cost a dictionary lookup.
+    """
+
+    def __init__(self):
+        self.users: dict[str, dict] = {}
+        self.modems: list[dict] = []
+        # User -> traffic shaping class number
+        self.classes: dict[str, int] = {}
+        self._verified: dict[str, tuple[str, bytes]] = {}
+
+    def load(self, state: dict) -> None:
+        self.users = state.get("users", {})
+        self.modems = state.get("modems", [])
+        self.classes = state.get("classes", {})
+        self._verified = {
+            name: entry for name, entry in self._verified.items()
+            if name in self.users and self.users[name]["password"] == entry[0]
+        }
+
+    def cached(self, user: str, password: str) -> Optional[bool]:
+        """True/False if the answer is known without PBKDF2, else None."""
+        record = self.users.get(user)
+        if record is None or not record.get("enabled", True):
+            return False
+        entry = self._verified.get(user)
+        if entry is None or entry[0] != record["password"]:
+            return None
+        return hmac.compare_digest(entry[1], hashlib.sha256(password.encode()).digest())
+
+    def remember(self, user: str, encoded: str, password: str) -> None:
+        self._verified[user] = (encoded, hashlib.sha256(password.encode()).digest())
+
+    def reply(self, user: str, ok: bool) -> str:
+        if not ok:
+            return 'ERR message="Invalid credentials"'
+        modem = pick_modem(user, self.users[user].get("groups", []), self.modems)
+        if modem is None:
+            return 'ERR message="No modem available for this user"'
+        reply = f"OK tag={modem['interface']}"
+        if user in self.classes:
+            reply += f" {SHAPE_NOTE}={self.classes[user]:x}"
+        return reply
+
+
+class Helper:
+    def __init__(self, cache: CredentialCache, socket_path: str, state_path: str):
+        self.cache = cache
+        self.socket_path = socket_path
+        self.state_path = state_path
+        self.out = sys.stdout
+        self._flush_pending = False
+        self._lookups: set[asyncio.Task] = set()
+
+    def load_state_file(self) -> None:
+        try:
+            with open(self.state_path) as f:
+                self.cache.load(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    async def follow_feed(self) -> None:
+        """Keep the cache in sync with ProxyFarm, reconnecting as needed."""
+        delay = 0.5
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10.0)
+                continue
+            delay = 0.5
+            try:
+                while line := await reader.readline():
+                    self.cache.load(json.loads(line))
+            except (OSError, ValueError):
+                pass
+            finally:
+                writer.close()
+
+    def answer(self, channel: Optional[str], text: str) -> None:
+        self.out.write(f"{channel} {text}\n" if channel is not None else f"{text}\n")
+        # One flush for all answers produced in this loop iteration
+        if not self._flush_pending:
+            self._flush_pending = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self) -> None:
+        self._flush_pending = False
+        self.out.flush()
+
+    async def lookup(
+        self, channel: Optional[str], user: str, password: str, encoded: str
+    ) -> None:
+        # Cache misses run PBKDF2 in a thread so other lookups keep flowing
+        try:
+            ok = await asyncio.to_thread(verify_password, password, encoded)
+            if ok:
+                self.cache.remember(user, encoded, password)
+            # The user may have been removed meanwhile
+            reply = self.cache.reply(user, ok and user in self.cache.users)
+        except Exception as e:
+            # Squid waits on the channel until it gets an answer
+            reply = f'BH message="Lookup failed: {type(e).__name__}"'
+        self.answer(channel, reply)
+
+    def handle(self, line: str) -> None:
+        parts = line.split(" ")
+        # Squid prefixes a channel ID when concurrency is enabled
+        channel = parts.pop(0) if len(parts) == 3 else None
+        if len(parts) != 2:
+            self.answer(channel, 'BH message="Malformed request"')
+            return
+        user, password = unquote(parts[0]), unquote(parts[1])
+        try:
+            known = self.cache.cached(user, password)
+            if known is None:
+                # The hash checked is the one current now, not after a feed update
+                encoded = self.cache.users[user]["password"]
+            else:
+                reply = self.cache.reply(user, known)
+        except Exception as e:
+            self.answer(channel, f'BH message="Lookup failed: {type(e).__name__}"')
+            return
+        if known is None:
+            task = asyncio.create_task(self.lookup(channel, user, password, encoded))
+            self._lookups.add(task)
+            task.add_done_callback(self._lookups.discard)
+        else:
+            self.answer(channel, reply)
+
+    async def run(self) -> None:
+        self.load_state_file()
+        feed = asyncio.create_task(self.follow_feed())
+
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=1 << 16)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        while line := await reader.readline():
+            line = line.decode().rstrip("\r\n")
+            if line:
+                self.handle(line)
+        await asyncio.gather(*self._lookups)
+        feed.cancel()
+        self.out.flush()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="ProxyFarm feed socket")
+    parser.add_argument("--state", default=DEFAULT_STATE, help="Last known state file")
+    args = parser.parse_args()
+    try:
+        asyncio.run(Helper(CredentialCache(), args.socket, args.state).run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
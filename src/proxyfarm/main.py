@@ -1,6 +1,9 @@
 """Main FastAPI application."""
 
+import argparse
 import logging
+import os
+import sys
 from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Optional
@@ -11,7 +14,16 @@ from fastapi import FastAPI
 from . import __version__
 from .api.router import api_router, root_router
 from .config import get_config, load_config
+from .core.proxyauth import proxy_auth
+from .core.squid import squid_manager
+from .core.store import state_store
+from .diagnostics import loop_monitor
 from .services.monitor import monitor_service
+from .reload import config_reloader
+from .startup import startup_tracker
+from .workers import worker_coordinator
+
+startup_tracker.mark("imported")
 
 # Configure logging
 logging.basicConfig(
@@ -21,26 +33,117 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def _imported(module: str, name: str):
+    """Global instance of an optional subsystem, if its module was imported.
+
+    One never imported was never started; the config reloader may have
+    started one disabled at startup, so its flag is not checked here.
+    """
+    loaded = sys.modules.get(f"{__package__}.{module}")
+    return getattr(loaded, name) if loaded is not None else None
+
+
+async def start_services():
+    """Start the background services (in the owner worker only).
+
+    Optional subsystems are imported only when enabled.
+    """
+    config = get_config()
+    services = [
+        ("store", state_store.start),
+        ("proxy_auth", proxy_auth.start),
+    ]
+    if config.shaping.enabled:
+        from .core.shaping import traffic_shaper
+
+        services.append(("shaping", traffic_shaper.start))
+    if config.dns.enabled:
+        from .core.dns import dns_resolver
+
+        services.append(("dns", dns_resolver.start))
+    services.append(("monitor", monitor_service.start))
+    if config.socks.enabled:
+        from .core.socks import socks_server
+
+        services.append(("socks", socks_server.start))
+    # Not needed to carry traffic, so they need not delay readiness
+    deferred = []
+    if config.conntrack.enabled:
+        from .core.conntrack import conntrack_tracker
+
+        deferred.append(("conntrack", conntrack_tracker.start))
+    if config.usage.enabled:
+        from .services.usage import usage_tracker
+
+        deferred.append(("usage", usage_tracker.start))
+    if not config.startup.defer_services:
+        services += deferred
+        deferred = []
+    for name, start in services:
+        with startup_tracker.phase(name):
+            await start()
+    await startup_tracker.start(deferred)
+    if config.bringup.enabled and config.bringup.on_startup:
+        from .core.bringup import modem_bringup
+
+        modem_bringup.start()
+
+
+async def stop_services():
+    """Stop the background services."""
+    await startup_tracker.stop()
+    for module, name in (
+        ("core.bringup", "modem_bringup"),
+        ("core.socks", "socks_server"),
+        ("services.usage", "usage_tracker"),
+    ):
+        if (service := _imported(module, name)) is not None:
+            await service.stop()
+    await monitor_service.stop()
+    for module, name in (
+        ("core.conntrack", "conntrack_tracker"),
+        ("core.dns", "dns_resolver"),
+    ):
+        if (service := _imported(module, name)) is not None:
+            await service.stop()
+    await proxy_auth.stop()
+    await state_store.stop()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan handler."""
     # Startup
     logger.info(f"Starting ProxyFarm v{__version__}")
-    await monitor_service.start()
+    await worker_coordinator.start(app, start_services, stop_services)
+    # Every worker follows config changes, not only the one running services
+    await config_reloader.start()
+    loop_monitor.start()
 
     yield
 
     # Shutdown
     logger.info("Shutting down ProxyFarm")
-    await monitor_service.stop()
+    loop_monitor.stop()
+    await config_reloader.stop()
+    await worker_coordinator.stop()
+    if (cluster_manager := _imported("core.cluster", "cluster_manager")) is not None:
+        await cluster_manager.close()
+    await squid_manager.close()
 
 
 def create_app(config_path: Optional[Path] = None) -> FastAPI:
     """Create and configure the FastAPI application."""
     # Load configuration
-    load_config(config_path)
+    with startup_tracker.phase("config"):
+        load_config(config_path)
     config = get_config()
 
+    if config.simulation.enabled:
+        from .core import sim
+
+        sim.install(config.simulation)
+
     app = FastAPI(
         title="ProxyFarm",
         description="LTE modem management service",
@@ -50,24 +153,45 @@ def create_app(config_path: Optional[Path] = None) -> FastAPI:
         redoc_url="/redoc",
     )
 
+    # Followers forward most API calls to the owner worker
+    app.middleware("http")(worker_coordinator.dispatch)
+
     # Include routers
     app.include_router(root_router)
     app.include_router(api_router)
 
+    startup_tracker.mark("app_created")
     return app
 
 
-# Default app instance
-app = create_app()
+def __getattr__(name: str):
+    # The default app ("proxyfarm.main:app") is built on first use, not on
+    # import, so importing this module neither loads the config nor builds it
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def main():
     """Entry point for running the server."""
-    config = get_config()
+    parser = argparse.ArgumentParser(description="ProxyFarm API server")
+    parser.add_argument("--config", type=Path, help="Path to config.yaml")
+    parser.add_argument("--port", type=int, help="Override api.port")
+    args = parser.parse_args()
+
+    if args.config:
+        # uvicorn imports the app factory by name, so pass the path via environment
+        os.environ["PROXYFARM_CONFIG"] = str(args.config)
+    config = load_config(args.config)
+
+    # Each worker builds its own app; none is built here just to be discarded
     uvicorn.run(
-        "proxyfarm.main:app",
+        "proxyfarm.main:create_app",
+        factory=True,
         host=config.api.host,
-        port=config.api.port,
+        port=args.port or config.api.port,
+        workers=config.api.workers,
         reload=False,
     )
 
@@ -0,0 +1,378 @@
+"""Config hot reload.
+
+The config file is re-read when it changes (inotify on its directory, so
+editors that save by renaming are seen too; polling where inotify is
+unavailable) or on ``POST /system/reload``. The new file is parsed and
+validated first; an invalid one is reported and the running config kept.
+A valid one replaces the running config in a single swap, and since code
+reads settings through ``get_config()`` when it uses them, most changes
+apply from the next operation on. Only components that hold on to
+settings are reconciled, and only when the settings they hold changed:
+the monitor loop is re-timed, listeners whose address changed are
+restarted, HTTP pools are replaced (old ones close once idle) and the
+shaping setup with its Squid rules is re-applied. Settings that need a
+new process (API bind address, workers, run directory, store path,
+simulation) are reported as such and keep their running values until the
+restart: a follower switching to another run directory would take a lock
+nobody holds and start a second set of services.
+
+Every worker watches the file for itself; only the one running the
+services reconciles them. A reload on the owner (API calls are forwarded
+there) is announced in the run directory, and followers re-read the file
+when they see it, so they follow even with ``reload.watch`` off.
+"""
+
+import asyncio
+import ctypes
+import logging
+import os
+import time
+from functools import partial
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+import yaml
+from pydantic import BaseModel, ValidationError
+
+from .config import Config, config_path, find_config, get_config, read_config, set_config
+from .core.cluster import cluster_manager
+from .core.conntrack import conntrack_tracker
+from .core.dns import dns_resolver
+from .core.proxyauth import proxy_auth
+from .core.shaping import traffic_shaper
+from .core.socks import socks_server
+from .core.squid import squid_manager
+from .diagnostics import loop_monitor
+from .schemas import ReloadResult, ReloadStatus
+from .services.monitor import monitor_service
+from .services.usage import usage_tracker
+from .startup import startup_tracker
+from .workers import worker_coordinator
+
+logger = logging.getLogger(__name__)
+
+# Owner's reload count, which followers watch, in the run directory
+_GENERATION_FILE = "config.generation"
+
+# IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_IN_MASK = 0x08 | 0x80 | 0x100
+
+# Settings only read when the process starts; None means the whole section
+_RESTART_REQUIRED: dict[str, Optional[set[str]]] = {
+    "api": {"host", "port", "workers", "run_dir"},
+    "store": {"enabled", "path"},
+    "simulation": None,
+}
+
+# Settings a service only reads when it starts, so changing them restarts it
+_START_SETTINGS = {
+    "dns": (dns_resolver, {"enabled", "listen_host", "listen_port"}),
+    "socks": (
+        socks_server, {"enabled", "host", "port", "backlog", "buffer_size", "pool_buffers"}
+    ),
+    "proxy_auth": (
+        proxy_auth, {"enabled", "socket_path", "state_path", "socket_group", "file_mode"}
+    ),
+    "conntrack": (conntrack_tracker, {"enabled", "receive_buffer"}),
+    "usage": (usage_tracker, {"enabled", "access_log", "chunk_size", "max_keys"}),
+}
+
+
+class ReloadError(Exception):
+    """The config file could not be read or is invalid."""
+
+
+def _changed_fields(old: BaseModel, new: BaseModel) -> set[str]:
+    return {name for name in type(old).model_fields if getattr(old, name) != getattr(new, name)}
+
+
+def _hold_restart_settings(old: Config, new: Config, changed: dict[str, set[str]]) -> None:
+    """Keep settings that need a restart at their running values in ``new``."""
+    for section, fields in changed.items():
+        restart = _RESTART_REQUIRED.get(section, set())
+        if restart is None:
+            setattr(new, section, getattr(old, section))
+            continue
+        for name in fields & restart:
+            setattr(getattr(new, section), name, getattr(getattr(old, section), name))
+
+
+def _owner_generation() -> Optional[str]:
+    try:
+        return (worker_coordinator.run_dir / _GENERATION_FILE).read_text()
+    except OSError:
+        return None
+
+
+def _signature(path: Path) -> Optional[tuple[int, int, int, int]]:
+    """Identity and version of a file, or None while it is missing."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _inotify(directory: Path) -> int:
+    """Non-blocking inotify descriptor watching ``directory`` for new contents."""
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, f"inotify_init1: {os.strerror(error)}")
+    if libc.inotify_add_watch(fd, os.fsencode(directory), _IN_MASK) < 0:
+        error = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(error, f"inotify_add_watch({directory}): {os.strerror(error)}")
+    return fd
+
+
+async def _restart(section: str, fields: set[str]) -> list[str]:
+    service, start_settings = _START_SETTINGS[section]
+    if not fields & start_settings or section in startup_tracker.deferred:
+        # Read live, or not started yet (it will start with the new config)
+        return []
+    await service.stop()
+    await service.start()
+    return [section]
+
+
+async def _monitor(fields: set[str]) -> list[str]:
+    await monitor_service.reconfigure()
+    return ["monitor"]
+
+
+async def _egress(fields: set[str]) -> list[str]:
+    # Route weights are recomputed by the monitor check
+    monitor_service.wake()
+    return ["monitor"]
+
+
+async def _shaping(fields: set[str]) -> list[str]:
+    await traffic_shaper.refresh()
+    return ["shaping"]
+
+
+async def _squid(fields: set[str]) -> list[str]:
+    squid_manager.reset_client()
+    return ["squid"]
+
+
+async def _cluster(fields: set[str]) -> list[str]:
+    cluster_manager.reset_clients()
+    return ["cluster"]
+
+
+async def _diagnostics(fields: set[str]) -> list[str]:
+    # Intervals are read live; the sample window and switch only on start
+    if not fields & {"enabled", "window", "keep_stalls"}:
+        return []
+    loop_monitor.stop()
+    loop_monitor.start()
+    return ["diagnostics"]
+
+
+Reconciler = Callable[[set[str]], Awaitable[list[str]]]
+
+_RECONCILERS: dict[str, Reconciler] = {
+    "monitor": _monitor,
+    "egress": _egress,
+    "shaping": _shaping,
+    "squid": _squid,
+    "cluster": _cluster,
+    "diagnostics": _diagnostics,
+    **{section: partial(_restart, section) for section in _START_SETTINGS},
+}
+
+
+class ConfigReloader:
+    """Watches the config file and applies changes to the running services."""
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._follow_task: Optional[asyncio.Task] = None
+        self._fd: Optional[int] = None
+        self._changed = asyncio.Event()
+        self._signature: Optional[tuple[int, int, int, int]] = None
+        self._path: Optional[Path] = None
+        self.mode: Optional[str] = None
+        self.reloads = 0
+        self.failures = 0
+        self.last: Optional[ReloadResult] = None
+        self.last_error: Optional[str] = None
+
+    async def start(self) -> None:
+        """Start watching the file the config was loaded from."""
+        self._path = config_path()
+        if self._path is None:
+            logger.info("Config not loaded from a file, not watching for changes")
+            return
+        self._signature = _signature(self._path)
+        self._changed = asyncio.Event()
+        try:
+            self._fd = _inotify(self._path.parent)
+            asyncio.get_running_loop().add_reader(self._fd, self._drain)
+            self.mode = "inotify"
+        except (OSError, AttributeError) as e:
+            logger.info(f"inotify unavailable ({e}), polling {self._path} for changes")
+            self.mode = "poll"
+        self._task = asyncio.create_task(self._watch())
+        if get_config().api.workers > 1:
+            self._follow_task = asyncio.create_task(self._follow())
+        logger.info(f"Watching {self._path} for config changes ({self.mode})")
+
+    async def stop(self) -> None:
+        for task in (self._task, self._follow_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._follow_task = None
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        self.mode = None
+
+    def _drain(self) -> None:
+        try:
+            # Which entry changed doesn't matter; the file's signature decides
+            os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        self._changed.set()
+
+    async def _watch(self) -> None:
+        while True:
+            if self.mode == "inotify":
+                await self._changed.wait()
+            else:
+                await asyncio.sleep(get_config().reload.poll_interval)
+            # Let the writer finish: wait until no event came for a while
+            while True:
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), get_config().reload.debounce)
+                except asyncio.TimeoutError:
+                    break
+            signature = _signature(self._path)
+            if signature is None or signature == self._signature:
+                continue
+            if not get_config().reload.watch:
+                continue
+            try:
+                await self.reload("watcher")
+            except ReloadError:
+                # Already logged; wait for the next edit instead of retrying
+                self._signature = signature
+            except Exception as e:
+                logger.exception(f"Config reload failed: {e}")
+
+    async def _follow(self) -> None:
+        """Follower: re-read the config whenever the owner reloaded it."""
+        seen = _owner_generation()
+        while True:
+            await asyncio.sleep(get_config().api.failover_interval)
+            if worker_coordinator.role != "follower":
+                continue
+            generation = _owner_generation()
+            if generation is None or generation == seen:
+                continue
+            seen = generation
+            try:
+                await self.reload("owner")
+            except ReloadError:
+                pass
+            except Exception as e:
+                logger.exception(f"Config reload failed: {e}")
+
+    def _announce(self) -> None:
+        """Owner: tell the followers a reload happened."""
+        path = worker_coordinator.run_dir / _GENERATION_FILE
+        tmp = path.with_suffix(".tmp")
+        try:
+            tmp.write_text(f"{os.getpid()} {self.reloads}\n")
+            tmp.replace(path)
+        except OSError as e:
+            logger.warning(f"Failed to announce the reload to other workers: {e}")
+
+    async def reload(self, source: str) -> ReloadResult:
+        """Re-read the config file and apply what changed.
+
+        Raises ReloadError, keeping the running config, if the file is invalid.
+        """
+        async with self._lock:
+            started = time.perf_counter()
+            path = config_path() or find_config()
+            signature = _signature(path) if path else None
+            try:
+                new = await asyncio.to_thread(read_config, path)
+            except (OSError, yaml.YAMLError, ValidationError) as e:
+                self.failures += 1
+                self.last_error = f"{path}: {e}"
+                logger.error(f"Invalid config, keeping the running one: {self.last_error}")
+                raise ReloadError(self.last_error) from e
+
+            old = get_config()
+            changed = {
+                section: _changed_fields(getattr(old, section), getattr(new, section))
+                for section in Config.model_fields
+                if getattr(old, section) != getattr(new, section)
+            }
+            _hold_restart_settings(old, new, changed)
+            set_config(new, path)
+            self._signature = signature
+            self.reloads += 1
+            self.last_error = None
+
+            result = ReloadResult(
+                source=source, path=str(path) if path else None, changed=sorted(changed)
+            )
+            for section, fields in changed.items():
+                restart = _RESTART_REQUIRED.get(section, set())
+                if restart is None or fields & restart:
+                    result.restart_required.append(section)
+                    fields = set() if restart is None else fields - restart
+                reconcile = _RECONCILERS.get(section)
+                if not fields or reconcile is None or worker_coordinator.role == "follower":
+                    continue
+                try:
+                    for component in await reconcile(fields):
+                        if component not in result.reconciled:
+                            result.reconciled.append(component)
+                except Exception as e:
+                    logger.exception(f"Applying {section} config failed: {e}")
+                    result.errors.append(f"{section}: {e}")
+
+            result.duration_seconds = time.perf_counter() - started
+            if changed:
+                logger.info(
+                    f"Config reloaded ({source}): changed {', '.join(result.changed)}"
+                    + (f"; reconciled {', '.join(result.reconciled)}" if result.reconciled else "")
+                    + (
+                        f"; restart needed for {', '.join(result.restart_required)}"
+                        if result.restart_required else ""
+                    )
+                )
+            self.last = result
+            if worker_coordinator.role == "owner":
+                self._announce()
+            return result
+
+    def status(self) -> ReloadStatus:
+        path = self._path or config_path()
+        return ReloadStatus(
+            path=str(path) if path else None,
+            watching=self.mode,
+            reloads=self.reloads,
+            failures=self.failures,
+            last=self.last,
+            last_error=self.last_error,
+        )
+
+
+# Global instance
+config_reloader = ConfigReloader()
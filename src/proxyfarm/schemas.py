@@ -51,6 +51,7 @@ class ModemListResponse(BaseModel):
 
 class USSDRequest(BaseModel):
     command: str = Field(..., example="*100#")
+    use_cache: bool = True
 
 
 class USSDResponse(BaseModel):
@@ -59,6 +60,20 @@ class USSDResponse(BaseModel):
     response: str
     success: bool
     error: Optional[str] = None
+    cached: bool = False
+
+
+class USSDBatchRequest(BaseModel):
+    command: str = Field(..., example="*100#")
+    modem_ids: Optional[list[int]] = None
+    use_cache: bool = True
+
+
+class USSDBatchResponse(BaseModel):
+    command: str
+    results: list[USSDResponse]
+    count: int
+    succeeded: int
 
 
 class RotationResult(BaseModel):
@@ -70,6 +85,108 @@ class RotationResult(BaseModel):
     duration_seconds: float
 
 
+class RotationRecord(BaseModel):
+    timestamp: datetime
+    modem_id: int
+    success: bool
+    old_ip: Optional[str] = None
+    new_ip: Optional[str] = None
+    error: Optional[str] = None
+    duration_seconds: float
+
+
+class ProbeRecord(BaseModel):
+    timestamp: datetime
+    modem_id: int
+    success: bool
+    latency_ms: Optional[float] = None
+    external_ip: Optional[str] = None
+
+
+class SpeedtestResult(BaseModel):
+    timestamp: datetime
+    modem_id: int
+    success: bool
+    interface: Optional[str] = None
+    download_mbps: Optional[float] = None
+    upload_mbps: Optional[float] = None
+    latency_ms: Optional[float] = None
+    jitter_ms: Optional[float] = None
+    downloaded_bytes: int = 0
+    uploaded_bytes: int = 0
+    # Radio conditions at the time, to tell weak signal from throttling
+    signal_quality: Optional[int] = None
+    operator_name: Optional[str] = None
+    duration_seconds: float
+    error: Optional[str] = None
+
+
+class RadioMode(BaseModel):
+    # Access technologies the modem may use, e.g. ["3g", "4g"]
+    allowed: list[str]
+    preferred: Optional[str] = None
+
+
+class RadioSettings(BaseModel):
+    modes: RadioMode
+    # Bands the modem may use; empty means every supported band
+    bands: list[str] = Field(default_factory=list)
+
+
+class RadioInfo(BaseModel):
+    modem_id: int
+    current: RadioSettings
+    supported_modes: list[RadioMode] = Field(default_factory=list)
+    supported_bands: list[str] = Field(default_factory=list)
+    access_technologies: list[str] = Field(default_factory=list)
+    # Operator and location/tracking area the modem is registered in
+    location: str
+
+
+class RadioTrial(BaseModel):
+    settings: RadioSettings
+    success: bool
+    download_mbps: Optional[float] = None
+    upload_mbps: Optional[float] = None
+    latency_ms: Optional[float] = None
+    score: Optional[float] = None
+    # Seconds until the modem carried traffic again after the change
+    settle_seconds: Optional[float] = None
+    error: Optional[str] = None
+
+
+class RadioProfile(BaseModel):
+    location: str
+    settings: RadioSettings
+    score: float
+    evaluated_at: datetime
+
+
+class RadioOptimization(BaseModel):
+    modem_id: int
+    # pending, running, completed, failed
+    status: str = "pending"
+    started_at: datetime
+    finished_at: Optional[datetime] = None
+    location: Optional[str] = None
+    # The settings the modem had, measured before any change
+    baseline: Optional[RadioTrial] = None
+    trials: list[RadioTrial] = Field(default_factory=list)
+    # Settings left on the modem when the run finished
+    applied: Optional[RadioSettings] = None
+    changed: bool = False
+    # Connectivity was lost on some trial and the original settings restored
+    rolled_back: bool = False
+    error: Optional[str] = None
+
+
+class RadioStatus(BaseModel):
+    info: Optional[RadioInfo] = None
+    # Best settings found for the modem at its current location
+    profile: Optional[RadioProfile] = None
+    last_optimization: Optional[RadioOptimization] = None
+
+
 class SystemStatus(BaseModel):
     status: str = "ok"
     modems_connected: int
@@ -84,12 +201,387 @@ class HealthResponse(BaseModel):
     timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 
+class ReadinessCheck(BaseModel):
+    # inventory, routing or proxy
+    name: str
+    ok: bool
+    detail: Optional[str] = None
+
+
+class StartupReport(BaseModel):
+    # When the process started, interpreter and imports included
+    started_at: datetime
+    # Inventory was seeded from the store before the first live check
+    warm_start: bool = False
+    # Seconds spent in each startup step, in order
+    phases: dict[str, float] = Field(default_factory=dict)
+    # Seconds from process start until each milestone was reached
+    milestones: dict[str, float] = Field(default_factory=dict)
+    time_to_ready: Optional[float] = None
+    # Time to ready of the previous run, from the store
+    previous_time_to_ready: Optional[float] = None
+
+
+class ReadinessResponse(BaseModel):
+    ready: bool
+    checks: list[ReadinessCheck] = Field(default_factory=list)
+    startup: StartupReport
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+
+class ReloadResult(BaseModel):
+    # api or watcher
+    source: str
+    path: Optional[str] = None
+    # Config sections that differ from the running config
+    changed: list[str] = Field(default_factory=list)
+    # Components restarted or re-timed to apply the changes
+    reconciled: list[str] = Field(default_factory=list)
+    # Sections with changes that only take effect after a service restart
+    restart_required: list[str] = Field(default_factory=list)
+    errors: list[str] = Field(default_factory=list)
+    duration_seconds: float = 0.0
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+
+class ReloadStatus(BaseModel):
+    path: Optional[str] = None
+    # inotify, poll, or None when no file is watched
+    watching: Optional[str] = None
+    reloads: int = 0
+    failures: int = 0
+    last: Optional[ReloadResult] = None
+    last_error: Optional[str] = None
+
+
+class LoopLag(BaseModel):
+    interval_ms: float
+    samples: int = 0
+    # How late the loop ran a timer: the time other work held it up
+    current_ms: float = 0.0
+    p50_ms: float = 0.0
+    p99_ms: float = 0.0
+    max_ms: float = 0.0
+
+
+class LoopStall(BaseModel):
+    started_at: datetime
+    # None while the loop is still blocked
+    duration_ms: Optional[float] = None
+    # Task running when the stall was caught, if any
+    task: Optional[str] = None
+    # Loop thread's stack when the stall was caught, outermost call first
+    stack: list[str] = Field(default_factory=list)
+
+
+class LoopReport(BaseModel):
+    running: bool
+    lag: Optional[LoopLag] = None
+    slow_callback_ms: float
+    stalls: int = 0
+    recent_stalls: list[LoopStall] = Field(default_factory=list)
+    tasks: int = 0
+
+
+class TaskInfo(BaseModel):
+    name: str
+    coroutine: Optional[str] = None
+    done: bool = False
+    # What the task is suspended on: a future, another task, a gather
+    awaiting: Optional[str] = None
+    # Await chain from the task's coroutine down, outermost first
+    stack: list[str] = Field(default_factory=list)
+
+
+class ProfileReport(BaseModel):
+    duration_seconds: float
+    interval_ms: float
+    samples: int
+    threads: str
+    # Collapsed stacks ("outer;inner" -> samples), most frequent first
+    stacks: dict[str, int] = Field(default_factory=dict)
+
+
 class ErrorResponse(BaseModel):
     error: str
     detail: Optional[str] = None
 
 
+class ModemRecoveryStatus(BaseModel):
+    modem_id: int
+    # closed, open (quarantined) or half_open (probe due)
+    breaker: str
+    next_action: Optional[str] = None
+    attempts: int = 0
+    in_progress: bool = False
+    incident_started: Optional[datetime] = None
+    next_attempt_at: Optional[datetime] = None
+    open_until: Optional[datetime] = None
+    last_action: Optional[str] = None
+    last_error: Optional[str] = None
+
+
+class RecoveryActionStats(BaseModel):
+    action: str
+    attempts: int
+    failures: int
+    recoveries: int
+    mean_time_to_recovery: Optional[float] = None
+
+
+class RecoveryReport(BaseModel):
+    modems: list[ModemRecoveryStatus]
+    actions: list[RecoveryActionStats]
+
+
+class ModemBringupStatus(BaseModel):
+    modem_id: int
+    connection: str
+    # pending, running, ready, skipped, failed
+    status: str = "pending"
+    actions: list[str] = Field(default_factory=list)
+    ip_address: Optional[str] = None
+    error: Optional[str] = None
+    duration_seconds: Optional[float] = None
+
+
+class BringupJob(BaseModel):
+    id: str
+    # running, completed, failed
+    status: str = "running"
+    started_at: datetime
+    finished_at: Optional[datetime] = None
+    modems_total: int = 0
+    modems_ready: int = 0
+    # Seconds from job start until the first / every modem carried traffic
+    time_to_first_ready: Optional[float] = None
+    time_to_capacity: Optional[float] = None
+    modems: list[ModemBringupStatus] = Field(default_factory=list)
+    error: Optional[str] = None
+
+
 class ReinitializeResponse(BaseModel):
     success: bool
     message: str
     error: Optional[str] = None
+    job: Optional[BringupJob] = None
+
+
+class AdmissionScopeStats(BaseModel):
+    scope: str
+    key: str
+    active: int
+    waiting: int
+
+
+class AdmissionEndpointStats(BaseModel):
+    limit: int
+    queue_size: int
+    active: int
+    waiting: int
+    admitted: int
+    rejected: int
+    timed_out: int
+    avg_wait_seconds: float
+    scoped: list[AdmissionScopeStats] = Field(default_factory=list)
+
+
+class ClusterModem(Modem):
+    global_id: str
+    node: str
+
+
+class ClusterNodeStatus(BaseModel):
+    name: str
+    url: str
+    reachable: bool
+    modems: int = 0
+    latency_ms: Optional[float] = None
+    error: Optional[str] = None
+    updated_at: Optional[datetime] = None
+
+
+class ClusterInventoryResponse(BaseModel):
+    modems: list[ClusterModem]
+    count: int
+    nodes: list[ClusterNodeStatus]
+
+
+class UsageEntry(BaseModel):
+    key: str
+    requests: int
+    bytes: int
+    statuses: dict[str, int] = Field(default_factory=dict)
+    modem_id: Optional[int] = None
+
+
+class UsageReport(BaseModel):
+    since: datetime
+    lines: int
+    parse_errors: int
+    clients: list[UsageEntry]
+    domains: list[UsageEntry]
+    outgoing: list[UsageEntry]
+
+
+class ProxyUser(BaseModel):
+    name: str
+    groups: list[str] = Field(default_factory=list)
+    enabled: bool = True
+    # Modem the helper currently sends this user through
+    modem_id: Optional[int] = None
+
+
+class ProxyUserRequest(BaseModel):
+    # Required for a new user; an existing user keeps its password if omitted
+    password: Optional[str] = None
+    groups: list[str] = Field(default_factory=list)
+    enabled: bool = True
+
+
+class ModemTagsRequest(BaseModel):
+    tags: list[str] = Field(default_factory=list, json_schema_extra={"example": ["premium"]})
+
+
+class ProxyGroup(BaseModel):
+    name: str
+    modem_ids: list[int]
+    usable_modem_ids: list[int]
+    users: list[str]
+
+
+class QuotaStatus(BaseModel):
+    modem_id: int
+    device_id: str
+    interface: Optional[str] = None
+    period_start: str
+    used_bytes: int
+    limit_bytes: Optional[int] = None
+    usage_ratio: Optional[float] = None
+    weight_factor: float = 1.0
+    sampled_at: Optional[datetime] = None
+
+
+class DNSUpstreamStats(BaseModel):
+    # None for the fallback servers used when no modem is available
+    modem_id: Optional[int] = None
+    interface: Optional[str] = None
+    servers: list[str] = Field(default_factory=list)
+    queries: int = 0
+    hits: int = 0
+    negative_hits: int = 0
+    misses: int = 0
+    prefetches: int = 0
+    errors: int = 0
+    entries: int = 0
+    hit_rate: Optional[float] = None
+
+
+class DNSReport(BaseModel):
+    enabled: bool
+    listening: bool
+    listen: str
+    # Modem the listener's queries go through (None: fallback servers)
+    primary_modem_id: Optional[int] = None
+    queries: int
+    hit_rate: Optional[float] = None
+    upstreams: list[DNSUpstreamStats]
+
+
+class ConnectorModemStats(BaseModel):
+    modem_id: int
+    samples: int
+    p50_ms: float
+    p90_ms: float
+    hedge_threshold_ms: float
+
+
+class ConnectorStats(BaseModel):
+    connects: int
+    failures: int
+    hedges: int
+    hedge_wins: int
+    retries: int
+    budget_exhausted: int
+    budget_tokens: float
+    modems: list[ConnectorModemStats]
+
+
+class SocksStats(BaseModel):
+    listening: bool
+    active_connections: int
+    connections: int
+    rejected: int
+    auth_failures: int
+    connect_failures: int
+    udp_associations: int
+    bytes_up: int
+    bytes_down: int
+    datagrams_up: int
+    datagrams_down: int
+    pooled_buffers: int
+
+
+class EgressFlows(BaseModel):
+    interface: str
+    modem_id: Optional[int] = None
+    active_flows: int = 0
+    # Flows seen starting / ending since the tracker started
+    opened: int = 0
+    closed: int = 0
+    # Bytes of ended flows, both directions (needs nf_conntrack_acct=1)
+    closed_bytes: int = 0
+    rx_bytes_per_second: float = 0.0
+    tx_bytes_per_second: float = 0.0
+
+
+class ConntrackStats(BaseModel):
+    running: bool
+    # Why tracking is down or its counts may be stale, until it recovers
+    error: Optional[str] = None
+    # nf_conntrack_acct is on, so ended flows report their bytes
+    accounting: bool = False
+    tracked_flows: int = 0
+    events: int = 0
+    # Full table reads: at start, after lost events and every resync_interval
+    dumps: int = 0
+    overruns: int = 0
+    egress: list[EgressFlows] = Field(default_factory=list)
+
+
+class ClientLimit(BaseModel):
+    # Proxy user name, or a client address / network for unauthenticated use
+    client: str
+    # Upload cap per modem uplink; None only gives the client its fair share
+    upload_kbit: Optional[int] = None
+    mark: Optional[int] = None
+
+
+class ClientLimitRequest(BaseModel):
+    upload_kbit: Optional[int] = Field(None, ge=8, json_schema_extra={"example": 2000})
+
+
+class ShapedInterface(BaseModel):
+    interface: str
+    modem_id: Optional[int] = None
+    # None when the link is not shaped, only split between clients
+    rate_kbit: Optional[int] = None
+    # speedtest or config
+    rate_source: Optional[str] = None
+    classes: int = 0
+    applied_at: Optional[datetime] = None
+    error: Optional[str] = None
+
+
+class ShapingStatus(BaseModel):
+    enabled: bool
+    qdisc: str
+    interfaces: list[ShapedInterface] = Field(default_factory=list)
+    clients: list[ClientLimit] = Field(default_factory=list)
+
+
+class EgressWeight(BaseModel):
+    modem_id: int
+    interface: Optional[str] = None
+    weight: int
+    factors: dict[str, float] = Field(default_factory=dict)
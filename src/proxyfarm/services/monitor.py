@@ -2,11 +2,24 @@
 
 import asyncio
 import logging
+import time
+from typing import Optional
 
 from ..config import get_config
+from ..core.connector import hedged_connector
+from ..core.conntrack import conntrack_tracker
+from ..core.dns import dns_resolver
+from ..core.egress import egress_balancer
 from ..core.modem import modem_manager
 from ..core.network import network_manager
-from ..core.rotation import ip_rotator
+from ..core.proxyauth import proxy_auth
+from ..core.quota import quota_tracker
+from ..core.radio import radio_optimizer
+from ..core.recovery import recovery_manager
+from ..core.shaping import traffic_shaper
+from ..core.speedtest import speed_tester
+from ..core.state import ModemRecord
+from ..core.store import state_store
 from ..schemas import ModemState
 
 logger = logging.getLogger(__name__)
@@ -18,20 +31,31 @@ class MonitorService:
     def __init__(self):
         self._running = False
         self._task = None
+        self._wakeup = asyncio.Event()
+        # Last known modem state, keyed by modem ID
+        self.inventory: dict[int, ModemRecord] = {}
+        # Wall-clock time the inventory was last refreshed
+        self.updated_at: Optional[float] = None
+        # True while the inventory comes from the store, not a live check
+        self.warm = False
 
     async def start(self):
         """Start the monitor service."""
+        await self._warm_start()
+
         config = get_config()
         if not config.monitor.enabled:
             logger.info("Monitor service disabled in config")
             return
+        self._start_loop()
 
+    def _start_loop(self):
         self._running = True
+        self._wakeup = asyncio.Event()
         self._task = asyncio.create_task(self._run())
         logger.info("Monitor service started")
 
-    async def stop(self):
-        """Stop the monitor service."""
+    async def _stop_loop(self):
         self._running = False
         if self._task:
             self._task.cancel()
@@ -39,25 +63,109 @@ class MonitorService:
                 await self._task
             except asyncio.CancelledError:
                 pass
+            self._task = None
+
+    def wake(self):
+        """Run the next check now instead of at the end of the interval."""
+        self._wakeup.set()
+
+    async def reconfigure(self):
+        """Apply a changed monitor config: start, stop or re-time the loop."""
+        enabled = get_config().monitor.enabled
+        if enabled and not self._running:
+            self._start_loop()
+        elif not enabled and self._running:
+            await self._stop_loop()
+            logger.info("Monitor loop stopped (disabled in config)")
+        else:
+            # The new interval counts from a check done with the new settings
+            self.wake()
+
+    async def _warm_start(self):
+        """Seed the inventory from the last persisted snapshot.
+
+        Only readers (the API's lite listing, flow accounting) get the stored
+        modems. Their addresses may be stale after a reboot, so proxy users,
+        SOCKS and DNS wait for the first live check to be given modems.
+        """
+        await quota_tracker.load()
+        await recovery_manager.load()
+        await speed_tester.load()
+        await radio_optimizer.load()
+        modems, updated_at = await state_store.load_inventory()
+        if modems:
+            self.inventory = {modem.id: modem for modem in modems}
+            self.updated_at = updated_at
+            self.warm = True
+            logger.info(f"Loaded {len(modems)} modem(s) from last known state")
+            conntrack_tracker.update_modems(list(self.inventory.values()))
+
+    async def stop(self):
+        """Stop the monitor service."""
+        await self._stop_loop()
+        await recovery_manager.stop()
+        await radio_optimizer.stop()
+        await speed_tester.stop()
         logger.info("Monitor service stopped")
 
     async def _run(self):
         """Main monitoring loop."""
-        config = get_config()
-        interval = config.monitor.interval
-
         while self._running:
+            self._wakeup.clear()
             try:
                 await self._check_modems()
             except Exception as e:
                 logger.exception(f"Error in monitor loop: {e}")
 
-            await asyncio.sleep(interval)
+            # Read every cycle, so a reloaded interval applies right away
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), get_config().monitor.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _update_inventory(self, modems: list[ModemRecord]):
+        # Known modems keep their record, updated in place
+        inventory = {}
+        for modem in modems:
+            record = self.inventory.get(modem.id)
+            if record is None:
+                record = modem
+            elif record is not modem:
+                record.update(modem)
+            inventory[modem.id] = record
+        self.inventory = inventory
+        self.updated_at = time.time()
+        self.warm = False
+        state_store.save_inventory(inventory.values())
 
     async def _check_modems(self):
-        """Check health of all modems."""
+        """Check health of all modems and hand failures to recovery."""
         config = get_config()
-        modems = await modem_manager.list_modems()
+        modem_ids = await modem_manager.list_modem_ids()
+        recovery_manager.prune(modem_ids)
+
+        # Modems with an open circuit are not queried until their probe is due
+        quarantined = recovery_manager.quarantined()
+        modems = await modem_manager.get_modems(
+            [modem_id for modem_id in modem_ids if modem_id not in quarantined]
+        )
+        self._update_inventory(modems + [
+            self.inventory[modem_id] for modem_id in quarantined if modem_id in self.inventory
+        ])
+        quota_tracker.sample(modems)
+        inventory = list(self.inventory.values())
+        conntrack_tracker.update_modems(inventory)
+        # Quarantined modems keep their inventory entry but get no traffic,
+        # whether or not egress routing is enabled
+        active = [modem for modem in inventory if modem.id not in quarantined]
+        speed_tester.schedule(active)
+        radio_optimizer.schedule(active)
+        await egress_balancer.apply(active)
+        await traffic_shaper.apply(active)
+        weights = egress_balancer.weights(active)
+        dns_resolver.update_modems(active, weights)
+        hedged_connector.update_modems(active, weights)
+        proxy_auth.update_modems(active, weights)
 
         for modem in modems:
             logger.debug(
@@ -65,31 +173,41 @@ class MonitorService:
                 f"ip={modem.ip_address}, signal={modem.signal_quality}%"
             )
 
+            # Radio tuning drops the connection on purpose and rolls back itself
+            if radio_optimizer.busy(modem.id):
+                continue
+
             # Check if modem is not connected
             if modem.state != ModemState.CONNECTED:
                 logger.warning(f"Modem {modem.id} is not connected (state: {modem.state})")
-
-                if config.monitor.auto_reconnect:
-                    logger.info(f"Attempting to reconnect modem {modem.id}")
-                    await ip_rotator.rotate(modem.id)
+                recovery_manager.report(modem.id, False, f"State {modem.state.value}")
                 continue
 
             # Check if modem has IP
             if not modem.ip_address:
                 logger.warning(f"Modem {modem.id} has no IP address")
+                recovery_manager.report(modem.id, False, "No IP address")
                 continue
 
             # Check internet connectivity
             if modem.interface:
+                started = time.monotonic()
                 connected, external_ip = await network_manager.check_internet_connectivity(
                     modem.interface, config.monitor.health_check_url
                 )
+                latency = time.monotonic() - started
+                state_store.record_probe(
+                    modem.id, connected, latency if connected else None, external_ip
+                )
                 if not connected:
                     logger.warning(
                         f"Modem {modem.id} ({modem.interface}) has no internet connectivity"
                     )
-                else:
-                    logger.debug(f"Modem {modem.id} external IP: {external_ip}")
+                    recovery_manager.report(modem.id, False, "No internet connectivity")
+                    continue
+                logger.debug(f"Modem {modem.id} external IP: {external_ip}")
+
+            recovery_manager.report(modem.id, True)
 
 
 # Global instance
@@ -0,0 +1,359 @@
+"""Traffic accounting from the Squid access log.
+
+The tracker follows the access log incrementally from a saved offset,
+survives ``squid -k rotate`` (rename) and copytruncate, parses new lines in
+batches off the event loop and aggregates bytes, requests and status classes
+per client, per destination domain and per outgoing address.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+from ..config import get_config
+from ..core.store import state_store
+
+logger = logging.getLogger(__name__)
+
+_STATE_KEY = "usage.state"
+
+# Counter slots: requests, bytes, then one per status class
+_REQUESTS, _BYTES, _S2XX, _S3XX, _S4XX, _S5XX, _SOTHER = range(7)
+_STATUS_SLOTS = {"2": _S2XX, "3": _S3XX, "4": _S4XX, "5": _S5XX}
+_STATUS_NAMES = {_S2XX: "2xx", _S3XX: "3xx", _S4XX: "4xx", _S5XX: "5xx", _SOTHER: "other"}
+
+OTHER_KEY = "(other)"
+
+
+def _domain(method: str, url: str) -> str:
+    """Extract the destination host from a logged request URL."""
+    if method == "CONNECT":
+        host = url
+    else:
+        scheme_end = url.find("://")
+        host = url[scheme_end + 3:] if scheme_end >= 0 else url
+        slash = host.find("/")
+        if slash >= 0:
+            host = host[:slash]
+        at = host.rfind("@")
+        if at >= 0:
+            host = host[at + 1:]
+    if host.startswith("["):
+        return host[1:host.find("]")] if "]" in host else host
+    colon = host.rfind(":")
+    if colon >= 0 and host[colon + 1:].isdigit():
+        host = host[:colon]
+    return host.lower() or "-"
+
+
+Batch = dict[str, dict[str, list[int]]]
+
+
+def parse_lines(lines: list[str]) -> tuple[Batch, int, int]:
+    """Aggregate access log lines into per-dimension counter deltas.
+
+    Understands Squid's native format, optionally followed by the outgoing
+    address (``%<la``) as in the ``proxyfarm`` logformat. Returns the deltas,
+    the number of parsed lines and the number of malformed lines.
+    """
+    batch: Batch = {"clients": {}, "domains": {}, "outgoing": {}}
+    clients, domains, outgoing = batch["clients"], batch["domains"], batch["outgoing"]
+    parsed = errors = 0
+
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 10:
+            if fields:
+                errors += 1
+            continue
+        try:
+            size = int(fields[4])
+        except ValueError:
+            errors += 1
+            continue
+
+        status = fields[3].partition("/")[2]
+        slot = _STATUS_SLOTS.get(status[:1], _SOTHER)
+        keys = (
+            (clients, fields[2]),
+            (domains, _domain(fields[5], fields[6])),
+            (outgoing, fields[10] if len(fields) > 10 else "-"),
+        )
+        for table, key in keys:
+            counters = table.get(key)
+            if counters is None:
+                counters = table[key] = [0] * 7
+            counters[_REQUESTS] += 1
+            counters[_BYTES] += size
+            counters[slot] += 1
+        parsed += 1
+
+    return batch, parsed, errors
+
+
+class BoundedCounters:
+    """Usage counters for at most ``max_keys`` keys.
+
+    When the table overflows, the least-used keys (by bytes) are folded into
+    a single ``(other)`` entry, so totals stay exact while memory is bounded.
+    """
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self.entries: dict[str, list[int]] = {}
+
+    def merge(self, deltas: dict[str, list[int]]) -> None:
+        entries = self.entries
+        for key, delta in deltas.items():
+            counters = entries.get(key)
+            if counters is None:
+                entries[key] = list(delta)
+            else:
+                for i, value in enumerate(delta):
+                    counters[i] += value
+        if len(entries) > self.max_keys:
+            self._compact()
+
+    def _compact(self) -> None:
+        # Shrink to 90% so compaction doesn't run on every merge
+        keep = max(1, int(self.max_keys * 0.9)) - 1
+        other = self.entries.pop(OTHER_KEY, [0] * 7)
+        ranked = sorted(self.entries.items(), key=lambda kv: kv[1][_BYTES], reverse=True)
+        self.entries = dict(ranked[:keep])
+        for _, counters in ranked[keep:]:
+            for i, value in enumerate(counters):
+                other[i] += value
+        self.entries[OTHER_KEY] = other
+
+    def top(self, limit: int) -> list[tuple[str, list[int]]]:
+        ranked = sorted(self.entries.items(), key=lambda kv: kv[1][_BYTES], reverse=True)
+        return ranked[:limit]
+
+    def to_dict(self) -> dict[str, list[int]]:
+        return self.entries
+
+    def load(self, entries: dict[str, list[int]]) -> None:
+        self.entries = {key: list(value) for key, value in entries.items()}
+
+
+def counters_to_entry(key: str, counters: list[int]) -> dict:
+    """Render a counter row for the API."""
+    return {
+        "key": key,
+        "requests": counters[_REQUESTS],
+        "bytes": counters[_BYTES],
+        "statuses": {
+            name: counters[slot] for slot, name in _STATUS_NAMES.items() if counters[slot]
+        },
+    }
+
+
+class LogFollower:
+    """Incrementally reads a log file, following renames and truncation."""
+
+    def __init__(self, path: Path, chunk_size: int):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.inode: Optional[int] = None
+        self.offset = 0
+        self._file = None
+        self._partial = b""
+
+    def resume(self, inode: Optional[int], offset: int) -> None:
+        """Continue from a saved position if it still refers to the same file."""
+        self.inode = inode
+        self.offset = offset
+
+    def _open(self, from_start: bool) -> bool:
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+        st = os.fstat(f.fileno())
+        if st.st_ino == self.inode and st.st_size >= self.offset:
+            f.seek(self.offset)
+        elif self.inode is None and not from_start:
+            # First run: only account for new traffic
+            f.seek(0, os.SEEK_END)
+        else:
+            f.seek(0)
+        self._file = f
+        self.inode = st.st_ino
+        self.offset = f.tell()
+        self._partial = b""
+        return True
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def read_lines(self, from_start: bool = False) -> list[str]:
+        """Read complete lines appended since the last call (blocking I/O)."""
+        if self._file is None and not self._open(from_start):
+            return []
+
+        data = self._file.read(self.chunk_size)
+        if not data:
+            self._check_rotation()
+            return []
+        self.offset += len(data)
+
+        data = self._partial + data
+        end = data.rfind(b"\n")
+        if end < 0:
+            self._partial = data
+            return []
+        self._partial = data[end + 1:]
+        return data[:end].decode("utf-8", "replace").split("\n")
+
+    def _check_rotation(self) -> None:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if st.st_ino != self.inode:
+            # Renamed by logrotate/squid -k rotate: the old file is drained,
+            # continue with the new one from its start.
+            logger.info(f"{self.path} was rotated, following new file")
+            self.close()
+            self.inode = None
+            self._open(from_start=True)
+        elif st.st_size < self.offset:
+            logger.info(f"{self.path} was truncated, reading from start")
+            self._file.seek(0)
+            self.offset = 0
+            self._partial = b""
+
+
+class UsageTracker:
+    """Background service following the Squid access log."""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+        self._follower: Optional[LogFollower] = None
+        self.clients = BoundedCounters(1000)
+        self.domains = BoundedCounters(1000)
+        self.outgoing = BoundedCounters(1000)
+        self.lines = 0
+        self.errors = 0
+        self.started_at = time.time()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        """Start following the access log."""
+        config = get_config().usage
+        if not config.enabled:
+            logger.info("Usage tracking disabled in config")
+            return
+
+        for counters in (self.clients, self.domains, self.outgoing):
+            counters.max_keys = config.max_keys
+        self.follow(Path(config.access_log), config.chunk_size)
+
+        saved = await state_store.get_value(_STATE_KEY)
+        if saved and saved.get("path") == config.access_log:
+            self._follower.resume(saved.get("inode"), saved.get("offset", 0))
+            self.clients.load(saved.get("clients", {}))
+            self.domains.load(saved.get("domains", {}))
+            self.outgoing.load(saved.get("outgoing", {}))
+            self.lines = saved.get("lines", 0)
+            self.started_at = saved.get("started_at", self.started_at)
+
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Usage tracker following {config.access_log}")
+
+    def follow(self, path: Path, chunk_size: int = 1024 * 1024) -> None:
+        """Point the tracker at a log file without starting the background task."""
+        self._follower = LogFollower(path, chunk_size)
+
+    async def stop(self) -> None:
+        """Stop following and persist the current position."""
+        if self._task:
+            # Let an in-flight read finish so offset and counters stay in step
+            self._stopping.set()
+            await self._task
+            self._task = None
+        if self._follower:
+            self._save()
+            self._follower.close()
+        logger.info("Usage tracker stopped")
+
+    def _save(self) -> None:
+        # Offset and counters are saved together so a restart neither
+        # re-counts nor drops lines.
+        state_store.set_value(_STATE_KEY, {
+            "path": str(self._follower.path),
+            "inode": self._follower.inode,
+            "offset": self._follower.offset - len(self._follower._partial),
+            "clients": self.clients.to_dict(),
+            "domains": self.domains.to_dict(),
+            "outgoing": self.outgoing.to_dict(),
+            "lines": self.lines,
+            "started_at": self.started_at,
+        })
+
+    def _read_batch(self, from_start: bool) -> tuple[Batch, int, int]:
+        lines = self._follower.read_lines(from_start)
+        return parse_lines(lines)
+
+    async def _step(self) -> int:
+        """Read and aggregate one chunk; returns the number of parsed lines."""
+        config = get_config().usage
+        batch, parsed, errors = await asyncio.to_thread(
+            self._read_batch, config.from_start
+        )
+        self.clients.merge(batch["clients"])
+        self.domains.merge(batch["domains"])
+        self.outgoing.merge(batch["outgoing"])
+        self.lines += parsed
+        self.errors += errors
+        return parsed
+
+    async def _run(self) -> None:
+        config = get_config().usage
+        last_save = time.monotonic()
+        while not self._stopping.is_set():
+            try:
+                parsed = await self._step()
+            except OSError as e:
+                logger.error(f"Failed to read {config.access_log}: {e}")
+                parsed = 0
+
+            if time.monotonic() - last_save > config.save_interval:
+                self._save()
+                last_save = time.monotonic()
+
+            # Keep reading without pause while there is a backlog
+            if parsed == 0:
+                try:
+                    await asyncio.wait_for(
+                        self._stopping.wait(), timeout=config.poll_interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+
+    async def catch_up(self) -> None:
+        """Process everything currently in the log (for tests and tools)."""
+        while await self._step():
+            pass
+
+    def reset(self) -> None:
+        """Clear all counters."""
+        for counters in (self.clients, self.domains, self.outgoing):
+            counters.entries = {}
+        self.lines = 0
+        self.errors = 0
+        self.started_at = time.time()
+
+
+# Global instance
+usage_tracker = UsageTracker()
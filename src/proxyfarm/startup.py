@@ -0,0 +1,218 @@
+"""Startup timing and readiness.
+
+``/health`` only says the process answers. ``/ready`` says the node can
+carry traffic: a live modem check (not the warm inventory loaded from the
+store) found ``startup.min_modems`` connected modems, the default route
+through them is installed, and the proxy accepts connections. Load
+balancers should probe ``/ready``.
+
+Time is counted from process start (read from ``/proc``, so interpreter
+startup and imports are included), with each startup step timed as a
+phase. The first time the node is ready, the time to ready is logged and
+kept in the store, so the next run reports it alongside its own.
+Services not needed to carry traffic are started only once ready.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable, Iterator, Optional
+
+from .config import get_config
+from .core.egress import egress_balancer
+from .core.modem import is_simulated
+from .core.socks import socks_server
+from .core.state import ModemRecord
+from .core.store import state_store
+from .schemas import ModemState, ReadinessCheck, ReadinessResponse, StartupReport
+from .services.monitor import monitor_service
+
+logger = logging.getLogger(__name__)
+
+ServiceHook = Callable[[], Awaitable[None]]
+
+_TIME_TO_READY_KEY = "startup.time_to_ready"
+# Seconds between checks until the node is first ready
+_WATCH_INTERVAL = 0.2
+
+
+def _process_started() -> float:
+    """Wall-clock time this process started."""
+    try:
+        # starttime is field 22, in clock ticks since boot; comm may hold spaces
+        stat = Path("/proc/self/stat").read_text().rsplit(")", 1)[1].split()
+        uptime = float(Path("/proc/uptime").read_text().split()[0])
+        since_boot = int(stat[19]) / os.sysconf("SC_CLK_TCK")
+        return time.time() - uptime + since_boot
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+class StartupTracker:
+    """Times startup steps and decides readiness."""
+
+    def __init__(self):
+        self.started_at = _process_started()
+        self.phases: dict[str, float] = {}
+        self.milestones: dict[str, float] = {}
+        self.warm_start = False
+        # Services waiting for readiness to start
+        self.deferred: list[str] = []
+        self._previous: Optional[float] = None
+        self._verdict: Optional[tuple[float, list[ReadinessCheck]]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return "ready" in self.milestones
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time a startup step."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.perf_counter() - started, 4)
+
+    def mark(self, name: str) -> None:
+        """Record when a milestone was first reached."""
+        if name not in self.milestones:
+            self.milestones[name] = round(time.time() - self.started_at, 4)
+
+    async def start(self, deferred: list[tuple[str, ServiceHook]]) -> None:
+        """Watch for readiness, then start the deferred services."""
+        self.mark("services_started")
+        self.warm_start = monitor_service.warm
+        self.deferred = [name for name, _ in deferred]
+        self._previous = await state_store.get_value(_TIME_TO_READY_KEY)
+        self._task = asyncio.create_task(self._watch(deferred))
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self, deferred: list[tuple[str, ServiceHook]]) -> None:
+        deadline = time.monotonic() + get_config().startup.defer_timeout
+        while not self.ready and time.monotonic() < deadline:
+            try:
+                await self._evaluate()
+            except Exception as e:
+                logger.exception(f"Readiness check failed: {e}")
+            if not self.ready:
+                await asyncio.sleep(_WATCH_INTERVAL)
+        if not self.ready:
+            logger.warning("Not ready yet, starting the deferred services anyway")
+        for name, start in deferred:
+            try:
+                with self.phase(name):
+                    await start()
+            except Exception as e:
+                logger.exception(f"Failed to start {name}: {e}")
+            self.deferred.remove(name)
+
+    async def check(self) -> ReadinessResponse:
+        """Readiness, re-verified at most every ``startup.cache_ttl`` seconds."""
+        ttl = get_config().startup.cache_ttl
+        if self._verdict is None or time.monotonic() - self._verdict[0] >= ttl:
+            await self._evaluate()
+        _, checks = self._verdict
+        return ReadinessResponse(
+            ready=all(check.ok for check in checks),
+            checks=checks,
+            startup=self.report(),
+        )
+
+    def report(self) -> StartupReport:
+        return StartupReport(
+            started_at=datetime.utcfromtimestamp(self.started_at),
+            warm_start=self.warm_start,
+            phases=self.phases,
+            milestones=self.milestones,
+            time_to_ready=self.milestones.get("ready"),
+            previous_time_to_ready=self._previous,
+        )
+
+    async def _evaluate(self) -> None:
+        checks = [self._check_inventory(), self._check_routing(), await self._check_proxy()]
+        self._verdict = (time.monotonic(), checks)
+        if checks[0].ok:
+            self.mark("inventory")
+        if all(check.ok for check in checks) and not self.ready:
+            self.mark("ready")
+            elapsed = self.milestones["ready"]
+            logger.info(
+                f"Ready {elapsed:.2f}s after process start"
+                + (f" (previous run: {self._previous:.2f}s)" if self._previous else "")
+            )
+            state_store.set_value(_TIME_TO_READY_KEY, elapsed)
+
+    @staticmethod
+    def _connected() -> list[ModemRecord]:
+        return [
+            modem for modem in monitor_service.inventory.values()
+            if modem.state == ModemState.CONNECTED and modem.ip_address
+        ]
+
+    def _check_inventory(self) -> ReadinessCheck:
+        total = len(monitor_service.inventory)
+        if monitor_service.updated_at is None or monitor_service.warm:
+            detail = "No live modem check yet"
+            if total:
+                detail += f" ({total} modem(s) from last known state)"
+            return ReadinessCheck(name="inventory", ok=False, detail=detail)
+        connected = len(self._connected())
+        return ReadinessCheck(
+            name="inventory",
+            ok=connected >= get_config().startup.min_modems,
+            detail=f"{connected}/{total} modem(s) connected",
+        )
+
+    def _check_routing(self) -> ReadinessCheck:
+        connected = self._connected()
+        usable = set(egress_balancer.weights(connected))
+        if get_config().egress.enabled:
+            # Only modems the installed default route goes through count
+            routed = {interface for _, interface, _ in egress_balancer.routes}
+            usable = {m.id for m in connected if m.id in usable and m.interface in routed}
+            detail = f"{len(usable)} modem(s) in the default route"
+        else:
+            detail = f"{len(usable)} modem(s) with a gateway"
+        return ReadinessCheck(
+            name="routing",
+            ok=len(usable) >= get_config().startup.min_modems,
+            detail=detail,
+        )
+
+    async def _check_proxy(self) -> ReadinessCheck:
+        config = get_config()
+        if not config.startup.check_proxy:
+            return ReadinessCheck(name="proxy", ok=True, detail="Not checked")
+        if config.socks.enabled and not socks_server.listening:
+            return ReadinessCheck(name="proxy", ok=False, detail="SOCKS listener is down")
+        if is_simulated():
+            return ReadinessCheck(name="proxy", ok=True, detail="Squid simulated")
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(config.squid.host, config.squid.port),
+                config.startup.proxy_timeout,
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            return ReadinessCheck(
+                name="proxy", ok=False, detail=f"Squid not accepting connections: {e!r}"
+            )
+        writer.close()
+        return ReadinessCheck(name="proxy", ok=True, detail="Squid accepting connections")
+
+
+# Global instance
+startup_tracker = StartupTracker()
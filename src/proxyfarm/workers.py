@@ -0,0 +1,342 @@
+"""Owner election and request forwarding for multi-worker deployments.
+
+With ``api.workers > 1`` uvicorn runs several processes of the app, but the
+background services (monitor, recovery, bring-up, DNS, usage accounting,
+state store) must run exactly once. Workers race for an exclusive
+``flock`` on ``<run_dir>/owner.lock``; the holder is the owner and starts
+the services. The others are followers and forward API requests to the
+owner over a unix socket, except cheap reads they can serve themselves:
+health, docs, and ``GET /modems?lite=true`` from the inventory snapshot the
+owner publishes to ``<run_dir>/inventory.json``. ``/ready`` is forwarded,
+since only the owner knows whether the node is ready.
+
+The lock is released by the kernel when the owner exits, however it exits.
+Followers keep retrying it, so one of them takes over (starts the services
+and the socket) within ``api.failover_interval``. Forwarded requests that
+find no owner are retried until ``api.forward_timeout``, then get ``503``.
+"""
+
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import struct
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+from fastapi import FastAPI, Request, Response
+from pydantic import TypeAdapter
+
+from .config import get_config
+from .core.state import ModemRecord
+from .services.monitor import monitor_service
+
+logger = logging.getLogger(__name__)
+
+ServiceHook = Callable[[], Awaitable[None]]
+
+# Header and body lengths of a frame
+_FRAME = struct.Struct("!II")
+# Hop-by-hop or recomputed headers not copied between processes
+_SKIP_HEADERS = {"content-length", "connection", "transfer-encoding"}
+
+
+@dataclass(slots=True)
+class InventorySnapshot:
+    updated_at: Optional[float]
+    warm: bool
+    modems: list[ModemRecord]
+
+
+_snapshot_adapter = TypeAdapter(InventorySnapshot)
+
+
+async def _send_frame(writer: asyncio.StreamWriter, header: dict, body: bytes) -> None:
+    data = json.dumps(header).encode()
+    writer.write(_FRAME.pack(len(data), len(body)) + data + body)
+    await writer.drain()
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> tuple[dict, bytes]:
+    header_len, body_len = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    header = json.loads(await reader.readexactly(header_len))
+    return header, await reader.readexactly(body_len)
+
+
+class WorkerCoordinator:
+    """Decides which worker runs the services and routes requests to it."""
+
+    def __init__(self):
+        self.role = "single"
+        self._app: Optional[FastAPI] = None
+        self._start_services: Optional[ServiceHook] = None
+        self._stop_services: Optional[ServiceHook] = None
+        self._lock_fd: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._task: Optional[asyncio.Task] = None
+        self._snapshot_mtime: Optional[int] = None
+        self._published_at: Optional[float] = None
+        self._stopping = False
+
+    @property
+    def run_dir(self) -> Path:
+        return Path(get_config().api.run_dir)
+
+    @property
+    def socket_path(self) -> Path:
+        return self.run_dir / "owner.sock"
+
+    @property
+    def snapshot_path(self) -> Path:
+        return self.run_dir / "inventory.json"
+
+    async def start(
+        self, app: FastAPI, start_services: ServiceHook, stop_services: ServiceHook
+    ) -> None:
+        """Start the services here, or become a follower of the owner."""
+        self._app = app
+        self._start_services = start_services
+        self._stop_services = stop_services
+        self._stopping = False
+
+        if get_config().api.workers <= 1:
+            self.role = "single"
+            await start_services()
+            return
+
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+        if self._try_lock():
+            await self._promote()
+        else:
+            self.role = "follower"
+            logger.info(f"Worker {os.getpid()} is a follower")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the services if this worker runs them, and release ownership."""
+        self._stopping = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        if self.role == "follower":
+            return
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            self.socket_path.unlink(missing_ok=True)
+        await self._stop_services()
+        if self._lock_fd is not None:
+            # Closing the descriptor releases the lock for a follower
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _try_lock(self) -> bool:
+        fd = os.open(self.run_dir / "owner.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._lock_fd = fd
+        return True
+
+    async def _promote(self) -> None:
+        logger.info(f"Worker {os.getpid()} is the owner, starting services")
+        self.role = "owner"
+        await self._start_services()
+        # A socket left by a dead owner would make the bind fail
+        self.socket_path.unlink(missing_ok=True)
+        self._server = await asyncio.start_unix_server(
+            self._handle, path=str(self.socket_path)
+        )
+
+    async def _run(self) -> None:
+        """Owner: publish the inventory. Follower: wait for the lock."""
+        while not self._stopping:
+            try:
+                if self.role == "owner":
+                    self._publish()
+                elif self._try_lock():
+                    logger.warning("Owner worker is gone, taking over")
+                    await self._promote()
+            except Exception as e:
+                logger.exception(f"Worker coordination failed: {e}")
+            await asyncio.sleep(get_config().api.failover_interval)
+
+    def _publish(self) -> None:
+        if monitor_service.updated_at == self._published_at:
+            return
+        snapshot = InventorySnapshot(
+            updated_at=monitor_service.updated_at,
+            warm=monitor_service.warm,
+            modems=list(monitor_service.inventory.values()),
+        )
+        tmp = self.snapshot_path.with_suffix(".tmp")
+        tmp.write_bytes(_snapshot_adapter.dump_json(snapshot))
+        tmp.replace(self.snapshot_path)
+        self._published_at = snapshot.updated_at
+
+    def _load_snapshot(self) -> None:
+        """Refresh the follower's inventory from the owner's snapshot."""
+        try:
+            mtime = self.snapshot_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._snapshot_mtime:
+            return
+        snapshot = _snapshot_adapter.validate_json(self.snapshot_path.read_bytes())
+        monitor_service.inventory = {modem.id: modem for modem in snapshot.modems}
+        monitor_service.updated_at = snapshot.updated_at
+        monitor_service.warm = snapshot.warm
+        self._snapshot_mtime = mtime
+
+    @staticmethod
+    def _serves_locally(request: Request) -> bool:
+        path = request.url.path
+        if path == "/ready":
+            return False
+        if not path.startswith("/api/"):
+            return True
+        return (
+            request.method == "GET"
+            and path == "/api/v1/modems"
+            and request.query_params.get("lite", "").lower() in ("1", "true", "yes", "on")
+        )
+
+    async def dispatch(
+        self, request: Request, call_next: Callable[[Request], Awaitable[Response]]
+    ) -> Response:
+        """HTTP middleware: forward requests a follower can't serve itself."""
+        if self.role != "follower":
+            return await call_next(request)
+        if self._serves_locally(request):
+            self._load_snapshot()
+            return await call_next(request)
+        return await self._forward(request)
+
+    async def _forward(self, request: Request) -> Response:
+        header = {
+            "method": request.method,
+            "path": request.url.path,
+            "query": request.url.query,
+            "headers": [
+                [key, value] for key, value in request.headers.items()
+                if key not in _SKIP_HEADERS
+            ],
+            "client": [request.client.host, request.client.port] if request.client else None,
+        }
+        body = await request.body()
+        config = get_config().api
+        deadline = time.monotonic() + config.forward_timeout
+
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(str(self.socket_path))
+            except (FileNotFoundError, ConnectionRefusedError):
+                # No owner right now: wait for a follower to take over
+                if time.monotonic() >= deadline:
+                    return Response(
+                        content=b'{"detail":"No owner worker available"}',
+                        status_code=503,
+                        media_type="application/json",
+                        headers={"Retry-After": "1"},
+                    )
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                await _send_frame(writer, header, body)
+                response, content = await asyncio.wait_for(
+                    _read_frame(reader), max(0.0, deadline - time.monotonic())
+                )
+            except (asyncio.IncompleteReadError, ConnectionError, asyncio.TimeoutError) as e:
+                logger.warning(f"Forwarding {request.method} {request.url.path} failed: {e!r}")
+                return Response(
+                    content=b'{"detail":"Owner worker did not answer"}',
+                    status_code=502,
+                    media_type="application/json",
+                )
+            finally:
+                writer.close()
+            return Response(
+                content=content,
+                status_code=response["status"],
+                headers={
+                    key: value for key, value in response["headers"]
+                    if key not in _SKIP_HEADERS
+                },
+            )
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Owner side: run a forwarded request through the app."""
+        try:
+            request, body = await _read_frame(reader)
+            status, headers, content = await self._call_app(request, body)
+            await _send_frame(writer, {"status": status, "headers": headers}, content)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _call_app(self, request: dict, body: bytes) -> tuple[int, list, bytes]:
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": request["method"],
+            "scheme": "http",
+            "path": request["path"],
+            "raw_path": request["path"].encode(),
+            "query_string": request["query"].encode(),
+            "root_path": "",
+            "headers": [
+                (key.encode("latin-1"), value.encode("latin-1"))
+                for key, value in request["headers"]
+            ],
+            "client": tuple(request["client"]) if request["client"] else None,
+            "server": None,
+        }
+        received = False
+        status = 500
+        headers: list[list[str]] = []
+        chunks: list[bytes] = []
+
+        async def receive() -> dict:
+            nonlocal received
+            if received:
+                # Nothing more will come; wait like a client that stays connected
+                await asyncio.Event().wait()
+            received = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message: dict) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers.extend(
+                    [key.decode("latin-1"), value.decode("latin-1")]
+                    for key, value in message.get("headers", [])
+                )
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        try:
+            await self._app(scope, receive, send)
+        except Exception:
+            # The app already sent its 500 response, if it could
+            logger.exception(f"Forwarded {request['method']} {request['path']} failed")
+        return status, headers, b"".join(chunks)
+
+
+# Global instance
+worker_coordinator = WorkerCoordinator()
@@ -0,0 +1,52 @@
+import pytest
+import yaml
+from fastapi.testclient import TestClient
+
+import proxyfarm.config as config_module
+from proxyfarm.config import Config, config_path, get_config, set_config
+
+API_KEY = "test-key"
+
+
+@pytest.fixture(autouse=True)
+def config():
+    """A default config per test, instead of whatever config.yaml is around."""
+    previous = config_module._config, config_path()
+    set_config(Config())
+    yield get_config()
+    config_module._config, config_module._config_path = previous
+
+
+@pytest.fixture
+def settings(tmp_path) -> dict:
+    """Config file for a simulated farm that needs no hardware or root.
+
+    Override this fixture in a test module to change it for the ``client``.
+    """
+    return {
+        "api": {"api_key": API_KEY, "run_dir": str(tmp_path / "run")},
+        "store": {"path": str(tmp_path / "state.db")},
+        "simulation": {"enabled": True, "modems": 3, "seed": 1, "latency": {}},
+        "bringup": {"on_startup": False},
+        "startup": {"check_proxy": False},
+        "reload": {"watch": False},
+        "dns": {"enabled": False},
+        "conntrack": {"enabled": False},
+        "usage": {"enabled": False},
+        "proxy_auth": {"enabled": False},
+    }
+
+
+@pytest.fixture
+def client(tmp_path, settings):
+    """API client for the app running on a simulated farm."""
+    from proxyfarm.core import sim
+    from proxyfarm.main import create_app
+
+    path = tmp_path / "config.yaml"
+    path.write_text(yaml.safe_dump(settings))
+    try:
+        with TestClient(create_app(path), headers={"X-API-Key": API_KEY}) as client:
+            yield client
+    finally:
+        sim.uninstall()
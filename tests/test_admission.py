@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from proxyfarm.admission import AdmissionController
+from proxyfarm.config import LimitConfig
+
+
+@pytest.fixture
+def controller(config):
+    config.admission.limits = {
+        "rotate": LimitConfig(
+            max_concurrent=2, per_modem=1, queue_size=1, queue_timeout=0.2, retry_after=7
+        ),
+    }
+    return AdmissionController()
+
+
+async def test_unlimited_endpoint(controller):
+    tickets = [await controller.acquire("ussd") for _ in range(10)]
+    for ticket in tickets:
+        ticket.release()
+    assert "ussd" not in controller.stats()
+
+
+async def test_disabled(controller, config):
+    config.admission.enabled = False
+    tickets = [await controller.acquire("rotate", modem_id=1) for _ in range(5)]
+    assert controller.stats()["rotate"]["admitted"] == 0
+    for ticket in tickets:
+        ticket.release()
+
+
+async def test_queued_request_gets_released_slot(controller):
+    first = await controller.acquire("rotate", modem_id=1)
+    waiter = asyncio.create_task(controller.acquire("rotate", modem_id=1))
+    await asyncio.sleep(0.01)
+    assert controller.stats()["rotate"]["waiting"] == 1
+
+    first.release()
+    second = await waiter
+    stats = controller.stats()["rotate"]
+    assert stats["admitted"] == 2
+    assert stats["rejected"] == 0
+    second.release()
+    assert controller.stats()["rotate"]["scoped"] == []
+
+
+async def test_queue_full(controller):
+    first = await controller.acquire("rotate", modem_id=1)
+    waiter = asyncio.create_task(controller.acquire("rotate", modem_id=1))
+    await asyncio.sleep(0.01)
+
+    with pytest.raises(HTTPException) as e:
+        await controller.acquire("rotate", modem_id=1)
+    assert e.value.status_code == 429
+    assert e.value.headers == {"Retry-After": "7"}
+
+    first.release()
+    (await waiter).release()
+    stats = controller.stats()["rotate"]
+    assert (stats["rejected"], stats["timed_out"]) == (1, 0)
+
+
+async def test_queue_timeout(controller):
+    first = await controller.acquire("rotate", modem_id=1)
+    with pytest.raises(HTTPException) as e:
+        await controller.acquire("rotate", modem_id=1)
+    assert e.value.status_code == 429
+    stats = controller.stats()["rotate"]
+    assert (stats["rejected"], stats["timed_out"], stats["waiting"]) == (1, 1, 0)
+    first.release()
+
+
+async def test_per_modem_and_global_limits(controller):
+    # One per modem, two overall
+    one = await controller.acquire("rotate", modem_id=1)
+    two = await controller.acquire("rotate", modem_id=2)
+    assert controller.stats()["rotate"]["active"] == 2
+
+    with pytest.raises(HTTPException):
+        await controller.acquire("rotate", modem_id=3)
+    # The rejected request gave back its per-modem slot
+    assert {e["key"] for e in controller.stats()["rotate"]["scoped"]} == {"1", "2"}
+
+    one.release()
+    three = await controller.acquire("rotate", modem_id=3)
+    two.release()
+    three.release()
+    stats = controller.stats()["rotate"]
+    assert (stats["active"], stats["admitted"], stats["scoped"]) == (0, 3, [])
+
+
+async def test_cancelled_waiter_frees_queue(controller):
+    first = await controller.acquire("rotate", modem_id=1)
+    waiter = asyncio.create_task(controller.acquire("rotate", modem_id=1))
+    await asyncio.sleep(0.01)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert controller.stats()["rotate"]["waiting"] == 0
+    first.release()
+    assert controller.stats()["rotate"]["scoped"] == []
+
+
+def test_invalid_modem_id_is_a_validation_error(client):
+    assert client.post("/api/v1/modems/abc/rotate").status_code == 422
+    assert client.post("/api/v1/modems/0/rotate").status_code == 200
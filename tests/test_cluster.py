@@ -0,0 +1,152 @@
+"""Aggregator mode against real node processes running the simulator."""
+
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+import pytest
+import yaml
+
+from proxyfarm.config import NodeConfig
+from proxyfarm.core.cluster import ClusterManager, NodeError, parse_global_id
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_node(workdir: Path, modems: int) -> tuple[subprocess.Popen, str]:
+    workdir.mkdir()
+    port = _free_port()
+    path = workdir / "config.yaml"
+    path.write_text(yaml.safe_dump({
+        "api": {"host": "127.0.0.1", "api_key": "node-key", "run_dir": str(workdir / "run")},
+        "store": {"path": str(workdir / "state.db")},
+        "simulation": {"enabled": True, "modems": modems, "latency": {}},
+        "bringup": {"on_startup": False},
+        "startup": {"check_proxy": False},
+        "dns": {"enabled": False},
+        "conntrack": {"enabled": False},
+        "usage": {"enabled": False},
+        "proxy_auth": {"enabled": False},
+    }))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "proxyfarm.main", "--config", str(path), "--port", str(port)],
+        env={**os.environ, "PYTHONPATH": str(SRC)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/ready", timeout=1).status_code == 200:
+                return server, url
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"Node with {modems} modems did not become ready")
+
+
+@pytest.fixture(scope="module")
+def node_urls(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp("nodes")
+    servers = []
+    try:
+        for name, modems in (("pi-1", 2), ("pi-2", 3)):
+            servers.append(_start_node(workdir / name, modems))
+        yield {"pi-1": servers[0][1], "pi-2": servers[1][1]}
+    finally:
+        for server, _ in servers:
+            server.terminate()
+            server.wait(10)
+
+
+@pytest.fixture
+async def cluster(config, node_urls):
+    config.cluster.enabled = True
+    config.cluster.nodes = [
+        NodeConfig(name=name, url=url, api_key="node-key") for name, url in node_urls.items()
+    ]
+    manager = ClusterManager()
+    yield manager
+    await manager.close()
+
+
+def test_parse_global_id():
+    assert parse_global_id("pi-2:0") == ("pi-2", 0)
+    assert parse_global_id("a:b:12") == ("a:b", 12)
+    for invalid in ("pi-2", ":1", "pi-2:x", "pi-2:-1"):
+        with pytest.raises(ValueError):
+            parse_global_id(invalid)
+
+
+async def test_merged_inventory(cluster):
+    modems = await cluster.inventory()
+    assert sorted(m.global_id for m in modems) == [
+        "pi-1:0", "pi-1:1", "pi-2:0", "pi-2:1", "pi-2:2",
+    ]
+    assert {m.node for m in modems} == {"pi-1", "pi-2"}
+    nodes = await cluster.nodes()
+    assert [(n.name, n.reachable, n.modems) for n in nodes] == [
+        ("pi-1", True, 2), ("pi-2", True, 3),
+    ]
+
+
+async def test_unreachable_node_does_not_hide_the_others(cluster, config):
+    config.cluster.nodes.append(
+        NodeConfig(name="pi-3", url=f"http://127.0.0.1:{_free_port()}", api_key="node-key")
+    )
+    modems = await cluster.inventory(refresh=True)
+    assert {m.node for m in modems} == {"pi-1", "pi-2"}
+    status = {n.name: n for n in await cluster.nodes()}
+    assert status["pi-3"].reachable is False
+    assert "unreachable" in status["pi-3"].error
+
+
+async def test_wrong_key_marks_node_unreachable(cluster, config):
+    config.cluster.nodes[0].api_key = "wrong"
+    await cluster.refresh()
+    status = {n.name: n for n in await cluster.nodes()}
+    assert status["pi-1"].reachable is False
+    assert status["pi-2"].reachable is True
+
+
+async def test_actions_go_to_the_owning_node(cluster):
+    result = await cluster.rotate("pi-2:1")
+    assert result.success and result.modem_id == 1
+
+    response = await cluster.send_ussd("pi-1:0", "*100#")
+    assert response.modem_id == 0 and response.command == "*100#"
+
+    with pytest.raises(NodeError) as e:
+        await cluster.rotate("pi-9:0")
+    assert e.value.status_code == 404
+    with pytest.raises(NodeError) as e:
+        await cluster.rotate("pi-1:7")
+    assert e.value.status_code == 404
+
+
+async def test_malformed_inventory_keeps_the_last_good_one(cluster, config):
+    await cluster.refresh()
+    node = config.cluster.nodes[0]
+    cluster._clients[node.name] = httpx.AsyncClient(
+        base_url=node.url,
+        transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, json={"modems": [{"id": "zero"}]})
+        ),
+    )
+    modems = await cluster.inventory(refresh=True)
+    assert len([m for m in modems if m.node == "pi-1"]) == 2
+    status = {n.name: n for n in await cluster.nodes()}
+    assert status["pi-1"].reachable is False
+    assert status["pi-1"].error.startswith("Malformed inventory")
@@ -0,0 +1,184 @@
+import asyncio
+import time
+
+import pytest
+
+from proxyfarm.core.connector import ConnectError, HedgedConnector, RetryBudget
+
+
+class Writer:
+    def __init__(self, modem_id: int):
+        self.modem_id = modem_id
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Modems:
+    """Scripted connect attempts: a delay and an optional error per modem."""
+
+    def __init__(self, connector: HedgedConnector, monkeypatch):
+        self.connector = connector
+        self.delays: dict[int, float] = {}
+        self.errors: dict[int, Exception] = {}
+        self.attempts: list[int] = []
+        self.writers: list[Writer] = []
+        monkeypatch.setattr(connector, "_attempt", self._attempt)
+        for modem_id in range(3):
+            connector.set_target(modem_id, f"wwan{modem_id}", f"100.64.{modem_id}.2")
+
+    async def _attempt(self, modem_id, host, port, ssl_context, raw=False):
+        self.attempts.append(modem_id)
+        started = time.monotonic()
+        await asyncio.sleep(self.delays.get(modem_id, 0.0))
+        if modem_id in self.errors:
+            raise self.errors[modem_id]
+        writer = Writer(modem_id)
+        self.writers.append(writer)
+        self.connector._record(modem_id, time.monotonic() - started)
+        return None, writer
+
+
+@pytest.fixture
+def connector(config):
+    config.connector.hedge_delay = 0.05
+    config.connector.min_hedge_delay = 0.01
+    config.connector.connect_timeout = 1.0
+    return HedgedConnector()
+
+
+@pytest.fixture
+def modems(connector, monkeypatch):
+    return Modems(connector, monkeypatch)
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, burst=2)
+    assert budget.withdraw() and budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    for _ in range(10):
+        budget.deposit()
+    assert budget.tokens == 2
+
+
+async def test_fast_modem_is_not_hedged(connector, modems):
+    connection = await connector.connect("example.com", 443, modem_id=0)
+    assert (connection.modem_id, connection.hedged) == (0, False)
+    assert modems.attempts == [0]
+
+
+async def test_slow_modem_is_hedged_and_loser_closed(connector, modems):
+    modems.delays[0] = 0.3
+    connection = await connector.connect("example.com", 443, modem_id=0)
+    assert connection.hedged and connection.hedge_won
+    assert connection.modem_id != 0
+    assert connector.counters["hedges"] == connector.counters["hedge_wins"] == 1
+
+    # The abandoned attempt is cancelled; had it connected it would be closed
+    await asyncio.sleep(0.35)
+    assert len(modems.writers) == 1
+    # and it counts towards modem 0's latency with the time it was given
+    assert connector._latency[0][0] >= 0.05
+
+
+async def test_hedge_can_lose_to_the_primary(connector, modems):
+    modems.delays = {0: 0.08, 1: 0.5, 2: 0.5}
+    connection = await connector.connect("example.com", 443, modem_id=0)
+    assert (connection.modem_id, connection.hedged, connection.hedge_won) == (0, True, False)
+
+
+async def test_failed_attempt_is_retried_elsewhere(connector, modems):
+    modems.errors[0] = ConnectionRefusedError("refused")
+    connection = await connector.connect("example.com", 443, modem_id=0)
+    assert connection.modem_id != 0
+    assert connector.counters["retries"] == 1
+
+
+async def test_all_attempts_failing(connector, modems):
+    for modem_id in range(3):
+        modems.errors[modem_id] = ConnectionRefusedError(f"refused {modem_id}")
+    with pytest.raises(ConnectError, match="refused 0"):
+        await connector.connect("example.com", 443, modem_id=0)
+    assert sorted(modems.attempts) == [0, 1, 2]
+    assert connector.counters["failures"] == 1
+
+
+async def test_sticky_connects_are_never_hedged(connector, modems):
+    modems.delays[0] = 0.1
+    connection = await connector.connect("example.com", 443, modem_id=0, sticky=True)
+    assert (connection.modem_id, connection.hedged) == (0, False)
+
+    modems.errors[0] = ConnectionResetError("reset")
+    with pytest.raises(ConnectError):
+        await connector.connect("example.com", 443, modem_id=0, sticky=True)
+    assert modems.attempts == [0, 0]
+
+
+async def test_exhausted_budget_stops_hedging(connector, modems, config):
+    config.connector.budget_burst = 1
+    config.connector.budget_ratio = 0.0
+    modems.delays[0] = 0.1
+
+    assert (await connector.connect("example.com", 443, modem_id=0)).hedged
+    connection = await connector.connect("example.com", 443, modem_id=0)
+    assert (connection.modem_id, connection.hedged) == (0, False)
+    assert connector.counters["budget_exhausted"] == 1
+
+
+async def test_timeout(connector, modems, config):
+    config.connector.connect_timeout = 0.2
+    config.connector.max_attempts = 1
+    modems.delays[0] = 5
+    with pytest.raises(ConnectError, match="timed out"):
+        await connector.connect("example.com", 443, modem_id=0)
+    assert connector._latency[0][0] == pytest.approx(0.2, abs=0.05)
+
+
+def test_threshold_follows_latency_percentile(connector, config):
+    config.connector.min_samples = 10
+    config.connector.max_hedge_delay = 0.5
+    assert connector.threshold(0) == 0.05
+    for i in range(10):
+        connector._record(0, 0.1 + i / 100)
+    assert connector.threshold(0) == pytest.approx(0.19)
+    connector._record(1, 3.0)
+    config.connector.min_samples = 1
+    assert connector.threshold(1) == 0.5
+
+
+def test_update_modems_skips_excluded(connector):
+    from proxyfarm.core.state import ModemRecord
+
+    modems = [
+        ModemRecord(id=i, interface=f"wwan{i}", ip_address=f"100.64.{i}.2") for i in range(3)
+    ]
+    connector.update_modems(modems, {0: 5, 1: 0, 2: 3})
+    assert connector.target(1) is None
+    assert connector.target(2) == ("wwan2", "100.64.2.2")
+    assert {connector.choose() for _ in range(50)} == {0, 2}
+
+
+async def test_open_socket_connects_to_a_local_server(connector):
+    accepted = asyncio.Event()
+
+    async def handle(reader, writer):
+        accepted.set()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    connector.set_target(0, None, "127.0.0.1")
+    try:
+        connection = await connector.open_socket("127.0.0.1", port, modem_id=0)
+        connection.sock.close()
+        await asyncio.wait_for(accepted.wait(), 1)
+        assert connection.modem_id == 0
+        assert len(connector._latency[0]) == 1
+    finally:
+        server.close()
+        await server.wait_closed()
@@ -0,0 +1,193 @@
+import asyncio
+import socket
+
+import pytest
+
+from proxyfarm.core import conntrack
+from proxyfarm.core.conntrack import (
+    IPCTNL_MSG_CT_DELETE,
+    IPCTNL_MSG_CT_NEW,
+    ConntrackTracker,
+    check_reply,
+    flow_message,
+    parse_flow,
+)
+from proxyfarm.core.state import ModemRecord
+
+MODEMS = [
+    ModemRecord(id=0, interface="wwan0", ip_address="100.64.0.2"),
+    ModemRecord(id=1, interface="wwan1", ip_address="100.64.1.2"),
+]
+
+
+def _flow(
+    msg_type: int, source: str, port: int, destination: str = "93.184.216.34", total: int = 0
+) -> bytes:
+    """A conntrack message as the kernel sends it for an event or a dump."""
+    message = flow_message(msg_type, 0, source, destination, port, 443, socket.IPPROTO_TCP)
+    if total:
+        counters = conntrack._nested(
+            conntrack._CTA_COUNTERS_ORIG,
+            conntrack._attr(conntrack._CTA_COUNTERS_BYTES, conntrack._U64.pack(total)),
+        )
+        message = _relength(message + counters)
+    return message
+
+
+def _relength(message: bytes, msg_type: int = None) -> bytes:
+    _, kind, *rest = conntrack._NLMSG.unpack_from(message)
+    if msg_type is not None:
+        kind = kind & ~0xFF | msg_type
+    return conntrack._NLMSG.pack(len(message), kind, *rest) + message[conntrack._NLMSG.size:]
+
+
+def _key(message: bytes) -> bytes:
+    return parse_flow(message, conntrack._HEADER_SIZE, len(message))[0]
+
+
+def _done() -> bytes:
+    # The kernel's NLMSG_DONE carries an int
+    size = conntrack._NLMSG.size + 4
+    return conntrack._NLMSG.pack(size, conntrack._NLMSG_DONE, 0, 1, 0) + bytes(4)
+
+
+def _error(code: int) -> bytes:
+    payload = conntrack._ERRNO.pack(-code) + bytes(conntrack._NLMSG.size)
+    size = conntrack._NLMSG.size + len(payload)
+    return conntrack._NLMSG.pack(size, conntrack._NLMSG_ERROR, 0, 1, 0) + payload
+
+
+def _handle(tracker: ConntrackTracker, *messages: bytes) -> bool:
+    data = b"".join(messages)
+    return tracker.handle(data, len(data))
+
+
+@pytest.fixture
+def tracker() -> ConntrackTracker:
+    tracker = ConntrackTracker()
+    tracker.update_modems(MODEMS)
+    return tracker
+
+
+def test_parse_flow():
+    message = _flow(IPCTNL_MSG_CT_DELETE, "100.64.0.2", 40000, total=1500)
+    key, source, reply_destination, total = parse_flow(
+        message, conntrack._HEADER_SIZE, len(message)
+    )
+    assert source == socket.inet_aton("100.64.0.2")
+    assert reply_destination is None
+    assert total == 1500
+
+    new = _flow(IPCTNL_MSG_CT_NEW, "100.64.0.2", 40000)
+    assert parse_flow(new, conntrack._HEADER_SIZE, len(new))[0] == key
+    assert parse_flow(new, conntrack._HEADER_SIZE, len(new))[2] == socket.inet_aton("100.64.0.2")
+
+
+def test_events_count_flows_per_modem(tracker):
+    _handle(
+        tracker,
+        _flow(IPCTNL_MSG_CT_NEW, "100.64.0.2", 40000),
+        _flow(IPCTNL_MSG_CT_NEW, "100.64.0.2", 40001),
+        _flow(IPCTNL_MSG_CT_NEW, "100.64.1.2", 40000),
+        # Seen twice (an event racing a table read): counted once
+        _flow(IPCTNL_MSG_CT_NEW, "100.64.1.2", 40000),
+        # Not through a modem
+        _flow(IPCTNL_MSG_CT_NEW, "192.168.1.10", 40000),
+    )
+    assert (tracker.active_flows(0), tracker.active_flows(1)) == (2, 1)
+
+    _handle(tracker, _flow(IPCTNL_MSG_CT_DELETE, "100.64.0.2", 40000, total=1234))
+    flows = tracker.modem_flows(0)
+    assert (flows.active_flows, flows.opened, flows.closed, flows.closed_bytes) == (1, 2, 1, 1234)
+    assert tracker.stats().events == 6
+    assert tracker.stats().tracked_flows == 2
+
+
+def test_masqueraded_flows_count_by_reply_destination(tracker):
+    # A LAN client's flow NATed out of modem 1: the reply comes back to its IP
+    original = flow_message(
+        IPCTNL_MSG_CT_DELETE, 0, "192.168.1.10", "93.184.216.34", 40000, 443, socket.IPPROTO_TCP
+    )
+    reply = conntrack._nested(conntrack._CTA_TUPLE_REPLY, conntrack._nested(
+        conntrack._CTA_TUPLE_IP,
+        conntrack._attr(conntrack._CTA_IP_V4_SRC, socket.inet_aton("93.184.216.34")),
+        conntrack._attr(conntrack._CTA_IP_V4_DST, socket.inet_aton("100.64.1.2")),
+    ))
+    message = _relength(original + reply, IPCTNL_MSG_CT_NEW)
+    _handle(tracker, message)
+    assert tracker._flows == {_key(message): "wwan1"}
+    assert tracker.active_flows(1) == 1
+
+
+def test_truncated_message_is_left_alone(tracker):
+    message = _flow(IPCTNL_MSG_CT_NEW, "100.64.0.2", 40000)
+    data = message + message[:-8]
+    tracker.handle(data, len(data))
+    assert tracker.active_flows(0) == 1
+
+
+def test_check_reply():
+    assert check_reply(_done(), len(_done()))
+    assert not check_reply(_error(0), len(_error(0)))
+    with pytest.raises(OSError, match="EPERM"):
+        check_reply(_error(1), len(_error(1)))
+    with pytest.raises(OSError):
+        _handle(ConntrackTracker(), _error(1))
+
+
+def test_modems_going_away(tracker):
+    _handle(tracker, _flow(IPCTNL_MSG_CT_NEW, "100.64.0.2", 40000))
+    tracker.update_modems(MODEMS[1:])
+    # Flows still open keep their egress, no longer tied to the modem
+    assert tracker.modem_flows(0) is None
+    assert [e.interface for e in tracker.stats().egress] == ["wwan0", "wwan1"]
+
+    _handle(tracker, _flow(IPCTNL_MSG_CT_DELETE, "100.64.0.2", 40000))
+    tracker.update_modems(MODEMS[1:])
+    assert [e.interface for e in tracker.stats().egress] == ["wwan1"]
+
+
+async def test_table_read_replays_events(tracker, monkeypatch):
+    ours, kernels = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    ours.setblocking(False)
+    kernels.setblocking(False)
+    monkeypatch.setattr(conntrack, "open_socket", lambda *args: ours)
+    loop = asyncio.get_running_loop()
+
+    async def kernel():
+        request = await loop.sock_recv(kernels, 4096)
+        assert request[4] == conntrack.IPCTNL_MSG_CT_GET
+        await loop.sock_sendall(
+            kernels,
+            _flow(IPCTNL_MSG_CT_NEW, "100.64.0.2", 1) + _flow(IPCTNL_MSG_CT_NEW, "100.64.0.2", 2),
+        )
+        await asyncio.sleep(0.01)
+        # Events arriving while the read is in progress
+        _handle(tracker, _flow(IPCTNL_MSG_CT_DELETE, "100.64.0.2", 1))
+        _handle(tracker, _flow(IPCTNL_MSG_CT_NEW, "100.64.1.2", 3))
+        await loop.sock_sendall(kernels, _flow(IPCTNL_MSG_CT_NEW, "100.64.0.2", 1) + _done())
+
+    try:
+        await asyncio.wait_for(asyncio.gather(tracker._dump(), kernel()), 2)
+    finally:
+        kernels.close()
+    assert (tracker.active_flows(0), tracker.active_flows(1)) == (1, 1)
+    # Flows found by the first read may end without an event
+    assert _key(_flow(IPCTNL_MSG_CT_NEW, "100.64.0.2", 2)) in tracker._stale
+    assert _key(_flow(IPCTNL_MSG_CT_NEW, "100.64.0.2", 1)) not in tracker._stale
+
+
+def test_rates_from_interface_counters(tracker, monkeypatch):
+    counters = {"wwan0": (1000, 500)}
+    monkeypatch.setattr(conntrack, "read_counters", lambda interface: counters.get(interface))
+    egress = tracker._egress["wwan0"]
+
+    tracker._sample(egress, 10.0, 0.5)
+    assert tracker.rate(0) is None
+    counters["wwan0"] = (3000, 1500)
+    tracker._sample(egress, 12.0, 0.5)
+    assert tracker.rate(0) == pytest.approx(0.5 * 1000 + 0.5 * 500)
+    # A counter reset (modem re-enumerated) is not a negative rate
+    counters["wwan0"] = (10, 10)
+    tracker._sample(egress, 13.0, 0.5)
+    assert tracker.rate(0) == pytest.approx(750)
@@ -0,0 +1,33 @@
+import sys
+
+from proxyfarm.diagnostics import _collapse, collapsed
+
+
+def test_collapsed_format():
+    stacks = {"main (a.py:1);run (a.py:5)": 3, "main (a.py:1)": 1}
+    assert collapsed(stacks) == "main (a.py:1);run (a.py:5) 3\nmain (a.py:1) 1\n"
+
+
+def test_collapsed_empty():
+    assert collapsed({}) == ""
+
+
+def _inner():
+    return sys._getframe()
+
+
+def _outer():
+    return _inner()
+
+
+def test_collapse_labels_innermost_first():
+    labels = {}
+    stack = _collapse(_outer(), labels)
+    assert stack[0].startswith("_inner (")
+    assert stack[1].startswith("_outer (")
+    assert stack[2].startswith("test_collapse_labels_innermost_first (")
+    assert f":{_inner.__code__.co_firstlineno})" in stack[0]
+    # Labels are cached per code object
+    assert labels[_inner.__code__] == stack[0]
+    line = collapsed({";".join(reversed(stack)): 1})
+    assert line.endswith(f"{stack[1]};{stack[0]} 1\n")
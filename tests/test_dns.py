@@ -0,0 +1,210 @@
+import asyncio
+import socket
+import struct
+
+import pytest
+
+from proxyfarm.core.dns import FALLBACK, DNSResolver, build_query, parse_message
+from proxyfarm.core.state import BearerRecord, ModemRecord
+
+NXDOMAIN = 3
+SERVFAIL = 2
+
+
+def _response(
+    query: bytes,
+    addresses: tuple[str, ...] = (),
+    ttl: int = 300,
+    rcode: int = 0,
+    soa: tuple[int, int] = None,
+    tc: bool = False,
+) -> bytes:
+    """A response to ``query``; names in records point back at the question."""
+    qid, flags = struct.unpack_from("!HH", query)
+    question_end = query.index(b"\x00", 12) + 5
+    flags = 0x8000 | 0x0080 | (flags & 0x0100) | rcode | (0x0200 if tc else 0)
+    records = b""
+    for address in addresses:
+        records += struct.pack("!HHHIH", 0xC00C, 1, 1, ttl, 4) + socket.inet_aton(address)
+    authority = b""
+    if soa:
+        soa_ttl, minimum = soa
+        rdata = b"\x00\x00" + struct.pack("!5I", 1, 3600, 600, 86400, minimum)
+        authority = struct.pack("!HHHIH", 0xC00C, 6, 1, soa_ttl, len(rdata)) + rdata
+    header = struct.pack("!6H", qid, flags, 1, len(addresses), 1 if soa else 0, 0)
+    return header + query[12:question_end] + records + authority
+
+
+class Upstream:
+    """Scripted DNS servers by address, answering the resolver's queries."""
+
+    def __init__(self, resolver: DNSResolver, monkeypatch):
+        self.queries: list[tuple[str, str, str]] = []
+        self.servers: dict[str, callable] = {}
+        monkeypatch.setattr(resolver, "_query_udp", self._udp)
+        monkeypatch.setattr(resolver, "_query_tcp", self._tcp)
+
+    async def _udp(self, server, interface, query, txid):
+        self.queries.append(("udp", server, parse_message(query).key[0]))
+        await asyncio.sleep(0.01)
+        return self.servers[server](query, "udp")
+
+    async def _tcp(self, server, interface, query):
+        self.queries.append(("tcp", server, parse_message(query).key[0]))
+        return self.servers[server](query, "tcp")
+
+
+@pytest.fixture
+def resolver():
+    return DNSResolver()
+
+
+@pytest.fixture
+def upstream(resolver, monkeypatch, config):
+    config.dns.fallback_servers = ["10.0.0.1", "10.0.0.2"]
+    upstream = Upstream(resolver, monkeypatch)
+    upstream.servers["10.0.0.1"] = lambda query, _: _response(query, ("93.184.216.34",))
+    upstream.servers["10.0.0.2"] = lambda query, _: _response(query, ("93.184.216.35",))
+    return upstream
+
+
+def test_parse_query_and_response():
+    query = build_query("Example.COM")
+    message = parse_message(query)
+    assert message.key == ("example.com", 1, 1)
+    assert message.flags & 0x0100
+
+    response = parse_message(_response(query, ("1.2.3.4", "5.6.7.8"), ttl=60))
+    assert response.addresses == ["1.2.3.4", "5.6.7.8"]
+    assert response.answer_ttl == 60
+    assert len(response.ttl_offsets) == 2
+
+    negative = parse_message(_response(query, rcode=NXDOMAIN, soa=(900, 120)))
+    assert (negative.rcode, negative.negative_ttl, negative.addresses) == (NXDOMAIN, 120, [])
+
+
+@pytest.mark.parametrize("cut", [5, 14, 30, -3])
+def test_parse_truncated(cut):
+    data = _response(build_query("example.com"), ("1.2.3.4",))[:cut]
+    with pytest.raises((ValueError, IndexError, struct.error)):
+        parse_message(data)
+
+
+def test_parse_compression_loop():
+    data = struct.pack("!6H", 1, 0, 1, 0, 0, 0) + b"\xc0\x0c"
+    with pytest.raises(ValueError):
+        parse_message(data)
+
+
+async def test_answers_are_cached_with_aging_ttls(resolver, upstream):
+    assert await resolver.lookup("example.com", FALLBACK) == ["93.184.216.34"]
+    query = build_query("example.com")
+    resolver._caches[FALLBACK][("example.com", 1, 1)].stored_at -= 100
+
+    response = parse_message(await resolver.resolve(query, FALLBACK))
+    assert response.id == parse_message(query).id
+    assert response.answer_ttl == 200
+    assert len(upstream.queries) == 1
+    stats = resolver.stats()
+    assert (stats.queries, stats.hit_rate) == (2, 0.5)
+
+
+async def test_negative_answers_are_cached(resolver, upstream, config):
+    config.dns.negative_ttl = 60
+    upstream.servers["10.0.0.1"] = lambda q, _: _response(q, rcode=NXDOMAIN, soa=(900, 300))
+    for _ in range(3):
+        assert await resolver.lookup("nx.example", FALLBACK) == []
+    assert len(upstream.queries) == 1
+    assert resolver._caches[FALLBACK][("nx.example", 1, 1)].ttl == 60
+
+
+async def test_concurrent_queries_share_one_upstream_query(resolver, upstream):
+    results = await asyncio.gather(*(resolver.lookup("example.com", FALLBACK) for _ in range(5)))
+    assert results == [["93.184.216.34"]] * 5
+    assert len(upstream.queries) == 1
+
+
+async def test_truncated_reply_fails_over_to_the_next_server(resolver, upstream):
+    upstream.servers["10.0.0.1"] = lambda q, _: _response(q, ("1.2.3.4",))[:20]
+    assert await resolver.lookup("example.com", FALLBACK) == ["93.184.216.35"]
+    assert [server for _, server, _ in upstream.queries] == ["10.0.0.1", "10.0.0.2"]
+
+
+async def test_mismatched_question_fails_over(resolver, upstream):
+    upstream.servers["10.0.0.1"] = lambda q, _: _response(build_query("other.example"))
+    assert await resolver.lookup("example.com", FALLBACK) == ["93.184.216.35"]
+
+
+async def test_tcp_retry_on_truncation(resolver, upstream):
+    def server(query, transport):
+        if transport == "udp":
+            return _response(query, tc=True)
+        return _response(query, ("9.9.9.9",))
+
+    upstream.servers["10.0.0.1"] = server
+    assert await resolver.lookup("big.example", FALLBACK) == ["9.9.9.9"]
+    assert [t for t, _, _ in upstream.queries] == ["udp", "tcp"]
+
+
+async def test_tcp_reply_cut_short_fails_over(resolver, upstream):
+    def server(query, transport):
+        if transport == "udp":
+            return _response(query, tc=True)
+        raise asyncio.IncompleteReadError(b"\x00", 2)
+
+    upstream.servers["10.0.0.1"] = server
+    assert await resolver.lookup("big.example", FALLBACK) == ["93.184.216.35"]
+
+
+async def test_every_server_failing_is_servfail(resolver, upstream):
+    upstream.servers["10.0.0.1"] = lambda q, _: _response(q, ("1.2.3.4",))[:-2]
+    upstream.servers["10.0.0.2"] = lambda q, _: q[:2]
+
+    response = parse_message(await resolver.resolve(build_query("example.com"), FALLBACK))
+    assert response.rcode == SERVFAIL
+    assert await resolver.lookup("example.com", FALLBACK) == []
+    assert resolver.stats().upstreams[0].errors == 2
+    assert FALLBACK not in resolver._caches
+
+
+async def test_listener_truncates_large_udp_answers(resolver, upstream):
+    many = tuple(f"10.1.{i // 256}.{i % 256}" for i in range(60))
+    upstream.servers["10.0.0.1"] = lambda q, _: _response(q, many)
+    query = build_query("many.example")
+
+    udp = parse_message(await resolver.handle(query, udp=True))
+    assert udp.flags & 0x0200 and udp.answers == 0
+    assert len(parse_message(await resolver.handle(query)).addresses) == 60
+    # Responses and garbage are not answered
+    assert await resolver.handle(_response(query)) is None
+    assert await resolver.handle(b"\x00\x01") is None
+
+
+def _modem(modem_id: int, dns: list[str]) -> ModemRecord:
+    return ModemRecord(
+        id=modem_id,
+        interface=f"wwan{modem_id}",
+        ip_address=f"100.64.{modem_id}.2",
+        bearer=BearerRecord(id=modem_id, dns=dns),
+    )
+
+
+async def test_per_modem_caches_and_primary(resolver, upstream):
+    upstream.servers["10.200.0.1"] = lambda q, _: _response(q, ("1.1.1.1",))
+    upstream.servers["10.200.1.1"] = lambda q, _: _response(q, ("2.2.2.2",))
+    modems = [_modem(0, ["10.200.0.1"]), _modem(1, ["10.200.1.1"])]
+    resolver.update_modems(modems, {0: 3, 1: 7})
+
+    assert await resolver.lookup("example.com", 0) == ["1.1.1.1"]
+    assert await resolver.lookup("example.com", 1) == ["2.2.2.2"]
+    # Listener queries go through the heaviest modem, and stay there
+    assert await resolver.lookup("example.com") == ["2.2.2.2"]
+    resolver.update_modems(modems, {0: 9, 1: 7})
+    assert resolver._pick() == 1
+
+    # A modem gone (or out of the route) loses its cache and its primary role
+    resolver.update_modems(modems[:1], {0: 9})
+    assert set(resolver._caches) == {0}
+    assert resolver._pick() == 0
+    resolver.update_modems(modems[:1], {0: 0})
+    assert resolver._pick() is FALLBACK
@@ -0,0 +1,113 @@
+import pytest
+
+from proxyfarm.config import SimulationConfig
+from proxyfarm.core import modem as modem_module
+from proxyfarm.core import sim
+from proxyfarm.core.egress import EgressBalancer
+from proxyfarm.core.network import network_manager
+from proxyfarm.core.state import BearerRecord, ModemRecord
+from proxyfarm.schemas import ModemState
+
+
+def _modem(modem_id: int, connected: bool = True) -> ModemRecord:
+    return ModemRecord(
+        id=modem_id,
+        state=ModemState.CONNECTED if connected else ModemState.REGISTERED,
+        interface=f"wwan{modem_id}",
+        bearer=BearerRecord(id=modem_id, gateway=f"100.64.{modem_id}.1"),
+    )
+
+
+@pytest.fixture
+def backend(config):
+    config.egress.enabled = True
+    try:
+        yield sim.install(SimulationConfig(modems=3, latency={}))
+    finally:
+        sim.uninstall()
+
+
+def test_weights():
+    balancer = EgressBalancer()
+    modems = [_modem(0), _modem(1), _modem(2), _modem(3, connected=False)]
+    balancer.set_factor(0, "quota", 0.5)
+    balancer.set_factor(0, "radio", 0.5)
+    balancer.set_factor(1, "quota", 2.0)
+    balancer.set_factor(2, "quota", 0)
+    assert balancer.weights(modems) == {0: 2, 1: 10, 2: 0}
+
+    balancer.clear_factor(2, "quota")
+    assert balancer.weights(modems)[2] == 10
+
+
+def test_never_takes_every_modem_out():
+    balancer = EgressBalancer()
+    for modem_id in (0, 1):
+        balancer.set_factor(modem_id, "quota", 0)
+    assert balancer.weights([_modem(0), _modem(1)]) == {0: 1, 1: 1}
+
+
+async def test_apply_only_on_change(backend):
+    balancer = EgressBalancer()
+    modems = [_modem(0), _modem(1)]
+    balancer.set_factor(1, "quota", 0.3)
+    assert await balancer.apply(modems)
+    assert await network_manager.get_default_multipath() == [
+        ("100.64.0.1", "wwan0", 10), ("100.64.1.1", "wwan1", 3),
+    ]
+    assert not await balancer.apply(modems)
+
+    balancer.set_factor(1, "quota", 0.5)
+    assert await balancer.refresh()
+    assert balancer.routes[1][2] == 5
+
+
+async def test_restores_a_route_replaced_outside(backend):
+    balancer = EgressBalancer()
+    modems = [_modem(0), _modem(1)]
+    balancer.set_factor(1, "quota", 0)
+    assert await balancer.apply(modems)
+
+    # The routing timer puts both modems back with equal weights
+    await modem_module.run_command([
+        "ip", "route", "replace", "default", "scope", "global",
+        "nexthop", "via", "100.64.0.1", "dev", "wwan0", "weight", "1",
+        "nexthop", "via", "100.64.1.1", "dev", "wwan1", "weight", "1",
+    ])
+    assert await balancer.apply(modems)
+    assert await network_manager.get_default_multipath() == [("100.64.0.1", "wwan0", 1)]
+
+
+async def test_single_hop_weight_is_not_compared(backend):
+    balancer = EgressBalancer()
+    assert await balancer.apply([_modem(0)])
+    # The kernel keeps no weight for a single nexthop
+    assert await network_manager.get_default_multipath() == [("100.64.0.1", "wwan0", 1)]
+    assert not await balancer.apply([_modem(0)])
+
+
+async def test_disabled(backend, config):
+    config.egress.enabled = False
+    assert not await EgressBalancer().apply([_modem(0)])
+    assert backend.default_route == []
+
+
+async def test_default_route_parsing(monkeypatch):
+    output = (
+        "default via 192.168.50.1 dev wlan0 metric 1000\n"
+        "default proto static\n"
+        "\tnexthop via 100.64.1.1 dev wwan1 weight 3\n"
+        "\tnexthop via 100.64.0.1 dev wwan0 weight 10\n"
+    )
+
+    async def ip(cmd, *args, **kwargs):
+        return output, "", 0
+
+    monkeypatch.setattr("proxyfarm.core.network.run_command", ip)
+    assert await network_manager.get_default_multipath() == [
+        ("100.64.0.1", "wwan0", 10), ("100.64.1.1", "wwan1", 3),
+    ]
+    output = "default via 192.168.50.1 dev wlan0 metric 1000\n"
+    assert await network_manager.get_default_multipath() == []
+    output = "default via 100.64.0.1 dev wwan0 proto static\n"
+    assert await network_manager.get_default_multipath() == [("100.64.0.1", "wwan0", 1)]
@@ -0,0 +1,166 @@
+import asyncio
+import io
+import json
+
+import pytest
+
+from proxyfarm.helper import CredentialCache, Helper, hash_password, pick_modem, verify_password
+
+HASH = hash_password("secret", iterations=1000)
+
+
+def _modems(*tags: list[str]) -> list[dict]:
+    return [
+        {"id": i, "interface": f"wwan{i}", "usable": True, "tags": list(t)}
+        for i, t in enumerate(tags)
+    ]
+
+
+@pytest.fixture
+def helper(tmp_path) -> Helper:
+    cache = CredentialCache()
+    cache.load({
+        "users": {
+            "alice": {"password": HASH, "groups": [], "enabled": True},
+            "bob": {"password": HASH, "groups": ["premium"], "enabled": True},
+            "carol": {"password": HASH, "groups": [], "enabled": False},
+            "dave": {"password": "pbkdf2_sha256$1000$zz$00", "groups": [], "enabled": True},
+        },
+        "modems": _modems([], ["premium"]),
+        "classes": {"alice": 0x11},
+    })
+    helper = Helper(cache, str(tmp_path / "helper.sock"), str(tmp_path / "state.json"))
+    helper.out = io.StringIO()
+    return helper
+
+
+async def _answers(helper: Helper, *lines: str) -> list[str]:
+    for line in lines:
+        helper.handle(line)
+    await asyncio.gather(*helper._lookups)
+    return helper.out.getvalue().splitlines()
+
+
+@pytest.mark.parametrize("encoded", [
+    "", "md5$1$00$00", "pbkdf2_sha256$x$00$00", "pbkdf2_sha256$1000$zz$00",
+    "pbkdf2_sha256$-1$00$00", "pbkdf2_sha256$1000$00",
+])
+def test_malformed_hashes_match_nothing(encoded):
+    assert verify_password("secret", HASH)
+    assert not verify_password("wrong", HASH)
+    assert not verify_password("secret", encoded)
+
+
+def test_pick_modem_by_group_and_stable():
+    modems = _modems([], ["premium"], ["premium"])
+    chosen = pick_modem("bob", ["premium"], modems)
+    assert chosen["id"] in (1, 2)
+    assert all(pick_modem("bob", ["premium"], modems) is chosen for _ in range(5))
+
+    # Only the users of a modem that goes away move
+    others = [m for m in modems if m is not chosen]
+    chosen["usable"] = False
+    assert pick_modem("bob", ["premium"], modems) in others
+    assert pick_modem("bob", ["nobody"], modems) is None
+
+
+async def test_replies_keep_their_channel(helper):
+    answers = await _answers(
+        helper, "0 alice secret", "1 bob secret", "2 alice wrong", "3 carol secret",
+        "4 eve secret",
+    )
+    alice_modem = pick_modem("alice", [], helper.cache.modems)["interface"]
+    assert sorted(answers) == [
+        f"0 OK tag={alice_modem} shape_=11",
+        "1 OK tag=wwan1",
+        '2 ERR message="Invalid credentials"',
+        '3 ERR message="Invalid credentials"',
+        '4 ERR message="Invalid credentials"',
+    ]
+
+
+async def test_verified_logins_are_cached(helper):
+    await _answers(helper, "0 alice secret")
+    helper.handle("1 alice secret")
+    # Answered right away, no PBKDF2 lookup
+    assert not helper._lookups
+    assert helper.out.getvalue().splitlines()[1].startswith("1 OK")
+    # A changed hash drops the cached login
+    helper.cache.load({**_state(helper), "users": {
+        "alice": {"password": hash_password("new", 1000), "groups": []},
+    }})
+    assert helper.cache.cached("alice", "secret") is None
+
+
+def _state(helper: Helper) -> dict:
+    return {"users": helper.cache.users, "modems": helper.cache.modems}
+
+
+async def test_malformed_requests(helper):
+    answers = await _answers(helper, "alice", "0 alice secret extra")
+    assert answers == ['BH message="Malformed request"'] * 2
+
+
+async def test_without_channel_ids(helper):
+    assert await _answers(helper, "bob%40x secret") == ['ERR message="Invalid credentials"']
+
+
+async def test_malformed_hash_is_answered(helper):
+    assert await _answers(helper, "7 dave secret") == ['7 ERR message="Invalid credentials"']
+
+
+async def test_user_removed_during_lookup_is_answered(helper):
+    helper.handle("5 alice secret")
+    helper.cache.load({"users": {}, "modems": helper.cache.modems})
+    await asyncio.gather(*helper._lookups)
+    assert helper.out.getvalue() == '5 ERR message="Invalid credentials"\n'
+
+
+async def test_broken_state_is_answered(helper):
+    helper.cache.modems = [{"id": 0}]
+    helper.cache.users["alice"]["password"] = HASH
+    answers = await _answers(helper, "1 alice secret", "2 bob secret")
+    assert sorted(answers) == [
+        '1 BH message="Lookup failed: KeyError"', '2 BH message="Lookup failed: KeyError"'
+    ]
+    # Synchronous answers too
+    helper.cache.users["erin"] = {"enabled": True}
+    assert (await _answers(helper, "3 erin x"))[-1] == '3 BH message="Lookup failed: KeyError"'
+
+
+async def test_feed_and_state_file(helper):
+    state = {"users": {"zed": {"password": HASH, "groups": []}}, "modems": _modems([])}
+    with open(helper.state_path, "w") as f:
+        json.dump(state, f)
+    helper.load_state_file()
+    assert set(helper.cache.users) == {"zed"}
+
+    async def push(reader, writer):
+        writer.write(json.dumps({**state, "users": {}}).encode() + b"\n")
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_unix_server(push, path=helper.socket_path)
+    feed = asyncio.create_task(helper.follow_feed())
+    try:
+        for _ in range(100):
+            if not helper.cache.users:
+                break
+            await asyncio.sleep(0.01)
+        assert helper.cache.users == {}
+    finally:
+        feed.cancel()
+        server.close()
+
+
+async def test_in_process_logins_with_a_malformed_hash():
+    from proxyfarm.core.proxyauth import ProxyAuth
+
+    auth = ProxyAuth()
+    auth._credentials.load({"users": {
+        "alice": {"password": HASH, "groups": []},
+        "dave": {"password": "pbkdf2_sha256$1000$zz$00", "groups": []},
+    }})
+    assert await auth.authenticate("alice", "secret")
+    assert not await auth.authenticate("dave", "secret")
+    assert not await auth.authenticate("eve", "secret")
@@ -0,0 +1,81 @@
+import pytest
+
+from proxyfarm.core import sim
+from proxyfarm.core.modem import modem_manager, set_command_backend
+from proxyfarm.core.recovery import recovery_manager
+from proxyfarm.services.monitor import monitor_service
+
+
+@pytest.fixture
+def settings(settings):
+    # Only the API runs commands
+    return {**settings, "monitor": {"enabled": False}}
+
+
+@pytest.fixture
+def commands(client):
+    """The mmcli commands run from now on."""
+    backend = sim.simulated_backend
+    seen: list[str] = []
+
+    async def record(cmd):
+        if cmd[0] == "mmcli":
+            seen.append(" ".join(cmd[1:]))
+        return await backend(cmd)
+
+    set_command_backend(record)
+    yield seen
+    set_command_backend(backend)
+
+
+def test_full_listing(client, commands):
+    modems = client.get("/api/v1/modems").json()["modems"]
+    assert [modem["id"] for modem in modems] == [0, 1, 2]
+    assert modems[0]["interface"] == "wwan0"
+    assert modems[0]["bearer"]["gateway"]
+    assert commands == ["-L", "-m 0", "-b 0", "-m 1", "-b 1", "-m 2", "-b 2"]
+
+
+def test_fields_skip_the_bearer_query(client, commands):
+    response = client.get("/api/v1/modems", params={"fields": "state,signal_quality"})
+    modems = response.json()["modems"]
+    assert modems[1].keys() == {"id", "state", "signal_quality"}
+    assert modems[1]["state"] == "connected"
+    assert commands == ["-L", "-m 0", "-m 1", "-m 2"]
+
+    commands.clear()
+    modems = client.get("/api/v1/modems", params={"fields": "ip_address"}).json()["modems"]
+    assert set(modems[0]) == {"id", "ip_address"}
+    assert "-b 0" in commands
+
+
+def test_ids_skip_the_listing(client, commands):
+    modems = client.get("/api/v1/modems", params={"ids": "2, 0", "fields": "id"}).json()
+    assert modems["modems"] == [{"id": 2}, {"id": 0}]
+    assert commands == ["-m 2", "-m 0"]
+
+
+def test_lite_runs_no_commands(client, commands, monkeypatch):
+    full = client.get("/api/v1/modems", params={"fields": "id,device_id"}).json()["modems"]
+    records = client.portal.call(modem_manager.get_modems, [0, 1, 2], None)
+    monkeypatch.setattr(monitor_service, "inventory", {modem.id: modem for modem in records})
+    commands.clear()
+
+    lite = client.get(
+        "/api/v1/modems", params={"lite": "true", "fields": "id,device_id", "ids": "0,1"}
+    ).json()["modems"]
+    assert lite == full[:2]
+    assert commands == []
+
+
+def test_quarantined_modems_are_left_out(client, commands, monkeypatch):
+    monkeypatch.setattr(recovery_manager, "quarantined", lambda: {1})
+    modems = client.get("/api/v1/modems", params={"fields": "id"}).json()["modems"]
+    assert modems == [{"id": 0}, {"id": 2}]
+    assert "-m 1" not in commands
+
+
+@pytest.mark.parametrize("params", [{"fields": "id,nonsense"}, {"ids": "1,x"}])
+def test_bad_parameters(client, params):
+    response = client.get("/api/v1/modems", params=params)
+    assert response.status_code == 422
@@ -0,0 +1,163 @@
+from datetime import date
+
+import pytest
+
+from proxyfarm.config import QuotaLimit
+from proxyfarm.core import quota
+from proxyfarm.core.egress import EgressBalancer
+from proxyfarm.core.quota import QuotaTracker, counter_delta, period_start
+from proxyfarm.core.state import ModemRecord
+
+
+def test_counter_increase():
+    assert counter_delta(1000, 1500, bits=64) == 500
+    assert counter_delta(1000, 1000, bits=32) == 0
+
+
+def test_counter_reset_64bit():
+    # Interface recreated: the counter restarted from zero
+    assert counter_delta(2**40, 300, bits=64) == 300
+    # Even from where a 32-bit counter would wrap
+    assert counter_delta(2**32 - 100, 50, bits=64) == 50
+
+
+def test_counter_wrap_32bit():
+    assert counter_delta(2**32 - 100, 50, bits=32) == 150
+
+
+def test_counter_reset_32bit_lower_half():
+    # A decrease from the lower half is a restart, not a wrap
+    assert counter_delta(2**20, 300, bits=32) == 300
+
+
+def test_period_start():
+    assert period_start(15, date(2026, 3, 20)) == date(2026, 3, 15)
+    assert period_start(15, date(2026, 3, 15)) == date(2026, 3, 15)
+    assert period_start(15, date(2026, 3, 2)) == date(2026, 2, 15)
+    assert period_start(28, date(2026, 1, 5)) == date(2025, 12, 28)
+
+
+class Sysfs:
+    """Interface byte counters under a fake /sys/class/net."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def set(self, interface: str, rx: int, tx: int) -> None:
+        stats = self.root / interface / "statistics"
+        stats.mkdir(parents=True, exist_ok=True)
+        (stats / "rx_bytes").write_text(f"{rx}\n")
+        (stats / "tx_bytes").write_text(f"{tx}\n")
+
+
+@pytest.fixture
+def sysfs(config, tmp_path):
+    config.quota.sysfs_root = str(tmp_path)
+    return Sysfs(tmp_path)
+
+
+@pytest.fixture
+def balancer(monkeypatch):
+    balancer = EgressBalancer()
+    monkeypatch.setattr(quota, "egress_balancer", balancer)
+    return balancer
+
+
+def _modem(modem_id: int, interface: str, device_id: str = "dev-a") -> ModemRecord:
+    return ModemRecord(id=modem_id, device_id=device_id, interface=interface)
+
+
+def test_usage_accumulates_from_a_baseline(sysfs, balancer):
+    tracker = QuotaTracker()
+    sysfs.set("wwan0", 5000, 1000)
+    tracker.sample([_modem(0, "wwan0")])
+    # Traffic before the first sample is not attributed
+    assert tracker.status()[0].used_bytes == 0
+
+    sysfs.set("wwan0", 8000, 1500)
+    tracker.sample([_modem(0, "wwan0")])
+    status = tracker.status()[0]
+    assert (status.modem_id, status.device_id, status.used_bytes) == (0, "dev-a", 3500)
+    assert tracker.rate(0) is not None
+
+
+def test_usage_follows_the_device_across_modem_ids(sysfs, balancer):
+    tracker = QuotaTracker()
+    sysfs.set("wwan0", 0, 0)
+    sysfs.set("wwan1", 0, 0)
+    tracker.sample([_modem(0, "wwan0", "dev-a"), _modem(1, "wwan1", "dev-b")])
+    sysfs.set("wwan0", 1000, 0)
+    sysfs.set("wwan1", 50, 0)
+    tracker.sample([_modem(0, "wwan0", "dev-a"), _modem(1, "wwan1", "dev-b")])
+
+    # Re-enumerated: the modem IDs swapped, the interfaces stayed
+    sysfs.set("wwan0", 1200, 0)
+    sysfs.set("wwan1", 60, 0)
+    tracker.sample([_modem(1, "wwan0", "dev-a"), _modem(0, "wwan1", "dev-b")])
+    usage = {s.device_id: (s.modem_id, s.used_bytes) for s in tracker.status()}
+    assert usage == {"dev-a": (1, 1200), "dev-b": (0, 60)}
+
+
+def test_new_interface_takes_a_new_baseline(sysfs, balancer):
+    tracker = QuotaTracker()
+    sysfs.set("wwan0", 100, 0)
+    tracker.sample([_modem(0, "wwan0")])
+    sysfs.set("wwan0", 600, 0)
+    tracker.sample([_modem(0, "wwan0")])
+    # Same device on another interface: its counter is not the old one
+    sysfs.set("wwan3", 90000, 0)
+    tracker.sample([_modem(0, "wwan3")])
+    sysfs.set("wwan3", 90100, 0)
+    tracker.sample([_modem(0, "wwan3")])
+    assert tracker.status()[0].used_bytes == 600
+
+
+def test_new_billing_period_resets_usage(sysfs, balancer, monkeypatch):
+    tracker = QuotaTracker()
+    sysfs.set("wwan0", 0, 0)
+    tracker.sample([_modem(0, "wwan0")])
+    sysfs.set("wwan0", 1000, 0)
+    tracker.sample([_modem(0, "wwan0")])
+
+    monkeypatch.setattr(quota, "period_start", lambda day, today=None: date(2099, 1, 1))
+    sysfs.set("wwan0", 1300, 0)
+    tracker.sample([_modem(0, "wwan0")])
+    status = tracker.status()[0]
+    assert (str(status.period_start), status.used_bytes) == ("2099-01-01", 300)
+
+
+def test_limits_steer_egress(sysfs, balancer, config):
+    config.quota.modems = {
+        "dev-a": QuotaLimit(limit_gb=1e-6),  # 1000 bytes, by device ID
+        1: QuotaLimit(limit_gb=1e-6),  # by modem ID
+    }
+    tracker = QuotaTracker()
+    modems = [_modem(0, "wwan0", "dev-a"), _modem(1, "wwan1", "dev-b"), _modem(2, "wwan2", "c")]
+    for interface in ("wwan0", "wwan1", "wwan2"):
+        sysfs.set(interface, 0, 0)
+    tracker.sample(modems)
+
+    sysfs.set("wwan0", 890, 0)  # halfway between the thresholds
+    sysfs.set("wwan1", 990, 0)  # past the hard threshold
+    sysfs.set("wwan2", 10**9, 0)  # no limit
+    tracker.sample(modems)
+
+    assert balancer.factors(0)["quota"] == pytest.approx(0.5)
+    assert balancer.factors(1)["quota"] == 0
+    assert "quota" not in balancer.factors(2)
+    ratios = {s.modem_id: s.usage_ratio for s in tracker.status()}
+    assert ratios == {0: pytest.approx(0.89), 1: pytest.approx(0.99), 2: None}
+
+
+def test_missing_counters_are_skipped(sysfs, balancer):
+    tracker = QuotaTracker()
+    tracker.sample([_modem(0, "wwan9"), ModemRecord(id=1)])
+    assert tracker.status() == []
+
+
+def test_disabled(sysfs, balancer, config):
+    config.quota.enabled = False
+    sysfs.set("wwan0", 0, 0)
+    tracker = QuotaTracker()
+    tracker.sample([_modem(0, "wwan0")])
+    assert tracker.status() == []
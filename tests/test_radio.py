@@ -0,0 +1,135 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from proxyfarm.config import SimulationConfig
+from proxyfarm.core import radio, sim
+from proxyfarm.core.egress import egress_balancer
+from proxyfarm.core.modem import modem_manager
+from proxyfarm.core.proxyauth import proxy_auth
+from proxyfarm.core.radio import RadioOptimizer, score
+from proxyfarm.core.rotation import ip_rotator
+from proxyfarm.core.speedtest import speed_tester
+from proxyfarm.core.state import device_key
+
+
+@pytest.fixture
+def farm(config, monkeypatch):
+    monkeypatch.setattr(radio, "_POLL_INTERVAL", 0.01)
+    config.radio.settle_timeout = 2.0
+    backend = sim.install(SimulationConfig(modems=2, seed=3, latency={}))
+    yield backend
+    sim.uninstall()
+
+
+@pytest.fixture
+def optimizer(farm, monkeypatch) -> RadioOptimizer:
+    optimizer = RadioOptimizer()
+    # Rotation asks the global optimizer whether a run is going on
+    monkeypatch.setattr(radio, "radio_optimizer", optimizer)
+    return optimizer
+
+
+def test_score():
+    assert score(None, 50.0) is None
+    assert score(0.0, 50.0) is None
+    assert score(40.0, 80.0) == 40.0
+    assert score(40.0, 200.0) == 20.0
+
+
+@pytest.mark.parametrize("start, end, inside, outside", [
+    (3, 6, [3, 5], [2, 6]),
+    (22, 4, [23, 0, 3], [4, 21]),
+    (5, 5, [0, 12], []),
+])
+def test_window(config, start, end, inside, outside):
+    config.radio.window_start, config.radio.window_end = start, end
+    optimizer = RadioOptimizer()
+    assert all(optimizer.in_window(datetime(2026, 1, 1, hour)) for hour in inside)
+    assert not any(optimizer.in_window(datetime(2026, 1, 1, hour)) for hour in outside)
+
+
+async def test_candidates(optimizer, config):
+    info = await modem_manager.get_radio(0)
+    config.radio.modes = ["4g"]
+    modes = optimizer.mode_candidates(info)
+    assert [m.modes.allowed for m in modes] == [["4g"]]
+
+    config.radio.bands = ["eutran-3", "eutran-7"]
+    bands = optimizer.band_candidates(info, modes[0].modes)
+    assert [settings.bands for settings in bands] == [["eutran-3"], ["eutran-7"]]
+    # Fewer than two bands: nothing to lock to
+    config.radio.bands = ["eutran-3"]
+    assert optimizer.band_candidates(info, modes[0].modes) == []
+
+
+async def test_run_drains_the_modem_and_keeps_a_profile(optimizer, config, monkeypatch):
+    config.radio.max_trials = 4
+    seen = []
+    measure = speed_tester.run
+
+    async def run(modem, keep=True):
+        # While settings change the modem takes no logins and no traffic
+        seen.append((egress_balancer.factor(modem.id), modem.id in proxy_auth._draining))
+        return await measure(modem, keep)
+
+    monkeypatch.setattr(speed_tester, "run", run)
+    run_, started = optimizer.start(0)
+    assert started and optimizer.start(0) == (run_, False)
+    finished = await optimizer.wait(0)
+
+    assert finished.status == "completed", finished.error
+    assert 1 <= len(finished.trials) <= 4
+    assert seen and all(entry == (0.0, True) for entry in seen)
+    assert egress_balancer.factors(0).get("radio") is None
+    assert 0 not in proxy_auth._draining
+    # Trials stay out of the speed test history
+    assert speed_tester.history(0) == []
+
+    modem = await modem_manager.get_modem(0)
+    profile = optimizer.profile(modem, finished.location)
+    assert profile.settings == finished.applied
+    assert device_key(modem) in optimizer._profiles
+    assert optimizer._pending == {}
+    assert radio._same((await modem_manager.get_radio(0)).current, finished.applied)
+
+
+async def test_rotation_waits_out_a_run(optimizer, monkeypatch):
+    release = asyncio.Event()
+    measure = speed_tester.run
+
+    async def run(modem, keep=True):
+        await release.wait()
+        return await measure(modem, keep)
+
+    monkeypatch.setattr(speed_tester, "run", run)
+    optimizer.start(1)
+    await asyncio.sleep(0.05)
+    assert optimizer.busy(1)
+
+    result = await ip_rotator.rotate(1)
+    assert (result.success, result.error) == (False, "Radio tuning in progress")
+    release.set()
+    await optimizer.wait(1)
+    assert not optimizer.busy(1)
+
+
+async def test_interrupted_run_is_rolled_back(optimizer, farm):
+    info = await modem_manager.get_radio(0)
+    original = info.current
+    modem = await modem_manager.get_modem(0)
+    trial = next(
+        settings for settings in optimizer.mode_candidates(info)
+        if not radio._same(settings, original)
+    )
+    assert await optimizer._apply(0, trial) is not None
+    assert radio._same((await modem_manager.get_radio(0)).current, trial)
+
+    # As loaded after a restart in the middle of that trial
+    optimizer._pending = {device_key(modem): original}
+    optimizer.schedule([modem])
+    await asyncio.gather(*optimizer._background)
+
+    assert optimizer._pending == {}
+    assert radio._same((await modem_manager.get_radio(0)).current, original)
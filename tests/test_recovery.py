@@ -0,0 +1,198 @@
+import asyncio
+import time
+
+import pytest
+
+from proxyfarm.core import recovery
+from proxyfarm.core.egress import EgressBalancer
+from proxyfarm.core.recovery import RecoveryManager
+from proxyfarm.core.rotation import ip_rotator
+
+
+class Actions:
+    """Recovery actions that record their calls and fail unless told not to."""
+
+    def __init__(self):
+        self.calls: list[str] = []
+        self.succeed = False
+        self.gate: asyncio.Event = asyncio.Event()
+        self.gate.set()
+
+    def __call__(self, name: str):
+        async def action(modem_id: int) -> bool:
+            await self.gate.wait()
+            self.calls.append(name)
+            return self.succeed
+
+        return action
+
+
+@pytest.fixture
+def balancer(monkeypatch):
+    balancer = EgressBalancer()
+    monkeypatch.setattr(recovery, "egress_balancer", balancer)
+    return balancer
+
+
+@pytest.fixture
+def actions():
+    return Actions()
+
+
+@pytest.fixture
+def manager(config, balancer, actions):
+    config.recovery.actions = ["reconnect", "bearer_reset"]
+    config.recovery.attempts_per_action = 2
+    config.recovery.backoff_base = 0
+    config.recovery.open_duration = 100
+    manager = RecoveryManager()
+    manager._actions = {name: actions(name) for name in ("reconnect", "bearer_reset")}
+    return manager
+
+
+async def _fail(manager: RecoveryManager, modem_id: int = 1) -> None:
+    """Report a failed check and let any action it started finish."""
+    manager.report(modem_id, False, "no connectivity")
+    task = manager._tasks.get(modem_id)
+    if task:
+        await task
+
+
+async def test_ladder_escalates_then_opens(manager, actions, balancer):
+    for _ in range(4):
+        await _fail(manager)
+    assert actions.calls == ["reconnect", "reconnect", "bearer_reset", "bearer_reset"]
+    assert manager.quarantined() == set()
+
+    await _fail(manager)
+    assert manager.quarantined() == {1}
+    assert balancer.factors(1) == {"recovery": 0.0}
+    status = manager.status().modems[0]
+    assert (status.breaker, status.attempts, status.next_action) == ("open", 4, None)
+
+    # Nothing runs while quarantined
+    await _fail(manager)
+    assert len(actions.calls) == 4
+
+
+async def test_recovery_resets_the_ladder(manager, actions, balancer):
+    await _fail(manager)
+    await _fail(manager)
+    await _fail(manager)
+    manager.report(1, True)
+
+    status = manager.status()
+    assert status.modems[0].breaker == "closed"
+    assert status.modems[0].next_action == "reconnect"
+    stats = {s.action: s for s in status.actions}
+    assert stats["bearer_reset"].recoveries == 1
+    assert stats["reconnect"].failures == 2
+    assert stats["reconnect"].recoveries == 0
+    assert stats["bearer_reset"].mean_time_to_recovery is not None
+
+
+async def test_half_open_probe(manager, actions, balancer):
+    for _ in range(5):
+        await _fail(manager)
+    state = manager._modems[1]
+    first_open = state.open_until - time.time()
+
+    # Probe due: one try of the mildest action
+    state.open_until = time.time() - 1
+    assert manager.status().modems[0].breaker == "half_open"
+    await _fail(manager)
+    assert actions.calls[-1] == "reconnect"
+
+    # Still failing afterwards: open again, for twice as long
+    await _fail(manager)
+    assert manager.quarantined() == {1}
+    assert state.open_until - time.time() == pytest.approx(2 * first_open, abs=1)
+
+    state.open_until = time.time() - 1
+    actions.succeed = True
+    await _fail(manager)
+    manager.report(1, True)
+    assert manager.quarantined() == set()
+    assert balancer.factors(1) == {}
+
+
+async def test_backoff_between_attempts(manager, actions, config):
+    config.recovery.backoff_base = 60
+    await _fail(manager)
+    await _fail(manager)
+    assert actions.calls == ["reconnect"]
+    assert manager.status().modems[0].next_attempt_at is not None
+
+
+async def test_one_action_at_a_time(manager, actions):
+    actions.gate.clear()
+    manager.report(1, False)
+    manager.report(1, False)
+    assert len(manager._tasks) == 1
+    actions.gate.set()
+    await manager._tasks[1]
+    assert actions.calls == ["reconnect"]
+
+
+async def test_disabled(manager, actions, config):
+    config.recovery.enabled = False
+    await _fail(manager)
+    config.recovery.enabled = True
+    config.monitor.auto_reconnect = False
+    await _fail(manager)
+    assert actions.calls == []
+    # Still tracked, so the incident shows up
+    assert manager.status().modems[0].incident_started is not None
+
+
+async def test_reset(manager, balancer):
+    for _ in range(5):
+        await _fail(manager)
+    assert manager.reset(1)
+    assert manager.quarantined() == set()
+    assert balancer.factors(1) == {}
+    assert not manager.reset(7)
+
+
+async def test_actions_hold_the_rotation_lock(manager, actions):
+    async with ip_rotator.lock(1):
+        manager.report(1, False)
+        await asyncio.sleep(0.01)
+        # Waiting for the operator's rotation to finish
+        assert actions.calls == []
+        assert 1 in manager._tasks
+    await manager._tasks[1]
+    assert actions.calls == ["reconnect"]
+
+    # And a rotation waits for a running action
+    actions.gate.clear()
+    manager.report(1, False)
+    await asyncio.sleep(0)
+    assert ip_rotator.lock(1).locked()
+    actions.gate.set()
+    await manager._tasks[1]
+    assert not ip_rotator.lock(1).locked()
+
+
+async def test_prune(manager, balancer):
+    for _ in range(5):
+        await _fail(manager)
+    manager.prune([2])
+    assert manager.status().modems == []
+    assert balancer.factors(1) == {}
+
+
+def test_quarantined_modem_is_kept_out_of_the_api(client):
+    from proxyfarm.core.recovery import ModemRecovery, recovery_manager
+
+    recovery_manager._modems[1] = ModemRecovery(
+        modem_id=1, breaker="open", open_until=time.time() + 100
+    )
+    try:
+        assert client.get("/api/v1/modems/1").status_code == 503
+        assert client.post("/api/v1/modems/1/rotate").status_code == 503
+        listed = client.get("/api/v1/modems").json()
+        assert [m["id"] for m in listed["modems"]] == [0, 2]
+        assert client.get("/api/v1/modems/0").status_code == 200
+    finally:
+        recovery_manager.reset(1)
@@ -0,0 +1,74 @@
+import pytest
+import yaml
+
+from proxyfarm.config import APIConfig, Config, get_config, set_config
+from proxyfarm.reload import ConfigReloader, ReloadError, _changed_fields, _hold_restart_settings
+
+
+def test_changed_fields():
+    old = APIConfig()
+    new = APIConfig(port=old.port + 1, api_key="secret")
+    assert _changed_fields(old, new) == {"port", "api_key"}
+    assert _changed_fields(old, APIConfig()) == set()
+
+
+def test_hold_restart_settings():
+    old = Config()
+    new = Config(
+        api={"port": old.api.port + 1, "api_key": "secret"},
+        simulation={"enabled": not old.simulation.enabled},
+    )
+    changed = {
+        "api": _changed_fields(old.api, new.api),
+        "simulation": _changed_fields(old.simulation, new.simulation),
+    }
+    _hold_restart_settings(old, new, changed)
+    # Restart-only fields and whole restart-only sections keep running values
+    assert new.api.port == old.api.port
+    assert new.simulation == old.simulation
+    assert new.api.api_key == "secret"
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    path = tmp_path / "config.yaml"
+    path.write_text("{}\n")
+    set_config(Config(), path)
+    return path
+
+
+async def test_reload_applies_changes(config_file):
+    port = get_config().api.port
+    config_file.write_text(yaml.safe_dump({"api": {"port": port + 1, "api_key": "secret"}}))
+
+    result = await ConfigReloader().reload("test")
+
+    assert result.changed == ["api"]
+    assert result.restart_required == ["api"]
+    assert get_config().api.api_key == "secret"
+    assert get_config().api.port == port
+
+
+@pytest.mark.parametrize(
+    "content",
+    ["api: [unclosed\n", "api:\n  port: not-a-number\n", "unknown_section: {}\nquota: 5\n"],
+)
+async def test_reload_rejects_invalid_config(config_file, content):
+    running = get_config()
+    config_file.write_text(content)
+    reloader = ConfigReloader()
+
+    with pytest.raises(ReloadError):
+        await reloader.reload("test")
+
+    assert get_config() is running
+    assert reloader.failures == 1
+    assert reloader.last_error.startswith(str(config_file))
+
+
+async def test_reload_missing_file(config_file):
+    running = get_config()
+    config_file.unlink()
+    with pytest.raises(ReloadError):
+        await ConfigReloader().reload("test")
+    assert get_config() is running
@@ -0,0 +1,137 @@
+from types import SimpleNamespace
+
+import pytest
+
+from proxyfarm.config import SimulationConfig
+from proxyfarm.core import sim
+from proxyfarm.core.modem import modem_manager, set_command_backend
+from proxyfarm.core.proxyauth import proxy_auth
+from proxyfarm.core.shaping import ClientClass, TrafficShaper, in_place, tc_batch
+
+
+def _classes(*minors: int, ceil: int = None) -> list[ClientClass]:
+    return [ClientClass(minor, 0x50000 + minor, ceil) for minor in minors]
+
+
+def test_full_setup():
+    lines = tc_batch("wwan0", 3000, _classes(2, 3, ceil=500), "cake")
+    assert lines[:2] == [
+        "qdisc replace dev wwan0 root handle 1: htb default fffe",
+        "class add dev wwan0 parent 1: classid 1:1 htb rate 3000kbit",
+    ]
+    # Three equal shares (default class included), capped clients get their cap
+    assert (
+        "class add dev wwan0 parent 1:1 classid 1:fffe htb rate 1000kbit ceil 3000kbit"
+        " quantum 1514"
+    ) in lines
+    assert (
+        "class add dev wwan0 parent 1:1 classid 1:2 htb rate 500kbit ceil 500kbit quantum 1514"
+    ) in lines
+    assert "qdisc add dev wwan0 parent 1:2 handle 2: cake unlimited besteffort" in lines
+    assert (
+        "filter add dev wwan0 parent 1: protocol all prio 1 handle 0x50003 fw classid 1:3"
+    ) in lines
+    # The default class has no filter: unmarked traffic falls into it
+    assert sum(line.startswith("filter") for line in lines) == 2
+
+
+def test_incremental_setup():
+    previous = _classes(2, 3)
+    lines = tc_batch("wwan0", 2000, _classes(3, 4), "fq_codel", previous=previous)
+    assert not any("root" in line for line in lines)
+    assert lines[:3] == [
+        "filter del dev wwan0 parent 1: protocol all prio 1 handle 0x50002 fw",
+        "class del dev wwan0 classid 1:2",
+        "class change dev wwan0 parent 1: classid 1:1 htb rate 2000kbit",
+    ]
+    assert any(line.startswith("class change dev wwan0 parent 1:1 classid 1:3 ") for line in lines)
+    assert any(line.startswith("class add dev wwan0 parent 1:1 classid 1:4 ") for line in lines)
+    assert "qdisc add dev wwan0 parent 1:4 handle 4: fq_codel" in lines
+
+
+def test_u32_filters_cannot_be_removed_in_place():
+    lines = tc_batch("wwan0", None, _classes(2), "fq_codel", classifier="u32")
+    assert (
+        "filter add dev wwan0 parent 1: protocol all prio 1 u32 match mark 0x50002"
+        " 0xffffffff flowid 1:2"
+    ) in lines
+    assert in_place(_classes(2), _classes(2, 3), "u32")
+    assert not in_place(_classes(2, 3), _classes(2), "u32")
+    assert in_place(_classes(2, 3), _classes(2), "fw")
+
+
+@pytest.fixture
+async def farm(config, monkeypatch):
+    config.shaping.enabled = True
+    config.shaping.default_rate_kbit = 4000
+    config.shaping.per_user_classes = False
+    backend = sim.install(SimulationConfig(modems=2, seed=1, latency={}))
+    commands = []
+
+    async def record(cmd):
+        commands.append(cmd)
+        return await backend(cmd)
+
+    set_command_backend(record)
+    monkeypatch.setattr(proxy_auth, "set_classes", lambda classes: None)
+    modems = await modem_manager.get_modems([0, 1], None)
+    yield SimpleNamespace(backend=backend, commands=commands, modems=modems)
+    sim.uninstall()
+
+
+def _batches(commands: list[list[str]]) -> int:
+    return sum(cmd[:2] == ["tc", "-batch"] for cmd in commands)
+
+
+async def test_shaper_applies_changes_in_place(farm, config):
+    shaper = TrafficShaper()
+    await shaper.set_limit("10.0.0.0/24", 1000)
+    await shaper.apply(farm.modems)
+    assert _batches(farm.commands) == 2
+    setup = farm.backend.qdiscs["wwan0"]
+    assert setup[0].startswith("qdisc replace dev wwan0 root")
+    assert any("classid 1:2 htb rate 1000kbit ceil 1000kbit" in line for line in setup)
+
+    # Nothing changed: no tc run
+    farm.commands.clear()
+    await shaper.apply(farm.modems)
+    assert _batches(farm.commands) == 0
+
+    # Another client: added under the existing root
+    await shaper.set_limit("10.0.1.5", None)
+    status = shaper.status()
+    assert [i.classes for i in status.interfaces] == [2, 2]
+    assert all(i.rate_kbit == 4000 and i.rate_source == "config" for i in status.interfaces)
+    setup = farm.backend.qdiscs["wwan1"]
+    assert sum(line.startswith("qdisc replace") for line in setup) == 1
+    assert any("classid 1:3 " in line for line in setup)
+
+    # ... and removed again without touching the other client's class
+    assert await shaper.delete_limit("10.0.1.5")
+    assert not any("classid 1:3 " in line for line in farm.backend.qdiscs["wwan1"])
+    assert shaper.limits()[0].mark == config.shaping.mark_base + 2
+
+
+async def test_classify(farm, config, monkeypatch):
+    config.shaping.per_user_classes = True
+    monkeypatch.setattr(
+        proxy_auth, "users", lambda: [SimpleNamespace(name="alice", enabled=True)]
+    )
+    shaper = TrafficShaper()
+    await shaper.set_limit("10.0.0.0/16", 5000)
+    await shaper.set_limit("10.0.1.0/24", 1000)
+
+    assert shaper.classify("alice").ceil_kbit is None
+    # The most specific network wins
+    assert shaper.classify(None, "10.0.1.7").ceil_kbit == 1000
+    assert shaper.classify(None, "10.0.9.7").ceil_kbit == 5000
+    assert shaper.classify(None, "192.168.0.1") is None
+    assert shaper.classify("bob", "not an address") is None
+
+    await shaper.apply(farm.modems)
+    assert set(farm.backend.qdiscs) == {"wwan0", "wwan1"}
+    config.shaping.enabled = False
+    assert shaper.classify("alice") is None
+    await shaper.refresh()
+    assert shaper.status().interfaces == []
+    assert farm.backend.qdiscs == {}
@@ -0,0 +1,205 @@
+import asyncio
+import socket
+
+import pytest
+
+from proxyfarm.core.connector import hedged_connector
+from proxyfarm.core.proxyauth import proxy_auth
+from proxyfarm.core.socks import BufferPool, SocksError, SocksServer, decode_address, encode_address
+
+
+@pytest.fixture
+def socks_config(config):
+    config.socks.enabled = True
+    config.socks.host = "127.0.0.1"
+    config.socks.port = 0
+    config.socks.auth = False
+    config.socks.buffer_size = 1024
+    config.connector.hedging = False
+    return config.socks
+
+
+@pytest.fixture
+async def server(socks_config, monkeypatch):
+    # One "modem": the loopback interface
+    monkeypatch.setattr(hedged_connector, "_targets", {})
+    monkeypatch.setattr(hedged_connector, "_latency", {})
+    hedged_connector.set_target(0, None, "127.0.0.1")
+    server = SocksServer()
+    await server.start()
+    yield server
+    await server.stop()
+
+
+@pytest.fixture
+async def echo():
+    async def handle(reader, writer):
+        while data := await reader.read(4096):
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    yield server.sockets[0].getsockname()[1]
+    server.close()
+
+
+async def _open(server: SocksServer, methods: bytes = b"\x00"):
+    reader, writer = await asyncio.open_connection(*server.address)
+    writer.write(bytes((5, len(methods))) + methods)
+    return reader, writer
+
+
+async def _request(reader, writer, command: int, host: str, port: int) -> tuple[int, str, int]:
+    writer.write(bytes((5, command, 0)) + encode_address(host, port))
+    head = await reader.readexactly(4)
+    atyp = head[3]
+    size = {1: 4, 4: 16}[atyp]
+    raw = bytes((atyp,)) + await reader.readexactly(size + 2)
+    host, port, _ = decode_address(raw)
+    return head[1], host, port
+
+
+@pytest.mark.parametrize("host", ["10.1.2.3", "2001:db8::1", "example.com"])
+def test_address_roundtrip(host):
+    data = b"xx" + encode_address(host, 8080) + b"payload"
+    assert decode_address(data, 2) == (host, 8080, len(data) - len(b"payload"))
+
+
+def test_address_errors():
+    with pytest.raises(ValueError):
+        decode_address(encode_address("10.1.2.3", 80)[:-1])
+    with pytest.raises(SocksError):
+        decode_address(b"\x09\x00\x00")
+
+
+def test_buffer_pool_keeps_a_bounded_number():
+    pool = BufferPool(16, keep=1)
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+    assert len(pool) == 1
+    assert pool.acquire() is first
+
+
+async def test_connect_and_relay(server, echo):
+    reader, writer = await _open(server)
+    assert await reader.readexactly(2) == b"\x05\x00"
+    code, host, port = await _request(reader, writer, 1, "127.0.0.1", echo)
+    assert (code, host) == (0, "127.0.0.1") and port
+
+    payload = bytes(range(256)) * 20
+    writer.write(payload)
+    assert await reader.readexactly(len(payload)) == payload
+    writer.close()
+    await asyncio.sleep(0.05)
+    assert server.counters["bytes_up"] == server.counters["bytes_down"] == len(payload)
+    assert server.counters["connections"] == 1
+
+
+async def test_no_acceptable_method(server, socks_config):
+    socks_config.auth = True
+    reader, writer = await _open(server, b"\x00")
+    assert await reader.readexactly(2) == b"\x05\xff"
+    assert await reader.read() == b""
+
+
+async def test_unsupported_command(server):
+    reader, writer = await _open(server)
+    await reader.readexactly(2)
+    # BIND is answered with "command not supported"
+    assert (await _request(reader, writer, 2, "127.0.0.1", 80))[0] == 7
+
+
+async def test_unsupported_address_type(server):
+    reader, writer = await _open(server)
+    await reader.readexactly(2)
+    writer.write(b"\x05\x01\x00\x09")
+    assert (await reader.readexactly(3))[1] == 8
+
+
+async def test_refused_connect(server):
+    unused = socket.socket()
+    unused.bind(("127.0.0.1", 0))
+    port = unused.getsockname()[1]
+    unused.close()
+
+    reader, writer = await _open(server)
+    await reader.readexactly(2)
+    assert (await _request(reader, writer, 1, "127.0.0.1", port))[0] == 5
+    assert server.counters["connect_failures"] == 1
+
+
+async def test_handshake_timeout(server, socks_config):
+    socks_config.handshake_timeout = 0.1
+    reader, writer = await asyncio.open_connection(*server.address)
+    assert await asyncio.wait_for(reader.read(), 1) == b""
+
+
+def _login(name: bytes, password: bytes) -> bytes:
+    return bytes((1, len(name))) + name + bytes((len(password),)) + password
+
+
+async def test_login(server, socks_config, echo, monkeypatch):
+    socks_config.auth = True
+
+    async def authenticate(name, password):
+        return (name, password) == ("alice", "secret")
+
+    monkeypatch.setattr(proxy_auth, "authenticate", authenticate)
+    monkeypatch.setattr(proxy_auth, "modem_for", lambda name: 0)
+
+    reader, writer = await _open(server, b"\x00\x02")
+    assert await reader.readexactly(2) == b"\x05\x02"
+    writer.write(_login(b"alice", b"wrong"))
+    assert await reader.readexactly(2) == b"\x01\x01"
+    assert await reader.read() == b""
+    assert server.counters["auth_failures"] == 1
+
+    reader, writer = await _open(server, b"\x02")
+    await reader.readexactly(2)
+    writer.write(_login(b"alice", b"secret"))
+    assert await reader.readexactly(2) == b"\x01\x00"
+    assert (await _request(reader, writer, 1, "127.0.0.1", echo))[0] == 0
+    writer.write(b"ping")
+    assert await reader.readexactly(4) == b"ping"
+    writer.close()
+
+
+async def test_udp_associate(server):
+    loop = asyncio.get_running_loop()
+
+    class Echo(asyncio.DatagramProtocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            self.transport.sendto(data.upper(), addr)
+
+    target, _ = await loop.create_datagram_endpoint(Echo, local_addr=("127.0.0.1", 0))
+    target_port = target.get_extra_info("sockname")[1]
+
+    class Client(asyncio.DatagramProtocol):
+        def __init__(self):
+            self.received = loop.create_future()
+
+        def datagram_received(self, data, addr):
+            self.received.set_result(data)
+
+    client, protocol = await loop.create_datagram_endpoint(Client, local_addr=("127.0.0.1", 0))
+    try:
+        reader, writer = await _open(server)
+        await reader.readexactly(2)
+        code, relay_host, relay_port = await _request(reader, writer, 3, "0.0.0.0", 0)
+        assert code == 0
+
+        header = b"\x00\x00\x00" + encode_address("127.0.0.1", target_port)
+        client.sendto(header + b"hello", (relay_host, relay_port))
+        data = await asyncio.wait_for(protocol.received, 2)
+        assert data == header + b"HELLO"
+        assert server.counters["udp_associations"] == 1
+        writer.close()
+    finally:
+        client.close()
+        target.close()
+
@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from proxyfarm.core import speedtest
+from proxyfarm.core.egress import EgressBalancer
+from proxyfarm.core.speedtest import SpeedTester, jitter
+from proxyfarm.core.state import ModemRecord
+from proxyfarm.core.store import state_store
+from proxyfarm.schemas import ModemState
+
+
+def _modem(modem_id: int, device_id: str = None) -> ModemRecord:
+    return ModemRecord(
+        id=modem_id,
+        device_id=device_id,
+        state=ModemState.CONNECTED,
+        interface=f"wwan{modem_id}",
+        ip_address=f"100.64.{modem_id}.2",
+    )
+
+
+@pytest.fixture
+def balancer(monkeypatch) -> EgressBalancer:
+    balancer = EgressBalancer()
+    monkeypatch.setattr(speedtest, "egress_balancer", balancer)
+    return balancer
+
+
+@pytest.fixture
+def tester(balancer) -> SpeedTester:
+    """A tester whose modems download at their configured speed."""
+    tester = SpeedTester()
+    tester.speeds = {}
+
+    async def measure(modem):
+        speed = tester.speeds.get(modem.device_id or modem.id, 10.0)
+        if speed is None:
+            raise ConnectionResetError("reset by peer")
+        return {"download_mbps": speed, "upload_mbps": speed / 4, "latency_ms": 30.0}
+
+    tester.set_backend(measure)
+    return tester
+
+
+@pytest.fixture
+async def store(config, tmp_path):
+    config.store.path = str(tmp_path / "state.db")
+    await state_store.start()
+    yield state_store
+    await state_store.stop()
+
+
+def test_jitter():
+    assert jitter([]) == jitter([5.0]) == 0.0
+    assert jitter([10.0, 20.0, 15.0, 15.0]) == pytest.approx(5.0)
+
+
+async def test_history_follows_the_device(tester):
+    tester.speeds["dev-a"] = 50.0
+    result = await tester.run(_modem(0, "dev-a"))
+    assert result.success and result.download_mbps == 50.0
+    assert result.interface == "wwan0"
+
+    # The modem re-enumerates as ID 3; ID 0 now belongs to another device
+    tester.schedule([_modem(3, "dev-a"), _modem(0, "dev-b")])
+    assert [r.download_mbps for r in tester.history(3)] == [50.0]
+    assert tester.history(0) == []
+
+
+async def test_failures_are_recorded(tester):
+    tester.speeds["dev-a"] = None
+    result = await tester.run(_modem(0, "dev-a"))
+    assert (result.success, result.error) == (False, "reset by peer")
+
+    offline = _modem(1, "dev-b")
+    offline.state = ModemState.REGISTERED
+    result = await tester.run(offline)
+    assert (result.success, result.error) == (False, "Modem is not connected")
+    assert tester.latest(1) is result
+
+
+async def test_trial_runs_stay_out_of_history(tester, balancer):
+    await tester.run(_modem(0, "dev-a"), keep=False)
+    assert tester.history(0) == []
+    assert balancer.factors(0) == {}
+
+
+async def test_throughput_factors(tester, balancer, config):
+    config.speedtest.min_factor = 0.2
+    tester.speeds.update({"dev-a": 100.0, "dev-b": 50.0, "dev-c": 5.0})
+    for modem_id, device in enumerate(("dev-a", "dev-b", "dev-c")):
+        await tester.run(_modem(modem_id, device))
+
+    assert balancer.factors(0) == {"throughput": 1.0}
+    assert balancer.factors(1) == {"throughput": 0.5}
+    assert balancer.factors(2) == {"throughput": 0.2}
+
+    # The median of the last `window` successful tests counts
+    config.speedtest.window = 3
+    tester.speeds["dev-b"] = 150.0
+    await tester.run(_modem(1, "dev-b"))
+    await tester.run(_modem(1, "dev-b"))
+    assert balancer.factors(1) == {"throughput": 1.0}
+    assert balancer.factors(0) == {"throughput": pytest.approx(100 / 150)}
+
+
+async def test_old_results_age_out(tester, balancer, config):
+    await tester.run(_modem(0, "dev-a"))
+    assert "throughput" in balancer.factors(0)
+    for result in tester._history["dev-a"]:
+        result.timestamp -= timedelta(seconds=config.speedtest.max_age + 1)
+    tester.schedule([_modem(0, "dev-a")])
+    assert balancer.factors(0) == {}
+
+
+async def test_schedule_picks_the_stalest_due_modem(tester, config):
+    config.speedtest.interval = 3600
+    modems = [_modem(0, "dev-a"), _modem(1, "dev-b")]
+    await tester.run(modems[0])
+    tester.schedule(modems)
+    await tester._task
+    assert tester.latest(1) is not None
+
+    # Both tested within the interval: nothing is due
+    tester.schedule(modems)
+    assert tester._task.done()
+    assert len(tester.history(0)) == len(tester.history(1)) == 1
+
+
+async def test_history_survives_a_restart(store, tester):
+    tester.speeds["dev-a"] = 42.0
+    await tester.run(_modem(0, "dev-a"))
+    await store.flush()
+
+    restarted = SpeedTester()
+    await restarted.load()
+    restarted.schedule([_modem(5, "dev-a")])
+    [result] = restarted.history(5)
+    assert result.download_mbps == 42.0
+    assert result.timestamp <= datetime.utcnow()
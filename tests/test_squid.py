@@ -0,0 +1,63 @@
+from proxyfarm.core.squid import parse_mgr_info, parse_mgr_utilization
+
+MGR_INFO = """\
+Squid Object Cache: Version 6.6
+Connection information for squid:
+\tNumber of clients accessing cache:\t12
+\tNumber of HTTP requests received:\t34567
+\tAverage HTTP requests per minute since start:\t123.4
+Median Service Times (seconds)  5 min    60 min:
+\tHTTP Requests (All):   0.04277  0.03427
+\tCache Misses:          0.04519  0.03622
+\tDNS Lookups:           0.00000  0.00094
+File descriptor usage for squid:
+\tMaximum number of file descriptors:   65536
+\tLargest file desc currently in use:    210
+\tNumber of file desc currently in use:  187
+\tAvailable number of file descriptors: 65349
+"""
+
+
+def test_parse_mgr_info():
+    stats = parse_mgr_info(MGR_INFO)
+    assert stats["clients"] == 12
+    assert stats["http_requests_total"] == 34567
+    assert stats["http_requests_per_minute"] == 123.4
+    assert stats["fd_max"] == 65536
+    assert stats["fd_in_use"] == 187
+    assert stats["fd_available"] == 65349
+    assert stats["fd_largest"] == 210
+    assert stats["median_service_times"] == {
+        "http_all": {"5min": 0.04277, "60min": 0.03427},
+        "cache_misses": {"5min": 0.04519, "60min": 0.03622},
+        "dns_lookups": {"5min": 0.0, "60min": 0.00094},
+    }
+
+
+def test_parse_mgr_info_ignores_unknown_and_malformed():
+    stats = parse_mgr_info(
+        "Median Service Times (seconds)  5 min    60 min:\n"
+        "\tCache Hits:  n/a\n"
+        "Connection information for squid:\n"
+        "\tNumber of clients accessing cache:\tunknown\n"
+        "\tSomething else:\t5\n"
+    )
+    assert stats == {"median_service_times": {}}
+
+
+def test_parse_mgr_utilization_keeps_the_5_minute_section():
+    stats = parse_mgr_utilization(
+        "Last 5 minutes:\n"
+        "client_http.requests = 12.5/sec\n"
+        "client_http.kbytes_in = 3.25/sec\n"
+        "client_http.kbytes_out = 410.0/sec\n"
+        "server.all.requests = 11.0/sec\n"
+        "Last 15 minutes:\n"
+        "client_http.requests = 99.0/sec\n"
+    )
+    assert stats == {
+        "requests_per_second": 12.5,
+        "client_kbytes_in_per_second": 3.25,
+        "client_kbytes_out_per_second": 410.0,
+        "server_requests_per_second": 11.0,
+    }
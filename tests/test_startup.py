@@ -0,0 +1,74 @@
+import sys
+import time
+
+import pytest
+
+from proxyfarm import main
+from proxyfarm.startup import startup_tracker
+
+
+@pytest.fixture(autouse=True)
+def fresh_tracker(monkeypatch):
+    # The tracker is global: start each test without earlier phases or verdicts
+    monkeypatch.setattr(startup_tracker, "phases", {})
+    monkeypatch.setattr(startup_tracker, "_verdict", None)
+
+
+def _wait_ready(client, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get("/ready")
+        if response.status_code == 200 or time.monotonic() > deadline:
+            return response
+        time.sleep(0.05)
+
+
+def test_ready_once_modems_are_connected(client):
+    response = _wait_ready(client)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["ready"]
+    assert {check["name"] for check in body["checks"]} == {"inventory", "routing", "proxy"}
+    assert "ready" in body["startup"]["milestones"]
+
+
+def test_disabled_subsystems_are_not_started(client):
+    phases = _wait_ready(client).json()["startup"]["phases"]
+    assert {"store", "proxy_auth", "monitor"} <= set(phases)
+    # Disabled in the test settings (SOCKS and shaping are off by default)
+    assert not {"dns", "socks", "shaping", "conntrack", "usage"} & set(phases)
+
+
+class TestNotEnoughModems:
+    @pytest.fixture
+    def settings(self, settings):
+        settings["startup"]["min_modems"] = 10
+        return settings
+
+    def test_not_ready(self, client):
+        response = client.get("/ready")
+        assert response.status_code == 503
+        checks = {check["name"]: check for check in response.json()["checks"]}
+        assert not checks["inventory"]["ok"]
+        # No authentication: load balancers probe it
+        assert client.get("/ready", headers={"X-API-Key": ""}).status_code == 503
+
+
+def test_subsystems_never_imported_are_not_stopped(monkeypatch):
+    monkeypatch.delitem(sys.modules, "proxyfarm.core.socks")
+    assert main._imported("core.socks", "socks_server") is None
+    assert main._imported("core.store", "state_store") is not None
+
+
+def test_phases_and_milestones(monkeypatch):
+    monkeypatch.setattr(startup_tracker, "milestones", {})
+    with pytest.raises(RuntimeError):
+        with startup_tracker.phase("failing"):
+            raise RuntimeError
+    # A failed step is still timed
+    assert "failing" in startup_tracker.phases
+    startup_tracker.mark("ready")
+    first = startup_tracker.milestones["ready"]
+    startup_tracker.mark("ready")
+    assert startup_tracker.milestones["ready"] == first
+    assert startup_tracker.report().time_to_ready == first
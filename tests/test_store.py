@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+import pytest
+
+from proxyfarm.core.state import BearerRecord, ModemRecord
+from proxyfarm.core.store import StateStore
+from proxyfarm.schemas import ModemState, RotationResult
+
+
+@pytest.fixture
+async def store(config, tmp_path):
+    config.store.path = str(tmp_path / "state.db")
+    store = StateStore()
+    await store.start()
+    yield store
+    await store.stop()
+
+
+def _rotation(modem_id: int, success: bool = True, new_ip: str = "100.64.0.9") -> RotationResult:
+    return RotationResult(
+        modem_id=modem_id,
+        success=success,
+        old_ip="100.64.0.1",
+        new_ip=new_ip if success else None,
+        error=None if success else "no bearer",
+        duration_seconds=1.5,
+    )
+
+
+async def test_rotation_history(store):
+    store.record_rotation(_rotation(1, new_ip="100.64.0.2"))
+    store.record_rotation(_rotation(1, success=False))
+    store.record_rotation(_rotation(2))
+
+    history = await store.rotation_history(1)
+    assert [(r.success, r.new_ip, r.error) for r in history] == [
+        (False, None, "no bearer"),
+        (True, "100.64.0.2", None),
+    ]
+    assert len(await store.rotation_history(1, limit=1)) == 1
+    assert await store.rotation_history(1, since=time.time() + 60) == []
+    assert await store.rotation_history(1, until=0) == []
+
+
+async def test_probe_history(store):
+    store.record_probe(3, True, 0.25, "100.64.0.3")
+    store.record_probe(3, False, None, None)
+    history = await store.probe_history(3)
+    assert [(p.success, p.latency_ms, p.external_ip) for p in history] == [
+        (False, None, None),
+        (True, 250.0, "100.64.0.3"),
+    ]
+
+
+async def test_retention(store):
+    store.record_probe(1, True, 0.1, None)
+    await store.flush()
+    store._db.execute("UPDATE probes SET ts = ?", (time.time() - 3 * 86400,))
+    store.record_probe(1, True, 0.2, None)
+    await store.flush()
+    store._prune(retention_days=2)
+    assert [p.latency_ms for p in await store.probe_history(1)] == [200.0]
+
+
+async def test_inventory_snapshot(store):
+    modem = ModemRecord(
+        id=0,
+        device_id="abc123",
+        state=ModemState.CONNECTED,
+        bearer=BearerRecord(id=0, interface="wwan0", dns=["10.0.0.1"]),
+        interface="wwan0",
+        ip_address="100.64.0.5",
+    )
+    store.save_inventory([ModemRecord(id=1)])
+    store.save_inventory([modem])
+    # The snapshot was taken when saved, not when written
+    modem.ip_address = "100.64.0.6"
+    await store.flush()
+
+    modems, updated_at = await store.load_inventory()
+    assert [m.id for m in modems] == [0]
+    assert modems[0].ip_address == "100.64.0.5"
+    assert modems[0].bearer.dns == ["10.0.0.1"]
+    assert modems[0].state == ModemState.CONNECTED
+    assert updated_at == pytest.approx(time.time(), abs=5)
+
+
+async def test_values_survive_a_restart(store):
+    store.set_value("quota.devices", {"abc": {"used": 12}})
+    # Readable before it is written
+    assert await store.get_value("quota.devices") == {"abc": {"used": 12}}
+    assert await store.get_value("missing", default=[]) == []
+
+    await store.stop()
+    await store.start()
+    assert await store.get_value("quota.devices") == {"abc": {"used": 12}}
+
+
+async def test_disabled(config):
+    config.store.enabled = False
+    store = StateStore()
+    await store.start()
+    store.record_probe(1, True, 0.1, None)
+    store.set_value("key", 1)
+    assert not store.enabled
+    assert await store.probe_history(1) == []
+    assert await store.load_inventory() == ([], None)
+    await store.stop()
+
+
+async def test_writer_survives_a_failed_batch(store, caplog):
+    store._enqueue("INSERT INTO probes (ts, modem_id, success) VALUES (?, ?, ?)", (0, 1, object()))
+    store._wakeup.set()
+    await asyncio.sleep(0.1)
+    assert "dropped 1 probes row(s)" in caplog.text
+    assert not store._task.done()
+
+    store.record_probe(1, True, 0.1, None)
+    store._wakeup.set()
+    await asyncio.sleep(0.1)
+    rows = store._db.execute("SELECT modem_id FROM probes").fetchall()
+    assert rows == [(1,)]
@@ -0,0 +1,188 @@
+import os
+
+import pytest
+
+from proxyfarm.core.store import state_store
+from proxyfarm.services.usage import (
+    OTHER_KEY,
+    BoundedCounters,
+    LogFollower,
+    UsageTracker,
+    parse_lines,
+)
+
+
+def _line(
+    client: str = "10.0.0.2",
+    status: str = "TCP_MISS/200",
+    size: int = 1000,
+    method: str = "GET",
+    url: str = "http://example.com/index.html",
+    outgoing: str = "100.64.0.1",
+) -> str:
+    return (
+        f"1700000000.123    150 {client} {status} {size} {method} {url}"
+        f" - HIER_DIRECT/93.184.216.34 text/html {outgoing}\n"
+    )
+
+
+def _write(path, *lines: str, mode: str = "a") -> None:
+    with open(path, mode) as f:
+        f.write("".join(lines))
+
+
+def test_parse_lines():
+    batch, parsed, errors = parse_lines([
+        _line().rstrip("\n"),
+        _line(status="TCP_TUNNEL/200", method="CONNECT", url="Example.com:443", size=500)
+        .rstrip("\n"),
+        _line(client="10.0.0.3", status="TCP_DENIED/403", size=0,
+              url="http://user:pw@[2001:db8::1]:8080/x").rstrip("\n"),
+        "1700000000.123 150 10.0.0.2 TCP_MISS/200 notanumber GET http://a/ - - -",
+        "truncated line",
+        "",
+    ])
+    assert (parsed, errors) == (3, 2)
+    assert batch["clients"]["10.0.0.2"][:3] == [2, 1500, 2]
+    assert set(batch["domains"]) == {"example.com", "2001:db8::1"}
+    assert batch["domains"]["example.com"][:2] == [2, 1500]
+    assert batch["domains"]["2001:db8::1"][4] == 1  # 4xx
+    assert batch["outgoing"]["100.64.0.1"][0] == 3
+
+
+def test_parse_lines_without_outgoing_address():
+    line = _line().rsplit(" ", 1)[0]
+    batch, parsed, _ = parse_lines([line])
+    assert parsed == 1
+    assert list(batch["outgoing"]) == ["-"]
+
+
+def test_bounded_counters_keep_totals():
+    counters = BoundedCounters(max_keys=10)
+    for i in range(25):
+        counters.merge({f"10.0.0.{i}": [1, i, 1, 0, 0, 0, 0]})
+    assert len(counters.entries) <= 10
+    assert OTHER_KEY in counters.entries
+    assert sum(c[0] for c in counters.entries.values()) == 25
+    assert sum(c[1] for c in counters.entries.values()) == sum(range(25))
+    # The heaviest keys are kept, the rest folded together
+    assert [key for key, _ in counters.top(2)] == [OTHER_KEY, "10.0.0.24"]
+
+
+def test_follower_skips_existing_lines_on_first_run(tmp_path):
+    log = tmp_path / "access.log"
+    _write(log, _line(), _line())
+    follower = LogFollower(log, chunk_size=4096)
+    assert follower.read_lines() == []
+    _write(log, _line(client="10.0.0.9"))
+    assert [line.split()[2] for line in follower.read_lines()] == ["10.0.0.9"]
+
+    assert len(LogFollower(log, chunk_size=4096).read_lines(from_start=True)) == 3
+
+
+def test_follower_holds_partial_lines(tmp_path):
+    log = tmp_path / "access.log"
+    log.touch()
+    follower = LogFollower(log, chunk_size=4096)
+    follower.read_lines()
+    line = _line()
+    _write(log, line[:20])
+    assert follower.read_lines() == []
+    _write(log, line[20:])
+    assert follower.read_lines() == [line.rstrip("\n")]
+
+
+def test_follower_reads_in_chunks(tmp_path):
+    log = tmp_path / "access.log"
+    _write(log, *(_line(size=i) for i in range(50)))
+    follower = LogFollower(log, chunk_size=256)
+    lines = []
+    for _ in range(100):
+        lines += follower.read_lines(from_start=True)
+    assert [int(line.split()[4]) for line in lines] == list(range(50))
+
+
+def test_follower_survives_rename_rotation(tmp_path):
+    log = tmp_path / "access.log"
+    log.touch()
+    follower = LogFollower(log, chunk_size=4096)
+    follower.read_lines()
+    _write(log, _line(size=1))
+    # squid -k rotate: written after our last read, then renamed away
+    _write(log, _line(size=2))
+    os.rename(log, tmp_path / "access.log.0")
+    _write(log, _line(size=3))
+
+    sizes = []
+    for _ in range(4):
+        sizes += [int(line.split()[4]) for line in follower.read_lines()]
+    assert sizes == [1, 2, 3]
+
+
+def test_follower_survives_copytruncate(tmp_path):
+    log = tmp_path / "access.log"
+    log.touch()
+    follower = LogFollower(log, chunk_size=4096)
+    follower.read_lines()
+    _write(log, _line(size=1), _line(size=2))
+    assert len(follower.read_lines()) == 2
+
+    _write(log, "", mode="w")
+    _write(log, _line(size=3))
+    sizes = []
+    for _ in range(3):
+        sizes += [int(line.split()[4]) for line in follower.read_lines()]
+    assert sizes == [3]
+
+
+def test_follower_resume(tmp_path):
+    log = tmp_path / "access.log"
+    _write(log, _line(size=1))
+    offset = log.stat().st_size
+    _write(log, _line(size=2))
+
+    follower = LogFollower(log, chunk_size=4096)
+    follower.resume(log.stat().st_ino, offset)
+    assert [int(line.split()[4]) for line in follower.read_lines()] == [2]
+
+    # Saved position of a file that has since been replaced: read it whole
+    replaced = tmp_path / "new.log"
+    _write(replaced, _line(size=5))
+    os.replace(replaced, log)
+    follower = LogFollower(log, chunk_size=4096)
+    follower.resume(12345678, offset)
+    assert [int(line.split()[4]) for line in follower.read_lines()] == [5]
+
+
+@pytest.fixture
+async def store(config, tmp_path):
+    config.store.path = str(tmp_path / "state.db")
+    await state_store.start()
+    yield state_store
+    await state_store.stop()
+
+
+async def test_tracker_restart_neither_recounts_nor_drops(store, config, tmp_path):
+    log = tmp_path / "access.log"
+    _write(log, _line(size=100))
+    config.usage.access_log = str(log)
+    config.usage.from_start = True
+    config.usage.poll_interval = 60
+
+    tracker = UsageTracker()
+    await tracker.start()
+    await tracker.catch_up()
+    # Half a line is not counted until it is complete
+    line = _line(size=10)
+    _write(log, _line(size=1), line[:30])
+    await tracker.catch_up()
+    assert tracker.lines == 2
+    await tracker.stop()
+
+    _write(log, line[30:])
+    tracker = UsageTracker()
+    await tracker.start()
+    await tracker.catch_up()
+    await tracker.stop()
+    assert tracker.lines == 3
+    assert tracker.clients.entries["10.0.0.2"][1] == 111
@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+
+from proxyfarm.core.modem import modem_manager
+from proxyfarm.core.ussd import USSDHandler
+
+
+class FakeModems:
+    """Stands in for ModemManager's USSD calls, recording the sessions."""
+
+    def __init__(self, delay: float = 0.01):
+        self.delay = delay
+        self.calls: list[tuple[int, str]] = []
+        self.cancelled: list[int] = []
+        self.active = 0
+        self.max_active = 0
+        self.fail: set[int] = set()
+
+    async def send_ussd(self, modem_id: int, command: str, timeout: float):
+        self.calls.append((modem_id, command))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        if modem_id in self.fail:
+            raise RuntimeError("modem gone")
+        return True, f"{command} on {modem_id}: balance 10"
+
+    async def cancel_ussd(self, modem_id: int) -> None:
+        self.cancelled.append(modem_id)
+
+
+@pytest.fixture
+def modems(monkeypatch):
+    fake = FakeModems()
+    monkeypatch.setattr(modem_manager, "send_ussd", fake.send_ussd)
+    monkeypatch.setattr(modem_manager, "cancel_ussd", fake.cancel_ussd)
+    return fake
+
+
+async def test_identical_commands_share_a_session(modems):
+    handler = USSDHandler()
+    results = await asyncio.gather(*(handler.send(1, "*102#") for _ in range(5)))
+    assert modems.calls == [(1, "*102#")]
+    assert {r.response for r in results} == {"*102# on 1: balance 10"}
+
+
+async def test_sessions_are_serialized_per_modem(modems):
+    handler = USSDHandler()
+    await asyncio.gather(handler.send(1, "*102#"), handler.send(1, "*103#"))
+    assert modems.max_active == 1
+
+    modems.max_active = 0
+    await asyncio.gather(handler.send(1, "*104#"), handler.send(2, "*104#"))
+    assert modems.max_active == 2
+
+
+async def test_cacheable_command_is_cached(modems, config):
+    config.ussd.cacheable_commands = ["*100#"]
+    handler = USSDHandler()
+
+    first = await handler.send(1, "*100#")
+    second = await handler.send(1, "*100#")
+    assert not first.cached and second.cached
+    assert second.response == first.response
+    assert len(modems.calls) == 1
+
+    # Other modems and commands outside the list go to the modem
+    await handler.send(2, "*100#")
+    await handler.send(1, "*102#")
+    await handler.send(1, "*102#")
+    assert len(modems.calls) == 4
+
+    await handler.send(1, "*100#", use_cache=False)
+    assert len(modems.calls) == 5
+
+
+async def test_cache_expiry_and_invalidation(modems, config):
+    config.ussd.cacheable_commands = ["*100#"]
+    handler = USSDHandler()
+
+    await handler.send(1, "*100#")
+    handler.invalidate(1)
+    await handler.send(1, "*100#")
+    assert len(modems.calls) == 2
+
+    config.ussd.cache_ttl = 0
+    await asyncio.sleep(0.001)
+    await handler.send(1, "*100#")
+    assert len(modems.calls) == 3
+
+
+async def test_failures_are_not_cached(modems, config, monkeypatch):
+    config.ussd.cacheable_commands = ["*100#"]
+    handler = USSDHandler()
+
+    async def rejected(modem_id, command, timeout):
+        modems.calls.append((modem_id, command))
+        return False, "Unknown application"
+
+    monkeypatch.setattr(modem_manager, "send_ussd", rejected)
+    result = await handler.send(1, "*100#")
+    assert not result.success and result.error == "Unknown application"
+    await handler.send(1, "*100#")
+    assert len(modems.calls) == 2
+
+
+async def test_timeout_cancels_the_session(modems, monkeypatch):
+    async def timing_out(modem_id, command, timeout):
+        raise asyncio.TimeoutError
+
+    monkeypatch.setattr(modem_manager, "send_ussd", timing_out)
+    result = await USSDHandler().send(3, "*100#")
+    assert not result.success
+    assert modems.cancelled == [3]
+
+
+async def test_caller_cancel_does_not_cancel_shared_session(modems):
+    handler = USSDHandler()
+    first = asyncio.create_task(handler.send(1, "*102#"))
+    second = asyncio.create_task(handler.send(1, "*102#"))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert (await second).success
+    assert modems.calls == [(1, "*102#")]
+
+
+async def test_send_many_reports_failures_per_modem(modems):
+    modems.fail = {2}
+    results = await USSDHandler().send_many([1, 2, 3], "*102#")
+    assert [r.modem_id for r in results] == [1, 2, 3]
+    assert [r.success for r in results] == [True, False, True]
+    assert results[1].error == "modem gone"
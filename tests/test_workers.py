@@ -0,0 +1,162 @@
+import asyncio
+import fcntl
+import os
+
+import httpx
+import pytest
+from fastapi import FastAPI, Request
+
+from proxyfarm.core.state import ModemRecord
+from proxyfarm.services.monitor import monitor_service
+from proxyfarm.workers import WorkerCoordinator
+
+
+class Worker:
+    """One uvicorn worker's app and coordinator, in this process."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.services = 0
+        self.coordinator = WorkerCoordinator()
+        self.app = FastAPI()
+        self.app.middleware("http")(self.coordinator.dispatch)
+
+        @self.app.get("/health")
+        async def health():
+            return {"worker": self.name}
+
+        @self.app.api_route("/api/v1/echo", methods=["GET", "POST"])
+        async def echo(request: Request):
+            return {
+                "worker": self.name,
+                "method": request.method,
+                "query": request.url.query,
+                "body": (await request.body()).decode(),
+                "header": request.headers.get("x-test"),
+            }
+
+        @self.app.get("/api/v1/modems")
+        async def modems():
+            return {"worker": self.name, "ids": list(monitor_service.inventory)}
+
+        @self.app.get("/api/v1/fail")
+        async def fail():
+            raise RuntimeError("boom")
+
+    async def start_services(self):
+        self.services += 1
+
+    async def stop_services(self):
+        self.services -= 1
+
+    async def start(self):
+        await self.coordinator.start(self.app, self.start_services, self.stop_services)
+
+    def client(self) -> httpx.AsyncClient:
+        transport = httpx.ASGITransport(app=self.app, raise_app_exceptions=False)
+        return httpx.AsyncClient(transport=transport, base_url="http://test")
+
+
+@pytest.fixture(autouse=True)
+def workers_config(config, tmp_path):
+    config.api.workers = 2
+    config.api.run_dir = str(tmp_path / "run")
+    config.api.failover_interval = 0.05
+    config.api.forward_timeout = 2.0
+
+
+@pytest.fixture
+async def workers():
+    started = [Worker("a"), Worker("b")]
+    for worker in started:
+        await worker.start()
+    yield started
+    for worker in started:
+        await worker.coordinator.stop()
+
+
+async def test_single_worker_runs_services(config):
+    config.api.workers = 1
+    worker = Worker("a")
+    await worker.start()
+    assert (worker.coordinator.role, worker.services) == ("single", 1)
+    await worker.coordinator.stop()
+    assert worker.services == 0
+
+
+async def test_one_owner_runs_the_services(workers):
+    owner, follower = workers
+    assert owner.coordinator.role == "owner"
+    assert follower.coordinator.role == "follower"
+    assert (owner.services, follower.services) == (1, 0)
+    assert owner.coordinator.socket_path.exists()
+
+
+async def test_follower_forwards_api_requests(workers):
+    owner, follower = workers
+    async with follower.client() as client:
+        response = await client.post(
+            "/api/v1/echo?x=1", content=b"payload", headers={"X-Test": "yes"}
+        )
+        assert response.status_code == 200
+        assert response.json() == {
+            "worker": "a", "method": "POST", "query": "x=1", "body": "payload", "header": "yes"
+        }
+        # Health is answered by the follower itself
+        assert (await client.get("/health")).json() == {"worker": "b"}
+        # An app error on the owner comes back as its 500
+        assert (await client.get("/api/v1/fail")).status_code == 500
+
+
+async def test_follower_serves_lite_listing_from_snapshot(workers, monkeypatch):
+    owner, follower = workers
+    monkeypatch.setattr(monitor_service, "inventory", {1: ModemRecord(id=1, interface="wwan1")})
+    monkeypatch.setattr(monitor_service, "updated_at", 1000.0)
+    monkeypatch.setattr(monitor_service, "warm", False)
+    owner.coordinator._publish()
+
+    # The follower process has its own (here: emptied) monitor state
+    monitor_service.inventory = {}
+    monitor_service.updated_at = None
+    async with follower.client() as client:
+        response = await client.get("/api/v1/modems", params={"lite": "true"})
+        assert response.json() == {"worker": "b", "ids": [1]}
+        assert monitor_service.inventory[1].interface == "wwan1"
+        assert monitor_service.updated_at == 1000.0
+        # Without lite the owner answers
+        assert (await client.get("/api/v1/modems")).json()["worker"] == "a"
+
+
+async def test_follower_takes_over_when_the_owner_exits(workers):
+    owner, follower = workers
+    await owner.coordinator.stop()
+    assert owner.services == 0
+
+    for _ in range(100):
+        if follower.coordinator.role == "owner":
+            break
+        await asyncio.sleep(0.02)
+    assert (follower.coordinator.role, follower.services) == ("owner", 1)
+
+    async with follower.client() as client:
+        assert (await client.get("/api/v1/echo")).json()["worker"] == "b"
+
+
+async def test_no_owner_is_503(config, tmp_path):
+    config.api.forward_timeout = 0.2
+    run_dir = tmp_path / "run"
+    run_dir.mkdir()
+    # Another process holds the lock but never opens the socket
+    fd = os.open(run_dir / "owner.lock", os.O_RDWR | os.O_CREAT)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    worker = Worker("b")
+    try:
+        await worker.start()
+        assert worker.coordinator.role == "follower"
+        async with worker.client() as client:
+            response = await client.get("/api/v1/echo")
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
+    finally:
+        await worker.coordinator.stop()
+        os.close(fd)